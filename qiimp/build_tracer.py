@@ -0,0 +1,130 @@
+import collections
+import contextlib
+import json
+import time
+
+import qiimp.xlsx_basics as xlsxbasics
+
+# A trace of a single workbook build: a span for each step of xlsx_builder.write_workbook, each carrying how much
+# xlsxwriter work happened during it (formulas written, data validations, formats created, etc.), exportable in the
+# Chrome trace-event format (load it in chrome://tracing or https://ui.perfetto.dev ).  The counters come from the
+# _TracingWorkbook/_TracingWorksheet subclasses below, which count (and, for formulas, time) the calls into xlsxwriter;
+# so, e.g., a span's formula_storage_seconds is the time xlsxwriter spent storing its formulas, and the rest of the
+# span is mostly QIIMP building the formula strings.
+#
+# NB: tracing is cheap enough (a counter bump, and a couple of clock reads per formula) that every build is traced.
+
+BUILD_TRACE_EXTENSION = ".trace.json"
+
+# counter names
+FORMULAS = "formulas"
+FORMULA_STORAGE_SECONDS = "formula_storage_seconds"
+STRINGS = "strings"
+DATA_VALIDATIONS = "data_validations"
+CONDITIONAL_FORMATS = "conditional_formats"
+FORMATS = "formats"
+BYTES_WRITTEN = "bytes_written"
+
+
+class BuildTracer(object):
+    def __init__(self):
+        self.counts = collections.Counter()
+        self._start_time = time.perf_counter()
+        self._spans = []  # (name, start seconds since tracer start, duration seconds, dict of counter changes)
+
+    def count(self, counter_name, amount=1):
+        self.counts[counter_name] += amount
+
+    @contextlib.contextmanager
+    def span(self, span_name):
+        """Record the time spent in the with block, and the counters' changes during it, as a span."""
+        start_counts = self.counts.copy()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            end_time = time.perf_counter()
+            changed_counts = {}
+            for curr_name, curr_value in self.counts.items():
+                curr_change = curr_value - start_counts[curr_name]
+                if curr_change:
+                    # NB: round off the float noise of the summed timings
+                    changed_counts[curr_name] = round(curr_change, 6) if isinstance(curr_change, float) \
+                        else curr_change
+            self._spans.append((span_name, start_time - self._start_time, end_time - start_time, changed_counts))
+
+    def make_workbook(self, output_target, workbook_options):
+        """Return an xlsxwriter Workbook whose xlsxwriter calls are counted by this tracer."""
+        return _TracingWorkbook(self, output_target, workbook_options)
+
+    def to_chrome_trace(self):
+        """Return the spans as a Chrome trace-event format dict (ready for json.dump)."""
+        # NB: a trace is of one build in one thread, so pid and tid are just placeholders
+        trace_events = [{"name": "thread_name", "ph": "M", "pid": 1, "tid": 1, "args": {"name": "workbook build"}}]
+        for curr_name, curr_start_seconds, curr_seconds, curr_counts in self._spans:
+            trace_events.append({"name": curr_name, "cat": "build", "ph": "X", "pid": 1, "tid": 1,
+                                 "ts": round(curr_start_seconds * 1000000, 3), "dur": round(curr_seconds * 1000000, 3),
+                                 "args": curr_counts})
+        # Chrome sorts the events itself, but spans are recorded as they finish (so inner spans come before their
+        # outer ones); put them in start order for anyone else reading the file
+        trace_events.sort(key=lambda x: x.get("ts", -1))
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+
+def write_chrome_trace(chrome_trace, file_path):
+    with open(file_path, "w") as f:
+        json.dump(chrome_trace, f)
+
+
+class _TracingWorkbook(xlsxbasics.FormulaTemplateWorkbook):
+    def __init__(self, build_tracer, output_target, workbook_options):
+        self.build_tracer = build_tracer
+        super().__init__(output_target, workbook_options)
+
+    def add_worksheet(self, name=None, worksheet_class=None):
+        worksheet = super().add_worksheet(name, worksheet_class=worksheet_class or _TracingWorksheet)
+        worksheet.build_tracer = self.build_tracer
+        return worksheet
+
+    def add_format(self, properties=None):
+        self.build_tracer.count(FORMATS)
+        return super().add_format(properties)
+
+
+class _TracingWorksheet(xlsxbasics.FormulaTemplateWorksheet):
+    # NB: the underscore methods are where xlsxwriter's many public write methods (and write() itself, for strings
+    # starting with "=") end up, after working out the cell's row and column
+    build_tracer = None  # set by _TracingWorkbook.add_worksheet
+    _is_writing_formula = False
+
+    def _write_formula(self, *args, **kwargs):
+        return self._write_traced_formula(super()._write_formula, args, kwargs)
+
+    def _write_array_formula(self, *args, **kwargs):
+        return self._write_traced_formula(super()._write_array_formula, args, kwargs)
+
+    def _write_traced_formula(self, write_func, args, kwargs):
+        # NB: xlsxwriter hands some formulas on from _write_formula to _write_array_formula; count them only once
+        if self._is_writing_formula:
+            return write_func(*args, **kwargs)
+
+        self._is_writing_formula = True
+        start_time = time.perf_counter()
+        try:
+            return write_func(*args, **kwargs)
+        finally:
+            self._is_writing_formula = False
+            self.build_tracer.count(FORMULA_STORAGE_SECONDS, time.perf_counter() - start_time)
+            self.build_tracer.count(FORMULAS)
+
+    def _write_string(self, *args, **kwargs):
+        self.build_tracer.count(STRINGS)
+        return super()._write_string(*args, **kwargs)
+
+    def data_validation(self, *args, **kwargs):
+        self.build_tracer.count(DATA_VALIDATIONS)
+        return super().data_validation(*args, **kwargs)
+
+    def conditional_format(self, *args, **kwargs):
+        self.build_tracer.count(CONDITIONAL_FORMATS)
+        return super().conditional_format(*args, **kwargs)
@@ -480,13 +480,124 @@ function makeValidationSettings(){
         submitHandler: function(form) {
             // show the wait message
             $("#loading-overlay").removeClass("hidden");
+            $("#loading-phase").text("");
 
-            // submit the form
-            form.submit();
+            // submit the form as a background generation job and follow its progress, if this browser can
+            if (window.WebSocket) {
+                submitAsJob(form);
+            } else {
+                submitDirectly(form);
+            }
+        }
+    };
+}
+
+function submitDirectly(form){
+    // if the server sends the workbook straight back as a download, this page stays put, so watch for the
+    // cookie the server sets with the download to know when to take down the wait message
+    if (g_transferred_variables.WORKBOOK_OUTPUT_MODE === "memory") {
+        watchForDownload(form);
+    }
+
+    // submit the form
+    form.submit();
+}
+
+function submitAsJob(form){
+    $.ajax({
+        url : g_transferred_variables.JOBS_PARTIAL_URL,
+        type : 'POST',
+        data : $(form).serialize(),
+        dataType: 'json',
+        success : function (job_info) {
+            watchJobProgress(form, job_info);
+        },
+        error: function (request, error) {
+            if (request.status === 503) {
+                $("#loading-overlay").addClass("hidden");
+                alert(request.responseJSON["error"]);
+            } else {
+                // post the form the old-fashioned way, so any error shows up on the usual error page
+                submitDirectly(form);
+            }
+        }
+    });
+}
+
+function watchJobProgress(form, job_info){
+    var is_finished = false;
+    var ws_protocol = (window.location.protocol === "https:") ? "wss://" : "ws://";
+    var socket = new WebSocket(ws_protocol + window.location.host + job_info["progress_url"]);
+
+    socket.onmessage = function (event) {
+        is_finished = showJobStatus(JSON.parse(event.data));
+    };
+    socket.onclose = function (event) {
+        // the connection can be cut (e.g., by a proxy's timeout) before the job is finished; if so, keep asking
+        if (!is_finished) {
+            pollJobStatus(form, job_info);
         }
     };
 }
 
+function pollJobStatus(form, job_info){
+    $.ajax({
+        url : job_info["status_url"],
+        type : 'GET',
+        dataType: 'json',
+        success : function (job_status) {
+            if (!showJobStatus(job_status)) {
+                window.setTimeout(function () {pollJobStatus(form, job_info);}, 2000);
+            }
+        },
+        // NB: with several server processes, this request may have reached one that doesn't know about the job
+        error: function (request, error) {submitDirectly(form);}
+    });
+}
+
+function showJobStatus(job_status){
+    // returns true if the job is finished
+    var build_phase_messages = {
+        metadata_grid: "Writing the metadata sheet ...",
+        static_grid: "Writing the validation sheet ...",
+        dynamic_grid: "Writing the validation formulas ...",
+        data_dictionary: "Writing the data dictionary ...",
+        yaml_dump: "Writing the hidden schema sheets ...",
+        zip_close: "Saving the workbook ..."
+    };
+
+    if (job_status["state"] === "done") {
+        $("#loading-overlay").addClass("hidden");
+        window.location = job_status["download_url"];
+        return true;
+    }
+    if (job_status["state"] === "failed") {
+        $("#loading-overlay").addClass("hidden");
+        alert("Generating the workbook failed: " + job_status["error"]);
+        return true;
+    }
+
+    var phase_message = build_phase_messages[job_status["phase"]];
+    $("#loading-phase").text(phase_message ? phase_message : "Waiting for the server ...");
+    return false;
+}
+
+function watchForDownload(form){
+    var token_name = "download_token";
+    var download_token = String(new Date().getTime()) + String(Math.floor(Math.random() * 1000000));
+    $(form).find("input[name='" + token_name + "']").remove();
+    $("<input>").attr({type: "hidden", name: token_name, value: download_token}).appendTo(form);
+
+    var cookie_str = token_name + "=" + download_token;
+    var download_timer = window.setInterval(function () {
+        if (document.cookie.split("; ").indexOf(cookie_str) > -1) {
+            window.clearInterval(download_timer);
+            document.cookie = token_name + "=; expires=Thu, 01 Jan 1970 00:00:00 GMT; path=/";
+            $("#loading-overlay").addClass("hidden");
+        }
+    }, 500);
+}
+
 function validateFormIfSubmitted(){
     if (g_submitted) {
         $('#metadata_form').valid();
@@ -74,7 +74,7 @@ function onSelectPackage(){
     // Make an ajax call to get the list of field names for this package and the list of reserved words
     $.ajax({
         url : g_transferred_variables.PACKAGE_PARTIAL_URL,
-        type : 'POST',
+        type : 'GET',
         data : package_info,
         dataType: 'json',
         success : ajax_ok,
@@ -0,0 +1,122 @@
+import math
+import time
+
+import tornado.locks
+
+# Workbook generation is by far the most expensive thing the server does, and without a limit a burst of submissions
+# just piles up in the generator's work queue: every one of them waits (holding its connection open) for all the
+# others, and the users at the back of the queue time out anyway.  Generations are therefore admitted through a
+# GenerationAdmission object, which lets a fixed number run at once, lets a fixed number more wait their turn, and
+# turns away anything beyond that right away (so the server can answer with a 503 and a Retry-After rather than
+# leaving the user hanging).
+#
+# Everything else the server does (the wizard page, /package, uploads, download pages, static files) is cheap and is
+# answered on the IOLoop without going through admission at all, so it never waits behind generation: in effect it
+# has its own priority lane.  Workbooks served from the workbook cache, or coalesced with a build already under way,
+# don't go through admission either, since they cost (almost) nothing.
+#
+# NB: the limits are per server process.
+
+# what to guess a generation takes before any have finished
+_DEFAULT_GENERATION_SECONDS = 30
+# how much weight each newly-finished generation gets in the running average of generation times
+_GENERATION_SECONDS_SMOOTHING = 0.2
+_MIN_RETRY_AFTER_SECONDS = 1
+_MAX_RETRY_AFTER_SECONDS = 300
+
+
+class GenerationRejectedError(Exception):
+    def __init__(self, retry_after_seconds):
+        super().__init__("Too many workbooks are being generated; try again in {0} seconds.".format(
+            retry_after_seconds))
+        self.retry_after_seconds = retry_after_seconds
+
+
+class GenerationAdmission(object):
+    def __init__(self, max_concurrent=0, max_queued=0):
+        # NB: a max_concurrent of 0 means no limit (and then max_queued doesn't matter); a max_queued of 0 means
+        # nothing waits: once max_concurrent generations are running, any more are turned away.
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+
+        self.num_running = 0
+        self.num_queued = 0
+        self.num_admitted = 0
+        self.num_rejected = 0
+        self.total_wait_seconds = 0
+        self.max_wait_seconds = 0
+        self.average_generation_seconds = None
+        self._semaphore = tornado.locks.Semaphore(max_concurrent) if max_concurrent else None
+
+    async def run(self, generate_func):
+        """Await generate_func() once there is room for it; raises GenerationRejectedError if there isn't."""
+        await self._acquire()
+        start_time = time.monotonic()
+        try:
+            return await generate_func()
+        finally:
+            self._release(time.monotonic() - start_time)
+
+    def is_full(self):
+        # NB: count running + queued together, since a generation that has just been handed a freed slot is briefly
+        # no longer running but not yet out of the queue
+        return bool(self.max_concurrent) and \
+            self.num_running + self.num_queued >= self.max_concurrent + self.max_queued
+
+    def get_num_free(self):
+        """Return how many more generations could be admitted right now, or None if there is no limit."""
+        if not self.max_concurrent:
+            return None
+        return max(self.max_concurrent + self.max_queued - self.num_running - self.num_queued, 0)
+
+    def get_retry_after_seconds(self):
+        generation_seconds = self.average_generation_seconds
+        if generation_seconds is None:
+            generation_seconds = _DEFAULT_GENERATION_SECONDS
+        # roughly how long until everything already queued has had its turn
+        num_rounds = math.ceil((self.num_queued + 1) / (self.max_concurrent or 1))
+        retry_after_seconds = int(math.ceil(generation_seconds * num_rounds))
+        return min(max(retry_after_seconds, _MIN_RETRY_AFTER_SECONDS), _MAX_RETRY_AFTER_SECONDS)
+
+    def get_stats(self):
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_queued": self.max_queued,
+            "num_running": self.num_running,
+            "num_queued": self.num_queued,
+            "num_admitted": self.num_admitted,
+            "num_rejected": self.num_rejected,
+            "total_wait_seconds": self.total_wait_seconds,
+            "max_wait_seconds": self.max_wait_seconds,
+            "average_generation_seconds": self.average_generation_seconds
+        }
+
+    async def _acquire(self):
+        if self.is_full():
+            self.num_rejected += 1
+            raise GenerationRejectedError(self.get_retry_after_seconds())
+
+        start_time = time.monotonic()
+        self.num_queued += 1
+        try:
+            if self._semaphore is not None:
+                await self._semaphore.acquire()
+        finally:
+            self.num_queued -= 1
+
+        wait_seconds = time.monotonic() - start_time
+        self.num_running += 1
+        self.num_admitted += 1
+        self.total_wait_seconds += wait_seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+
+    def _release(self, generation_seconds):
+        self.num_running -= 1
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+        if self.average_generation_seconds is None:
+            self.average_generation_seconds = generation_seconds
+        else:
+            self.average_generation_seconds += \
+                _GENERATION_SECONDS_SMOOTHING * (generation_seconds - self.average_generation_seconds)
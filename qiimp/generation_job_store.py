@@ -0,0 +1,197 @@
+import collections
+import concurrent.futures
+import functools
+import json
+import os
+import sqlite3
+import time
+import uuid
+
+import tornado.ioloop
+
+# Generation jobs (see generation_jobs) live in the memory of the server process running them, so when that process
+# stops--a deploy, a crash, a worker restarted by the supervisor--any jobs it had not finished would simply be lost.
+# To prevent that, every job is also recorded in a small SQLite database shared by all the server processes, along
+# with the form arguments it was submitted with.  The process running a job holds a lease on it, which it renews
+# periodically while the job is under way and gives up if it shuts down before finishing; any server process
+# (including a restarted one) can then claim a job whose lease has run out, and run it again from its stored
+# arguments.  Claiming is done in a single write transaction, so two processes can never both claim the same job.
+#
+# Finished jobs are kept (for a while) too: they let any server process answer questions about a job that another
+# process ran, and a resumed job whose workbook turns out to have been finished already, by the same or an identical
+# job, just gets that workbook instead of being built again.
+#
+# NB: the database calls are small and local, but a write can still have to wait (for up to the busy timeout) while
+# another server process holds the database's write lock, so they are made on the store's own thread rather than on
+# the IOLoop: every method except close returns a future.  Having just the one thread also means the calls are made in
+# the order they were asked for.
+
+PENDING_STATE = "pending"
+DONE_STATE = "done"
+FAILED_STATE = "failed"
+
+StoredJob = collections.namedtuple("StoredJob", ["job_id", "fingerprint", "state", "arguments", "file_name",
+                                                 "error", "created_time"])
+
+_CREATE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS generation_jobs (
+    job_id TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    env TEXT,
+    sample_type TEXT,
+    arguments_json TEXT NOT NULL,
+    state TEXT NOT NULL,
+    owner_id TEXT,
+    lease_expires REAL NOT NULL DEFAULT 0,
+    file_name TEXT,
+    error TEXT,
+    created_time REAL NOT NULL,
+    finished_time REAL
+)"""
+_CREATE_INDICES_SQL = [
+    "CREATE INDEX IF NOT EXISTS generation_jobs_by_state ON generation_jobs (state, lease_expires)",
+    "CREATE INDEX IF NOT EXISTS generation_jobs_by_fingerprint ON generation_jobs (fingerprint, state)"
+]
+_STORED_JOB_COLUMNS = "job_id, fingerprint, state, arguments_json, file_name, error, created_time"
+
+
+def _on_store_thread(method):
+    # runs the method on the store's thread, returning a future for its result
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return tornado.ioloop.IOLoop.current().run_in_executor(
+            self._executor, functools.partial(method, self, *args, **kwargs))
+    return wrapper
+
+
+class GenerationJobStore(object):
+    def __init__(self, db_path, lease_seconds):
+        db_dir_path = os.path.dirname(db_path)
+        if db_dir_path:
+            os.makedirs(db_dir_path, exist_ok=True)
+
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        # identifies this server process's leases; NB: not the pid, since pids get reused across restarts
+        self.owner_id = uuid.uuid4().hex
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                               thread_name_prefix="generation_job_store")
+        # NB: isolation_level=None means autocommit, with transactions started explicitly where they are needed; and
+        # the connection is made here but used only on the store's thread (and by close, once that thread is done)
+        self._connection = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(_CREATE_TABLE_SQL)
+        for curr_sql in _CREATE_INDICES_SQL:
+            self._connection.execute(curr_sql)
+
+    @_on_store_thread
+    def add(self, job_id, fingerprint, package_key, arguments_obj):
+        """Record a newly submitted job, leased to this process; arguments_obj is like tornado's request.arguments."""
+        now = time.time()
+        env, sample_type = package_key
+        self._connection.execute(
+            "INSERT INTO generation_jobs (job_id, fingerprint, env, sample_type, arguments_json, state, owner_id, "
+            "lease_expires, created_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, fingerprint, env, sample_type, _dump_arguments(arguments_obj), PENDING_STATE, self.owner_id,
+             now + self.lease_seconds, now))
+
+    @_on_store_thread
+    def renew_leases(self, job_ids):
+        if job_ids:
+            self._connection.execute(
+                "UPDATE generation_jobs SET lease_expires = ? "
+                "WHERE owner_id = ? AND state = ? AND job_id IN ({0})".format(_make_placeholders(job_ids)),
+                [time.time() + self.lease_seconds, self.owner_id, PENDING_STATE] + list(job_ids))
+
+    @_on_store_thread
+    def release(self, job_ids):
+        """Give up this process's leases on these jobs (e.g., at shut-down), so another process can claim them now."""
+        if job_ids:
+            self._connection.execute(
+                "UPDATE generation_jobs SET lease_expires = 0 "
+                "WHERE owner_id = ? AND state = ? AND job_id IN ({0})".format(_make_placeholders(job_ids)),
+                [self.owner_id, PENDING_STATE] + list(job_ids))
+
+    @_on_store_thread
+    def claim_orphans(self, max_jobs=None):
+        """Claim (oldest first) up to max_jobs pending jobs that no process holds a lease on; returns StoredJobs."""
+        if max_jobs is not None and max_jobs <= 0:
+            return []
+
+        now = time.time()
+        # NB: BEGIN IMMEDIATE takes the database's write lock up front, so no other process can claim the same jobs
+        # between the select and the update
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self._connection.execute(
+                "SELECT {0} FROM generation_jobs WHERE state = ? AND lease_expires < ? ORDER BY created_time "
+                "LIMIT ?".format(_STORED_JOB_COLUMNS),
+                (PENDING_STATE, now, -1 if max_jobs is None else max_jobs)).fetchall()
+            result = [_make_stored_job(x) for x in rows]
+            if result:
+                self._connection.execute(
+                    "UPDATE generation_jobs SET owner_id = ?, lease_expires = ? WHERE job_id IN ({0})".format(
+                        _make_placeholders(result)),
+                    [self.owner_id, now + self.lease_seconds] + [x.job_id for x in result])
+            self._connection.execute("COMMIT")
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        return result
+
+    @_on_store_thread
+    def finish(self, job_id, state, file_name=None, error=None):
+        self._connection.execute(
+            "UPDATE generation_jobs SET state = ?, file_name = ?, error = ?, finished_time = ?, lease_expires = 0 "
+            "WHERE job_id = ?", (state, file_name, error, time.time(), job_id))
+
+    @_on_store_thread
+    def get(self, job_id):
+        row = self._connection.execute(
+            "SELECT {0} FROM generation_jobs WHERE job_id = ?".format(_STORED_JOB_COLUMNS), (job_id,)).fetchone()
+        return None if row is None else _make_stored_job(row)
+
+    @_on_store_thread
+    def find_completed_file_name(self, fingerprint):
+        """Return the file name of the most recent finished workbook with this fingerprint, or None."""
+        row = self._connection.execute(
+            "SELECT file_name FROM generation_jobs WHERE fingerprint = ? AND state = ? AND file_name IS NOT NULL "
+            "ORDER BY finished_time DESC LIMIT 1", (fingerprint, DONE_STATE)).fetchone()
+        return None if row is None else row[0]
+
+    @_on_store_thread
+    def remove_finished(self, max_age_seconds):
+        self._connection.execute("DELETE FROM generation_jobs WHERE state != ? AND finished_time < ?",
+                                 (PENDING_STATE, time.time() - max_age_seconds))
+
+    @_on_store_thread
+    def get_stats(self):
+        result = {"num_" + x: 0 for x in [PENDING_STATE, DONE_STATE, FAILED_STATE]}
+        for curr_state, curr_count in self._connection.execute(
+                "SELECT state, COUNT(*) FROM generation_jobs GROUP BY state"):
+            result["num_" + curr_state] = curr_count
+        return result
+
+    def close(self):
+        """Wait for any calls still under way, then close the database; NB: not a future."""
+        self._executor.shutdown(wait=True)
+        self._connection.close()
+
+
+def _dump_arguments(arguments_obj):
+    # form values arrive as bytes; latin-1 maps every byte to a character and back again unchanged
+    return json.dumps({k: [x.decode("latin-1") for x in v] for k, v in arguments_obj.items()})
+
+
+def _load_arguments(arguments_json):
+    return {k: [x.encode("latin-1") for x in v] for k, v in json.loads(arguments_json).items()}
+
+
+def _make_stored_job(row):
+    job_id, fingerprint, state, arguments_json, file_name, error, created_time = row
+    return StoredJob(job_id, fingerprint, state, _load_arguments(arguments_json), file_name, error, created_time)
+
+
+def _make_placeholders(items):
+    return ", ".join("?" * len(items))
@@ -0,0 +1,113 @@
+import time
+import uuid
+
+# Building a big workbook can take a minute or more, and holding an HTTP request open all that time ties up a
+# connection and falls foul of any proxy or load balancer with a shorter timeout.  So the wizard page instead submits
+# its form as a generation job: the submission returns a job id right away, the workbook is built in the background,
+# and the page follows the job's progress (over a websocket, or by polling) until it can send the user to the
+# download.
+#
+# NB: jobs are held in memory by the server process running them; the other server processes (and the server after a
+# restart) know them only from the job store (see generation_job_store), which has their state but not their progress.
+
+QUEUED_STATE = "queued"
+RUNNING_STATE = "running"
+DONE_STATE = "done"
+FAILED_STATE = "failed"
+
+
+class GenerationJob(object):
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.state = QUEUED_STATE
+        self.phase = None  # the xlsx_builder.BuildPhases value of the phase the build most recently started
+        self.generated_workbook = None
+        self.error = None
+        self.retry_after_seconds = None
+        self.created_time = time.time()
+        self.finished_time = None
+        self._listeners = []
+
+    @property
+    def is_finished(self):
+        return self.state in [DONE_STATE, FAILED_STATE]
+
+    def add_listener(self, listener):
+        """listener is called with this job every time its state or phase changes."""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def set_phase(self, build_phase):
+        # NB: progress can trail in after the job is already finished; ignore it
+        if self.is_finished:
+            return
+        self.state = RUNNING_STATE
+        self.phase = build_phase.value
+        self._notify_listeners()
+
+    def succeed(self, generated_workbook):
+        self.generated_workbook = generated_workbook
+        self._finish(DONE_STATE)
+
+    def fail(self, error, retry_after_seconds=None):
+        self.error = error
+        self.retry_after_seconds = retry_after_seconds
+        self._finish(FAILED_STATE)
+
+    def _finish(self, state):
+        self.state = state
+        self.finished_time = time.time()
+        self._notify_listeners()
+        self._listeners = []
+
+    def _notify_listeners(self):
+        # NB: copy, since a listener may remove itself
+        for curr_listener in list(self._listeners):
+            curr_listener(self)
+
+
+class GenerationJobs(object):
+    """The generation jobs of this server process, by job id; finished jobs are forgotten after retention_seconds."""
+
+    def __init__(self, retention_seconds):
+        self.retention_seconds = retention_seconds
+        self.num_created = 0
+        self._jobs_by_id = {}
+
+    def create(self, job_id=None):
+        # NB: a job_id is given for a job resumed from the job store
+        self._remove_expired()
+        job = GenerationJob(job_id or uuid.uuid4().hex)
+        self._jobs_by_id[job.job_id] = job
+        self.num_created += 1
+        return job
+
+    def get(self, job_id):
+        job = self._jobs_by_id.get(job_id)
+        if job is not None and self._is_expired(job, time.time()):
+            return None
+        return job
+
+    def remove(self, job_id):
+        self._jobs_by_id.pop(job_id, None)
+
+    def get_unfinished_job_ids(self):
+        return [x.job_id for x in self._jobs_by_id.values() if not x.is_finished]
+
+    def get_stats(self):
+        result = {"num_created": self.num_created}
+        for curr_state in [QUEUED_STATE, RUNNING_STATE, DONE_STATE, FAILED_STATE]:
+            result["num_" + curr_state] = sum(1 for x in self._jobs_by_id.values() if x.state == curr_state)
+        return result
+
+    def _is_expired(self, job, now):
+        return job.is_finished and now - job.finished_time > self.retention_seconds
+
+    def _remove_expired(self):
+        now = time.time()
+        expired_job_ids = [x.job_id for x in self._jobs_by_id.values() if self._is_expired(x, now)]
+        for curr_job_id in expired_job_ids:
+            del self._jobs_by_id[curr_job_id]
@@ -1,3 +1,4 @@
+import concurrent.futures
 import copy
 import os
 import warnings
@@ -25,6 +26,11 @@ def update_schema(base_schema, fields_to_modify_schemas, add_silently=False, for
         curr_schema_mods_copy = copy.deepcopy(curr_schema_modifications)
 
         if curr_field_name in base_schema:
+            # NB: the field schemas in base_schema may be shared with other schemas (e.g., when base_schema is a
+            # shallow copy of one of the precomputed package schemas), so never change one in place: make a
+            # (shallow) copy of the field's schema, change that, and put the copy into base_schema instead.
+            base_schema[curr_field_name] = dict(base_schema[curr_field_name])
+
             # NB: setting force_piecemeal_overwrite to True is VERY DANGEROUS and should only be done in special
             # situations where other code in the application enforces the consistency of the resulting field schema.
             # The reason this option exists is so that locale defaults (only) can be overwritten without the
@@ -76,14 +82,35 @@ def load_schemas_for_package_key(env_key, sampletype_key, parent_stack_by_env_na
     return result
 
 
-def load_environment_and_sampletype_info(envs_definitions, displayname_by_sampletypes_list, package_dir_path):
+def load_schemas_for_all_package_keys(parent_stack_by_env_name, env_schemas):
+    """Resolve the package schema for every env/sampletype combination once, up front.
+
+    Returns a dict of package schemas keyed by (env name, sampletype name).  The same schema objects are handed to
+    every request that asks for that package, so they must be treated as read-only: anyone wanting to change one
+    should make a shallow copy of it and change that via update_schema, which never modifies field schemas in place.
+    """
+    result = {}
+    for curr_env_name, curr_parent_stack in parent_stack_by_env_name.items():
+        curr_env_sampletype_names = set()
+        for curr_stack_env_name in curr_parent_stack:
+            curr_env_sampletype_names.update(env_schemas[curr_stack_env_name][_SAMPLE_TYPES_KEY].keys())
+
+        for curr_sampletype_name in sorted(curr_env_sampletype_names):
+            result[(curr_env_name, curr_sampletype_name)] = load_schemas_for_package_key(
+                curr_env_name, curr_sampletype_name, parent_stack_by_env_name, env_schemas)
+
+    return result
+
+
+def load_environment_and_sampletype_info(envs_definitions, displayname_by_sampletypes_list, package_dir_path,
+                                         schema_cache=None, num_workers=1):
     # TODO: someday: this giant function would be much clearer if broken up some!
     sampletypes_display_dicts_list = _make_sampletypes_display_dicts_list(displayname_by_sampletypes_list)
 
     all_env_names_list = []
     display_envs_dicts_list = []
     parent_env_name_by_env_name = {}
-    env_schemas = {}
+    package_filepaths_by_env_name = {}
 
     for curr_env in envs_definitions:
         curr_env_name, curr_env_dict = mws.get_single_key_and_subdict(curr_env)
@@ -96,19 +123,54 @@ def load_environment_and_sampletype_info(envs_definitions, displayname_by_sample
         if curr_env_parent_name is not None:
             parent_env_name_by_env_name[curr_env_name] = curr_env_parent_name
 
+        # Just work out which package file each env and env/sampletype needs for now; many of them share the same
+        # file (e.g., human-gut.xlsx serves the human stool, colon_content AND colon_mucosa sampletypes), so the
+        # files are loaded afterwards, once each, in _load_schemas_by_filepath.
         curr_env_context_desc = "environment '{0}'".format(curr_env_name)
-        curr_env_schemas = {_ENV_SCHEMA_KEY: _load_schema_from_filename_val(package_dir_path, curr_env_dict,
-                                                                            curr_env_context_desc)}
+        curr_env_filepath = _get_filepath_from_filename_val(package_dir_path, curr_env_dict, curr_env_context_desc)
 
-        curr_env_sampletype_schemas_by_name = {}
+        curr_env_sampletype_filepaths_by_name = {}
         curr_env_sampletype_dicts_list = curr_env_dict[_FILENAME_BY_SAMPLETYPES_LIST_KEY]
         for curr_env_sampletype in curr_env_sampletype_dicts_list:
             curr_env_sampletype_name, curr_env_sampletype_filename = mws.get_single_key_and_subdict(curr_env_sampletype)
 
             curr_sample_context_desc = "sample type '{0}' in {1}".format(curr_env_sampletype_name, curr_env_context_desc)
-            curr_env_sampletype_schema = _load_schema_from_filename_val(package_dir_path, curr_env_sampletype_filename,
-                                                                        curr_sample_context_desc)
-            curr_env_sampletype_schemas_by_name[curr_env_sampletype_name] = curr_env_sampletype_schema
+            curr_env_sampletype_filepaths_by_name[curr_env_sampletype_name] = _get_filepath_from_filename_val(
+                package_dir_path, curr_env_sampletype_filename, curr_sample_context_desc)
+
+        package_filepaths_by_env_name[curr_env_name] = (curr_env_filepath, curr_env_sampletype_filepaths_by_name)
+
+    # NB: dicts keep insertion order, so the files are listed (and loaded) in the order of the environments yaml
+    context_descs_by_filepath = {}
+    num_package_references = 0
+    for curr_env_name in all_env_names_list:
+        curr_env_filepath, curr_env_sampletype_filepaths_by_name = package_filepaths_by_env_name[curr_env_name]
+        curr_env_context_desc = "environment '{0}'".format(curr_env_name)
+        curr_filepath_and_context_tuples = [(curr_env_filepath, curr_env_context_desc)]
+        for curr_env_sampletype_name, curr_env_sampletype_filepath in curr_env_sampletype_filepaths_by_name.items():
+            curr_filepath_and_context_tuples.append((curr_env_sampletype_filepath, "sample type '{0}' in {1}".format(
+                curr_env_sampletype_name, curr_env_context_desc)))
+
+        for curr_filepath, curr_context_desc in curr_filepath_and_context_tuples:
+            if curr_filepath is not None:
+                num_package_references += 1
+                context_descs_by_filepath.setdefault(curr_filepath, []).append(curr_context_desc)
+
+    schemas_by_filepath = _load_schemas_by_filepath(context_descs_by_filepath, schema_cache, num_workers)
+    print("loaded {0} unique package files for {1} package references".format(
+        len(schemas_by_filepath), num_package_references))
+
+    # NB: the same schema object is shared by every env and/or sampletype that uses its file; this is safe because
+    # the env_schemas are only ever read (see load_schemas_for_package_key, which builds a new schema from copies).
+    env_schemas = {}
+    for curr_env_name in all_env_names_list:
+        curr_env_filepath, curr_env_sampletype_filepaths_by_name = package_filepaths_by_env_name[curr_env_name]
+        curr_env_schemas = {_ENV_SCHEMA_KEY: _get_schema_for_filepath(curr_env_filepath, schemas_by_filepath)}
+
+        curr_env_sampletype_schemas_by_name = {}
+        for curr_env_sampletype_name, curr_env_sampletype_filepath in curr_env_sampletype_filepaths_by_name.items():
+            curr_env_sampletype_schemas_by_name[curr_env_sampletype_name] = _get_schema_for_filepath(
+                curr_env_sampletype_filepath, schemas_by_filepath)
 
         curr_env_schemas[_SAMPLE_TYPES_KEY] = curr_env_sampletype_schemas_by_name
         env_schemas[curr_env_name] = curr_env_schemas
@@ -147,8 +209,8 @@ def load_environment_and_sampletype_info(envs_definitions, displayname_by_sample
            parent_stack_by_env_name, env_schemas
 
 
-def _load_schema_from_filename_val(base_dir, a_dict, context_description):
-    a_schema = {}
+def _get_filepath_from_filename_val(base_dir, a_dict, context_description):
+    a_filepath = None
 
     # input "a_dict" can be either a filename string or a dictionary that
     # contains a key for filename, the value of which is the filename string.
@@ -163,9 +225,67 @@ def _load_schema_from_filename_val(base_dir, a_dict, context_description):
     if a_filename is None:
         warnings.warn("No filename specified for {0}.".format(context_description))
     else:
-        a_filepath = os.path.join(base_dir, a_filename)
-        a_schema = xlsxbasics.load_yaml_from_wizard_xlsx(a_filepath, xlsxbasics.SheetNames.schema.value)
-    return a_schema
+        # resolve the path fully so that different spellings of the same file are recognized as the same file
+        a_filepath = os.path.realpath(os.path.join(base_dir, a_filename))
+    return a_filepath
+
+
+def _load_schemas_by_filepath(context_descs_by_filepath, schema_cache=None, num_workers=1):
+    # num_workers of 0 (or None) means one per cpu, as for concurrent.futures; 1 means load in this process
+    filepaths_to_load = list(context_descs_by_filepath.keys())
+    result = {}
+
+    # Loading from the cache is much cheaper than starting worker processes, so only the files that aren't already
+    # cached are worth farming out.  NB: the workers are given the signatures taken here, so no file is hashed twice.
+    file_signatures_by_filepath = {}
+    if schema_cache is not None and num_workers != 1:
+        for curr_filepath in filepaths_to_load:
+            curr_file_signature = schema_cache.get_file_signature(curr_filepath)
+            file_signatures_by_filepath[curr_filepath] = curr_file_signature
+            result[curr_filepath] = None if curr_file_signature is None else schema_cache.get_cached_yaml(
+                curr_filepath, xlsxbasics.SheetNames.schema.value, curr_file_signature)
+        filepaths_to_load = [x for x in filepaths_to_load if result[x] is None]
+
+    if num_workers == 1 or len(filepaths_to_load) <= 1:
+        for curr_filepath in filepaths_to_load:
+            result[curr_filepath] = _load_package_schema_or_raise(
+                curr_filepath, context_descs_by_filepath, schema_cache, file_signatures_by_filepath.get(curr_filepath))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers or None) as executor:
+            futures_by_filepath = {x: executor.submit(_load_package_schema, x, schema_cache,
+                                                      file_signatures_by_filepath.get(x))
+                                   for x in filepaths_to_load}
+            for curr_filepath, curr_future in futures_by_filepath.items():
+                result[curr_filepath] = _load_package_schema_or_raise(curr_filepath, context_descs_by_filepath,
+                                                                      future=curr_future)
+
+    # return the schemas in the same (deterministic) order regardless of how/where they were loaded
+    return {x: result[x] for x in context_descs_by_filepath}
+
+
+def _load_package_schema_or_raise(filepath, context_descs_by_filepath, schema_cache=None, file_signature=None,
+                                  future=None):
+    try:
+        if future is not None:
+            return future.result()
+        return _load_package_schema(filepath, schema_cache, file_signature)
+    except Exception as e:
+        raise ValueError("Unable to load package file '{0}' for {1}: {2}".format(
+            filepath, " and ".join(context_descs_by_filepath[filepath]), e)) from e
+
+
+# NB: must be a module-level function so that it can be run in a worker process
+def _load_package_schema(filepath, schema_cache=None, file_signature=None):
+    # the schema cache (a metadata_package_schema_cache.PackageSchemaCache), if any, skips opening the workbook if it
+    # has already seen this exact file; file_signature, if known, is the file's signature from that cache
+    if schema_cache is None:
+        return xlsxbasics.load_yaml_from_wizard_xlsx(filepath, xlsxbasics.SheetNames.schema.value)
+    return schema_cache.load_yaml_from_wizard_xlsx(filepath, xlsxbasics.SheetNames.schema.value, file_signature)
+
+
+def _get_schema_for_filepath(filepath, schemas_by_filepath):
+    # an env or sampletype with no package file simply adds nothing to the schema
+    return {} if filepath is None else schemas_by_filepath[filepath]
 
 
 # TODO: someday: rename as the product isn't really stack-like: it starts with most general, not least general
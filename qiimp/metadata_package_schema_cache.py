@@ -0,0 +1,150 @@
+import collections
+import hashlib
+import json
+import os
+import tempfile
+
+import qiimp.xlsx_basics as xlsxbasics
+
+_CACHE_FILE_EXTENSION = ".json"
+_VERSION_KEY = "version"
+_FILEPATH_KEY = "filepath"
+_SHEETNAME_KEY = "sheetname"
+_MTIME_KEY = "mtime"
+_SIZE_KEY = "size"
+_CONTENT_HASH_KEY = "content_hash"
+_SCHEMA_KEY = "schema"
+
+# what identifies one exact version of a package file
+FileSignature = collections.namedtuple("FileSignature", ["mtime", "size", "content_hash"])
+
+
+class PackageSchemaCache(object):
+    """On-disk cache of the yaml schemas stored in the package xlsx files.
+
+    Opening a package workbook and parsing the yaml inside it is by far the most expensive part of server start-up,
+    and the package files almost never change between restarts.  Each cache entry records the path, modification
+    time, size and content hash of the package file it came from, as well as the QIIMP version that wrote it; if
+    any of those don't match, the entry is ignored and the package file is re-read (and the entry re-written).
+
+    Entries are plain JSON (never pickles), so that whoever can write to the cache directory can at worst spoil the
+    schemas, not run code in the server.  A schema that JSON can't hold exactly (a date, say) just isn't cached.
+    """
+
+    def __init__(self, cache_dir_path, version):
+        self.cache_dir_path = cache_dir_path
+        self.version = version
+
+    def get_file_signature(self, filepath):
+        """Return the file's FileSignature, or None if the file can't be read.
+
+        Hashing a package file means reading all of it, so a caller that looks a file up with get_cached_yaml and then
+        (on a miss) loads it with load_yaml_from_wizard_xlsx can pass the signature to both, to hash the file only once.
+        """
+        try:
+            return _get_file_signature(os.path.abspath(filepath))
+        except OSError:
+            return None
+
+    def get_cached_yaml(self, filepath, yaml_sheetname, file_signature=None):
+        """Return the cached schema for the file, or None if there is no valid cache entry for it."""
+        filepath = os.path.abspath(filepath)
+        if file_signature is None:
+            file_signature = self.get_file_signature(filepath)
+            if file_signature is None:
+                # leave it to the actual load to report the problem with the package file
+                return None
+        cache_entry_path = self._get_cache_entry_path(filepath, yaml_sheetname)
+        return self._read_cache_entry(cache_entry_path, filepath, yaml_sheetname, file_signature)
+
+    def load_yaml_from_wizard_xlsx(self, filepath, yaml_sheetname, file_signature=None):
+        filepath = os.path.abspath(filepath)
+        if file_signature is None:
+            file_signature = _get_file_signature(filepath)
+        cache_entry_path = self._get_cache_entry_path(filepath, yaml_sheetname)
+
+        # NB: if the file changes after its signature was taken, the entry written here has the old signature, so it
+        # is simply ignored next time
+        result = self._read_cache_entry(cache_entry_path, filepath, yaml_sheetname, file_signature)
+        if result is None:
+            result = xlsxbasics.load_yaml_from_wizard_xlsx(filepath, yaml_sheetname)
+            self._write_cache_entry(cache_entry_path, {
+                _VERSION_KEY: self.version,
+                _FILEPATH_KEY: filepath,
+                _SHEETNAME_KEY: yaml_sheetname,
+                _MTIME_KEY: file_signature.mtime,
+                _SIZE_KEY: file_signature.size,
+                _CONTENT_HASH_KEY: file_signature.content_hash,
+                _SCHEMA_KEY: result
+            })
+
+        return result
+
+    def _get_cache_entry_path(self, filepath, yaml_sheetname):
+        # one entry per package file (and sheet), named by a hash of the package file's full path so that
+        # packages with the same file name in different directories can't collide
+        entry_key = "{0}!{1}".format(filepath, yaml_sheetname).encode("utf-8")
+        entry_file_name = hashlib.sha1(entry_key).hexdigest() + _CACHE_FILE_EXTENSION
+        return os.path.join(self.cache_dir_path, entry_file_name)
+
+    def _read_cache_entry(self, cache_entry_path, filepath, yaml_sheetname, file_signature):
+        try:
+            with open(cache_entry_path, "r", encoding="utf-8") as f:
+                cache_entry = json.load(f)
+        except Exception:
+            # a missing, truncated or otherwise unreadable entry is just a cache miss
+            return None
+
+        expected_keyvals = {
+            _VERSION_KEY: self.version,
+            _FILEPATH_KEY: filepath,
+            _SHEETNAME_KEY: yaml_sheetname,
+            _MTIME_KEY: file_signature.mtime,
+            _SIZE_KEY: file_signature.size,
+            _CONTENT_HASH_KEY: file_signature.content_hash
+        }
+        if not isinstance(cache_entry, dict) or _SCHEMA_KEY not in cache_entry:
+            return None
+        for curr_key, curr_expected_val in expected_keyvals.items():
+            if cache_entry.get(curr_key) != curr_expected_val:
+                return None
+
+        return cache_entry[_SCHEMA_KEY]
+
+    def _write_cache_entry(self, cache_entry_path, cache_entry):
+        # The cache is strictly an optimization, so failing to write it (e.g., on a read-only file system) must not
+        # stop the server from starting.  Write to a temp file and then move it into place so that a crash mid-write
+        # (or two servers starting at once) can never leave a half-written entry behind.
+        try:
+            cache_entry_json = json.dumps(cache_entry)
+        except (TypeError, ValueError):
+            return  # not something JSON can hold
+        # NB: JSON would quietly turn, e.g., a number key into a string, which would then come back out of the cache
+        if json.loads(cache_entry_json) != cache_entry:
+            return
+
+        try:
+            os.makedirs(self.cache_dir_path, exist_ok=True)
+            temp_fd, temp_path = tempfile.mkstemp(dir=self.cache_dir_path, suffix=".tmp")
+            try:
+                with os.fdopen(temp_fd, "w", encoding="utf-8") as f:
+                    f.write(cache_entry_json)
+                os.replace(temp_path, cache_entry_path)
+            except Exception:
+                os.remove(temp_path)
+                raise
+        except OSError:
+            pass
+
+
+def _get_file_signature(filepath):
+    file_stats = os.stat(filepath)
+    return FileSignature(file_stats.st_mtime, file_stats.st_size, _get_content_hash(filepath))
+
+
+def _get_content_hash(filepath):
+    hasher = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
@@ -1,8 +1,10 @@
 import argparse
-from collections import defaultdict
-import copy
+from collections import defaultdict, namedtuple
+import hashlib
+import hmac
 # import itertools
 import json
+import os
 import sys
 import traceback
 import tempfile
@@ -12,17 +14,42 @@ from urllib.parse import quote
 # import openpyxl
 # import pandas
 import re
+import tornado.httpserver
 import tornado.ioloop  # Note: Pycharm thinks this import isn't used, but it is
+import tornado.iostream
+import tornado.netutil
 import tornado.web  # Note: Pycharm thinks this import isn't used, but it is
 import tornado.websocket
 
 import qiimp.metadata_wizard_settings as mws
 import qiimp.metadata_package_schema_builder as mpsb
+import qiimp.metadata_package_schema_cache
+import qiimp.build_tracer
+import qiimp.generation_admission
+import qiimp.generation_job_store
+import qiimp.generation_jobs
+import qiimp.multipart_stream_parser
+import qiimp.output_retention
+import qiimp.request_profiler
 import qiimp.schema_builder
+import qiimp.server_metrics
+import qiimp.server_supervisor
+import qiimp.workbook_cache
+import qiimp.workbook_generator
 import qiimp.xlsx_builder
 import qiimp.xlsx_validation_builder
 import qiimp.xlsx_basics
 
+_XLSX_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+_DOWNLOAD_CHUNK_BYTES = 64 * 1024
+_DOWNLOAD_TOKEN_NAME = "download_token"
+_DOWNLOAD_TOKEN_REGEX = re.compile(r"^[A-Za-z0-9]{1,64}$")
+_PROFILE_TOKEN_HEADER = "X-Qiimp-Profile-Token"
+_PROFILE_FILE_HEADER = "X-Qiimp-Profile-File"
+_MONITORING_AUTH_SCHEME = "Bearer "
+
+_WorkbookInputs = namedtuple("_WorkbookInputs", ["study_name", "package_schema", "form_dict", "fingerprint"])
+
 _allowed_min_browser_versions = {
     'chrome': 49,
     'firefox': 48,
@@ -32,9 +59,15 @@ _allowed_min_browser_versions = {
 def _parse_cmd_line_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--deployed", help="run with non-local settings from config", action="store_true")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="number of server processes to run (default 1); 0 means one per cpu")
 
     args = parser.parse_args()
-    return args.deployed
+    if args.processes < 0:
+        parser.error("--processes must be 0 or more")
+    if args.processes != 1 and not hasattr(os, "fork"):
+        parser.error("--processes is only supported on platforms that can fork")
+    return args.deployed, args.processes
 
 
 def _parse_form_value(curr_value, retain_list=False):
@@ -48,60 +81,501 @@ def _parse_form_value(curr_value, retain_list=False):
     return revised_values
 
 
-def _get_package_schema_by_env_and_sample_type(wiz_state, arguments_obj):
+def _get_package_key(arguments_obj):
     env_value = _parse_form_value(arguments_obj[mws.InputNames.environment.value])
     sampletype_value = _parse_form_value(arguments_obj[mws.InputNames.sample_type.value])
-    result = mpsb.load_schemas_for_package_key(
-        env_value, sampletype_value, wiz_state.parent_stack_by_env_name, wiz_state.env_schemas)
+    return env_value, sampletype_value
+
+
+def _get_package_schema_by_env_and_sample_type(wiz_state, arguments_obj):
+    env_value, sampletype_value = _get_package_key(arguments_obj)
+    # NB: the returned schema is shared with every other request for the same package, so it must not be modified;
+    # make a shallow copy and change it only via mpsb.update_schema, which copies any field schema it changes.
+    result = None
+    if wiz_state.package_schemas_by_key is not None:
+        result = wiz_state.package_schemas_by_key.get((env_value, sampletype_value))
+
+    if result is None:
+        # not one of the precomputed combinations (e.g., a sample type that isn't defined for the chosen
+        # environment), so work it out the slow way, just as if there were no precomputed schemas
+        result = mpsb.load_schemas_for_package_key(
+            env_value, sampletype_value, wiz_state.parent_stack_by_env_name, wiz_state.env_schemas)
     return result
 
 
+def _get_package_response(wiz_state, arguments_obj, use_memo=True):
+    package_key = _get_package_key(arguments_obj)
+
+    # The response depends only on the package and on settings that are fixed at start-up, so it is worked out once
+    # per package and then reused.  Only the precomputed packages are remembered, so that requests for arbitrary
+    # made-up env/sampletype combinations can't make the memo grow without limit.
+    is_known_package = wiz_state.package_schemas_by_key is not None and \
+        package_key in wiz_state.package_schemas_by_key
+    if use_memo and is_known_package and package_key in wiz_state.package_responses_by_key:
+        return wiz_state.package_responses_by_key[package_key]
+
+    package_schema = _get_package_schema_by_env_and_sample_type(wiz_state, arguments_obj)
+
+    field_descriptions = []
+    sorted_keys = qiimp.xlsx_basics.sort_keys(package_schema)
+    for curr_field_name in sorted_keys:
+        curr_field_dict = package_schema[curr_field_name]
+        curr_desc = qiimp.xlsx_validation_builder.get_field_constraint_description(curr_field_dict, wiz_state.regex_handler)
+        field_descriptions.append({"name": curr_field_name,
+                                   "description": curr_desc})
+
+    response_bytes = json.dumps(
+        {"field_names": sorted(package_schema.keys()),
+         "reserved_words": wiz_state.reserved_words_list,
+         "field_descriptions": field_descriptions}).encode("utf-8")
+    # NB: a strong etag, since the same package always gets byte-for-byte the same response
+    etag = '"{0}"'.format(hashlib.sha1(response_bytes).hexdigest())
+
+    result = (response_bytes, etag)
+    if is_known_package:
+        wiz_state.package_responses_by_key[package_key] = result
+    return result
+
+
+def _get_workbook_inputs(wiz_state, arguments_obj):
+    # first get the package schema info
+    package_schema = _get_package_schema_by_env_and_sample_type(wiz_state, arguments_obj)
+
+    study_name = None
+    study_default_locale = None
+    dict_of_field_schemas_by_index = defaultdict(dict)
+    for curr_key, curr_value in arguments_obj.items():
+        # per issue #53, all user-provided fields must be lower-cased
+        curr_key = curr_key.lower()
+
+        # ignore the "*_template" keys
+        if not curr_key.endswith(mws.TEMPLATE_SUFFIX):
+            if curr_key == mws.InputNames.study_name.value:
+                study_name = _parse_form_value(curr_value)
+            # TODO: Get rid of hardcode of field name
+            elif curr_key == "default_study_location_select":
+                study_default_locale = _parse_form_value(curr_value)
+            else:
+                retain_list = False
+                # slice off the field index at the end
+                split_val = curr_key.split(mws.SEPARATOR)
+                index_str = split_val[-1]
+                if "[]" in index_str:
+                    retain_list = True
+                index_str = index_str.replace("[]", "")
+                try:
+                    index = int(index_str)  # index will be last separated value in key name
+                    curr_schema = dict_of_field_schemas_by_index[index]
+                    base_key = curr_key.replace(mws.SEPARATOR + index_str, "")
+
+                    revised_values = _parse_form_value(curr_value, retain_list)
+                    if revised_values:  # "truish"--not empty string, whitespace, etc
+                        curr_schema[base_key] = revised_values
+                except ValueError:
+                    pass  # ignore fields that don't end with a field index number
+                # end if this key really has a value
+            # end if this key isn't for study_name
+        # end if this is a real key and not a template key
+    # next form field
+
+    dict_of_validation_schema_by_index = {}
+    for curr_key in dict_of_field_schemas_by_index:
+        curr_schema = dict_of_field_schemas_by_index[curr_key]
+        # The only time when multiple fields come back is when the input is a continuous field, in which
+        # case the units for that field are split out and put in *another* field that always has the same
+        # value (ugh, but this is the customer requirement).
+        field_name_and_schema_tuples_list = qiimp.schema_builder.get_validation_schemas(curr_schema, wiz_state.regex_handler)
+        for field_name, curr_validation_schema in field_name_and_schema_tuples_list:
+            dict_of_validation_schema_by_index[field_name] = curr_validation_schema
+
+    # a shallow copy is enough here: update_schema (used for the locale defaults) copies any field schema it
+    # changes rather than changing it in place, and the custom fields simply replace whole entries
+    mutable_package_schema = dict(package_schema)
+    mutable_package_schema = _update_package_with_locale_defaults(wiz_state, mutable_package_schema,
+                                                                  study_default_locale)
+    mutable_package_schema.update(dict_of_validation_schema_by_index)
+
+    # identical submissions get the workbook already built (or being built) for the first of them
+    workbook_fingerprint = _make_workbook_fingerprint(wiz_state, mutable_package_schema, dict_of_field_schemas_by_index,
+                                                      study_default_locale, study_name)
+    return _WorkbookInputs(study_name, mutable_package_schema, dict_of_field_schemas_by_index, workbook_fingerprint)
+
+
+def _make_workbook_fingerprint(wiz_state, package_schema, form_dict, study_default_locale, study_name):
+    # NB: every setting that changes how the workbook generator builds a workbook belongs in the build settings
+    build_settings = {"num_allowable_samples": qiimp.xlsx_builder.DEFAULT_NUM_ALLOWABLE_SAMPLES,
+                      "static_grid_layout": wiz_state.static_grid_layout,
+                      "rank_strategy": wiz_state.rank_strategy,
+                      "workbook_output_mode": wiz_state.workbook_output_mode}
+    return qiimp.workbook_cache.make_workbook_fingerprint(wiz_state.VERSION, package_schema, form_dict,
+                                                          study_default_locale, study_name, build_settings)
+
+
+def _update_package_with_locale_defaults(wiz_state, package_schema, study_default_locale):
+    locale_fields_to_modify = None
+    for curr_locale_dict in wiz_state.default_locales_list:
+        curr_locale, curr_locale_subdict = mws.get_single_key_and_subdict(curr_locale_dict)
+        if study_default_locale == curr_locale:
+            locale_fields_to_modify = curr_locale_subdict
+            break
+
+    if locale_fields_to_modify is None:
+        raise ValueError("Default study locale '{0}' was not found among known default locales.".format(
+            study_default_locale))
+
+    package_schema = mpsb.update_schema(package_schema, locale_fields_to_modify, add_silently=False,
+                                        force_piecemeal_overwrite=True)
+    return package_schema
+
+
+async def _get_or_generate_workbook(app_settings, workbook_inputs, progress_callback=None, profile_file_base=None):
+    workbook_generator = app_settings["workbook_generator"]
+    workbook_cache = app_settings["workbook_cache"]
+    generation_admission = app_settings["generation_admission"]
+
+    # NB: the workbook is built by the workbook generator's workers, NOT here on the IOLoop, so that other
+    # requests can still be served while it is being built; only actual builds need to be admitted.  If this
+    # request is coalesced with a build already under way, the progress is reported to that build's requester only.
+    def generate():
+        return generation_admission.run(lambda: workbook_generator.generate(
+            workbook_inputs.study_name, workbook_inputs.package_schema, workbook_inputs.form_dict,
+            progress_callback=progress_callback, profile_file_base=profile_file_base))
+
+    if profile_file_base is not None:
+        # a profiled request is no use unless it really builds its workbook, so it skips the cache
+        return await generate()
+    return await workbook_cache.get_or_generate(workbook_inputs.fingerprint, generate)
+
+
+def _check_monitoring_allowed(handler):
+    # /status and /metrics tell a good deal about the server, so they are served only to requests carrying the
+    # configured monitoring token, as a bearer token (which is what Prometheus sends); an empty token turns them off
+    monitoring_token = handler.application.settings["wizard_state"].monitoring_token
+    auth_header = handler.request.headers.get("Authorization", "")
+    offered_token = auth_header[len(_MONITORING_AUTH_SCHEME):] if auth_header.startswith(_MONITORING_AUTH_SCHEME) \
+        else ""
+    if not monitoring_token or \
+            not hmac.compare_digest(offered_token.encode("utf-8"), monitoring_token.encode("utf-8")):
+        raise tornado.web.HTTPError(403, "Server monitoring is not allowed.")
+
+
+def _is_profiling_requested(handler):
+    # Profiling is for admins only, so a request is profiled only if it carries the configured profiling token; a
+    # request that asks without the right token (or when profiling is turned off) is refused outright
+    offered_token = handler.request.headers.get(_PROFILE_TOKEN_HEADER)
+    if offered_token is None:
+        return False
+
+    profiling_token = handler.application.settings["wizard_state"].profiling_token
+    if not profiling_token or not hmac.compare_digest(offered_token.encode("utf-8"), profiling_token.encode("utf-8")):
+        raise tornado.web.HTTPError(403, "Request profiling is not allowed.")
+    return True
+
+
+def _get_profile_file_base(handler, arguments_obj, num_fields):
+    wiz_state = handler.application.settings["wizard_state"]
+    profile_file_base = qiimp.request_profiler.make_profile_file_base(
+        wiz_state.profile_output_path, type(handler).__name__, _get_package_key(arguments_obj), num_fields)
+    # tell the admin which profile files belong to this request (the name only: where they are is their business)
+    handler.set_header(_PROFILE_FILE_HEADER, os.path.basename(profile_file_base))
+    return profile_file_base
+
+
+async def _stream_workbook(handler, generated_workbook):
+    # The workbook was built in memory, so send it straight back as a download (rather than redirecting to a
+    # download page and having the browser fetch it again).
+    handler.set_header("Content-Type", _XLSX_CONTENT_TYPE)
+    handler.set_header("Content-Disposition", 'attachment; filename="{0}"'.format(generated_workbook.file_name))
+    handler.set_header("Content-Length", len(generated_workbook.content))
+
+    # The wizard page shows a "please wait" overlay while the workbook is generated; when it posts the form directly
+    # the page isn't replaced by a download response, so it watches for this cookie to know when to take the
+    # overlay down.
+    download_token = handler.get_argument(_DOWNLOAD_TOKEN_NAME, None)
+    if download_token is not None and _DOWNLOAD_TOKEN_REGEX.match(download_token):
+        handler.set_cookie(_DOWNLOAD_TOKEN_NAME, download_token)
+
+    content_view = memoryview(generated_workbook.content)
+    try:
+        for chunk_start in range(0, len(content_view), _DOWNLOAD_CHUNK_BYTES):
+            handler.write(bytes(content_view[chunk_start:chunk_start + _DOWNLOAD_CHUNK_BYTES]))
+            await handler.flush()
+        handler.finish()
+    except tornado.iostream.StreamClosedError:
+        pass  # the user went away before the download finished
+
+
+def _start_generation_job(app_settings, job, workbook_inputs, is_resumed=False):
+    # NB: tell the request tracker about the job, so a shutting-down server process waits for it like any other
+    # request
+    app_settings["request_tracker"].start_request()
+    tornado.ioloop.IOLoop.current().spawn_callback(_run_generation_job, app_settings, job, workbook_inputs,
+                                                   is_resumed)
+
+
+async def _run_generation_job(app_settings, job, workbook_inputs, is_resumed):
+    generation_jobs = app_settings["generation_jobs"]
+    job_store = app_settings["generation_job_store"]
+    try:
+        # a resumed job may well have been finished already (or an identical one may have been), by this or another
+        # server process; NB: a fresh job is only looked up in the workbook cache (by _get_or_generate_workbook), just
+        # like a workbook asked for directly, so it doesn't pay for a database query each time
+        generated_workbook = None
+        if is_resumed:
+            generated_workbook = await _find_completed_workbook(app_settings, workbook_inputs.fingerprint)
+        if generated_workbook is None:
+            generated_workbook = await _get_or_generate_workbook(app_settings, workbook_inputs,
+                                                                 progress_callback=job.set_phase)
+        job.succeed(generated_workbook)
+        # NB: only workbooks written to the output directory can be found again by file name
+        stored_file_name = generated_workbook.file_name if generated_workbook.content is None else None
+        await job_store.finish(job.job_id, qiimp.generation_job_store.DONE_STATE, file_name=stored_file_name)
+    except qiimp.generation_admission.GenerationRejectedError as e:
+        if is_resumed:
+            # no room for it after all; leave it for a later round (here or in another server process)
+            generation_jobs.remove(job.job_id)
+            await job_store.release([job.job_id])
+        else:
+            job.fail(str(e), e.retry_after_seconds)
+            await job_store.finish(job.job_id, qiimp.generation_job_store.FAILED_STATE, error=job.error)
+    except Exception as e:
+        traceback.print_exc()
+        job.fail("".join(traceback.format_exception_only(type(e), e)).strip())
+        await job_store.finish(job.job_id, qiimp.generation_job_store.FAILED_STATE, error=job.error)
+    finally:
+        app_settings["request_tracker"].finish_request()
+
+
+async def _find_completed_workbook(app_settings, fingerprint):
+    wiz_state = app_settings["wizard_state"]
+    if app_settings["workbook_generator"].in_memory:
+        return None  # workbooks built in memory aren't kept anywhere another server process could find them
+
+    file_name = await app_settings["generation_job_store"].find_completed_file_name(fingerprint)
+    if file_name is None:
+        return None
+    try:
+        # mark the file as recently used, so the output retention doesn't remove it just yet
+        os.utime(wiz_state.get_output_path(file_name))
+    except OSError:
+        return None  # already removed by the output retention
+    return qiimp.xlsx_builder.GeneratedWorkbook(file_name, None)
+
+
+def _get_stored_job_status(wiz_state, stored_job):
+    # like _get_job_status, for a job known only from the job store
+    result = {"job_id": stored_job.job_id,
+              "state": qiimp.generation_jobs.QUEUED_STATE,
+              "phase": None,
+              "download_url": None,
+              "trace_url": None,
+              "error": stored_job.error,
+              "retry_after_seconds": None}
+
+    if stored_job.state == qiimp.generation_job_store.DONE_STATE:
+        result["state"] = qiimp.generation_jobs.DONE_STATE
+        if stored_job.file_name is not None:
+            result["download_url"] = "{0}{1}".format(wiz_state.partial_download_url, stored_job.file_name)
+        else:
+            result["download_url"] = "{0}{1}/workbook".format(wiz_state.partial_jobs_url, stored_job.job_id)
+    elif stored_job.state == qiimp.generation_job_store.FAILED_STATE:
+        result["state"] = qiimp.generation_jobs.FAILED_STATE
+    return result
+
+
+async def _maintain_generation_jobs(app_settings):
+    # Keep hold of the jobs this server process is running, pick up any that were abandoned by a server process that
+    # stopped (or crashed) before finishing them, and forget finished jobs once they are old enough.
+    wiz_state = app_settings["wizard_state"]
+    generation_jobs = app_settings["generation_jobs"]
+    job_store = app_settings["generation_job_store"]
+
+    await job_store.renew_leases(generation_jobs.get_unfinished_job_ids())
+
+    # NB: claim only as many as there is room for, so resumed jobs aren't turned away by the admission control
+    for stored_job in await job_store.claim_orphans(app_settings["generation_admission"].get_num_free()):
+        try:
+            workbook_inputs = _get_workbook_inputs(wiz_state, stored_job.arguments)
+        except Exception as e:
+            # e.g., the package it was for no longer exists
+            await job_store.finish(stored_job.job_id, qiimp.generation_job_store.FAILED_STATE,
+                                   error="".join(traceback.format_exception_only(type(e), e)).strip())
+            continue
+
+        print("resuming generation job {0}".format(stored_job.job_id))
+        _start_generation_job(app_settings, generation_jobs.create(stored_job.job_id), workbook_inputs,
+                              is_resumed=True)
+
+    await job_store.remove_finished(wiz_state.generation_job_retention_seconds)
+
+
+def _get_job_status(wiz_state, job):
+    result = {"job_id": job.job_id,
+              "state": job.state,
+              "phase": job.phase,
+              "download_url": None,
+              "trace_url": None,
+              "error": job.error,
+              "retry_after_seconds": job.retry_after_seconds}
+
+    if job.state == qiimp.generation_jobs.DONE_STATE:
+        if job.generated_workbook.content is None:
+            result["download_url"] = "{0}{1}".format(wiz_state.partial_download_url,
+                                                     job.generated_workbook.file_name)
+        else:
+            result["download_url"] = "{0}{1}/workbook".format(wiz_state.partial_jobs_url, job.job_id)
+        if job.generated_workbook.build_trace is not None:
+            result["trace_url"] = "{0}{1}/trace".format(wiz_state.partial_jobs_url, job.job_id)
+    return result
+
+
+def _write_generation_rejected(handler, rejected_error):
+    handler.set_status(503)
+    handler.set_header("Retry-After", str(rejected_error.retry_after_seconds))
+    handler.set_header("Content-Type", "text/plain; charset=UTF-8")
+    handler.finish(str(rejected_error))
+
+
+def _write_json(handler, response_dict):
+    # for the responses that describe the server's current state, which must never be cached
+    handler.set_header("Content-Type", "application/json; charset=UTF-8")
+    handler.set_header("Cache-Control", "no-store")
+    handler.finish(json.dumps(response_dict))
+
+
+async def _get_component_stats(app_settings):
+    return {"output_retention": app_settings["output_retention"].get_stats(),
+            "workbook_cache": app_settings["workbook_cache"].get_stats(),
+            "generation_admission": app_settings["generation_admission"].get_stats(),
+            "generation_jobs": app_settings["generation_jobs"].get_stats(),
+            "generation_job_store": await app_settings["generation_job_store"].get_stats()}
+
+
+async def _write_metrics_snapshot(app_settings):
+    # share this server process's metrics and stats with the others (see server_metrics.MetricsSnapshots)
+    component_stats = await _get_component_stats(app_settings)
+    metric_families = app_settings["server_metrics"].get_families(component_stats)
+    await tornado.ioloop.IOLoop.current().run_in_executor(
+        None, app_settings["metrics_snapshots"].write, component_stats, metric_families)
+
+
+async def _read_other_metrics_snapshots(app_settings):
+    return await tornado.ioloop.IOLoop.current().run_in_executor(None, app_settings["metrics_snapshots"].read_others)
+
+
+class _MeteredApplication(tornado.web.Application):
+    def log_request(self, handler):
+        # count and time every finished request for /metrics, then log it as usual
+        self.settings["server_metrics"].observe_request(handler)
+        super().log_request(handler)
+
+
 class PackageHandler(tornado.web.RequestHandler):
-    def get(self, *args, **kwargs):
-        raise NotImplementedError("Get not supported for PackageHandler.")
+    def get(self, *args):
+        self._write_package_response()
 
     def post(self, *args):
+        self._write_package_response()
+
+    def _write_package_response(self):
         wiz_state = self.application.settings["wizard_state"]
-        package_schema = _get_package_schema_by_env_and_sample_type(wiz_state, self.request.arguments)
-
-        field_descriptions = []
-        sorted_keys = qiimp.xlsx_basics.sort_keys(package_schema)
-        for curr_field_name in sorted_keys:
-            curr_field_dict = package_schema[curr_field_name]
-            curr_desc = qiimp.xlsx_validation_builder.get_field_constraint_description(curr_field_dict, wiz_state.regex_handler)
-            field_descriptions.append({"name": curr_field_name,
-                                       "description": curr_desc})
-
-        self.write(json.dumps(
-            {"field_names": sorted(package_schema.keys()),
-             "reserved_words": wiz_state.reserved_words_list,
-             "field_descriptions": field_descriptions}))
+        for curr_argument_name in [mws.InputNames.environment.value, mws.InputNames.sample_type.value]:
+            if not self.request.arguments.get(curr_argument_name):
+                raise tornado.web.HTTPError(400, "Missing argument '{0}'.".format(curr_argument_name))
+
+        if not _is_profiling_requested(self):
+            response_bytes, etag = _get_package_response(wiz_state, self.request.arguments)
+        else:
+            num_fields = len(_get_package_schema_by_env_and_sample_type(wiz_state, self.request.arguments))
+            profile_file_base = _get_profile_file_base(self, self.request.arguments, num_fields)
+            # NB: bypass the memo, or there would be nothing to profile
+            response_bytes, etag = qiimp.request_profiler.profile_call(
+                lambda: _get_package_response(wiz_state, self.request.arguments, use_memo=False), profile_file_base)
+
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.set_header("Etag", etag)
+        # let browsers and proxies keep the response, but have them check it is still current (which is cheap, and
+        # means a server restart with changed package files is picked up) before using it
+        self.set_header("Cache-Control", "public, no-cache")
+
+        if self.check_etag_header():
+            self.set_status(304)
+        else:
+            self.write(response_bytes)
         self.finish()
 
+    def compute_etag(self):
+        # the etag is set explicitly (and cached with the response) so tornado doesn't need to hash the body again
+        return None
+
     def data_received(self, chunk):
         # PyCharm tells me that this abstract method must be implemented to derive from RequestHandler ...
         pass
 
 
+@tornado.web.stream_request_body
 class UploadHandler(tornado.web.RequestHandler):
+    # NB: the upload body is parsed as it arrives (see multipart_stream_parser) rather than being buffered in memory
+    # by tornado, since a filled-in workbook from a big study can be large
+    def prepare(self):
+        wiz_state = self.application.settings["wizard_state"]
+        self._multipart_parser = None
+        self._multipart_parse_error = None
+
+        if self.request.method != "POST":
+            return
+
+        self.request.connection.set_max_body_size(wiz_state.max_upload_bytes)
+        # NB: prepare runs before tornado itself reads (and checks) the Content-Length, so it may not be a number
+        content_length = self.request.headers.get("Content-Length")
+        try:
+            content_length = None if content_length is None else int(content_length)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "Content-Length is not a number.")
+        if content_length is not None and content_length > wiz_state.max_upload_bytes:
+            raise tornado.web.HTTPError(413, "Upload is larger than the maximum of {0} bytes.".format(
+                wiz_state.max_upload_bytes))
+
+        try:
+            self._multipart_parser = qiimp.multipart_stream_parser.MultipartStreamParser(
+                self.request.headers.get("Content-Type", ""), wiz_state.upload_spool_memory_bytes)
+        except qiimp.multipart_stream_parser.MultipartParseError as e:
+            raise tornado.web.HTTPError(400, str(e))
+
+    def data_received(self, chunk):
+        # NB: tornado doesn't turn an HTTPError raised here into a response--it just drops the connection--so a bad
+        # body is noted, the rest of it ignored, and the error reported by post.  Any other method's body (e.g., a PUT's)
+        # has no parser to go to, and is just ignored too.
+        if self._multipart_parser is None or self._multipart_parse_error is not None:
+            return
+        try:
+            self._multipart_parser.data_received(chunk)
+        except qiimp.multipart_stream_parser.MultipartParseError as e:
+            self._multipart_parse_error = e
+
     def get(self, *args, **kwargs):
         raise NotImplementedError("Get not supported for UploadHandler.")
 
     def post(self, *args):
+        if self._multipart_parse_error is not None:
+            raise tornado.web.HTTPError(400, str(self._multipart_parse_error))
+        try:
+            self._multipart_parser.finish()
+        except qiimp.multipart_stream_parser.MultipartParseError as e:
+            raise tornado.web.HTTPError(400, str(e))
+
         # TODO: someday: refactor hard-coding of element name
-        fileinfo_dict = self.request.files["files[]"][0]
-        file_name = fileinfo_dict['filename']
+        uploaded_files = self._multipart_parser.files.get("files[]")
+        if not uploaded_files:
+            raise tornado.web.HTTPError(400, "No file was uploaded.")
+        uploaded_file = uploaded_files[0]
+        file_name = uploaded_file.filename
         result_dict = {"files": [{"name": file_name}]}
 
-        # The libraries for reading xlsx files don't accept a stream, only a file name, so I HAVE to write this to a
-        # file at least temporarily ...
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx")
-        temp_file.write(fileinfo_dict['body'])
-        temp_file.close()  # but DON'T delete yet
-
+        # The zip-level xlsx reader accepts a stream, so the form sheet can be read straight out of the spool
         try:
             form_dict = mws.load_yaml_from_wizard_xlsx(
-                temp_file.name, qiimp.xlsx_basics.SheetNames.form.value)
+                uploaded_file.spool, qiimp.xlsx_basics.SheetNames.form.value, display_name=file_name)
             result_dict["fields"] = form_dict
         except ValueError as e:
             if str(e).startswith(mws.NON_WIZARD_XLSX_ERROR_PREFIX):
@@ -113,9 +587,19 @@ class UploadHandler(tornado.web.RequestHandler):
         self.write(json.dumps(result_dict))
         self.finish()
 
-    def data_received(self, chunk):
-        # PyCharm tells me that this abstract method must be implemented to derive from RequestHandler ...
-        pass
+    def on_finish(self):
+        self._close_spools()
+
+    def on_connection_close(self):
+        # the client went away mid-upload; on_finish won't necessarily be called, so clean up here too
+        self._close_spools()
+        super().on_connection_close()
+
+    def _close_spools(self):
+        multipart_parser = getattr(self, "_multipart_parser", None)
+        if multipart_parser is not None:
+            multipart_parser.close()
+            self._multipart_parser = None
 
 
 # class MergeHandler(tornado.web.RequestHandler):
@@ -224,72 +708,39 @@ class MainHandler(tornado.web.RequestHandler):
                     hosts_list=wiz_state.envs_display_dicts_list,
                     full_main_url=wiz_state._get_url(make_full_url=True))
 
-    def post(self):
+    def prepare(self):
+        # let a shutting-down server process know that this request is still being worked on; generating a
+        # workbook can take a while, and the user should get it rather than a dropped connection
+        self.application.settings["request_tracker"].start_request()
+
+    def on_finish(self):
+        self.application.settings["request_tracker"].finish_request()
+
+    async def post(self):
         wiz_state = self.application.settings["wizard_state"]
+        is_profiled = _is_profiling_requested(self)
 
         try:
-            # first get the package schema info
-            package_schema = _get_package_schema_by_env_and_sample_type(wiz_state, self.request.arguments)
-
-            study_name = None
-            study_default_locale = None
-            dict_of_field_schemas_by_index = defaultdict(dict)
-            for curr_key, curr_value in self.request.arguments.items():
-                # per issue #53, all user-provided fields must be lower-cased
-                curr_key = curr_key.lower()
-
-                # ignore the "*_template" keys
-                if not curr_key.endswith(mws.TEMPLATE_SUFFIX):
-                    if curr_key == mws.InputNames.study_name.value:
-                        study_name = _parse_form_value(curr_value)
-                    # TODO: Get rid of hardcode of field name
-                    elif curr_key == "default_study_location_select":
-                        study_default_locale = _parse_form_value(curr_value)
-                    else:
-                        retain_list = False
-                        # slice off the field index at the end
-                        split_val = curr_key.split(mws.SEPARATOR)
-                        index_str = split_val[-1]
-                        if "[]" in index_str:
-                            retain_list = True
-                        index_str = index_str.replace("[]", "")
-                        try:
-                            index = int(index_str)  # index will be last separated value in key name
-                            curr_schema = dict_of_field_schemas_by_index[index]
-                            base_key = curr_key.replace(mws.SEPARATOR + index_str, "")
-
-                            revised_values = _parse_form_value(curr_value, retain_list)
-                            if revised_values:  # "truish"--not empty string, whitespace, etc
-                                curr_schema[base_key] = revised_values
-                        except ValueError:
-                            pass  # ignore fields that don't end with a field index number
-                        # end if this key really has a value
-                    # end if this key isn't for study_name
-                # end if this is a real key and not a template key
-            # next form field
-
-            dict_of_validation_schema_by_index = {}
-            for curr_key in dict_of_field_schemas_by_index:
-                curr_schema = dict_of_field_schemas_by_index[curr_key]
-                # The only time when multiple fields come back is when the input is a continuous field, in which
-                # case the units for that field are split out and put in *another* field that always has the same
-                # value (ugh, but this is the customer requirement).
-                field_name_and_schema_tuples_list = qiimp.schema_builder.get_validation_schemas(curr_schema, wiz_state.regex_handler)
-                for field_name, curr_validation_schema in field_name_and_schema_tuples_list:
-                    dict_of_validation_schema_by_index[field_name] = curr_validation_schema
-
-            mutable_package_schema = copy.deepcopy(package_schema)
-            mutable_package_schema = self._update_package_with_locale_defaults(mutable_package_schema,
-                                                                               study_default_locale)
-            mutable_package_schema.update(dict_of_validation_schema_by_index)
-
-            file_name = qiimp.xlsx_builder.write_workbook(study_name, mutable_package_schema,
-                                                                    dict_of_field_schemas_by_index,
-                                                                    wiz_state)
-
-            self.redirect("{0}{1}".format(wiz_state.partial_download_url, file_name))
+            workbook_inputs = _get_workbook_inputs(wiz_state, self.request.arguments)
+            profile_file_base = None
+            if is_profiled:
+                profile_file_base = _get_profile_file_base(self, self.request.arguments,
+                                                           len(workbook_inputs.package_schema))
+            generated_workbook = await _get_or_generate_workbook(self.application.settings, workbook_inputs,
+                                                                 profile_file_base=profile_file_base)
+        except qiimp.generation_admission.GenerationRejectedError as e:
+            # too busy: say so right away, rather than making the user wait behind everyone else
+            _write_generation_rejected(self, e)
+            return
         except Exception as e:
             self.send_error(exc_info=sys.exc_info())
+            return
+
+        if generated_workbook.content is None:
+            # written to the output directory, so send the user to the page that links to it
+            self.redirect("{0}{1}".format(wiz_state.partial_download_url, generated_workbook.file_name))
+        else:
+            await _stream_workbook(self, generated_workbook)
 
     def write_error(self, status_code, **kwargs):
         wiz_state = self.application.settings["wizard_state"]
@@ -317,23 +768,184 @@ class MainHandler(tornado.web.RequestHandler):
         # PyCharm tells me that this abstract method must be implemented to derive from RequestHandler ...
         pass
 
-    def _update_package_with_locale_defaults(self, package_schema, study_default_locale):
+
+class JobsHandler(tornado.web.RequestHandler):
+    async def post(self, *args):
+        # submit the wizard form as a generation job: answers right away with the job's id and urls, and the
+        # workbook is built in the background
+        wiz_state = self.application.settings["wizard_state"]
+        generation_admission = self.application.settings["generation_admission"]
+        generation_jobs = self.application.settings["generation_jobs"]
+
+        try:
+            workbook_inputs = _get_workbook_inputs(wiz_state, self.request.arguments)
+        except Exception as e:
+            self.send_error(400, exc_info=sys.exc_info())
+            return
+
+        if generation_admission.is_full():
+            retry_after_seconds = generation_admission.get_retry_after_seconds()
+            self.set_header("Retry-After", str(retry_after_seconds))
+            self.set_status(503)
+            _write_json(self, {"error": str(qiimp.generation_admission.GenerationRejectedError(retry_after_seconds)),
+                               "retry_after_seconds": retry_after_seconds})
+            return
+
+        job = generation_jobs.create()
+        # NB: recorded before it starts, so it will be resumed if this server process stops before finishing it
+        await self.application.settings["generation_job_store"].add(
+            job.job_id, workbook_inputs.fingerprint, _get_package_key(self.request.arguments), self.request.arguments)
+        _start_generation_job(self.application.settings, job, workbook_inputs)
+
+        job_url = "{0}{1}".format(wiz_state.partial_jobs_url, job.job_id)
+        self.set_status(202)
+        _write_json(self, {"job_id": job.job_id,
+                           "status_url": job_url,
+                           "progress_url": job_url + "/progress"})
+
+    def write_error(self, status_code, **kwargs):
+        error = self._reason
+        if "exc_info" in kwargs:
+            exc_type, exc_value, exc_traceback = kwargs["exc_info"]
+            error = "".join(traceback.format_exception_only(exc_type, exc_value)).strip()
+        _write_json(self, {"error": error})
+
+    def data_received(self, chunk):
+        # PyCharm tells me that this abstract method must be implemented to derive from RequestHandler ...
+        pass
+
+
+class JobHandler(tornado.web.RequestHandler):
+    async def get(self, job_id):
+        wiz_state = self.application.settings["wizard_state"]
+        job = self.application.settings["generation_jobs"].get(job_id)
+        if job is not None:
+            _write_json(self, _get_job_status(wiz_state, job))
+            return
+
+        # not one of this server process's jobs, but perhaps another's
+        stored_job = await self.application.settings["generation_job_store"].get(job_id)
+        if stored_job is None:
+            raise tornado.web.HTTPError(404)
+        _write_json(self, _get_stored_job_status(wiz_state, stored_job))
+
+    def data_received(self, chunk):
+        # PyCharm tells me that this abstract method must be implemented to derive from RequestHandler ...
+        pass
+
+
+class JobProgressHandler(tornado.websocket.WebSocketHandler):
+    # Sends the job's status (as in JobHandler) right away and then every time it changes, and closes the connection
+    # once the job is finished.
+    def prepare(self):
+        # NB: prepare runs before the websocket handshake, so an unknown job can still get a plain 404
+        job_id = self.path_args[0]
+        self._job = self.application.settings["generation_jobs"].get(job_id)
+        if self._job is None:
+            raise tornado.web.HTTPError(404)
+
+    def open(self, job_id):
+        self._job.add_listener(self._send_job_status)
+        self._send_job_status(self._job)
+
+    def on_close(self):
+        self._job.remove_listener(self._send_job_status)
+
+    def _send_job_status(self, job):
+        wiz_state = self.application.settings["wizard_state"]
+        try:
+            self.write_message(json.dumps(_get_job_status(wiz_state, job)))
+        except tornado.websocket.WebSocketClosedError:
+            job.remove_listener(self._send_job_status)
+            return
+
+        if job.is_finished:
+            self.close()
+
+
+class JobWorkbookHandler(tornado.web.RequestHandler):
+    async def get(self, job_id):
+        # only for jobs whose workbook was built in memory; workbooks written to disk have their own download page
+        job = self.application.settings["generation_jobs"].get(job_id)
+        if job is not None and job.generated_workbook is not None and job.generated_workbook.content is not None:
+            await _stream_workbook(self, job.generated_workbook)
+            return
+
+        # The workbook was built by another server process (or by this one before it restarted), so it isn't here
+        # to send; build it again from the job's stored arguments instead.
         wiz_state = self.application.settings["wizard_state"]
+        stored_job = await self.application.settings["generation_job_store"].get(job_id)
+        if stored_job is None or stored_job.state != qiimp.generation_job_store.DONE_STATE:
+            raise tornado.web.HTTPError(404)
+
+        self.application.settings["request_tracker"].start_request()
+        try:
+            workbook_inputs = _get_workbook_inputs(wiz_state, stored_job.arguments)
+            generated_workbook = await _get_or_generate_workbook(self.application.settings, workbook_inputs)
+        except qiimp.generation_admission.GenerationRejectedError as e:
+            _write_generation_rejected(self, e)
+            return
+        finally:
+            self.application.settings["request_tracker"].finish_request()
 
-        locale_fields_to_modify = None
-        for curr_locale_dict in wiz_state.default_locales_list:
-            curr_locale, curr_locale_subdict = mws.get_single_key_and_subdict(curr_locale_dict)
-            if study_default_locale == curr_locale:
-                locale_fields_to_modify = curr_locale_subdict
-                break
+        if generated_workbook.content is None:
+            self.redirect("{0}{1}".format(wiz_state.partial_download_url, generated_workbook.file_name))
+        else:
+            await _stream_workbook(self, generated_workbook)
 
-        if locale_fields_to_modify is None:
-            raise ValueError("Default study locale '{0}' was not found among known default locales.".format(
-                study_default_locale))
+    def data_received(self, chunk):
+        # PyCharm tells me that this abstract method must be implemented to derive from RequestHandler ...
+        pass
 
-        package_schema = mpsb.update_schema(package_schema, locale_fields_to_modify, add_silently=False,
-                                            force_piecemeal_overwrite=True)
-        return package_schema
+
+class JobTraceHandler(tornado.web.RequestHandler):
+    def get(self, job_id):
+        # the Chrome trace of the build that made the job's workbook (see build_tracer); only known for this server
+        # process's own jobs
+        job = self.application.settings["generation_jobs"].get(job_id)
+        if job is None or job.generated_workbook is None or job.generated_workbook.build_trace is None:
+            raise tornado.web.HTTPError(404)
+
+        self.set_header("Content-Disposition", "attachment; filename={0}{1}".format(
+            job_id, qiimp.build_tracer.BUILD_TRACE_EXTENSION))
+        _write_json(self, job.generated_workbook.build_trace)
+
+    def data_received(self, chunk):
+        # PyCharm tells me that this abstract method must be implemented to derive from RequestHandler ...
+        pass
+
+
+class StatusHandler(tornado.web.RequestHandler):
+    async def get(self, *args):
+        _check_monitoring_allowed(self)
+        status_dict = {"pid": os.getpid()}
+        status_dict.update(await _get_component_stats(self.application.settings))
+        # and the (slightly older) stats of any other server processes
+        status_dict["other_processes"] = []
+        for curr_snapshot in await _read_other_metrics_snapshots(self.application.settings):
+            curr_status_dict = {"pid": curr_snapshot.pid, "snapshot_time": curr_snapshot.snapshot_time}
+            curr_status_dict.update(curr_snapshot.stats_by_group)
+            status_dict["other_processes"].append(curr_status_dict)
+        _write_json(self, status_dict)
+
+    def data_received(self, chunk):
+        # PyCharm tells me that this abstract method must be implemented to derive from RequestHandler ...
+        pass
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    async def get(self, *args):
+        _check_monitoring_allowed(self)
+        server_metrics = self.application.settings["server_metrics"]
+        component_stats = await _get_component_stats(self.application.settings)
+        other_snapshots = await _read_other_metrics_snapshots(self.application.settings)
+        self.set_header("Content-Type", qiimp.server_metrics.METRICS_CONTENT_TYPE)
+        self.set_header("Cache-Control", "no-store")
+        self.finish(server_metrics.render(component_stats, [x.families for x in other_snapshots]))
+
+    def data_received(self, chunk):
+        # PyCharm tells me that this abstract method must be implemented to derive from RequestHandler ...
+        pass
 
 
 class DownloadHandler(tornado.web.RequestHandler):
@@ -350,39 +962,146 @@ class DownloadHandler(tornado.web.RequestHandler):
 
 def main():
     wizard_state = mws.MetadataWizardState()
-    is_deployed = _parse_cmd_line_args()
+    is_deployed, num_processes = _parse_cmd_line_args()
     wizard_state.set_up(is_deployed)
 
     # get the package info; NB that the reason this isn't done in wizard_state.set_up is that mpsb references
     # wizard_state and so having wizard_state also reference mpsb would create a circular reference; refactoring
     # would be necessary to make it possible to move this.
+    schema_cache = qiimp.metadata_package_schema_cache.PackageSchemaCache(wizard_state.package_cache_path,
+                                                                          wizard_state.VERSION)
     env_and_sampletype_infos = mpsb.load_environment_and_sampletype_info(wizard_state.environment_definitions,
                                                                          wizard_state.displayname_by_sampletypes_list,
-                                                                         wizard_state.packages_dir_path)
+                                                                         wizard_state.packages_dir_path,
+                                                                         schema_cache,
+                                                                         wizard_state.package_load_workers)
     wizard_state.set_env_and_sampletype_infos(env_and_sampletype_infos)
+    wizard_state.set_package_schemas_by_key(mpsb.load_schemas_for_all_package_keys(
+        wizard_state.parent_stack_by_env_name, wizard_state.env_schemas))
+
+    # NB: bind the listening socket(s) BEFORE forking any server processes so that they all share them
+    sockets = tornado.netutil.bind_sockets(wizard_state.listen_port)
+
+    if num_processes == 1:
+        _run_server_process(wizard_state, sockets, num_processes)
+    else:
+        num_processes = num_processes or os.cpu_count()
+        print("starting {0} server processes".format(num_processes))
+        qiimp.server_supervisor.supervise_workers(num_processes,
+                                                  lambda: _run_server_process(wizard_state, sockets, num_processes),
+                                                  wizard_state.shutdown_drain_seconds)
+
+
+def _get_num_generation_workers(wizard_state, num_server_processes):
+    # A generation_workers of 0 means one per cpu, but that is one per cpu for the whole server: every server process
+    # has its own pool of workers, so with several server processes each gets only its share of the cpus.
+    if wizard_state.generation_workers or num_server_processes == 1:
+        return wizard_state.generation_workers
+    return max((os.cpu_count() or 1) // num_server_processes, 1)
+
+
+def _make_application(wizard_state, settings):
+    return _MeteredApplication([
+        (re.escape(wizard_state._get_url()), MainHandler),
+        (re.escape(wizard_state.partial_download_url) + r"([^/]+)", DownloadHandler),
+        (re.escape(wizard_state.partial_upload_url) + r"$", UploadHandler),
+        (re.escape(wizard_state.partial_package_url) + r"$", PackageHandler),
+        (re.escape(wizard_state.partial_status_url) + r"$", StatusHandler),
+        (re.escape(wizard_state.partial_metrics_url) + r"$", MetricsHandler),
+        (re.escape(wizard_state.partial_jobs_url) + r"$", JobsHandler),
+        (re.escape(wizard_state.partial_jobs_url) + r"([0-9a-f]+)$", JobHandler),
+        (re.escape(wizard_state.partial_jobs_url) + r"([0-9a-f]+)/progress$", JobProgressHandler),
+        (re.escape(wizard_state.partial_jobs_url) + r"([0-9a-f]+)/workbook$", JobWorkbookHandler),
+        (re.escape(wizard_state.partial_jobs_url) + r"([0-9a-f]+)/trace$", JobTraceHandler)
+    ], **settings)
+
+
+def _run_server_process(wizard_state, sockets, num_server_processes):
+    # NB: create the generator only once the wizard state is completely set up, since each worker process gets a
+    # copy of the wizard state as it is when the generator is created--and only after any forking of server
+    # processes, since a process pool can't be carried across a fork
+    server_metrics = qiimp.server_metrics.ServerMetrics(os.getpid())
+    # NB: a process whose snapshot is a few intervals old is taken to be gone
+    metrics_snapshots = qiimp.server_metrics.MetricsSnapshots(
+        wizard_state.metrics_snapshot_path, os.getpid(),
+        max_age_seconds=3 * wizard_state.metrics_snapshot_interval_seconds)
+    workbook_generator = qiimp.workbook_generator.WorkbookGenerator(wizard_state, wizard_state.generation_executor,
+                                                                     _get_num_generation_workers(
+                                                                         wizard_state, num_server_processes),
+                                                                     wizard_state.workbook_output_mode,
+                                                                     build_timing_callback=server_metrics.observe_build)
+    request_tracker = qiimp.server_supervisor.InFlightRequestTracker()
+    workbook_cache = qiimp.workbook_cache.WorkbookCache(wizard_state, wizard_state.workbook_cache_max_entries,
+                                                        wizard_state.workbook_cache_max_bytes)
+    generation_admission = qiimp.generation_admission.GenerationAdmission(
+        wizard_state.generation_max_concurrent, wizard_state.generation_max_queued)
+    generation_jobs = qiimp.generation_jobs.GenerationJobs(wizard_state.generation_job_retention_seconds)
+    # NB: a server process that stops without finishing a job keeps its lease on it for a few resume intervals, so
+    # it must really be gone before another process takes the job over
+    generation_job_store = qiimp.generation_job_store.GenerationJobStore(
+        wizard_state.generation_job_store_path, lease_seconds=3 * wizard_state.generation_job_resume_interval_seconds)
+    output_retention = qiimp.output_retention.OutputRetention(
+        wizard_state.get_output_dir_path(), max_total_bytes=wizard_state.output_max_bytes,
+        max_num_files=wizard_state.output_max_files,
+        max_age_seconds=wizard_state.output_max_age_hours * 60 * 60)
+    # NB: a profiled request leaves its profile files behind, so they need tidying up just as the workbooks do
+    profile_retention = qiimp.output_retention.OutputRetention(
+        wizard_state.profile_output_path, max_total_bytes=wizard_state.profile_max_bytes,
+        max_num_files=wizard_state.profile_max_files, max_age_seconds=wizard_state.profile_max_age_hours * 60 * 60)
 
     settings = {
         "static_path": wizard_state.static_path,
         "static_url_prefix": wizard_state.static_url_prefix,
         "template_path": wizard_state.templates_dir_path,
         "wizard_state": wizard_state,
+        "workbook_generator": workbook_generator,
+        "request_tracker": request_tracker,
+        "output_retention": output_retention,
+        "workbook_cache": workbook_cache,
+        "generation_admission": generation_admission,
+        "generation_jobs": generation_jobs,
+        "generation_job_store": generation_job_store,
+        "server_metrics": server_metrics,
+        "metrics_snapshots": metrics_snapshots,
     }
 
-    application = tornado.web.Application([
-        (re.escape(wizard_state._get_url()), MainHandler),
-        (re.escape(wizard_state.partial_download_url) + r"([^/]+)", DownloadHandler),
-        (re.escape(wizard_state.partial_upload_url) + r"$", UploadHandler),
-        (re.escape(wizard_state.partial_package_url) + r"$", PackageHandler)
-    ], **settings)
+    application = _make_application(wizard_state, settings)
 
     ssl_options = None
     if wizard_state.use_ssl:
         ssl_options = {"certfile": wizard_state.certificate_file,
                        "keyfile": wizard_state.key_file}
 
+    server = tornado.httpserver.HTTPServer(application, ssl_options=ssl_options)
+    server.add_sockets(sockets)
+    output_retention.start(wizard_state.output_retention_interval_seconds)
+    profile_retention.start(wizard_state.output_retention_interval_seconds)
+    # resume any jobs left unfinished when the server last stopped as soon as it starts, then keep checking
+    tornado.ioloop.IOLoop.current().add_callback(_maintain_generation_jobs, settings)
+    job_maintenance_callback = tornado.ioloop.PeriodicCallback(
+        lambda: _maintain_generation_jobs(settings), wizard_state.generation_job_resume_interval_seconds * 1000)
+    job_maintenance_callback.start()
+    tornado.ioloop.IOLoop.current().add_callback(_write_metrics_snapshot, settings)
+    metrics_snapshot_callback = tornado.ioloop.PeriodicCallback(
+        lambda: _write_metrics_snapshot(settings), wizard_state.metrics_snapshot_interval_seconds * 1000)
+    metrics_snapshot_callback.start()
+
+    def on_stopped():
+        output_retention.stop()
+        profile_retention.stop()
+        job_maintenance_callback.stop()
+        metrics_snapshot_callback.stop()
+        metrics_snapshots.remove()
+        # let another (or the restarted) server process take over any jobs that didn't finish in time; NB: the
+        # IOLoop has stopped by now, so run it just long enough for that
+        tornado.ioloop.IOLoop.current().run_sync(
+            lambda: generation_job_store.release(generation_jobs.get_unfinished_job_ids()))
+        generation_job_store.close()
+        workbook_generator.shutdown()
+
     print("server ready")
-    application.listen(wizard_state.listen_port, ssl_options=ssl_options)
-    tornado.ioloop.IOLoop.instance().start()
+    qiimp.server_supervisor.run_worker(server, request_tracker, wizard_state.shutdown_drain_seconds,
+                                       on_stopped=on_stopped)
 
 
 if __name__ == "__main__":
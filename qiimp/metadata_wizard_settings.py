@@ -3,9 +3,10 @@ import datetime
 from enum import Enum
 import os
 
-import openpyxl
 import yaml
 
+import qiimp.xlsx_zip_reader as xlsx_zip_reader
+
 SEPARATOR = "_"
 TEMPLATE_SUFFIX = SEPARATOR + "template"
 # TODO: someday: move this into the config
@@ -23,6 +24,9 @@ DISPLAY_NAME_KEY = "display_name"
 DOWNLOAD_URL_FOLDER = "/download"
 PACKAGE_URL_FOLDER = "/package"
 UPLOAD_URL_FOLDER = "/upload"
+STATUS_URL_FOLDER = "/status"
+JOBS_URL_FOLDER = "/jobs"
+METRICS_URL_FOLDER = "/metrics"
 # Per Austin, make default column width "at least wide enough to handle
 # host_scientific_name <snip> our largest mandatory metadata title";
 # Sizing approach (magic # 1.25 ~= width of 1 character) from
@@ -40,20 +44,34 @@ def get_single_key_and_subdict(a_dict):
     return single_key, a_dict[single_key]
 
 
-def load_yaml_from_wizard_xlsx(filepath, yaml_sheetname):
-    assumed_cell = "A1"
-    wb = openpyxl.load_workbook(filename=filepath)
-    check_is_metadata_wizard_file(wb, yaml_sheetname, filepath)
+def load_yaml_from_wizard_xlsx(filepath, yaml_sheetname, display_name=None):
+    """Read the yaml out of cell A1 of the named sheet of a QIIMP workbook.
 
-    yaml_sheet = wb[yaml_sheetname]
-    yaml_string = yaml_sheet[assumed_cell].value
-    yaml_dict = yaml.load(yaml_string)
+    filepath may be a path or a seekable binary file object; display_name, if given, is used in place of filepath in
+    error messages (e.g., to show the user the name of the file they uploaded rather than that of a temp file).
+    """
+    assumed_cell = "A1"
+    display_name = filepath if display_name is None else display_name
+
+    # NB: xlsx_zip_reader only reads the one cell needed rather than loading the whole workbook with openpyxl
+    try:
+        with xlsx_zip_reader.XlsxZipReader(filepath) as xlsx_reader:
+            check_is_metadata_wizard_file(xlsx_reader, yaml_sheetname, display_name)
+            yaml_string = xlsx_reader.read_cell_value(yaml_sheetname, assumed_cell)
+    except xlsx_zip_reader.READ_ERRORS:
+        # not an xlsx file at all, or a damaged one: either way, not a QIIMP spreadsheet that can be used
+        raise ValueError("{0}'{1}' .".format(NON_WIZARD_XLSX_ERROR_PREFIX, display_name))
+
+    # The yaml in these sheets is only ever plain dicts/lists/scalars (and the uploaded ones come from users), so
+    # there is no reason to allow arbitrary python objects to be constructed from it.
+    yaml_dict = yaml.safe_load(yaml_string)
     return yaml_dict
 
 
 # TODO: someday: grrr ... this doesn't really belong here, I feel, but can't move it xlsx_basics because that
 # would create a circular reference, so some refactoring is called for ...
 def check_is_metadata_wizard_file(openpyxl_workbook, yaml_sheetname, filepath):
+    # NB: openpyxl_workbook can be anything with a sheetnames property, including an xlsx_zip_reader.XlsxZipReader
     sheet_names = openpyxl_workbook.sheetnames
     if yaml_sheetname not in sheet_names:
         error_msg = "{0}'{1}' .".format(NON_WIZARD_XLSX_ERROR_PREFIX, filepath)
@@ -62,7 +80,7 @@ def check_is_metadata_wizard_file(openpyxl_workbook, yaml_sheetname, filepath):
 
 def _load_yaml_from_fp(filepath):
     with open(filepath, 'r') as stream:
-        result = yaml.load(stream)
+        result = yaml.safe_load(stream)
     return result
 
 
@@ -155,6 +173,33 @@ class DefaultTypes(Enum):
     text_default = "text_default"
 
 
+class StaticGridLayouts(Enum):
+    # see xlsx_static_grid_builder
+    inline = "inline"
+    hidden_sheet = "hidden_sheet"
+
+
+class RankStrategies(Enum):
+    # see xlsx_static_grid_builder
+    countif = "countif"
+    running_count = "running_count"
+
+
+class WorkbookOutputModes(Enum):
+    # see workbook_generator
+    disk = "disk"
+    memory = "memory"
+
+
+def _check_config_value(key, value, allowed_values_enum):
+    # catch a mistyped setting when the server starts, rather than when the first workbook is built
+    allowed_values = [x.value for x in allowed_values_enum]
+    if value not in allowed_values:
+        raise ValueError("Unrecognized {0} '{1}' in config; expected one of: {2}".format(
+            key, value, ", ".join("'{0}'".format(x) for x in allowed_values)))
+    return value
+
+
 class MetadataWizardState(object):
     def __init__(self):
         # I think this should NOT be in the config; new versions SHOULD involve changing code.
@@ -181,11 +226,43 @@ class MetadataWizardState(object):
         self.settings_dir_path = None
         self.templates_dir_path = None
         self.client_scripts_dir_path = None
+        self.package_cache_path = None
+        self.package_load_workers = 1
+        self.generation_executor = None
+        self.generation_workers = 1
+        self.workbook_output_mode = None
+        self.shutdown_drain_seconds = 120
+        self.max_upload_bytes = 100 * 1024 * 1024
+        self.upload_spool_memory_bytes = 1024 * 1024
+        self.output_max_bytes = 0
+        self.output_max_files = 0
+        self.output_max_age_hours = 0
+        self.output_retention_interval_seconds = 300
+        self.workbook_cache_max_entries = 0
+        self.workbook_cache_max_bytes = 0
+        self.generation_max_concurrent = 0
+        self.generation_max_queued = 0
+        self.generation_job_retention_seconds = 3600
+        self.generation_job_store_path = None
+        self.generation_job_resume_interval_seconds = 30
+        self.profiling_token = None
+        self.profile_output_path = None
+        self.profile_max_bytes = 0
+        self.profile_max_files = 0
+        self.profile_max_age_hours = 0
+        self.monitoring_token = None
+        self.metrics_snapshot_path = None
+        self.metrics_snapshot_interval_seconds = 15
+        self.static_grid_layout = None
+        self.rank_strategy = None
 
         self.main_url = None
         self.partial_package_url = None
         self.partial_download_url = None
         self.partial_upload_url = None
+        self.partial_status_url = None
+        self.partial_jobs_url = None
+        self.partial_metrics_url = None
         self.full_upload_url = None
         #self.full_merge_url = None
         self.listen_port = None
@@ -204,6 +281,8 @@ class MetadataWizardState(object):
         self.sampletype_display_dicts_list = None
         self.parent_stack_by_env_name = None
         self.env_schemas = None
+        self.package_schemas_by_key = None
+        self.package_responses_by_key = {}
 
         # self.merge_info_by_merge_id = {}
 
@@ -219,11 +298,21 @@ class MetadataWizardState(object):
         self.use_ssl = bool(self.certificate_file and self.key_file)
         self.protocol = "https" if self.use_ssl else "http"
         if self.static_path == "": self.static_path = self.install_dir
+        if self.package_cache_path == "": self.package_cache_path = os.path.join(self.install_dir, "cache")
+        if self.generation_job_store_path == "":
+            self.generation_job_store_path = os.path.join(self.install_dir, "cache", "generation_jobs.sqlite")
+        if self.profile_output_path == "":
+            self.profile_output_path = os.path.join(self.install_dir, "cache", "profiles")
+        if self.metrics_snapshot_path == "":
+            self.metrics_snapshot_path = os.path.join(self.install_dir, "cache", "metrics")
 
         self.static_url_prefix = self._get_url(self.static_url_folder)
         self.partial_package_url = self._get_url(PACKAGE_URL_FOLDER)
         self.partial_download_url = self._get_url(DOWNLOAD_URL_FOLDER)
         self.partial_upload_url = self._get_url(UPLOAD_URL_FOLDER)
+        self.partial_status_url = self._get_url(STATUS_URL_FOLDER)
+        self.partial_jobs_url = self._get_url(JOBS_URL_FOLDER)
+        self.partial_metrics_url = self._get_url(METRICS_URL_FOLDER)
         self.full_upload_url = self._get_url(UPLOAD_URL_FOLDER, True)
         # self.full_merge_url = "{0}://{1}/merge".format(self.protocol, self.main_url)
 
@@ -242,9 +331,17 @@ class MetadataWizardState(object):
         self.parent_stack_by_env_name = env_and_sampletype_infos_tuple[3]
         self.env_schemas = env_and_sampletype_infos_tuple[4]
 
+    def set_package_schemas_by_key(self, package_schemas_by_key):
+        # NB: These values come from metadata_package_schema_builder.load_schemas_for_all_package_keys and are shared
+        # by all requests, so they must not be modified
+        self.package_schemas_by_key = package_schemas_by_key
+
     def get_output_path(self, file_name):
         return os.path.join(self.install_dir, self.get_partial_output_path(file_name))
 
+    def get_output_dir_path(self):
+        return os.path.dirname(self.get_output_path("placeholder.txt"))
+
     def get_partial_output_path(self, file_name):
         return os.path.join("output", file_name)
 
@@ -269,6 +366,51 @@ class MetadataWizardState(object):
         self.main_url = config_parser.get(section_name, "main_url")
         self.certificate_file = self._apply_default_path(os.path.expanduser(config_parser.get(section_name, 'CERTIFICATE_FILE')))
         self.key_file = self._apply_default_path(os.path.expanduser(config_parser.get(section_name, 'KEY_FILE')))
+        self.package_cache_path = os.path.expanduser(config_parser.get(section_name, "package_cache_path", fallback=""))
+        self.package_load_workers = config_parser.getint(section_name, "package_load_workers", fallback=1)
+        self.generation_executor = config_parser.get(section_name, "generation_executor", fallback="thread")
+        self.generation_workers = config_parser.getint(section_name, "generation_workers", fallback=1)
+        self.workbook_output_mode = _check_config_value(
+            "workbook_output_mode",
+            config_parser.get(section_name, "workbook_output_mode", fallback=WorkbookOutputModes.disk.value),
+            WorkbookOutputModes)
+        self.shutdown_drain_seconds = config_parser.getint(section_name, "shutdown_drain_seconds", fallback=120)
+        self.max_upload_bytes = config_parser.getint(section_name, "max_upload_bytes", fallback=self.max_upload_bytes)
+        self.upload_spool_memory_bytes = config_parser.getint(section_name, "upload_spool_memory_bytes",
+                                                              fallback=self.upload_spool_memory_bytes)
+        self.output_max_bytes = config_parser.getint(section_name, "output_max_bytes", fallback=0)
+        self.output_max_files = config_parser.getint(section_name, "output_max_files", fallback=0)
+        self.output_max_age_hours = config_parser.getfloat(section_name, "output_max_age_hours", fallback=0)
+        self.output_retention_interval_seconds = config_parser.getint(
+            section_name, "output_retention_interval_seconds", fallback=300)
+        self.workbook_cache_max_entries = config_parser.getint(section_name, "workbook_cache_max_entries", fallback=0)
+        self.workbook_cache_max_bytes = config_parser.getint(section_name, "workbook_cache_max_bytes", fallback=0)
+        self.generation_max_concurrent = config_parser.getint(section_name, "generation_max_concurrent", fallback=0)
+        self.generation_max_queued = config_parser.getint(section_name, "generation_max_queued", fallback=0)
+        self.generation_job_retention_seconds = config_parser.getint(
+            section_name, "generation_job_retention_seconds", fallback=3600)
+        self.generation_job_store_path = os.path.expanduser(
+            config_parser.get(section_name, "generation_job_store_path", fallback=""))
+        self.generation_job_resume_interval_seconds = config_parser.getint(
+            section_name, "generation_job_resume_interval_seconds", fallback=30)
+        self.profiling_token = config_parser.get(section_name, "profiling_token", fallback="")
+        self.profile_output_path = os.path.expanduser(
+            config_parser.get(section_name, "profile_output_path", fallback=""))
+        self.profile_max_bytes = config_parser.getint(section_name, "profile_max_bytes", fallback=0)
+        self.profile_max_files = config_parser.getint(section_name, "profile_max_files", fallback=0)
+        self.profile_max_age_hours = config_parser.getfloat(section_name, "profile_max_age_hours", fallback=0)
+        self.monitoring_token = config_parser.get(section_name, "monitoring_token", fallback="")
+        self.metrics_snapshot_path = os.path.expanduser(
+            config_parser.get(section_name, "metrics_snapshot_path", fallback=""))
+        self.metrics_snapshot_interval_seconds = config_parser.getint(
+            section_name, "metrics_snapshot_interval_seconds", fallback=15)
+        self.static_grid_layout = _check_config_value(
+            "static_grid_layout",
+            config_parser.get(section_name, "static_grid_layout", fallback=StaticGridLayouts.inline.value),
+            StaticGridLayouts)
+        self.rank_strategy = _check_config_value(
+            "rank_strategy", config_parser.get(section_name, "rank_strategy", fallback=RankStrategies.countif.value),
+            RankStrategies)
 
     def _apply_default_path(self, file_name):
         # assume that, if the file name doesn't already include a path,
@@ -300,7 +442,7 @@ class RegexHandler(object):
 
     def __init__(self, regex_definitions_yaml_fp):
         with open(regex_definitions_yaml_fp) as f:
-            self._dict_of_regex_dicts = yaml.load(f)
+            self._dict_of_regex_dicts = yaml.safe_load(f)
 
     def get_regex_val_by_name(self, regex_name):
         return self._get_relevant_item_dict_if_any(regex_name, self.REGEX_KEY)
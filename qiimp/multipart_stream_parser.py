@@ -0,0 +1,180 @@
+import collections
+import email.message
+import email.utils
+import tempfile
+
+import tornado.httputil
+
+# Tornado's own multipart handling needs the whole request body in memory before it can parse it, so a big upload
+# means a big memory spike.  This parser is instead fed the body a chunk at a time (as it arrives, from a
+# stream_request_body handler) and writes each uploaded file into a "spool" that stays in memory while it is small but
+# moves to a temporary file on disk once it grows past a threshold.  The caller must call close() when it is done so
+# the spools (and any temporary files behind them) are cleaned up.
+
+_CRLF = b"\r\n"
+_HEADERS_END = b"\r\n\r\n"
+_FINAL_BOUNDARY_SUFFIX = b"--"
+_MAX_HEADERS_BYTES = 16 * 1024
+_MAX_FIELD_BYTES = 64 * 1024
+
+_PREAMBLE_STATE = "preamble"
+_AFTER_BOUNDARY_STATE = "after_boundary"
+_HEADERS_STATE = "headers"
+_BODY_STATE = "body"
+_DONE_STATE = "done"
+
+UploadedFile = collections.namedtuple("UploadedFile", ["filename", "content_type", "spool"])
+
+
+class MultipartParseError(ValueError):
+    pass
+
+
+class MultipartStreamParser(object):
+    def __init__(self, content_type_header, spool_max_memory_bytes):
+        boundary = _get_header_param("Content-Type", content_type_header, "boundary")
+        if not content_type_header.lower().startswith("multipart/form-data") or not boundary:
+            raise MultipartParseError("Request is not multipart/form-data with a boundary.")
+
+        self.spool_max_memory_bytes = spool_max_memory_bytes
+        self.files = {}  # field name to list of UploadedFile
+        self.arguments = {}  # field name to list of bytes, like tornado's request.arguments
+
+        self._first_boundary = b"--" + boundary.encode("latin-1")
+        # every boundary after the first is preceded by the line break that ends the previous part's body
+        self._boundary = _CRLF + self._first_boundary
+        self._buffer = bytearray()
+        self._state = _PREAMBLE_STATE
+        self._curr_name = None
+        self._curr_file = None
+        self._curr_field_value = None
+
+    @property
+    def is_done(self):
+        return self._state == _DONE_STATE
+
+    def data_received(self, chunk):
+        self._buffer.extend(chunk)
+        while self._parse_buffer():
+            pass
+
+    def finish(self):
+        """Call once the whole body has been received; raises if the body was cut short."""
+        if self._state != _DONE_STATE:
+            raise MultipartParseError("Multipart body ended before its final boundary.")
+
+    def close(self):
+        for curr_files_list in self.files.values():
+            for curr_file in curr_files_list:
+                curr_file.spool.close()
+        self.files = {}
+
+    def _parse_buffer(self):
+        # returns True if it made progress and should be called again
+        if self._state == _PREAMBLE_STATE:
+            # anything before the first boundary is ignored (per the spec)
+            boundary_index = self._buffer.find(self._first_boundary)
+            if boundary_index < 0:
+                # keep just enough to recognize a boundary split across chunks
+                del self._buffer[:max(len(self._buffer) - len(self._first_boundary), 0)]
+                return False
+            del self._buffer[:boundary_index + len(self._first_boundary)]
+            self._state = _AFTER_BOUNDARY_STATE
+            return True
+
+        if self._state == _AFTER_BOUNDARY_STATE:
+            if len(self._buffer) < 2:
+                return False
+            if self._buffer.startswith(_FINAL_BOUNDARY_SUFFIX):
+                self._state = _DONE_STATE
+                self._buffer.clear()  # NB: the epilogue, if any, is ignored
+                return False
+            if not self._buffer.startswith(_CRLF):
+                raise MultipartParseError("Malformed multipart boundary.")
+            del self._buffer[:len(_CRLF)]
+            self._state = _HEADERS_STATE
+            return True
+
+        if self._state == _HEADERS_STATE:
+            headers_end_index = self._buffer.find(_HEADERS_END)
+            if headers_end_index < 0:
+                if len(self._buffer) > _MAX_HEADERS_BYTES:
+                    raise MultipartParseError("Multipart part headers are too long.")
+                return False
+            try:
+                headers_text = bytes(self._buffer[:headers_end_index]).decode("utf-8")
+            except UnicodeDecodeError:
+                raise MultipartParseError("Multipart part headers are not valid utf-8.")
+            self._start_part(headers_text)
+            del self._buffer[:headers_end_index + len(_HEADERS_END)]
+            self._state = _BODY_STATE
+            return True
+
+        if self._state == _BODY_STATE:
+            boundary_index = self._buffer.find(self._boundary)
+            if boundary_index < 0:
+                # write out everything that can't be the start of a boundary split across chunks
+                safe_length = len(self._buffer) - (len(self._boundary) - 1)
+                if safe_length > 0:
+                    self._write_part_data(self._buffer[:safe_length])
+                    del self._buffer[:safe_length]
+                return False
+            self._write_part_data(self._buffer[:boundary_index])
+            del self._buffer[:boundary_index + len(self._boundary)]
+            self._finish_part()
+            self._state = _AFTER_BOUNDARY_STATE
+            return True
+
+        # done: ignore anything else
+        self._buffer.clear()
+        return False
+
+    def _start_part(self, headers_text):
+        try:
+            headers = tornado.httputil.HTTPHeaders.parse(headers_text)
+        except tornado.httputil.HTTPInputError as e:
+            raise MultipartParseError("Malformed multipart part headers: {0}".format(e))
+        disposition_header = headers.get("Content-Disposition", "")
+        if not disposition_header.lower().startswith("form-data"):
+            raise MultipartParseError("Multipart part is missing a form-data Content-Disposition.")
+
+        self._curr_name = _get_header_param("Content-Disposition", disposition_header, "name")
+        if self._curr_name is None:
+            raise MultipartParseError("Multipart part has no name.")
+
+        filename = _get_header_param("Content-Disposition", disposition_header, "filename")
+        if filename is None:
+            self._curr_file = None
+            self._curr_field_value = bytearray()
+        else:
+            spool = tempfile.SpooledTemporaryFile(max_size=self.spool_max_memory_bytes)
+            self._curr_file = UploadedFile(filename, headers.get("Content-Type", "application/unknown"), spool)
+            self._curr_field_value = None
+            # NB: add the file right away so that close() cleans it up even if the body turns out to be broken
+            self.files.setdefault(self._curr_name, []).append(self._curr_file)
+
+    def _write_part_data(self, data):
+        if self._curr_file is not None:
+            self._curr_file.spool.write(data)
+        else:
+            # plain form fields are kept in memory, so they had better be small
+            if len(self._curr_field_value) + len(data) > _MAX_FIELD_BYTES:
+                raise MultipartParseError("Multipart field '{0}' is too long.".format(self._curr_name))
+            self._curr_field_value.extend(data)
+
+    def _finish_part(self):
+        if self._curr_file is not None:
+            self._curr_file.spool.seek(0)
+        else:
+            self.arguments.setdefault(self._curr_name, []).append(bytes(self._curr_field_value))
+        self._curr_name = self._curr_file = self._curr_field_value = None
+
+
+def _get_header_param(header_name, header_value, param_name):
+    # the email package knows how to parse (quoted, escaped, rfc 2231-encoded) header parameters
+    message = email.message.Message()
+    message[header_name] = header_value
+    result = message.get_param(param_name, header=header_name)
+    if isinstance(result, tuple):
+        result = email.utils.collapse_rfc2231_value(result)
+    return result
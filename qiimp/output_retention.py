@@ -0,0 +1,135 @@
+import os
+import time
+
+import tornado.ioloop
+
+# Every generated workbook is written to the output directory, and nothing ever used to remove them, so under
+# sustained use the output volume fills up.  The OutputRetention object here is run periodically and removes workbooks
+# that are older than the maximum age, then removes the least recently used workbooks until the directory is back
+# under its maximum file count and total size.  Listing and stat-ing a directory of thousands of workbooks (perhaps
+# on a network file system) can take a while, so the periodic runs are made on a thread from the IOLoop's executor
+# rather than on the IOLoop itself; the PeriodicCallback waits for each run to finish before scheduling the next, so
+# runs never overlap.
+#
+# NB: "least recently used" is judged by the later of each file's access and modification times.  On file systems
+# mounted noatime (or relatime, where the access time is only updated occasionally) that is effectively the creation
+# time, which is fine for our purposes since a workbook is generally downloaded just once, right after it is made.
+#
+# When several server processes share the output directory, each runs its own OutputRetention; that is harmless, as
+# a file that another process has already removed is simply skipped.
+
+# files that are part of the install rather than generated output
+_PROTECTED_FILE_NAMES = {"placeholder.txt"}
+# never evict a file this new for size/count reasons, so a workbook can't vanish before the user gets to download it
+_MIN_RETAIN_SECONDS = 10 * 60
+
+
+class OutputRetention(object):
+    def __init__(self, output_dir_path, max_total_bytes=0, max_num_files=0, max_age_seconds=0):
+        # NB: a limit of 0 means "no limit"
+        self.output_dir_path = output_dir_path
+        self.max_total_bytes = max_total_bytes
+        self.max_num_files = max_num_files
+        self.max_age_seconds = max_age_seconds
+
+        self.total_bytes = 0
+        self.num_files = 0
+        self.num_evicted_files = 0
+        self.num_evicted_bytes = 0
+        self.num_runs = 0
+        self.last_run_time = None
+        self.last_run_seconds = None
+        self._periodic_callback = None
+
+    def start(self, interval_seconds):
+        # run once right away (or as soon as the IOLoop is running), then periodically
+        self._periodic_callback = tornado.ioloop.PeriodicCallback(self._enforce_off_ioloop, interval_seconds * 1000)
+        tornado.ioloop.IOLoop.current().add_callback(self._start_periodic_callback)
+
+    async def _start_periodic_callback(self):
+        await self._enforce_off_ioloop()
+        # NB: stop may have been called during that first run
+        if self._periodic_callback is not None:
+            self._periodic_callback.start()
+
+    async def _enforce_off_ioloop(self):
+        await tornado.ioloop.IOLoop.current().run_in_executor(None, self.enforce)
+
+    def stop(self):
+        if self._periodic_callback is not None:
+            self._periodic_callback.stop()
+            self._periodic_callback = None
+
+    def get_stats(self):
+        return {
+            "total_bytes": self.total_bytes,
+            "num_files": self.num_files,
+            "max_total_bytes": self.max_total_bytes,
+            "max_num_files": self.max_num_files,
+            "max_age_seconds": self.max_age_seconds,
+            "num_evicted_files": self.num_evicted_files,
+            "num_evicted_bytes": self.num_evicted_bytes,
+            "num_runs": self.num_runs,
+            "last_run_time": self.last_run_time,
+            "last_run_seconds": self.last_run_seconds
+        }
+
+    def enforce(self, now=None):
+        start_time = time.time()
+        if now is None:
+            now = start_time
+
+        # (last used time, size, path) for each output file, least recently used first
+        file_infos = sorted(self._list_output_files())
+        total_bytes = sum(x[1] for x in file_infos)
+
+        num_files = len(file_infos)
+        for curr_last_used, curr_size, curr_path in file_infos:
+            curr_age = now - curr_last_used
+            is_evictable = curr_age >= _MIN_RETAIN_SECONDS
+            is_too_old = self.max_age_seconds and curr_age > self.max_age_seconds
+            is_too_many = self.max_num_files and num_files > self.max_num_files
+            is_too_big = self.max_total_bytes and total_bytes > self.max_total_bytes
+
+            if is_evictable and (is_too_old or is_too_many or is_too_big):
+                if self._remove_file(curr_path, curr_size):
+                    num_files -= 1
+                    total_bytes -= curr_size
+
+        self.num_files = num_files
+        self.total_bytes = total_bytes
+        self.num_runs += 1
+        self.last_run_time = now
+        self.last_run_seconds = time.time() - start_time
+
+    def _list_output_files(self):
+        result = []
+        try:
+            dir_entries = list(os.scandir(self.output_dir_path))
+        except FileNotFoundError:
+            return result
+
+        for curr_entry in dir_entries:
+            if curr_entry.name in _PROTECTED_FILE_NAMES:
+                continue
+            try:
+                if not curr_entry.is_file(follow_symlinks=False):
+                    continue
+                curr_stats = curr_entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue  # removed since the directory was listed
+            result.append((max(curr_stats.st_atime, curr_stats.st_mtime), curr_stats.st_size, curr_entry.path))
+        return result
+
+    def _remove_file(self, file_path, file_size):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            # someone else (e.g., another server process) got there first; it is gone either way
+            return True
+        except OSError:
+            return False
+
+        self.num_evicted_files += 1
+        self.num_evicted_bytes += file_size
+        return True
@@ -0,0 +1,24 @@
+import pycel.lib.stats
+
+# Stand-ins for the Excel functions QIIMP's rank helpers use that pycel (which recalculates workbooks in Python, for
+# the tests and workbook_benchmark; it isn't a dependency of QIIMP itself) lacks or can't do.  pycel looks functions up
+# by name in the modules it is given as plugins before its own, so pass it this module's name:
+#     pycel.ExcelCompiler(excel=workbook, plugins=[qiimp.pycel_functions.__name__])
+# Only import this module where pycel is installed.
+
+
+def rows(range_values):
+    # NB: a range of a single cell comes in as just that cell's value
+    return len(range_values) if isinstance(range_values, tuple) else 1
+
+
+def columns(range_values):
+    return len(range_values[0]) if isinstance(range_values, tuple) else 1
+
+
+def countif(range_values, criteria):
+    # pycel's COUNTIF takes only a single criterion, but the countif rank strategy's array formulas give it a whole
+    # range of them (e.g., =COUNTIF(AK$2:AK$11,"<="&$AK2:AK11)), for which Excel counts once per criterion
+    if not isinstance(criteria, tuple):
+        return pycel.lib.stats.countif(range_values, criteria)
+    return tuple(tuple(pycel.lib.stats.countif(range_values, x) for x in curr_row) for curr_row in criteria)
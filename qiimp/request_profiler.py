@@ -0,0 +1,88 @@
+import collections
+import cProfile
+import os
+import re
+import sys
+import threading
+import time
+
+# When a request is slow in production, it is usually because of the particular package or custom fields it asked
+# for, which are hard to guess after the fact.  So an admin can instead ask the server to profile one specific
+# request (see the server's _is_profiling_requested): the work is run under cProfile, which is saved as a .prof file
+# (for pstats, snakeviz, etc.), and at the same time under a simple sampling profiler, which is saved as a .collapsed
+# file of "frame;frame;frame count" lines (for flamegraph.pl, speedscope, etc.).  The file names are tagged with the
+# package and the number of fields so the profiles of a problem package are easy to pick out.
+
+PROFILE_STATS_EXTENSION = ".prof"
+COLLAPSED_STACKS_EXTENSION = ".collapsed"
+
+_SAMPLE_INTERVAL_SECONDS = 0.005
+# NB: cProfile can only profile one thing at a time (as of python 3.12, across all threads), so profiled requests
+# take turns
+_profile_lock = threading.Lock()
+
+
+def make_profile_file_base(output_dir_path, handler_name, package_key, num_fields):
+    """Return the path, minus extension, for the profile files of a request for this package."""
+    os.makedirs(output_dir_path, exist_ok=True)
+    env, sample_type = package_key
+    tag_pieces = [time.strftime("%Y%m%d-%H%M%S"), str(os.getpid()), handler_name, str(env), str(sample_type),
+                  "{0}fields".format(num_fields)]
+    file_base_name = "_".join(re.sub(r"[^A-Za-z0-9.-]+", "-", x) for x in tag_pieces)
+    return os.path.join(output_dir_path, file_base_name)
+
+
+def profile_call(func, profile_file_base):
+    """Call func() under both profilers, save the profile files, and return whatever func returned."""
+    with _profile_lock:
+        sampler = _StackSampler(threading.get_ident())
+        profiler = cProfile.Profile()
+        sampler.start()
+        profiler.enable()
+        try:
+            return func()
+        finally:
+            profiler.disable()
+            sampler.stop()
+            profiler.dump_stats(profile_file_base + PROFILE_STATS_EXTENSION)
+            sampler.write_collapsed_stacks(profile_file_base + COLLAPSED_STACKS_EXTENSION)
+
+
+class _StackSampler(object):
+    # periodically records the stack of the given thread, from another thread
+    def __init__(self, target_thread_id):
+        self.target_thread_id = target_thread_id
+        self.counts_by_stack = collections.Counter()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample, name="stack_sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def write_collapsed_stacks(self, file_path):
+        with open(file_path, "w") as f:
+            for curr_stack, curr_count in sorted(self.counts_by_stack.items()):
+                f.write("{0} {1}\n".format(curr_stack, curr_count))
+
+    def _sample(self):
+        while not self._stop_event.wait(_SAMPLE_INTERVAL_SECONDS):
+            frame = sys._current_frames().get(self.target_thread_id)
+            frame_names = []
+            while frame is not None:
+                frame_names.append(_get_frame_name(frame))
+                frame = frame.f_back
+            if frame_names:
+                # outermost frame first
+                self.counts_by_stack[";".join(reversed(frame_names))] += 1
+
+
+def _get_frame_name(frame):
+    code = frame.f_code
+    # NB: semicolons and spaces separate frames and counts in the collapsed format, so keep them out of the names
+    return "{0}({1}:{2})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno).replace(
+        ";", ":").replace(" ", "_")
@@ -0,0 +1,262 @@
+import bisect
+import collections
+import json
+import math
+import os
+import tempfile
+import time
+
+# Metrics for the /metrics endpoint, in the Prometheus text exposition format: request counts and latencies by
+# handler, how long each phase of building a workbook takes, and the current state of the generation queue, output
+# directory and workbook cache.  (Written out by hand, since the format is simple and QIIMP needs very little of it.)
+#
+# NB: the metrics are kept per server process, and every metric carries a "pid" label to keep the processes' numbers
+# apart.  With several server processes, each scrape of /metrics is answered by whichever process gets it, so each
+# process also writes a snapshot of its metrics (and stats) to a directory shared by all of them every so often (see
+# MetricsSnapshots); the process answering the scrape reports its own metrics as they are now along with the latest
+# snapshots of all the others.
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_REQUEST_SECONDS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+_BUILD_SECONDS_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300]
+_SNAPSHOT_FILE_EXTENSION = ".json"
+
+# (stats group, stat name, metric type, help) for the stats reported by the server's other components; a stats group
+# is one of the dicts passed to render, e.g. the workbook cache's get_stats()
+_STATS_METRICS = [
+    ("generation_admission", "num_running", "gauge", "Workbook generations running."),
+    ("generation_admission", "num_queued", "gauge", "Workbook generations waiting to be admitted."),
+    ("generation_admission", "num_admitted", "counter", "Workbook generations admitted."),
+    ("generation_admission", "num_rejected", "counter", "Workbook generations turned away as too many."),
+    ("generation_jobs", "num_queued", "gauge", "Generation jobs not yet started."),
+    ("generation_jobs", "num_running", "gauge", "Generation jobs being built."),
+    ("output_retention", "total_bytes", "gauge", "Size of the output directory at its last retention check."),
+    ("output_retention", "num_files", "gauge", "Files in the output directory at its last retention check."),
+    ("output_retention", "num_evicted_files", "counter", "Files removed from the output directory."),
+    ("workbook_cache", "num_entries", "gauge", "Workbooks in the workbook cache."),
+    ("workbook_cache", "total_bytes", "gauge", "Bytes of workbooks held in memory by the workbook cache."),
+    ("workbook_cache", "num_hits", "counter", "Workbook cache lookups that found a workbook."),
+    ("workbook_cache", "num_misses", "counter", "Workbook cache lookups that found no workbook."),
+    ("workbook_cache", "num_coalesced", "counter", "Submissions that waited on an identical build under way."),
+]
+
+# one metric (with its header info) and all of its sample lines
+MetricFamily = collections.namedtuple("MetricFamily", ["name", "type", "help", "samples"])
+# the latest metrics of another server process, as read from its snapshot
+ProcessSnapshot = collections.namedtuple("ProcessSnapshot", ["pid", "snapshot_time", "stats_by_group", "families"])
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets  # upper bounds, in increasing order; NB: the +Inf bucket is implicit
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        bucket_index = bisect.bisect_left(self.buckets, value)
+        if bucket_index < len(self.buckets):
+            self.bucket_counts[bucket_index] += 1
+        self.count += 1
+        self.sum += value
+
+    def get_cumulative_counts(self):
+        """Return (upper bound, count of observations <= it) for each bucket, as Prometheus wants them."""
+        result = []
+        running_count = 0
+        for curr_bound, curr_count in zip(self.buckets, self.bucket_counts):
+            running_count += curr_count
+            result.append((curr_bound, running_count))
+        result.append((math.inf, self.count))
+        return result
+
+
+class ServerMetrics(object):
+    def __init__(self, pid):
+        self.pid = pid
+        self.request_counts = collections.Counter()  # (handler, method, status) to count
+        self.request_seconds_by_handler = {}  # (handler, method) to Histogram
+        self.build_seconds_by_phase = {}  # BuildPhases value to Histogram
+        self.build_seconds = Histogram(_BUILD_SECONDS_BUCKETS)
+
+    def observe_request(self, handler):
+        # called once each request is finished (see the server's Application.log_request)
+        handler_name = type(handler).__name__
+        method = handler.request.method
+        self.request_counts[(handler_name, method, str(handler.get_status()))] += 1
+
+        histogram_key = (handler_name, method)
+        if histogram_key not in self.request_seconds_by_handler:
+            self.request_seconds_by_handler[histogram_key] = Histogram(_REQUEST_SECONDS_BUCKETS)
+        self.request_seconds_by_handler[histogram_key].observe(handler.request.request_time())
+
+    def observe_build(self, phase_seconds_by_phase, total_seconds):
+        # matches the signature of the workbook generator's build_timing_callback
+        for curr_phase, curr_seconds in phase_seconds_by_phase.items():
+            if curr_phase not in self.build_seconds_by_phase:
+                self.build_seconds_by_phase[curr_phase] = Histogram(_BUILD_SECONDS_BUCKETS)
+            self.build_seconds_by_phase[curr_phase].observe(curr_seconds)
+        self.build_seconds.observe(total_seconds)
+
+    def get_families(self, stats_by_group):
+        """Return a list of MetricFamily; stats_by_group holds the get_stats() dicts of the components."""
+        result = []
+
+        family = self._add_family(result, "qiimp_http_requests_total", "counter", "HTTP requests finished, by handler.")
+        for (curr_handler, curr_method, curr_status), curr_count in sorted(self.request_counts.items()):
+            family.samples.append(self._make_sample("qiimp_http_requests_total", curr_count, handler=curr_handler,
+                                                    method=curr_method, status=curr_status))
+
+        family = self._add_family(result, "qiimp_http_request_duration_seconds", "histogram",
+                                  "HTTP request latency, by handler.")
+        for (curr_handler, curr_method), curr_histogram in sorted(self.request_seconds_by_handler.items()):
+            self._add_histogram(family, curr_histogram, handler=curr_handler, method=curr_method)
+
+        family = self._add_family(result, "qiimp_workbook_build_phase_seconds", "histogram",
+                                  "Time spent in each phase of building a workbook.")
+        for curr_phase, curr_histogram in sorted(self.build_seconds_by_phase.items()):
+            self._add_histogram(family, curr_histogram, phase=curr_phase)
+
+        family = self._add_family(result, "qiimp_workbook_build_seconds", "histogram",
+                                  "Total time spent building a workbook.")
+        self._add_histogram(family, self.build_seconds)
+
+        for curr_group, curr_stat_name, curr_type, curr_help in _STATS_METRICS:
+            curr_value = stats_by_group.get(curr_group, {}).get(curr_stat_name)
+            if curr_value is None:
+                continue
+            metric_name = "qiimp_{0}_{1}".format(curr_group, curr_stat_name.replace("num_", "", 1))
+            if curr_type == "counter":
+                metric_name += "_total"
+            family = self._add_family(result, metric_name, curr_type, curr_help)
+            family.samples.append(self._make_sample(metric_name, curr_value))
+
+        # a ratio is handier for a dashboard than working it out from the two counters every time
+        cache_stats = stats_by_group.get("workbook_cache")
+        if cache_stats is not None:
+            num_lookups = cache_stats["num_hits"] + cache_stats["num_misses"]
+            family = self._add_family(result, "qiimp_workbook_cache_hit_ratio", "gauge",
+                                      "Fraction of workbook cache lookups that found a workbook.")
+            family.samples.append(self._make_sample("qiimp_workbook_cache_hit_ratio",
+                                                    cache_stats["num_hits"] / num_lookups if num_lookups else 0))
+
+        return result
+
+    def render(self, stats_by_group, other_families_lists=()):
+        """Return the metrics as Prometheus text, along with those of other server processes (see get_families)."""
+        return render_families([self.get_families(stats_by_group)] + list(other_families_lists))
+
+    @staticmethod
+    def _add_family(families, metric_name, metric_type, help_text):
+        family = MetricFamily(metric_name, metric_type, help_text, [])
+        families.append(family)
+        return family
+
+    def _add_histogram(self, family, histogram, **labels):
+        for curr_bound, curr_count in histogram.get_cumulative_counts():
+            family.samples.append(self._make_sample(family.name + "_bucket", curr_count, le=_format_value(curr_bound),
+                                                    **labels))
+        family.samples.append(self._make_sample(family.name + "_sum", histogram.sum, **labels))
+        family.samples.append(self._make_sample(family.name + "_count", histogram.count, **labels))
+
+    def _make_sample(self, metric_name, value, **labels):
+        labels["pid"] = str(self.pid)
+        labels_str = ",".join('{0}="{1}"'.format(k, _escape_label_value(v)) for k, v in sorted(labels.items()))
+        return "{0}{{{1}}} {2}".format(metric_name, labels_str, _format_value(value))
+
+
+class MetricsSnapshots(object):
+    """The latest metrics and stats of each server process, kept as one small json file per process in a shared dir.
+
+    A snapshot older than max_age_seconds is taken to be from a process that is gone (a process that stops cleanly
+    removes its own) and is ignored.
+    """
+
+    def __init__(self, dir_path, pid, max_age_seconds):
+        self.dir_path = dir_path
+        self.pid = pid
+        self.max_age_seconds = max_age_seconds
+
+    def write(self, stats_by_group, families):
+        # NB: like the package schema cache, write to a temp file and then move it into place, so a reader never sees
+        # a half-written snapshot; and failing to write one must not take the server down
+        snapshot = {"pid": self.pid, "snapshot_time": time.time(), "stats_by_group": stats_by_group,
+                    "families": [list(x) for x in families]}
+        try:
+            os.makedirs(self.dir_path, exist_ok=True)
+            temp_fd, temp_path = tempfile.mkstemp(dir=self.dir_path, suffix=".tmp")
+            try:
+                with os.fdopen(temp_fd, "w") as f:
+                    json.dump(snapshot, f)
+                os.replace(temp_path, self._get_snapshot_path(self.pid))
+            except Exception:
+                os.remove(temp_path)
+                raise
+        except OSError:
+            pass
+
+    def read_others(self, now=None):
+        """Return a ProcessSnapshot for each other server process with a recent enough snapshot, by pid."""
+        if now is None:
+            now = time.time()
+
+        result = []
+        try:
+            file_names = sorted(os.listdir(self.dir_path))
+        except FileNotFoundError:
+            return result
+
+        for curr_file_name in file_names:
+            if not curr_file_name.endswith(_SNAPSHOT_FILE_EXTENSION) or \
+                    curr_file_name == os.path.basename(self._get_snapshot_path(self.pid)):
+                continue
+            try:
+                with open(os.path.join(self.dir_path, curr_file_name)) as f:
+                    snapshot = json.load(f)
+                curr_snapshot = ProcessSnapshot(snapshot["pid"], snapshot["snapshot_time"],
+                                                snapshot["stats_by_group"],
+                                                [MetricFamily(*x) for x in snapshot["families"]])
+            except (OSError, ValueError, KeyError, TypeError):
+                continue  # removed since the directory was listed, or not a snapshot after all
+            if now - curr_snapshot.snapshot_time <= self.max_age_seconds:
+                result.append(curr_snapshot)
+        return sorted(result)
+
+    def remove(self):
+        try:
+            os.remove(self._get_snapshot_path(self.pid))
+        except OSError:
+            pass
+
+    def _get_snapshot_path(self, pid):
+        return os.path.join(self.dir_path, str(pid) + _SNAPSHOT_FILE_EXTENSION)
+
+
+def render_families(families_lists):
+    """Return Prometheus text for lists of MetricFamily (e.g., one list per server process), merged by metric."""
+    # NB: the format wants each metric's header once, followed by all of that metric's samples
+    merged_families = collections.OrderedDict()
+    for curr_families in families_lists:
+        for curr_family in curr_families:
+            if curr_family.name not in merged_families:
+                merged_families[curr_family.name] = MetricFamily(curr_family.name, curr_family.type, curr_family.help,
+                                                                 [])
+            merged_families[curr_family.name].samples.extend(curr_family.samples)
+
+    lines = []
+    for curr_family in merged_families.values():
+        lines.append("# HELP {0} {1}".format(curr_family.name, curr_family.help))
+        lines.append("# TYPE {0} {1}".format(curr_family.name, curr_family.type))
+        lines.extend(curr_family.samples)
+    return "\n".join(lines) + "\n"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape_label_value(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
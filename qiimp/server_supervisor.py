@@ -0,0 +1,137 @@
+import asyncio
+import datetime
+import os
+import signal
+import sys
+import time
+
+import tornado.ioloop
+import tornado.locks
+import tornado.util
+
+# Running several server processes lets QIIMP use more than one cpu to answer requests.  The parent process loads the
+# settings and all the package schemas ONCE and then forks the workers, so the workers share the (large) parsed
+# schemas copy-on-write instead of each loading and holding its own copy.  The parent then just supervises: it
+# restarts any worker that dies, and on SIGTERM (or SIGINT) it passes the signal on to the workers, each of which stops
+# accepting new connections and finishes the requests it already has before exiting.
+
+# a worker that dies sooner than this after starting is probably failing at start-up, so don't restart it in a loop
+_MIN_WORKER_LIFETIME_SECONDS = 1
+_POLL_INTERVAL_SECONDS = 0.5
+# once asked to shut down, how much longer than the workers' own drain timeout to wait before killing them
+_KILL_GRACE_SECONDS = 5
+
+
+class InFlightRequestTracker(object):
+    """Counts requests that are still being worked on, so a shutting-down worker can wait for them to finish."""
+
+    def __init__(self):
+        self.num_in_flight = 0
+        self._idle_event = tornado.locks.Event()
+        self._idle_event.set()
+
+    def start_request(self):
+        self.num_in_flight += 1
+        self._idle_event.clear()
+
+    def finish_request(self):
+        self.num_in_flight = max(self.num_in_flight - 1, 0)
+        if self.num_in_flight == 0:
+            self._idle_event.set()
+
+    async def wait_until_idle(self, timeout_seconds):
+        """Return True if all in-flight requests finished, False if the timeout ran out first."""
+        try:
+            await self._idle_event.wait(timeout=datetime.timedelta(seconds=timeout_seconds))
+            return True
+        except tornado.util.TimeoutError:
+            return False
+
+
+def run_worker(server, request_tracker, drain_timeout_seconds, on_stopped=None):
+    """Run the IOLoop for this (already listening) server until SIGTERM/SIGINT, then drain and stop."""
+    io_loop = tornado.ioloop.IOLoop.current()
+    is_shutting_down = []  # NB: a list so the nested functions can set it
+
+    async def shut_down():
+        # stop taking new connections, but let the requests already under way finish
+        server.stop()
+        if not await request_tracker.wait_until_idle(drain_timeout_seconds):
+            print("process {0} stopping with {1} request(s) still in flight".format(
+                os.getpid(), request_tracker.num_in_flight), file=sys.stderr)
+        io_loop.stop()
+
+    def request_shut_down():
+        # NB: a ctrl-c at the terminal sends SIGINT to the workers as well as the SIGTERM forwarded by the supervisor
+        if not is_shutting_down:
+            is_shutting_down.append(True)
+            io_loop.add_callback(shut_down)
+
+    asyncio_loop = asyncio.get_event_loop()
+    for curr_signal in [signal.SIGTERM, signal.SIGINT]:
+        asyncio_loop.add_signal_handler(curr_signal, request_shut_down)
+
+    io_loop.start()
+    if on_stopped is not None:
+        on_stopped()
+
+
+def supervise_workers(num_processes, run_worker_func, drain_timeout_seconds):
+    """Fork num_processes workers, each running run_worker_func, and keep them running until told to stop."""
+    worker_start_times_by_pid = {}
+    shut_down_deadline = []  # NB: a list so the signal handler can set it
+
+    def start_worker():
+        pid = os.fork()
+        if pid == 0:
+            # in the worker: restore default signal handling; the worker sets up its own handlers
+            for curr_signal in [signal.SIGTERM, signal.SIGINT]:
+                signal.signal(curr_signal, signal.SIG_DFL)
+            exit_code = 0
+            try:
+                run_worker_func()
+            except BaseException:
+                sys.excepthook(*sys.exc_info())
+                exit_code = 1
+            finally:
+                # never return into the supervisor's code in a worker
+                os._exit(exit_code)
+
+        worker_start_times_by_pid[pid] = time.time()
+
+    def handle_shut_down_signal(signal_num, frame):
+        if not shut_down_deadline:
+            shut_down_deadline.append(time.time() + drain_timeout_seconds + _KILL_GRACE_SECONDS)
+        for curr_pid in list(worker_start_times_by_pid):
+            _signal_worker(curr_pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, handle_shut_down_signal)
+    signal.signal(signal.SIGINT, handle_shut_down_signal)
+
+    for _ in range(num_processes):
+        start_worker()
+
+    while worker_start_times_by_pid:
+        pid, exit_status = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            if shut_down_deadline and time.time() > shut_down_deadline[0]:
+                for curr_pid in list(worker_start_times_by_pid):
+                    _signal_worker(curr_pid, signal.SIGKILL)
+            time.sleep(_POLL_INTERVAL_SECONDS)
+            continue
+
+        start_time = worker_start_times_by_pid.pop(pid, None)
+        if start_time is None or shut_down_deadline:
+            continue
+
+        print("worker process {0} exited with status {1}; restarting it".format(pid, exit_status), file=sys.stderr)
+        if time.time() - start_time < _MIN_WORKER_LIFETIME_SECONDS:
+            time.sleep(_MIN_WORKER_LIFETIME_SECONDS)
+        start_worker()
+
+
+def _signal_worker(pid, signal_num):
+    try:
+        os.kill(pid, signal_num)
+    except ProcessLookupError:
+        pass  # already gone
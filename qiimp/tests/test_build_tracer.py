@@ -0,0 +1,59 @@
+import io
+from unittest import main, TestCase
+
+import qiimp.build_tracer as bt
+
+
+class TestBuildTracer(TestCase):
+    def test_span_counts(self):
+        tracer = bt.BuildTracer()
+        output_stream = io.BytesIO()
+        workbook = tracer.make_workbook(output_stream, {"in_memory": True})
+        worksheet = workbook.add_worksheet("sheet")
+
+        with tracer.span("formulas"):
+            worksheet.write("A1", "=1+1")
+            worksheet.write_formula(1, 0, "=SUM(A1:A1)", workbook.add_format({"bold": True}))
+            # handed on by xlsxwriter from _write_formula to _write_array_formula, but still just one formula
+            worksheet.write_formula(2, 0, "{=SUM(A1:A2)}")
+            worksheet.write_string(3, 0, "some text")
+        with tracer.span("validations"):
+            worksheet.data_validation("B1:B10", {"validate": "integer", "criteria": ">", "value": 0})
+            worksheet.conditional_format("C1:C10", {"type": "cell", "criteria": ">", "value": 1,
+                                                    "format": workbook.add_format({"italic": True})})
+        with tracer.span("close"):
+            workbook.close()
+            tracer.count(bt.BYTES_WRITTEN, output_stream.tell())
+
+        trace_events = tracer.to_chrome_trace()["traceEvents"]
+        self.assertEqual(["thread_name", "formulas", "validations", "close"], [x["name"] for x in trace_events])
+        formula_args = trace_events[1]["args"]
+        self.assertEqual(3, formula_args.pop(bt.FORMULAS))
+        self.assertGreater(formula_args.pop(bt.FORMULA_STORAGE_SECONDS), 0)
+        self.assertEqual({bt.FORMATS: 1, bt.STRINGS: 1}, formula_args)
+        self.assertEqual({bt.DATA_VALIDATIONS: 1, bt.CONDITIONAL_FORMATS: 1, bt.FORMATS: 1}, trace_events[2]["args"])
+        self.assertEqual({bt.BYTES_WRITTEN: len(output_stream.getvalue())}, trace_events[3]["args"])
+
+        for curr_event in trace_events[1:]:
+            self.assertEqual("X", curr_event["ph"])
+            self.assertGreaterEqual(curr_event["ts"], 0)
+            self.assertGreaterEqual(curr_event["dur"], 0)
+
+    def test_nested_spans(self):
+        tracer = bt.BuildTracer()
+        with tracer.span("outer"):
+            tracer.count(bt.FORMULAS, 2)
+            with tracer.span("inner"):
+                tracer.count(bt.FORMULAS)
+
+        trace_events = tracer.to_chrome_trace()["traceEvents"]
+        # in start order, not finishing order
+        self.assertEqual(["thread_name", "outer", "inner"], [x["name"] for x in trace_events])
+        self.assertEqual({bt.FORMULAS: 3}, trace_events[1]["args"])
+        self.assertEqual({bt.FORMULAS: 1}, trace_events[2]["args"])
+        self.assertLessEqual(trace_events[2]["ts"] + trace_events[2]["dur"],
+                             trace_events[1]["ts"] + trace_events[1]["dur"])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+from unittest import main
+
+import tornado.gen
+import tornado.locks
+import tornado.testing
+
+import qiimp.generation_admission as ga
+
+
+class TestGenerationAdmission(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.generations_finished = tornado.locks.Event()
+
+    async def _mock_generate(self):
+        await self.generations_finished.wait()
+        return "workbook"
+
+    @tornado.testing.gen_test
+    async def test_run_queues_then_rejects(self):
+        admission = ga.GenerationAdmission(max_concurrent=1, max_queued=1)
+        running = tornado.gen.convert_yielded(admission.run(self._mock_generate))
+        queued = tornado.gen.convert_yielded(admission.run(self._mock_generate))
+        await tornado.gen.sleep(0)
+        self.assertEqual(1, admission.num_running)
+        self.assertEqual(1, admission.num_queued)
+        self.assertEqual(0, admission.get_num_free())
+
+        with self.assertRaises(ga.GenerationRejectedError) as context:
+            await admission.run(self._mock_generate)
+        self.assertGreaterEqual(context.exception.retry_after_seconds, 1)
+
+        self.generations_finished.set()
+        self.assertEqual(["workbook", "workbook"], await tornado.gen.multi([running, queued]))
+
+        obs = admission.get_stats()
+        self.assertEqual(0, obs["num_running"])
+        self.assertEqual(0, obs["num_queued"])
+        self.assertEqual(2, obs["num_admitted"])
+        self.assertEqual(1, obs["num_rejected"])
+        self.assertIsNotNone(obs["average_generation_seconds"])
+
+    @tornado.testing.gen_test
+    async def test_run_no_limit(self):
+        admission = ga.GenerationAdmission()
+        waiters = [admission.run(self._mock_generate) for _ in range(5)]
+        self.io_loop.call_later(0.01, self.generations_finished.set)
+        self.assertEqual(["workbook"] * 5, await tornado.gen.multi(waiters))
+        self.assertEqual(0, admission.num_rejected)
+        self.assertIsNone(admission.get_num_free())
+
+    @tornado.testing.gen_test
+    async def test_run_releases_on_error(self):
+        async def failing_generate():
+            raise ValueError("no workbook for you")
+
+        admission = ga.GenerationAdmission(max_concurrent=1)
+        with self.assertRaisesRegex(ValueError, "no workbook for you"):
+            await admission.run(failing_generate)
+
+        self.generations_finished.set()
+        self.assertEqual("workbook", await admission.run(self._mock_generate))
+
+    def test_get_retry_after_seconds(self):
+        admission = ga.GenerationAdmission(max_concurrent=2, max_queued=10)
+        admission.average_generation_seconds = 10
+        admission.num_queued = 3
+        self.assertEqual(20, admission.get_retry_after_seconds())
+
+        admission.average_generation_seconds = 10000
+        self.assertEqual(300, admission.get_retry_after_seconds())
+
+
+if __name__ == '__main__':
+    main()
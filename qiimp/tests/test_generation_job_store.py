@@ -0,0 +1,108 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+from unittest import main
+
+import tornado.testing
+
+import qiimp.generation_job_store as gjs
+
+
+class TestGenerationJobStore(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.temp_dir_path = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.temp_dir_path, "subdir", "jobs.sqlite")
+        self.arguments = {"study_name": [b"my study"], "env": [b"human"], "sample_type": [b"stool"],
+                          "odd_field_0": [b"\xe9", b""]}
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir_path)
+        super().tearDown()
+
+    def _make_store(self, lease_seconds=60):
+        store = gjs.GenerationJobStore(self.db_path, lease_seconds)
+        self.addCleanup(store.close)
+        return store
+
+    @tornado.testing.gen_test
+    async def test_add_and_get(self):
+        store = self._make_store()
+        await store.add("abc", "fingerprint1", ("human", "stool"), self.arguments)
+
+        obs = await store.get("abc")
+        self.assertEqual("fingerprint1", obs.fingerprint)
+        self.assertEqual(gjs.PENDING_STATE, obs.state)
+        self.assertEqual(self.arguments, obs.arguments)
+        self.assertIsNone(await store.get("def"))
+
+    @tornado.testing.gen_test
+    async def test_calls_made_in_order_off_the_ioloop(self):
+        store = self._make_store()
+        calling_threads = set()
+        store._connection.set_trace_callback(lambda sql: calling_threads.add(threading.current_thread()))
+
+        # NB: not waiting for the add before asking for the finish
+        add_future = store.add("abc", "fingerprint1", ("human", "stool"), self.arguments)
+        await store.finish("abc", gjs.DONE_STATE)
+        await add_future
+
+        self.assertEqual(gjs.DONE_STATE, (await store.get("abc")).state)
+        self.assertEqual(1, len(calling_threads))
+        self.assertNotIn(threading.current_thread(), calling_threads)
+
+    @tornado.testing.gen_test
+    async def test_claim_orphans(self):
+        first_store = self._make_store()
+        await first_store.add("abc", "fingerprint1", ("human", "stool"), self.arguments)
+        await first_store.add("def", "fingerprint2", ("human", "stool"), self.arguments)
+
+        # both jobs are leased to the first store's process, so there is nothing to claim
+        second_store = self._make_store()
+        self.assertEqual([], await second_store.claim_orphans())
+
+        # ... until it lets them go (or its leases run out)
+        await first_store.release(["abc", "def"])
+        self.assertEqual(["abc"], [x.job_id for x in await second_store.claim_orphans(max_jobs=1)])
+        self.assertEqual(["def"], [x.job_id for x in await second_store.claim_orphans()])
+        self.assertEqual([], await first_store.claim_orphans())
+
+        # and the first store can't release (or renew) what it no longer holds
+        await first_store.release(["abc"])
+        self.assertEqual([], await first_store.claim_orphans())
+
+    @tornado.testing.gen_test
+    async def test_claim_orphans_expired_lease(self):
+        first_store = self._make_store(lease_seconds=0.01)
+        await first_store.add("abc", "fingerprint1", ("human", "stool"), self.arguments)
+        await asyncio.sleep(0.02)
+
+        second_store = self._make_store()
+        self.assertEqual(["abc"], [x.job_id for x in await second_store.claim_orphans()])
+
+    @tornado.testing.gen_test
+    async def test_finish(self):
+        store = self._make_store(lease_seconds=0.01)
+        await store.add("abc", "fingerprint1", ("human", "stool"), self.arguments)
+        await store.add("def", "fingerprint1", ("human", "stool"), self.arguments)
+        await store.finish("abc", gjs.DONE_STATE, file_name="my-study_1234.xlsx")
+        await store.finish("def", gjs.FAILED_STATE, error="oops")
+        await asyncio.sleep(0.02)
+
+        # finished jobs are never resumed
+        self.assertEqual([], await store.claim_orphans())
+        self.assertEqual("my-study_1234.xlsx", await store.find_completed_file_name("fingerprint1"))
+        self.assertIsNone(await store.find_completed_file_name("fingerprint2"))
+        self.assertEqual("oops", (await store.get("def")).error)
+        self.assertEqual({"num_pending": 0, "num_done": 1, "num_failed": 1}, await store.get_stats())
+
+        await store.remove_finished(max_age_seconds=3600)
+        self.assertIsNotNone(await store.get("abc"))
+        await store.remove_finished(max_age_seconds=0)
+        self.assertIsNone(await store.get("abc"))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+from unittest import main, mock, TestCase
+
+import qiimp.generation_jobs as gj
+import qiimp.xlsx_builder
+
+
+class TestGenerationJob(TestCase):
+    def test_progress_and_listeners(self):
+        job = gj.GenerationJob("abc")
+        reported = []
+        job.add_listener(lambda x: reported.append((x.state, x.phase)))
+        self.assertEqual(gj.QUEUED_STATE, job.state)
+
+        job.set_phase(qiimp.xlsx_builder.BuildPhases.metadata_grid)
+        job.set_phase(qiimp.xlsx_builder.BuildPhases.zip_close)
+        job.succeed(qiimp.xlsx_builder.GeneratedWorkbook("a.xlsx", None))
+        # progress that trails in after the job is finished is ignored
+        job.set_phase(qiimp.xlsx_builder.BuildPhases.dynamic_grid)
+
+        self.assertEqual([(gj.RUNNING_STATE, "metadata_grid"), (gj.RUNNING_STATE, "zip_close"),
+                          (gj.DONE_STATE, "zip_close")], reported)
+        self.assertTrue(job.is_finished)
+
+    def test_fail(self):
+        job = gj.GenerationJob("abc")
+        listener = mock.Mock()
+        job.add_listener(listener)
+        job.remove_listener(listener)
+        job.fail("too busy", retry_after_seconds=30)
+
+        self.assertEqual(gj.FAILED_STATE, job.state)
+        self.assertEqual("too busy", job.error)
+        self.assertEqual(30, job.retry_after_seconds)
+        listener.assert_not_called()
+
+
+class TestGenerationJobs(TestCase):
+    def test_create_and_get(self):
+        jobs = gj.GenerationJobs(retention_seconds=60)
+        job = jobs.create()
+        self.assertIs(job, jobs.get(job.job_id))
+        self.assertIsNone(jobs.get("nope"))
+        self.assertNotEqual(job.job_id, jobs.create().job_id)
+
+        resumed_job = jobs.create("abc")
+        self.assertIs(resumed_job, jobs.get("abc"))
+        resumed_job.fail("oops")
+        self.assertEqual(2, len(jobs.get_unfinished_job_ids()))
+        self.assertNotIn("abc", jobs.get_unfinished_job_ids())
+
+        jobs.remove("abc")
+        self.assertIsNone(jobs.get("abc"))
+
+    def test_finished_jobs_expire(self):
+        jobs = gj.GenerationJobs(retention_seconds=60)
+        finished_job = jobs.create()
+        finished_job.fail("oops")
+        running_job = jobs.create()
+        running_job.created_time -= 1000
+
+        finished_job.finished_time -= 61
+        self.assertIsNone(jobs.get(finished_job.job_id))
+        self.assertIs(running_job, jobs.get(running_job.job_id))
+
+        jobs.create()
+        self.assertEqual({"num_created": 3, "num_queued": 2, "num_running": 0, "num_done": 0, "num_failed": 0},
+                         jobs.get_stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+from unittest import main, TestCase, mock
+import concurrent.futures
+import copy
+import os
+import tempfile
+
+import qiimp.metadata_package_schema_builder as mpsb
+import qiimp.metadata_package_schema_cache as mpsc
+
+
+class TestMetadataPackageSchemaBuilder(TestCase):
+    def setUp(self):
+        self.parent_stack_by_env_name = {"base": ["base"], "human": ["base", "human"]}
+        self.env_schemas = {
+            "base": {
+                "env_schema": {"sample_name": {"type": "string"}, "latitude": {"type": "number", "min": -90}},
+                "sampletypes": {"stool": {"body_site": {"type": "string", "allowed": ["gut"]}}}
+            },
+            "human": {
+                "env_schema": {"host_taxid": {"type": "integer", "default": 9606}},
+                "sampletypes": {"skin": {"body_site": {"type": "string", "allowed": ["skin"]}}}
+            }
+        }
+
+    def test_update_schema_does_not_change_shared_field_schemas(self):
+        shared_schema = {"latitude": {"type": "number", "min": -90, "max": 90}}
+        exp_shared_schema = copy.deepcopy(shared_schema)
+
+        obs = mpsb.update_schema(dict(shared_schema), {"latitude": {"default": 32.5}}, force_piecemeal_overwrite=True)
+        self.assertEqual(exp_shared_schema, shared_schema)
+        self.assertEqual({"type": "number", "min": -90, "max": 90, "default": 32.5}, obs["latitude"])
+
+    def test_load_schemas_for_all_package_keys(self):
+        obs = mpsb.load_schemas_for_all_package_keys(self.parent_stack_by_env_name, self.env_schemas)
+
+        self.assertEqual({("base", "stool"), ("human", "stool"), ("human", "skin")}, set(obs.keys()))
+        for (curr_env_name, curr_sampletype_name), curr_schema in obs.items():
+            exp = mpsb.load_schemas_for_package_key(curr_env_name, curr_sampletype_name,
+                                                    self.parent_stack_by_env_name, self.env_schemas)
+            self.assertEqual(exp, curr_schema)
+        self.assertEqual(["skin"], obs[("human", "skin")]["body_site"]["allowed"])
+
+
+
+class TestLoadEnvironmentAndSampletypeInfo(TestCase):
+    def setUp(self):
+        # NB: the loader is mocked, so the package files need only exist (for the schema cache)
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.package_dir_path = os.path.realpath(self.temp_dir.name)
+        for curr_file_name in ["base.xlsx", "human.xlsx", "human-gut.xlsx", "human-skin.xlsx"]:
+            self._write_package_file(curr_file_name, b"a package")
+        self.envs_definitions = [
+            {"base": {"display_name": None, "filename": "base.xlsx", "parent": None,
+                      "filename_by_sampletypes_list": []}},
+            {"human": {"display_name": "Human", "filename": "human.xlsx", "parent": "base",
+                       "filename_by_sampletypes_list": [{"stool": "human-gut.xlsx"},
+                                                        {"colon_content": {"filename": "human-gut.xlsx"}},
+                                                        {"skin": "human-skin.xlsx"}]}}
+        ]
+        self.displayname_by_sampletypes_list = [{"stool": "Stool"}, {"colon_content": "Colon Content"},
+                                                {"skin": "Skin"}]
+
+        patcher = mock.patch("qiimp.xlsx_basics.load_yaml_from_wizard_xlsx", side_effect=_mock_load_yaml)
+        self.mock_loader = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _write_package_file(self, file_name, file_bytes):
+        with open(os.path.join(self.package_dir_path, file_name), "wb") as f:
+            f.write(file_bytes)
+
+    def _load(self, schema_cache=None, num_workers=1):
+        return mpsb.load_environment_and_sampletype_info(self.envs_definitions, self.displayname_by_sampletypes_list,
+                                                         self.package_dir_path, schema_cache, num_workers)
+
+    def _make_partly_filled_cache(self):
+        schema_cache = mpsc.PackageSchemaCache(os.path.join(self.temp_dir.name, "cache"), "v1")
+        schema_cache.load_yaml_from_wizard_xlsx(os.path.join(self.package_dir_path, "human.xlsx"), "metadata_schema")
+        self.mock_loader.reset_mock()
+        return schema_cache
+
+    def test_each_package_file_loaded_once(self):
+        env_schemas = self._load()[4]
+
+        # in the order of the environments yaml, and just once each, even though two sample types use human-gut.xlsx
+        self.assertEqual(["base.xlsx", "human.xlsx", "human-gut.xlsx", "human-skin.xlsx"],
+                         [os.path.basename(x[0][0]) for x in self.mock_loader.call_args_list])
+        human_sampletype_schemas = env_schemas["human"]["sampletypes"]
+        self.assertEqual({"human-gut.xlsx": {"type": "string"}}, human_sampletype_schemas["stool"])
+        self.assertIs(human_sampletype_schemas["stool"], human_sampletype_schemas["colon_content"])
+        self.assertEqual({"human-skin.xlsx": {"type": "string"}}, human_sampletype_schemas["skin"])
+
+    def test_package_file_error_names_every_use(self):
+        self._write_package_file("human-gut.xlsx", b"broken")
+        for curr_num_workers in [1, 2]:
+            with self.assertRaisesRegex(
+                    ValueError, "Unable to load package file '.*human-gut.xlsx' for sample type 'stool' in "
+                                "environment 'human' and sample type 'colon_content' in environment 'human': "
+                                "unreadable"):
+                self._load(num_workers=curr_num_workers)
+
+    def test_parallel_load_matches_serial_load(self):
+        exp = self._load()
+
+        # one file comes from the cache and the rest from the worker processes, but nothing comes out in a different
+        # order because of it
+        obs = self._load(self._make_partly_filled_cache(), num_workers=2)
+        self.assertEqual(exp, obs)
+        self.assertEqual(list(exp[4]), list(obs[4]))
+        self.assertEqual(list(exp[4]["human"]["sampletypes"]), list(obs[4]["human"]["sampletypes"]))
+
+        context_descs_by_filepath = {os.path.join(self.package_dir_path, x): ["test"]
+                                     for x in ["human-skin.xlsx", "human.xlsx", "base.xlsx", "human-gut.xlsx"]}
+        obs_schemas_by_filepath = mpsb._load_schemas_by_filepath(context_descs_by_filepath,
+                                                                 self._make_partly_filled_cache(), num_workers=2)
+        self.assertEqual(list(context_descs_by_filepath), list(obs_schemas_by_filepath))
+
+    def test_parallel_load_hashes_each_file_once(self):
+        schema_cache = self._make_partly_filled_cache()
+
+        # NB: worker threads rather than processes, so that the hashing done by the workers can be counted
+        with mock.patch("concurrent.futures.ProcessPoolExecutor", concurrent.futures.ThreadPoolExecutor), \
+                mock.patch("qiimp.metadata_package_schema_cache._get_content_hash",
+                           wraps=mpsc._get_content_hash) as mock_hasher:
+            self._load(schema_cache, num_workers=2)
+
+        self.assertEqual(sorted(["base.xlsx", "human.xlsx", "human-gut.xlsx", "human-skin.xlsx"]),
+                         sorted(os.path.basename(x[0][0]) for x in mock_hasher.call_args_list))
+        self.assertEqual(3, self.mock_loader.call_count)
+
+
+def _mock_load_yaml(filepath, yaml_sheetname):
+    with open(filepath, "rb") as f:
+        if f.read() == b"broken":
+            raise ValueError("unreadable")
+    return {os.path.basename(filepath): {"type": "string"}}
+
+
+if __name__ == '__main__':
+    main()
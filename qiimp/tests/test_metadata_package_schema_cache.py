@@ -0,0 +1,101 @@
+from unittest import main, TestCase, mock
+import datetime
+import json
+import os
+import tempfile
+
+import qiimp.metadata_package_schema_cache as mpsc
+
+
+class TestPackageSchemaCache(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.temp_dir.name, "cache")
+        self.package_fp = os.path.join(self.temp_dir.name, "a-package.xlsx")
+        with open(self.package_fp, "wb") as f:
+            f.write(b"not really an xlsx, but the loader is mocked")
+
+        patcher = mock.patch("qiimp.xlsx_basics.load_yaml_from_wizard_xlsx",
+                             side_effect=lambda fp, sheetname: {"field": {"type": "string", "from": fp}})
+        self.mock_loader = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def test_load_yaml_from_wizard_xlsx_reuses_entry(self):
+        first_cache = mpsc.PackageSchemaCache(self.cache_dir, "v1")
+        exp = first_cache.load_yaml_from_wizard_xlsx(self.package_fp, "metadata_schema")
+
+        # a new cache object stands in for a restarted server
+        second_cache = mpsc.PackageSchemaCache(self.cache_dir, "v1")
+        obs = second_cache.load_yaml_from_wizard_xlsx(self.package_fp, "metadata_schema")
+        self.assertEqual(exp, obs)
+        self.assertEqual(1, self.mock_loader.call_count)
+
+    def test_load_yaml_from_wizard_xlsx_version_change(self):
+        mpsc.PackageSchemaCache(self.cache_dir, "v1").load_yaml_from_wizard_xlsx(self.package_fp, "metadata_schema")
+        mpsc.PackageSchemaCache(self.cache_dir, "v2").load_yaml_from_wizard_xlsx(self.package_fp, "metadata_schema")
+        self.assertEqual(2, self.mock_loader.call_count)
+
+    def test_load_yaml_from_wizard_xlsx_file_change(self):
+        a_cache = mpsc.PackageSchemaCache(self.cache_dir, "v1")
+        a_cache.load_yaml_from_wizard_xlsx(self.package_fp, "metadata_schema")
+
+        # same size, and mtime put back the way it was, so only the content hash differs
+        orig_stats = os.stat(self.package_fp)
+        with open(self.package_fp, "wb") as f:
+            f.write(b"NOT really an xlsx, but the loader is mocked")
+        os.utime(self.package_fp, ns=(orig_stats.st_atime_ns, orig_stats.st_mtime_ns))
+
+        a_cache.load_yaml_from_wizard_xlsx(self.package_fp, "metadata_schema")
+        self.assertEqual(2, self.mock_loader.call_count)
+
+    def test_load_yaml_from_wizard_xlsx_corrupt_entry(self):
+        a_cache = mpsc.PackageSchemaCache(self.cache_dir, "v1")
+        a_cache.load_yaml_from_wizard_xlsx(self.package_fp, "metadata_schema")
+        for curr_file_name in os.listdir(self.cache_dir):
+            with open(os.path.join(self.cache_dir, curr_file_name), "wb") as f:
+                f.write(b"garbage")
+
+        obs = a_cache.load_yaml_from_wizard_xlsx(self.package_fp, "metadata_schema")
+        self.assertEqual("string", obs["field"]["type"])
+        self.assertEqual(2, self.mock_loader.call_count)
+
+    def test_load_yaml_from_wizard_xlsx_entries_are_json(self):
+        a_cache = mpsc.PackageSchemaCache(self.cache_dir, "v1")
+        exp = a_cache.load_yaml_from_wizard_xlsx(self.package_fp, "metadata_schema")
+
+        cache_file_names = os.listdir(self.cache_dir)
+        self.assertEqual(1, len(cache_file_names))
+        with open(os.path.join(self.cache_dir, cache_file_names[0]), encoding="utf-8") as f:
+            self.assertEqual(exp, json.load(f)["schema"])
+
+    def test_load_yaml_from_wizard_xlsx_not_json(self):
+        # a schema JSON can't hold exactly isn't cached (and leaves nothing behind), but still loads
+        for curr_schema in [{"field": {"type": "datetime", "min": datetime.date(2020, 1, 1)}},
+                            {"field": {"type": "integer", "allowed": {1: "one"}}}]:
+            with self.subTest(schema=curr_schema):
+                self.mock_loader.reset_mock(side_effect=True)
+                self.mock_loader.return_value = curr_schema
+                a_cache = mpsc.PackageSchemaCache(self.cache_dir, "v1")
+
+                self.assertEqual(curr_schema, a_cache.load_yaml_from_wizard_xlsx(self.package_fp, "metadata_schema"))
+                self.assertEqual(curr_schema, a_cache.load_yaml_from_wizard_xlsx(self.package_fp, "metadata_schema"))
+                self.assertEqual(2, self.mock_loader.call_count)
+                self.assertFalse(os.path.exists(self.cache_dir) and os.listdir(self.cache_dir))
+
+    def test_file_signature_hashes_once(self):
+        a_cache = mpsc.PackageSchemaCache(self.cache_dir, "v1")
+        with mock.patch("qiimp.metadata_package_schema_cache._get_content_hash",
+                        wraps=mpsc._get_content_hash) as mock_hasher:
+            file_signature = a_cache.get_file_signature(self.package_fp)
+            self.assertIsNone(a_cache.get_cached_yaml(self.package_fp, "metadata_schema", file_signature))
+            a_cache.load_yaml_from_wizard_xlsx(self.package_fp, "metadata_schema", file_signature)
+            obs = a_cache.get_cached_yaml(self.package_fp, "metadata_schema", file_signature)
+
+        self.assertEqual("string", obs["field"]["type"])
+        self.assertEqual(1, mock_hasher.call_count)
+        self.assertIsNone(a_cache.get_file_signature(os.path.join(self.temp_dir.name, "no-such-package.xlsx")))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,476 @@
+from unittest import main, mock, TestCase
+import asyncio
+import json
+import os
+import socket
+import tempfile
+import urllib.parse
+
+import tornado.iostream
+import tornado.locks
+import tornado.testing
+import tornado.websocket
+
+import qiimp.generation_admission
+import qiimp.generation_job_store
+import qiimp.generation_jobs
+import qiimp.metadata_wizard_server as mwserver
+import qiimp.metadata_wizard_settings as mws
+import qiimp.output_retention
+import qiimp.request_profiler
+import qiimp.server_metrics
+import qiimp.server_supervisor
+import qiimp.workbook_cache
+import qiimp.xlsx_builder
+
+_PACKAGE_KEY = ("human", "stool")
+_FORM_ARGUMENTS = {mws.InputNames.environment.value: _PACKAGE_KEY[0],
+                   mws.InputNames.sample_type.value: _PACKAGE_KEY[1],
+                   mws.InputNames.study_name.value: "my_study"}
+
+
+class _MockWorkbookGenerator(object):
+    # builds "workbooks" in memory right away, unless told to wait until release_event is set
+    def __init__(self):
+        self.in_memory = True
+        self.release_event = None
+        self.generate_calls = []
+
+    async def generate(self, study_name, schema_dict, form_dict, progress_callback=None, profile_file_base=None):
+        self.generate_calls.append((study_name, profile_file_base))
+        if profile_file_base is not None:
+            # the real generator profiles the build in its worker; this leaves the same files behind
+            qiimp.request_profiler.profile_call(lambda: None, profile_file_base)
+        if self.release_event is not None:
+            await self.release_event.wait()
+        if progress_callback is not None:
+            for curr_phase in qiimp.xlsx_builder.BuildPhases:
+                progress_callback(curr_phase)
+        return qiimp.xlsx_builder.GeneratedWorkbook("{0}.xlsx".format(study_name), b"xlsx bytes")
+
+
+class ServerHandlerTestCase(tornado.testing.AsyncHTTPTestCase):
+    # the handlers, with everything behind them real except the workbook generator and the form parsing
+    def get_app(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+        self.wizard_state = mws.MetadataWizardState()
+        self.wizard_state.set_up(False)
+        self.wizard_state.profile_output_path = os.path.join(self.temp_dir.name, "profiles")
+        self.wizard_state.monitoring_token = "monitoring secret"
+        self.workbook_generator = _MockWorkbookGenerator()
+        self.job_store = qiimp.generation_job_store.GenerationJobStore(
+            os.path.join(self.temp_dir.name, "generation_jobs.sqlite"), lease_seconds=60)
+        self.addCleanup(self.job_store.close)
+        self.settings = {
+            "template_path": self.wizard_state.templates_dir_path,
+            "wizard_state": self.wizard_state,
+            "workbook_generator": self.workbook_generator,
+            "request_tracker": qiimp.server_supervisor.InFlightRequestTracker(),
+            "output_retention": qiimp.output_retention.OutputRetention(self.temp_dir.name),
+            "workbook_cache": qiimp.workbook_cache.WorkbookCache(self.wizard_state),
+            "generation_admission": qiimp.generation_admission.GenerationAdmission(1, 0),
+            "generation_jobs": qiimp.generation_jobs.GenerationJobs(60),
+            "generation_job_store": self.job_store,
+            "server_metrics": qiimp.server_metrics.ServerMetrics(os.getpid()),
+            "metrics_snapshots": qiimp.server_metrics.MetricsSnapshots(
+                os.path.join(self.temp_dir.name, "metrics"), os.getpid(), max_age_seconds=60),
+        }
+        return mwserver._make_application(self.wizard_state, self.settings)
+
+    def setUp(self):
+        super().setUp()
+        self._occupied_slots = []
+        # NB: the form parsing (and the package schemas it needs) is tested elsewhere
+        patcher = mock.patch("qiimp.metadata_wizard_server._get_workbook_inputs", side_effect=_mock_get_workbook_inputs)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post_form(self, url, headers=None):
+        return self.fetch(url, method="POST", body=urllib.parse.urlencode(_FORM_ARGUMENTS), headers=headers)
+
+    def occupy_generation_slot(self):
+        # fill the (one-slot) generation admission, as if some other workbook were being built
+        release_event = tornado.locks.Event()
+        blocker = asyncio.ensure_future(self.settings["generation_admission"].run(release_event.wait),
+                                        loop=self.io_loop.asyncio_loop)
+        self.io_loop.run_sync(lambda: asyncio.sleep(0))
+        self.assertTrue(self.settings["generation_admission"].is_full())
+        self._occupied_slots.append((release_event, blocker))
+
+    def tearDown(self):
+        # NB: free the slots while the IOLoop is still open
+        for release_event, blocker in self._occupied_slots:
+            release_event.set()
+            self.io_loop.run_sync(lambda: blocker)
+        super().tearDown()
+
+
+def _mock_get_workbook_inputs(wiz_state, arguments_obj):
+    study_name = mwserver._parse_form_value(arguments_obj[mws.InputNames.study_name.value])
+    package_schema = {"sample_name": {}}
+    return mwserver._WorkbookInputs(study_name, package_schema, {}, mwserver._make_workbook_fingerprint(
+        wiz_state, package_schema, {}, "us", study_name))
+
+
+class TestJobHandlers(ServerHandlerTestCase):
+    def _submit_job(self):
+        response = self.post_form(self.wizard_state.partial_jobs_url)
+        self.assertEqual(202, response.code)
+        return json.loads(response.body)
+
+    def _get_stored_job(self, job_id):
+        return self.io_loop.run_sync(lambda: self.job_store.get(job_id))
+
+    def _wait_for_job(self, job_id):
+        job = self.settings["generation_jobs"].get(job_id)
+        for _ in range(100):
+            if job.is_finished:
+                return job
+            self.io_loop.run_sync(lambda: asyncio.sleep(0.01))
+        self.fail("job {0} never finished".format(job_id))
+
+    def test_submit_job(self):
+        self.workbook_generator.release_event = tornado.locks.Event()
+        obs = self._submit_job()
+
+        job_url = "{0}{1}".format(self.wizard_state.partial_jobs_url, obs["job_id"])
+        self.assertEqual({"job_id": obs["job_id"], "status_url": job_url, "progress_url": job_url + "/progress"}, obs)
+        self.assertEqual(qiimp.generation_job_store.PENDING_STATE, self._get_stored_job(obs["job_id"]).state)
+
+        self.workbook_generator.release_event.set()
+        self._wait_for_job(obs["job_id"])
+        response = self.fetch(job_url)
+        self.assertEqual(200, response.code)
+        obs_status = json.loads(response.body)
+        self.assertEqual(qiimp.generation_jobs.DONE_STATE, obs_status["state"])
+        self.assertEqual(job_url + "/workbook", obs_status["download_url"])
+        self.assertEqual(qiimp.generation_job_store.DONE_STATE, self._get_stored_job(obs["job_id"]).state)
+
+    def test_submit_job_busy(self):
+        self.occupy_generation_slot()
+        response = self.post_form(self.wizard_state.partial_jobs_url)
+
+        self.assertEqual(503, response.code)
+        self.assertEqual("30", response.headers["Retry-After"])
+        self.assertEqual(30, json.loads(response.body)["retry_after_seconds"])
+        self.assertEqual([], self.workbook_generator.generate_calls)
+
+    def test_get_unknown_job(self):
+        self.assertEqual(404, self.fetch(self.wizard_state.partial_jobs_url + "abc123").code)
+
+    @tornado.testing.gen_test
+    async def test_job_progress(self):
+        self.workbook_generator.release_event = tornado.locks.Event()
+        response = await self.http_client.fetch(self.get_url(self.wizard_state.partial_jobs_url), method="POST",
+                                                 body=urllib.parse.urlencode(_FORM_ARGUMENTS))
+        progress_url = json.loads(response.body)["progress_url"]
+
+        connection = await tornado.websocket.websocket_connect(
+            "ws://127.0.0.1:{0}{1}".format(self.get_http_port(), progress_url))
+        obs_statuses = [json.loads(await connection.read_message())]
+        self.workbook_generator.release_event.set()
+        while True:
+            message = await connection.read_message()
+            if message is None:
+                break  # the server closes the connection once the job is finished
+            obs_statuses.append(json.loads(message))
+
+        self.assertEqual([qiimp.generation_jobs.QUEUED_STATE] +
+                         [qiimp.generation_jobs.RUNNING_STATE] * len(qiimp.xlsx_builder.BuildPhases) +
+                         [qiimp.generation_jobs.DONE_STATE],
+                         [x["state"] for x in obs_statuses])
+        self.assertEqual([None] + [x.value for x in qiimp.xlsx_builder.BuildPhases],
+                         [x["phase"] for x in obs_statuses[:-1]])
+        self.assertIsNotNone(obs_statuses[-1]["download_url"])
+
+    def test_job_progress_unknown_job(self):
+        # a plain 404, rather than a websocket that opens only to close again
+        self.assertEqual(404, self.fetch(self.wizard_state.partial_jobs_url + "abc123/progress").code)
+
+    def test_get_job_workbook(self):
+        job_id = self._submit_job()["job_id"]
+        self._wait_for_job(job_id)
+
+        response = self.fetch("{0}{1}/workbook".format(self.wizard_state.partial_jobs_url, job_id))
+        self.assertEqual(200, response.code)
+        self.assertEqual(b"xlsx bytes", response.body)
+        self.assertEqual('attachment; filename="my_study.xlsx"', response.headers["Content-Disposition"])
+        self.assertEqual(1, len(self.workbook_generator.generate_calls))
+
+    def _add_other_process_job(self, state):
+        # a job that some other server process ran, so it is known here only from the job store
+        job_id = "abc123"
+        self.io_loop.run_sync(lambda: self.job_store.add(job_id, "fingerprint_my_study", _PACKAGE_KEY,
+                                                         {k: [v.encode("ascii")] for k, v in _FORM_ARGUMENTS.items()}))
+        if state is not None:
+            self.io_loop.run_sync(lambda: self.job_store.finish(job_id, state))
+        return "{0}{1}/workbook".format(self.wizard_state.partial_jobs_url, job_id)
+
+    def test_get_job_workbook_rebuilt(self):
+        workbook_url = self._add_other_process_job(qiimp.generation_job_store.DONE_STATE)
+
+        # the workbook isn't in this process's memory, so it is built again, on a plain GET
+        response = self.fetch(workbook_url)
+        self.assertEqual(200, response.code)
+        self.assertEqual(b"xlsx bytes", response.body)
+        self.assertEqual([("my_study", None)], self.workbook_generator.generate_calls)
+        self.assertEqual(0, self.settings["request_tracker"].num_in_flight)
+
+    def test_get_job_workbook_rebuild_busy(self):
+        workbook_url = self._add_other_process_job(qiimp.generation_job_store.DONE_STATE)
+        self.occupy_generation_slot()
+
+        response = self.fetch(workbook_url)
+        self.assertEqual(503, response.code)
+        self.assertEqual("30", response.headers["Retry-After"])
+        self.assertEqual([], self.workbook_generator.generate_calls)
+        self.assertEqual(0, self.settings["request_tracker"].num_in_flight)
+
+    def test_get_job_workbook_not_done(self):
+        workbook_url = self._add_other_process_job(None)
+        self.assertEqual(404, self.fetch(workbook_url).code)
+        self.assertEqual([], self.workbook_generator.generate_calls)
+
+
+
+class TestMonitoringHandlers(ServerHandlerTestCase):
+    def _get_monitoring_urls(self):
+        return [self.wizard_state.partial_status_url, self.wizard_state.partial_metrics_url]
+
+    def test_monitoring_not_allowed(self):
+        for curr_url in self._get_monitoring_urls():
+            self.assertEqual(403, self.fetch(curr_url).code)
+            self.assertEqual(403, self.fetch(curr_url, headers={"Authorization": "Bearer wrong secret"}).code)
+            self.assertEqual(403, self.fetch(curr_url, headers={"Authorization": "monitoring secret"}).code)
+
+        # an empty token turns monitoring off altogether
+        self.wizard_state.monitoring_token = ""
+        for curr_url in self._get_monitoring_urls():
+            self.assertEqual(403, self.fetch(curr_url, headers={"Authorization": "Bearer "}).code)
+
+    def test_monitoring_other_processes(self):
+        other_metrics = qiimp.server_metrics.ServerMetrics(99999999)
+        other_metrics.observe_build({"metadata_grid": 0.3}, 2.5)
+        other_stats = {"workbook_cache": {"num_hits": 3, "num_misses": 1}}
+        other_snapshots = qiimp.server_metrics.MetricsSnapshots(
+            self.settings["metrics_snapshots"].dir_path, 99999999, max_age_seconds=60)
+        other_snapshots.write(other_stats, other_metrics.get_families(other_stats))
+        headers = {"Authorization": "Bearer monitoring secret"}
+
+        response = self.fetch(self.wizard_state.partial_metrics_url, headers=headers)
+        self.assertEqual(200, response.code)
+        obs_lines = response.body.decode("utf-8").splitlines()
+        self.assertIn('qiimp_workbook_build_seconds_sum{pid="99999999"} 2.5', obs_lines)
+        self.assertIn('qiimp_workbook_build_seconds_sum{{pid="{0}"}} 0'.format(os.getpid()), obs_lines)
+        self.assertEqual(1, obs_lines.count("# TYPE qiimp_workbook_build_seconds histogram"))
+
+        response = self.fetch(self.wizard_state.partial_status_url, headers=headers)
+        self.assertEqual(200, response.code)
+        status_dict = json.loads(response.body)
+        self.assertEqual(os.getpid(), status_dict["pid"])
+        self.assertIn("workbook_cache", status_dict)
+        self.assertEqual([99999999], [x["pid"] for x in status_dict["other_processes"]])
+        self.assertEqual(other_stats["workbook_cache"], status_dict["other_processes"][0]["workbook_cache"])
+
+    def test_write_metrics_snapshot(self):
+        self.io_loop.run_sync(lambda: mwserver._write_metrics_snapshot(self.settings))
+        other_snapshots = qiimp.server_metrics.MetricsSnapshots(
+            self.settings["metrics_snapshots"].dir_path, 99999999, max_age_seconds=60)
+        obs = other_snapshots.read_others()
+        self.assertEqual([os.getpid()], [x.pid for x in obs])
+        self.assertIn("generation_job_store", obs[0].stats_by_group)
+
+
+class TestProfiling(ServerHandlerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.wizard_state.profiling_token = "profiling secret"
+        self.profile_headers = {mwserver._PROFILE_TOKEN_HEADER: "profiling secret"}
+        self.wizard_state.package_schemas_by_key = {_PACKAGE_KEY: {"sample_name": {"type": "string"}}}
+        self.package_url = "{0}?{1}".format(self.wizard_state.partial_package_url, urllib.parse.urlencode(
+            {mws.InputNames.environment.value: _PACKAGE_KEY[0], mws.InputNames.sample_type.value: _PACKAGE_KEY[1]}))
+
+    def _assert_profile_files_written(self, response):
+        profile_file_name = response.headers[mwserver._PROFILE_FILE_HEADER]
+        profile_file_base = os.path.join(self.wizard_state.profile_output_path, profile_file_name)
+        for curr_extension in [qiimp.request_profiler.PROFILE_STATS_EXTENSION,
+                               qiimp.request_profiler.COLLAPSED_STACKS_EXTENSION]:
+            self.assertTrue(os.path.isfile(profile_file_base + curr_extension))
+        return profile_file_base
+
+    def test_profiling_not_allowed(self):
+        for curr_token in ["wrong secret", ""]:
+            headers = {mwserver._PROFILE_TOKEN_HEADER: curr_token}
+            self.assertEqual(403, self.post_form(self.wizard_state._get_url(), headers=headers).code)
+            self.assertEqual(403, self.fetch(self.package_url, headers=headers).code)
+
+        # an empty token turns profiling off altogether
+        self.wizard_state.profiling_token = ""
+        self.assertEqual(403, self.post_form(self.wizard_state._get_url(), headers={
+            mwserver._PROFILE_TOKEN_HEADER: ""}).code)
+        self.assertEqual([], self.workbook_generator.generate_calls)
+        self.assertFalse(os.path.exists(self.wizard_state.profile_output_path))
+
+    def test_not_profiled(self):
+        response = self.post_form(self.wizard_state._get_url())
+        self.assertEqual(200, response.code)
+        self.assertNotIn(mwserver._PROFILE_FILE_HEADER, response.headers)
+        self.assertEqual([("my_study", None)], self.workbook_generator.generate_calls)
+
+        response = self.fetch(self.package_url)
+        self.assertEqual(200, response.code)
+        self.assertNotIn(mwserver._PROFILE_FILE_HEADER, response.headers)
+
+    def test_profile_workbook(self):
+        # an identical workbook is already cached, but a profiled request builds its own anyway
+        self.settings["workbook_cache"].max_entries = 10
+        self.assertEqual(200, self.post_form(self.wizard_state._get_url()).code)
+        self.assertEqual(200, self.post_form(self.wizard_state._get_url()).code)
+        self.assertEqual(1, len(self.workbook_generator.generate_calls))
+
+        response = self.post_form(self.wizard_state._get_url(), headers=self.profile_headers)
+        self.assertEqual(200, response.code)
+        self.assertEqual(b"xlsx bytes", response.body)
+        profile_file_base = self._assert_profile_files_written(response)
+        self.assertEqual(("my_study", profile_file_base), self.workbook_generator.generate_calls[-1])
+        self.assertIn("MainHandler", profile_file_base)
+
+    def test_profile_package(self):
+        # a profiled request works the response out again rather than using the memo
+        self.wizard_state.package_responses_by_key[_PACKAGE_KEY] = (b"memo", '"memo"')
+        self.assertEqual(b"memo", self.fetch(self.package_url).body)
+
+        response = self.fetch(self.package_url, headers=self.profile_headers)
+        self.assertEqual(200, response.code)
+        self.assertEqual(["sample_name"], json.loads(response.body)["field_names"])
+        profile_file_base = self._assert_profile_files_written(response)
+        self.assertIn("PackageHandler", profile_file_base)
+
+
+class TestPackageHandler(ServerHandlerTestCase):
+    def test_package_missing_argument(self):
+        environment_only = urllib.parse.urlencode({mws.InputNames.environment.value: _PACKAGE_KEY[0]})
+        for curr_method, curr_query, curr_body in [("GET", "", None), ("GET", environment_only, None),
+                                                   ("POST", "", ""), ("POST", "", environment_only)]:
+            with self.subTest(method=curr_method, query=curr_query, body=curr_body):
+                response = self.fetch("{0}?{1}".format(self.wizard_state.partial_package_url, curr_query),
+                                      method=curr_method, body=curr_body)
+                self.assertEqual(400, response.code)
+
+
+class TestUploadHandler(ServerHandlerTestCase):
+    def _send_raw_request(self, headers, body, method="POST"):
+        # NB: a raw request, since tornado's own client won't send a malformed one
+        async def send():
+            stream = tornado.iostream.IOStream(socket.socket())
+            await stream.connect(("127.0.0.1", self.get_http_port()))
+            request_lines = ["{0} {1} HTTP/1.1".format(method, self.wizard_state.partial_upload_url), "Host: localhost"]
+            request_lines.extend("{0}: {1}".format(k, v) for k, v in headers.items())
+            await stream.write(("\r\n".join(request_lines) + "\r\n\r\n").encode("latin-1") + body)
+            status_line = await stream.read_until(b"\r\n")
+            stream.close()
+            return int(status_line.split()[1])
+        return self.io_loop.run_sync(send)
+
+    def test_upload_bad_content_length(self):
+        obs = self._send_raw_request({"Content-Length": "lots",
+                                      "Content-Type": "multipart/form-data; boundary=xyz"}, b"")
+        self.assertEqual(400, obs)
+
+    def test_upload_bad_part_headers(self):
+        body = b'--xyz\r\nContent-Disposition: form-data; name="files[]"; filename="\xe9tude.xlsx"\r\n\r\ndata' \
+               b'\r\n--xyz--\r\n'
+        obs = self._send_raw_request({"Content-Length": str(len(body)),
+                                      "Content-Type": "multipart/form-data; boundary=xyz"}, body)
+        self.assertEqual(400, obs)
+
+    def test_upload_body_with_other_method(self):
+        # only a POST's body is parsed; any other method's is ignored, and the method itself refused
+        body = b'--xyz\r\nContent-Disposition: form-data; name="files[]"; filename="study.xlsx"\r\n\r\ndata' \
+               b'\r\n--xyz--\r\n'
+        obs = self._send_raw_request({"Content-Length": str(len(body)),
+                                      "Content-Type": "multipart/form-data; boundary=xyz"}, body, method="PUT")
+        self.assertEqual(405, obs)
+
+
+class TestRunGenerationJob(ServerHandlerTestCase):
+    def setUp(self):
+        super().setUp()
+        # an identical job already finished (by another server process, say), and its workbook is still on disk
+        self.workbook_generator.in_memory = False
+        self.wizard_state.install_dir = self.temp_dir.name
+        os.makedirs(self.wizard_state.get_output_dir_path())
+        with open(self.wizard_state.get_output_path("my_study_1234.xlsx"), "wb") as f:
+            f.write(b"xlsx bytes")
+        fingerprint = self._get_workbook_inputs().fingerprint
+        self.io_loop.run_sync(lambda: self.job_store.add("abc123", fingerprint, _PACKAGE_KEY, {}))
+        self.io_loop.run_sync(lambda: self.job_store.finish("abc123", qiimp.generation_job_store.DONE_STATE,
+                                                            file_name="my_study_1234.xlsx"))
+
+    def _get_workbook_inputs(self):
+        return _mock_get_workbook_inputs(self.wizard_state, {mws.InputNames.study_name.value: [b"my_study"]})
+
+    def _run_job(self, is_resumed):
+        job = self.settings["generation_jobs"].create()
+        workbook_inputs = self._get_workbook_inputs()
+        self.io_loop.run_sync(lambda: mwserver._run_generation_job(self.settings, job, workbook_inputs, is_resumed))
+        return job
+
+    def test_resumed_job_uses_completed_workbook(self):
+        obs = self._run_job(is_resumed=True)
+
+        self.assertEqual(qiimp.generation_jobs.DONE_STATE, obs.state)
+        self.assertEqual("my_study_1234.xlsx", obs.generated_workbook.file_name)
+        self.assertEqual([], self.workbook_generator.generate_calls)
+
+    def test_fresh_job_is_generated(self):
+        obs = self._run_job(is_resumed=False)
+
+        self.assertEqual(qiimp.generation_jobs.DONE_STATE, obs.state)
+        self.assertEqual("my_study.xlsx", obs.generated_workbook.file_name)
+        self.assertEqual([("my_study", None)], self.workbook_generator.generate_calls)
+
+    def test_resumed_job_with_changed_build_settings_is_generated(self):
+        # as if the server had been restarted with a changed setting: neither the workbook cache nor the job store
+        # may hand out the workbook built with the old one
+        old_fingerprint = self._get_workbook_inputs().fingerprint
+        self.settings["workbook_cache"].max_entries = 10
+        self.settings["workbook_cache"].put(old_fingerprint,
+                                            qiimp.xlsx_builder.GeneratedWorkbook("my_study_1234.xlsx", None))
+        changed_settings = [(self.wizard_state, "static_grid_layout", "hidden_sheet"),
+                            (self.wizard_state, "rank_strategy", "running_count"),
+                            (self.wizard_state, "workbook_output_mode", "memory"),
+                            (qiimp.xlsx_builder, "DEFAULT_NUM_ALLOWABLE_SAMPLES", 5000)]
+        for curr_obj, curr_attr_name, curr_value in changed_settings:
+            with self.subTest(setting=curr_attr_name), mock.patch.object(curr_obj, curr_attr_name, curr_value):
+                self.workbook_generator.generate_calls = []
+                new_fingerprint = self._get_workbook_inputs().fingerprint
+
+                self.assertNotEqual(old_fingerprint, new_fingerprint)
+                self.assertIsNone(self.settings["workbook_cache"].get(new_fingerprint))
+                self.assertIsNone(self.io_loop.run_sync(
+                    lambda: mwserver._find_completed_workbook(self.settings, new_fingerprint)))
+                obs = self._run_job(is_resumed=True)
+                self.assertEqual("my_study.xlsx", obs.generated_workbook.file_name)
+                self.assertEqual([("my_study", None)], self.workbook_generator.generate_calls)
+
+
+class TestGetNumGenerationWorkers(TestCase):
+    def test_get_num_generation_workers(self):
+        wizard_state = mock.Mock(generation_workers=0)
+        with mock.patch("os.cpu_count", return_value=8):
+            # one per cpu, shared among the server processes
+            self.assertEqual(0, mwserver._get_num_generation_workers(wizard_state, 1))
+            self.assertEqual(4, mwserver._get_num_generation_workers(wizard_state, 2))
+            self.assertEqual(1, mwserver._get_num_generation_workers(wizard_state, 8))
+            self.assertEqual(1, mwserver._get_num_generation_workers(wizard_state, 16))
+
+            # an explicit number is left alone
+            wizard_state.generation_workers = 3
+            self.assertEqual(3, mwserver._get_num_generation_workers(wizard_state, 2))
+
+
+if __name__ == '__main__':
+    main()
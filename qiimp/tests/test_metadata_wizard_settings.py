@@ -0,0 +1,51 @@
+from unittest import main, TestCase
+import os
+import tempfile
+
+import qiimp.metadata_wizard_settings as mws
+
+
+class TestMetadataWizardState(TestCase):
+    def setUp(self):
+        self.wizard_state = mws.MetadataWizardState()
+        self.wizard_state.set_up(False)
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def _load_config_with(self, key, value):
+        # read a copy of the real config, with the key's value in the LOCAL section changed
+        with open(os.path.join(self.wizard_state.settings_dir_path, "config.txt")) as f:
+            config_lines = f.read().splitlines()
+        local_index = config_lines.index("[LOCAL]")
+        key_index = next(x for x in range(local_index, len(config_lines)) if config_lines[x].startswith(key + ":"))
+        config_lines[key_index] = "{0}: {1}".format(key, value)
+        with open(os.path.join(self.temp_dir.name, "config.txt"), "w") as f:
+            f.write("\n".join(config_lines))
+
+        self.wizard_state.settings_dir_path = self.temp_dir.name
+        self.wizard_state._get_config_values(False)
+
+    def test_static_grid_layout(self):
+        self._load_config_with("static_grid_layout", "hidden_sheet")
+        self.assertEqual(mws.StaticGridLayouts.hidden_sheet.value, self.wizard_state.static_grid_layout)
+
+        with self.assertRaisesRegex(ValueError, "Unrecognized static_grid_layout 'hidden-sheet' in config"):
+            self._load_config_with("static_grid_layout", "hidden-sheet")
+
+    def test_rank_strategy(self):
+        self._load_config_with("rank_strategy", "running_count")
+        self.assertEqual(mws.RankStrategies.running_count.value, self.wizard_state.rank_strategy)
+
+        with self.assertRaisesRegex(ValueError, "Unrecognized rank_strategy 'countiff' in config"):
+            self._load_config_with("rank_strategy", "countiff")
+
+    def test_workbook_output_mode(self):
+        self._load_config_with("workbook_output_mode", "memory")
+        self.assertEqual(mws.WorkbookOutputModes.memory.value, self.wizard_state.workbook_output_mode)
+
+        with self.assertRaisesRegex(ValueError, "Unrecognized workbook_output_mode 'in_memory' in config"):
+            self._load_config_with("workbook_output_mode", "in_memory")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+from unittest import main, TestCase
+
+import qiimp.multipart_stream_parser as msp
+
+_BOUNDARY = "----qiimpTestBoundary7MA4YWxk"
+_CONTENT_TYPE = "multipart/form-data; boundary={0}".format(_BOUNDARY)
+
+
+def _make_body(file_bytes):
+    return b"".join([
+        b"preamble to be ignored\r\n",
+        "--{0}\r\n".format(_BOUNDARY).encode(),
+        b'Content-Disposition: form-data; name="merge_id"\r\n\r\n',
+        b"12345\r\n",
+        "--{0}\r\n".format(_BOUNDARY).encode(),
+        b'Content-Disposition: form-data; name="files[]"; filename="my study.xlsx"\r\n',
+        b"Content-Type: application/vnd.openxmlformats-officedocument.spreadsheetml.sheet\r\n\r\n",
+        file_bytes,
+        "\r\n--{0}--\r\n".format(_BOUNDARY).encode()
+    ])
+
+
+class TestMultipartStreamParser(TestCase):
+    def setUp(self):
+        # includes line breaks and partial boundaries, which must be treated as plain data
+        self.file_bytes = (b"PK\x03\x04 binary \r\n--" + _BOUNDARY[:10].encode() + b"\r\n") * 500
+
+    def _parse(self, body, chunk_size, spool_max_memory_bytes=1024 * 1024):
+        parser = msp.MultipartStreamParser(_CONTENT_TYPE, spool_max_memory_bytes)
+        self.addCleanup(parser.close)
+        for start_index in range(0, len(body), chunk_size):
+            parser.data_received(body[start_index:start_index + chunk_size])
+        parser.finish()
+        return parser
+
+    def test_data_received_any_chunk_size(self):
+        body = _make_body(self.file_bytes)
+        for curr_chunk_size in [1, 7, 64, 4096, len(body)]:
+            parser = self._parse(body, curr_chunk_size)
+            self.assertEqual({"merge_id": [b"12345"]}, parser.arguments)
+            uploaded_file = parser.files["files[]"][0]
+            self.assertEqual("my study.xlsx", uploaded_file.filename)
+            self.assertEqual(self.file_bytes, uploaded_file.spool.read())
+
+    def test_data_received_spools_to_disk(self):
+        parser = self._parse(_make_body(self.file_bytes), 1000, spool_max_memory_bytes=100)
+        spool = parser.files["files[]"][0].spool
+        self.assertTrue(spool._rolled)
+        self.assertEqual(self.file_bytes, spool.read())
+
+        parser.close()
+        self.assertTrue(spool.closed)
+
+    def test_finish_truncated_body(self):
+        parser = msp.MultipartStreamParser(_CONTENT_TYPE, 1024)
+        self.addCleanup(parser.close)
+        parser.data_received(_make_body(self.file_bytes)[:-50])
+        with self.assertRaisesRegex(msp.MultipartParseError, "before its final boundary"):
+            parser.finish()
+
+    def test_data_received_bad_part_headers(self):
+        bad_headers_list = [
+            b'Content-Disposition: form-data; name="files[]"; filename="\xe9tude.xlsx"',
+            b'Content-Disposition form-data; name="files[]"'
+        ]
+        for curr_headers in bad_headers_list:
+            parser = msp.MultipartStreamParser(_CONTENT_TYPE, 1024)
+            self.addCleanup(parser.close)
+            with self.assertRaises(msp.MultipartParseError):
+                parser.data_received("--{0}\r\n".format(_BOUNDARY).encode() + curr_headers + b"\r\n\r\ndata")
+
+    def test_init_not_multipart(self):
+        with self.assertRaises(msp.MultipartParseError):
+            msp.MultipartStreamParser("application/x-www-form-urlencoded", 1024)
+
+
+if __name__ == '__main__':
+    main()
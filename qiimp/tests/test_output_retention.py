@@ -0,0 +1,86 @@
+from unittest import main, mock, TestCase
+import asyncio
+import os
+import tempfile
+import threading
+
+import tornado.testing
+
+import qiimp.output_retention as ore
+
+
+class TestOutputRetention(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.now = 1000000000
+
+        # file_0 is the least recently used, file_4 the most
+        for file_index in range(5):
+            self._make_file("file_{0}.xlsx".format(file_index), 100, self.now - (5 - file_index) * 3600)
+        self._make_file("placeholder.txt", 0, self.now - 100 * 3600)
+
+    def _make_file(self, file_name, size, last_used_time):
+        file_path = os.path.join(self.temp_dir.name, file_name)
+        with open(file_path, "wb") as f:
+            f.write(b"x" * size)
+        os.utime(file_path, (last_used_time, last_used_time))
+
+    def _get_remaining_file_names(self):
+        return sorted(os.listdir(self.temp_dir.name))
+
+    def test_enforce_max_num_files(self):
+        retention = ore.OutputRetention(self.temp_dir.name, max_num_files=3)
+        retention.enforce(now=self.now)
+        self.assertEqual(["file_2.xlsx", "file_3.xlsx", "file_4.xlsx", "placeholder.txt"],
+                         self._get_remaining_file_names())
+        stats = retention.get_stats()
+        self.assertEqual((3, 300, 2, 200), (stats["num_files"], stats["total_bytes"], stats["num_evicted_files"],
+                                            stats["num_evicted_bytes"]))
+
+    def test_enforce_max_total_bytes_and_age(self):
+        retention = ore.OutputRetention(self.temp_dir.name, max_total_bytes=350, max_age_seconds=4.5 * 3600)
+        retention.enforce(now=self.now)
+        # file_0 is too old, and file_1 must go to get under the size limit
+        self.assertEqual(["file_2.xlsx", "file_3.xlsx", "file_4.xlsx", "placeholder.txt"],
+                         self._get_remaining_file_names())
+
+    def test_enforce_keeps_new_files(self):
+        self._make_file("brand_new.xlsx", 1000, self.now - 60)
+        retention = ore.OutputRetention(self.temp_dir.name, max_total_bytes=1, max_num_files=1)
+        retention.enforce(now=self.now)
+        self.assertEqual(["brand_new.xlsx", "placeholder.txt"], self._get_remaining_file_names())
+
+    def test_enforce_no_limits(self):
+        retention = ore.OutputRetention(self.temp_dir.name)
+        retention.enforce(now=self.now)
+        self.assertEqual(6, len(self._get_remaining_file_names()))
+        self.assertEqual(0, retention.get_stats()["num_evicted_files"])
+
+
+class TestOutputRetentionStart(tornado.testing.AsyncTestCase):
+    @tornado.testing.gen_test
+    async def test_start_runs_off_the_ioloop(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        retention = ore.OutputRetention(temp_dir.name)
+        enforcing_threads = []
+        real_enforce = retention.enforce
+
+        def record_enforce():
+            enforcing_threads.append(threading.current_thread())
+            real_enforce()
+
+        with mock.patch.object(retention, "enforce", side_effect=record_enforce):
+            retention.start(0.01)
+            self.addCleanup(retention.stop)
+            while retention.num_runs < 3:
+                await asyncio.sleep(0.01)
+
+        self.assertNotIn(threading.current_thread(), enforcing_threads)
+        retention.stop()
+        self.assertIsNone(retention._periodic_callback)
+
+
+if __name__ == '__main__':
+    main()
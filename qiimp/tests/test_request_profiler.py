@@ -0,0 +1,60 @@
+import os
+import pstats
+import shutil
+import tempfile
+import time
+from unittest import main, TestCase
+
+import qiimp.request_profiler as rp
+
+
+def _spin(seconds):
+    end_time = time.perf_counter() + seconds
+    while time.perf_counter() < end_time:
+        pass
+    return "spun"
+
+
+class TestRequestProfiler(TestCase):
+    def setUp(self):
+        self.temp_dir_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir_path)
+
+    def test_make_profile_file_base(self):
+        output_dir_path = os.path.join(self.temp_dir_path, "profiles")
+        obs = rp.make_profile_file_base(output_dir_path, "MainHandler", ("human", "stool; or not"), 123)
+
+        self.assertTrue(os.path.isdir(output_dir_path))
+        self.assertEqual(output_dir_path, os.path.dirname(obs))
+        self.assertTrue(os.path.basename(obs).endswith("_MainHandler_human_stool-or-not_123fields"))
+
+    def test_profile_call(self):
+        profile_file_base = os.path.join(self.temp_dir_path, "test")
+        obs = rp.profile_call(lambda: _spin(0.2), profile_file_base)
+        self.assertEqual("spun", obs)
+
+        stats = pstats.Stats(profile_file_base + rp.PROFILE_STATS_EXTENSION)
+        self.assertIn("_spin", [x[2] for x in stats.stats])
+
+        with open(profile_file_base + rp.COLLAPSED_STACKS_EXTENSION) as f:
+            collapsed_lines = f.read().splitlines()
+        self.assertTrue(collapsed_lines)
+        for curr_line in collapsed_lines:
+            curr_stack, curr_count = curr_line.rsplit(" ", 1)
+            self.assertNotIn(" ", curr_stack)
+            self.assertGreater(int(curr_count), 0)
+        self.assertTrue(any("_spin(test_request_profiler.py:" in x for x in collapsed_lines))
+
+    def test_profile_call_error(self):
+        # the profiles are saved even if the profiled call fails
+        profile_file_base = os.path.join(self.temp_dir_path, "test")
+        with self.assertRaises(ZeroDivisionError):
+            rp.profile_call(lambda: 1 / 0, profile_file_base)
+        self.assertTrue(os.path.exists(profile_file_base + rp.PROFILE_STATS_EXTENSION))
+        self.assertTrue(os.path.exists(profile_file_base + rp.COLLAPSED_STACKS_EXTENSION))
+
+
+if __name__ == '__main__':
+    main()
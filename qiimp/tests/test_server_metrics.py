@@ -0,0 +1,109 @@
+from unittest import main, mock, TestCase
+import os
+import tempfile
+
+import qiimp.server_metrics as sm
+
+
+class TestHistogram(TestCase):
+    def test_observe(self):
+        histogram = sm.Histogram([1, 5])
+        for curr_value in [0.5, 1, 3, 10]:
+            histogram.observe(curr_value)
+
+        self.assertEqual([(1, 2), (5, 3), (float("inf"), 4)], histogram.get_cumulative_counts())
+        self.assertEqual(4, histogram.count)
+        self.assertEqual(14.5, histogram.sum)
+
+
+class TestServerMetrics(TestCase):
+    def _make_handler(self, handler_class_name, method, status, request_seconds):
+        handler = type(handler_class_name, (mock.Mock,), {})()
+        handler.request.method = method
+        handler.request.request_time.return_value = request_seconds
+        handler.get_status.return_value = status
+        return handler
+
+    def test_render(self):
+        metrics = sm.ServerMetrics(123)
+        metrics.observe_request(self._make_handler("PackageHandler", "GET", 200, 0.003))
+        metrics.observe_request(self._make_handler("PackageHandler", "GET", 304, 0.001))
+        metrics.observe_request(self._make_handler("MainHandler", "POST", 500, 2))
+        metrics.observe_build({"metadata_grid": 0.2, "zip_close": 1.5}, 1.8)
+
+        obs = metrics.render({"workbook_cache": {"num_hits": 1, "num_misses": 3, "num_entries": 2},
+                              "generation_admission": {"num_queued": 4}})
+        obs_lines = obs.splitlines()
+
+        self.assertIn('qiimp_http_requests_total{handler="PackageHandler",method="GET",pid="123",status="304"} 1',
+                      obs_lines)
+        self.assertIn('qiimp_http_request_duration_seconds_bucket{handler="PackageHandler",le="0.005",method="GET",'
+                      'pid="123"} 2', obs_lines)
+        self.assertIn('qiimp_http_request_duration_seconds_count{handler="MainHandler",method="POST",pid="123"} 1',
+                      obs_lines)
+        self.assertIn('qiimp_workbook_build_phase_seconds_bucket{le="0.25",phase="metadata_grid",pid="123"} 1',
+                      obs_lines)
+        self.assertIn('qiimp_workbook_build_phase_seconds_bucket{le="+Inf",phase="zip_close",pid="123"} 1',
+                      obs_lines)
+        self.assertIn('qiimp_workbook_build_seconds_sum{pid="123"} 1.8', obs_lines)
+        self.assertIn("# TYPE qiimp_workbook_cache_hits_total counter", obs_lines)
+        self.assertIn('qiimp_workbook_cache_hits_total{pid="123"} 1', obs_lines)
+        self.assertIn('qiimp_workbook_cache_entries{pid="123"} 2', obs_lines)
+        self.assertIn('qiimp_workbook_cache_hit_ratio{pid="123"} 0.25', obs_lines)
+        self.assertIn('qiimp_generation_admission_queued{pid="123"} 4', obs_lines)
+        # stats that weren't given are just left out
+        self.assertNotIn("qiimp_output_retention_total_bytes", obs)
+        self.assertTrue(obs.endswith("\n"))
+
+    def test_render_other_processes(self):
+        metrics = sm.ServerMetrics(123)
+        metrics.observe_build({"metadata_grid": 0.2}, 1.8)
+        other_metrics = sm.ServerMetrics(456)
+        other_metrics.observe_build({"metadata_grid": 0.3}, 2.5)
+
+        obs_lines = metrics.render({}, [other_metrics.get_families({})]).splitlines()
+        # each metric's header appears once, followed by the samples of every process
+        self.assertEqual(1, obs_lines.count("# TYPE qiimp_workbook_build_seconds histogram"))
+        header_index = obs_lines.index("# TYPE qiimp_workbook_build_seconds histogram")
+        self.assertEqual(2 * (len(sm._BUILD_SECONDS_BUCKETS) + 3),
+                         len([x for x in obs_lines[header_index + 1:] if not x.startswith("#")
+                              and x.startswith("qiimp_workbook_build_seconds_")]))
+        self.assertIn('qiimp_workbook_build_seconds_sum{pid="123"} 1.8', obs_lines)
+        self.assertIn('qiimp_workbook_build_seconds_sum{pid="456"} 2.5', obs_lines)
+
+
+class TestMetricsSnapshots(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.dir_path = os.path.join(self.temp_dir.name, "metrics")
+
+    def test_write_and_read_others(self):
+        snapshots = sm.MetricsSnapshots(self.dir_path, 123, max_age_seconds=60)
+        other_snapshots = sm.MetricsSnapshots(self.dir_path, 456, max_age_seconds=60)
+        self.assertEqual([], snapshots.read_others())
+
+        metrics = sm.ServerMetrics(456)
+        metrics.observe_build({"metadata_grid": 0.2}, 1.8)
+        other_families = metrics.get_families({"workbook_cache": {"num_hits": 1, "num_misses": 1}})
+        other_snapshots.write({"workbook_cache": {"num_hits": 1, "num_misses": 1}}, other_families)
+        snapshots.write({}, [])
+        with open(os.path.join(self.dir_path, "789.json"), "w") as f:
+            f.write("{not json")
+
+        # a process doesn't see its own snapshot, and a broken one is skipped
+        obs = snapshots.read_others()
+        self.assertEqual([456], [x.pid for x in obs])
+        self.assertEqual({"workbook_cache": {"num_hits": 1, "num_misses": 1}}, obs[0].stats_by_group)
+        self.assertEqual(other_families, obs[0].families)
+        self.assertEqual([123], [x.pid for x in other_snapshots.read_others()])
+
+        # an old snapshot is from a process that is gone
+        self.assertEqual([], snapshots.read_others(now=obs[0].snapshot_time + 61))
+
+        other_snapshots.remove()
+        self.assertEqual([], snapshots.read_others())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import asyncio
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import main, mock, TestCase
+
+import tornado.ioloop
+import tornado.testing
+
+import qiimp.server_supervisor as ss
+
+
+class TestInFlightRequestTracker(tornado.testing.AsyncTestCase):
+    @tornado.testing.gen_test
+    async def test_wait_until_idle(self):
+        tracker = ss.InFlightRequestTracker()
+        self.assertTrue(await tracker.wait_until_idle(1))
+
+        tracker.start_request()
+        tracker.start_request()
+        self.io_loop.call_later(0.01, tracker.finish_request)
+        self.io_loop.call_later(0.02, tracker.finish_request)
+        self.assertTrue(await tracker.wait_until_idle(5))
+        self.assertEqual(0, tracker.num_in_flight)
+
+    @tornado.testing.gen_test
+    async def test_wait_until_idle_timeout(self):
+        tracker = ss.InFlightRequestTracker()
+        tracker.start_request()
+        self.assertFalse(await tracker.wait_until_idle(0.01))
+        self.assertEqual(1, tracker.num_in_flight)
+
+
+class TestRunWorker(TestCase):
+    def setUp(self):
+        self.asyncio_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.asyncio_loop)
+        self.io_loop = tornado.ioloop.IOLoop.current()
+        self.server = mock.Mock()
+        self.tracker = ss.InFlightRequestTracker()
+        self.events = []
+
+    def tearDown(self):
+        # NB: SIGINT rather than SIGTERM in these tests, so a handler that somehow wasn't installed can't kill the run
+        for curr_signal in [signal.SIGTERM, signal.SIGINT]:
+            self.asyncio_loop.remove_signal_handler(curr_signal)
+        self.asyncio_loop.close()
+        asyncio.set_event_loop(None)
+
+    def _send_sigint(self):
+        self.events.append("signal")
+        os.kill(os.getpid(), signal.SIGINT)
+
+    def _finish_request(self):
+        self.events.append("request finished")
+        self.tracker.finish_request()
+
+    def test_run_worker_drains_then_stops(self):
+        self.tracker.start_request()
+        self.io_loop.call_later(0.01, self._send_sigint)
+        self.io_loop.call_later(0.1, self._finish_request)
+
+        ss.run_worker(self.server, self.tracker, 5, on_stopped=lambda: self.events.append("stopped"))
+        self.server.stop.assert_called_once_with()
+        self.assertEqual(["signal", "request finished", "stopped"], self.events)
+
+    def test_run_worker_drain_timeout(self):
+        # a request that never finishes doesn't keep the worker from stopping
+        self.tracker.start_request()
+        self.io_loop.call_later(0.01, self._send_sigint)
+
+        with mock.patch("sys.stderr") as mock_stderr:
+            ss.run_worker(self.server, self.tracker, 0.05, on_stopped=lambda: self.events.append("stopped"))
+        self.server.stop.assert_called_once_with()
+        self.assertEqual(["signal", "stopped"], self.events)
+        self.assertEqual(1, self.tracker.num_in_flight)
+        self.assertTrue(mock_stderr.write.called)
+
+
+# run in its own python process, since the supervisor takes over that process's signal handling and forks it
+_SUPERVISOR_SCRIPT = """
+import os
+import sys
+import time
+
+import qiimp.server_supervisor as ss
+
+out_dir_path = sys.argv[1]
+
+
+def run_worker():
+    open(os.path.join(out_dir_path, "started", str(os.getpid())), "w").close()
+    # the first worker to start dies at once, to be restarted by the supervisor
+    try:
+        os.close(os.open(os.path.join(out_dir_path, "died"), os.O_CREAT | os.O_EXCL))
+        os._exit(3)
+    except FileExistsError:
+        pass
+    # the others run until the supervisor passes on the SIGTERM, which (by default) kills them
+    time.sleep(60)
+
+
+ss.supervise_workers(2, run_worker, 1)
+print("supervisor done")
+"""
+
+
+class TestSuperviseWorkers(TestCase):
+    def setUp(self):
+        self.temp_dir_path = tempfile.mkdtemp()
+        self.started_dir_path = os.path.join(self.temp_dir_path, "started")
+        os.mkdir(self.started_dir_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir_path)
+
+    def _wait_for_num_started(self, num_started):
+        deadline = time.time() + 10
+        while len(os.listdir(self.started_dir_path)) < num_started and time.time() < deadline:
+            time.sleep(0.05)
+        return os.listdir(self.started_dir_path)
+
+    def test_supervise_workers(self):
+        repo_dir_path = os.path.dirname(os.path.dirname(os.path.abspath(ss.__file__)))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([repo_dir_path, os.environ.get("PYTHONPATH", "")]))
+        supervisor = subprocess.Popen([sys.executable, "-c", _SUPERVISOR_SCRIPT, self.temp_dir_path], env=env,
+                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        try:
+            # two workers, plus the restart of the one that died
+            started_pids = self._wait_for_num_started(3)
+            self.assertEqual(3, len(started_pids))
+
+            supervisor.send_signal(signal.SIGTERM)
+            out, err = supervisor.communicate(timeout=10)
+        finally:
+            if supervisor.poll() is None:
+                supervisor.kill()
+                supervisor.communicate()
+
+        self.assertEqual(0, supervisor.returncode, err)
+        self.assertEqual("supervisor done\n", out)
+        self.assertEqual(1, err.count("restarting it"))
+        for curr_pid in started_pids:
+            with self.assertRaises(ProcessLookupError):
+                os.kill(int(curr_pid), 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+import io
+import os
+import sys
+from unittest import main, mock, skipUnless, TestCase
+
+import qiimp.metadata_wizard_settings as mws
+import qiimp.workbook_benchmark as wb
+import qiimp.xlsx_builder as xb
+import qiimp.xlsx_static_grid_builder as xsgb
+
+
+class TestWorkbookBenchmark(TestCase):
+    def setUp(self):
+        self.regex_handler = mws.RegexHandler(os.path.join(os.path.dirname(mws.__file__), "settings",
+                                                           "regex_definitions.yaml"))
+        self.base_schema = {"sample_name": {"type": "string", "unique": True, "required": True, "empty": False,
+                                            "is_phi": False}}
+
+    def test_make_synthetic_schema(self):
+        obs_schema, obs_form_dict = wb.make_synthetic_schema(self.base_schema, 20, 300, self.regex_handler)
+
+        self.assertEqual(20, len(obs_schema))
+        self.assertEqual(19, len(obs_form_dict))
+        self.assertIs(self.base_schema["sample_name"], obs_schema["sample_name"])
+        # every kind of field is in there
+        for curr_kind in wb._SYNTHETIC_FIELD_KINDS:
+            self.assertIn("synthetic_{0}_{1}".format(curr_kind, wb._SYNTHETIC_FIELD_KINDS.index(curr_kind)),
+                          obs_schema)
+
+        self.assertEqual(300, len(obs_schema["synthetic_large_categorical_4"]["allowed"]))
+        self.assertEqual(5, len(obs_schema["synthetic_categorical_1"]["allowed"]))
+        self.assertTrue(obs_schema["synthetic_unique_text_7"]["unique"])
+        self.assertNotIn("unique", obs_schema["synthetic_text_0"])
+        self.assertEqual({"type": "integer", "min": "0", "max_exclusive": "1000"},
+                         {k: v for k, v in obs_schema["synthetic_integer_2"].items() if k in ["type", "min",
+                                                                                             "max_exclusive"]})
+        # datetimes are checked by regex, and may be left missing
+        datetime_schemas = obs_schema["synthetic_datetime_3"]["anyof"]
+        self.assertEqual(["not collected", "not provided"], datetime_schemas[0]["allowed"])
+        self.assertEqual("datetime", datetime_schemas[1]["type"])
+        self.assertIn("regex", datetime_schemas[1])
+
+    def test_get_cases(self):
+        obs = wb._get_cases(["human:stool"], [10, 600], [1000, 10000], 500)
+
+        self.assertEqual(["package-human-stool_samples1000", "synthetic-10fields_samples1000",
+                          "synthetic-600fields_samples1000", "package-human-stool_samples10000",
+                          "synthetic-10fields_samples10000", "synthetic-600fields_samples10000"],
+                         [x["name"] for x in obs])
+        self.assertEqual(["human", "stool"], obs[0]["package_key"])
+        self.assertEqual((600, 500, 10000), (obs[5]["num_fields"], obs[5]["categorical_size"],
+                                             obs[5]["num_allowable_samples"]))
+        self.assertEqual({("inline", "countif")}, set((x["static_grid_layout"], x["rank_strategy"]) for x in obs))
+
+    def test_get_cases_static_grid_layouts(self):
+        obs = wb._get_cases(["human:stool"], [10], [1000], 500, ["inline", "hidden_sheet"])
+
+        self.assertEqual(["package-human-stool_samples1000", "package-human-stool_samples1000_hidden_sheet",
+                          "synthetic-10fields_samples1000", "synthetic-10fields_samples1000_hidden_sheet"],
+                         [x["name"] for x in obs])
+        self.assertEqual(["inline", "hidden_sheet", "inline", "hidden_sheet"],
+                         [x["static_grid_layout"] for x in obs])
+        self.assertEqual((10, 500, 1000), (obs[3]["num_fields"], obs[3]["categorical_size"],
+                                           obs[3]["num_allowable_samples"]))
+
+    def test_get_cases_rank_strategies(self):
+        obs = wb._get_cases(["human:stool"], [], [1000], 500, ["inline", "hidden_sheet"], ["countif", "running_count"])
+
+        self.assertEqual(["package-human-stool_samples1000", "package-human-stool_samples1000_running_count",
+                          "package-human-stool_samples1000_hidden_sheet",
+                          "package-human-stool_samples1000_hidden_sheet_running_count"],
+                         [x["name"] for x in obs])
+        self.assertEqual([("inline", "countif"), ("inline", "running_count"), ("hidden_sheet", "countif"),
+                          ("hidden_sheet", "running_count")],
+                         [(x["static_grid_layout"], x["rank_strategy"]) for x in obs])
+
+    def test_describe_result_with_baseline(self):
+        baseline_results_by_name = wb._get_median_results_by_name([
+            {"name": "a", "wall_seconds": 10, "peak_rss_bytes": 100},
+            {"name": "a", "wall_seconds": 20, "peak_rss_bytes": 300},
+            {"name": "a", "wall_seconds": 12, "peak_rss_bytes": 200},
+            {"name": "a", "error": "oops"}])
+        self.assertEqual({"a": {"wall_seconds": 12, "peak_rss_bytes": 200}}, baseline_results_by_name)
+
+        obs = wb._describe_result({"name": "a", "wall_seconds": 9, "peak_rss_bytes": 250 * 2 ** 20,
+                                   "num_formulas": 1234, "output_bytes": 3 * 2 ** 20},
+                                  {"wall_seconds": 12, "peak_rss_bytes": 200 * 2 ** 20})
+        self.assertEqual("a: 9.00s, peak RSS 250 MB, 1234 formulas, 3.0 MB (time -25.0%, peak RSS +25.0% vs. "
+                         "baseline)", obs)
+
+    def test_describe_result_with_recalculation(self):
+        baseline_results_by_name = wb._get_median_results_by_name([
+            {"name": "a", "wall_seconds": 10, "peak_rss_bytes": 100, "recalculation_seconds": 4},
+            {"name": "a", "wall_seconds": 20, "peak_rss_bytes": 300, "recalculation_seconds": 2},
+            {"name": "a", "wall_seconds": 12, "peak_rss_bytes": 200, "recalculation_seconds": 3},
+            {"name": "b", "wall_seconds": 10, "peak_rss_bytes": 100, "recalculation_seconds": 4},
+            {"name": "b", "wall_seconds": 12, "peak_rss_bytes": 200}])
+        self.assertEqual({"a": {"wall_seconds": 12, "peak_rss_bytes": 200, "recalculation_seconds": 3},
+                          "b": {"wall_seconds": 11, "peak_rss_bytes": 150}}, baseline_results_by_name)
+
+        obs = wb._describe_result({"name": "a", "wall_seconds": 9, "peak_rss_bytes": 250 * 2 ** 20,
+                                   "num_formulas": 1234, "output_bytes": 3 * 2 ** 20, "recalculation_seconds": 1.5},
+                                  {"wall_seconds": 12, "peak_rss_bytes": 200 * 2 ** 20, "recalculation_seconds": 3})
+        self.assertEqual("a: 9.00s, peak RSS 250 MB, 1234 formulas, 3.0 MB, rank recalculation 1.50s (time -25.0%, "
+                         "peak RSS +25.0%, rank recalculation -50.0% vs. baseline)", obs)
+
+    def test_parse_cmd_line_args_recalculate_without_pycel(self):
+        with mock.patch.object(wb, "pycel", None), \
+                mock.patch.object(sys, "argv", ["benchmark_qiimp_workbooks", "--recalculate"]), \
+                mock.patch("sys.stderr", io.StringIO()) as stderr:
+            with self.assertRaises(SystemExit):
+                wb._parse_cmd_line_args()
+        self.assertIn("--recalculate needs pycel", stderr.getvalue())
+
+
+@skipUnless(wb.pycel is not None, "pycel is not installed")
+class TestTimeRankRecalculation(TestCase):
+    def setUp(self):
+        self.wizard_state = mws.MetadataWizardState()
+        self.wizard_state.set_up(False)
+        base_schema = {"sample_name": {"type": "string", "unique": True, "required": True, "empty": False,
+                                       "is_phi": False}}
+        self.schema_dict, self.form_dict = wb.make_synthetic_schema(base_schema, 6, 5,
+                                                                    self.wizard_state.regex_handler)
+
+    def test_time_rank_recalculation(self):
+        for curr_layout in [xsgb.INLINE_LAYOUT, xsgb.HIDDEN_SHEET_LAYOUT]:
+            for curr_rank_strategy in [xsgb.COUNTIF_RANK_STRATEGY, xsgb.RUNNING_COUNT_RANK_STRATEGY]:
+                with self.subTest(static_grid_layout=curr_layout, rank_strategy=curr_rank_strategy):
+                    output_stream = io.BytesIO()
+                    xb.write_workbook("my study", self.schema_dict, self.form_dict, self.wizard_state,
+                                      output_stream=output_stream, num_allowable_samples=10,
+                                      static_grid_layout=curr_layout, rank_strategy=curr_rank_strategy)
+                    output_stream.seek(0)
+
+                    obs = wb.time_rank_recalculation(output_stream, len(self.schema_dict),
+                                                     self.wizard_state.regex_handler, 10, curr_layout,
+                                                     curr_rank_strategy)
+                    self.assertGreater(obs, 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+from unittest import main, TestCase
+import os
+import tempfile
+
+import tornado.gen
+import tornado.locks
+import tornado.testing
+
+import qiimp.workbook_cache as wc
+import qiimp.xlsx_builder
+
+
+class _MockWizardState(object):
+    def __init__(self, output_dir_path):
+        self.output_dir_path = output_dir_path
+
+    def get_output_path(self, file_name):
+        return os.path.join(self.output_dir_path, file_name)
+
+
+class TestMakeWorkbookFingerprint(TestCase):
+    def test_make_workbook_fingerprint(self):
+        schema = {"sample_name": {"type": "string", "unique": True}, "ph": {"type": "number", "min": 0}}
+        reordered_schema = {"ph": {"min": 0, "type": "number"}, "sample_name": {"unique": True, "type": "string"}}
+        build_settings = {"static_grid_layout": "inline", "rank_strategy": "countif"}
+        exp = wc.make_workbook_fingerprint("v0.3", schema, {0: {"field_name": "ph"}}, "us", "my study", build_settings)
+
+        self.assertEqual(exp, wc.make_workbook_fingerprint(
+            "v0.3", reordered_schema, {0: {"field_name": "ph"}}, "us", "my study",
+            {"rank_strategy": "countif", "static_grid_layout": "inline"}))
+        self.assertNotEqual(exp, wc.make_workbook_fingerprint(
+            "v0.3", schema, {0: {"field_name": "ph"}}, "us", "my other study", build_settings))
+        self.assertNotEqual(exp, wc.make_workbook_fingerprint(
+            "v0.4", schema, {0: {"field_name": "ph"}}, "us", "my study", build_settings))
+        self.assertNotEqual(exp, wc.make_workbook_fingerprint(
+            "v0.3", schema, {0: {"field_name": "ph"}}, "us", "my study",
+            {"static_grid_layout": "inline", "rank_strategy": "running_count"}))
+
+
+class TestWorkbookCache(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.wizard_state = _MockWizardState(self.temp_dir.name)
+
+    def test_get_and_put_in_memory(self):
+        cache = wc.WorkbookCache(self.wizard_state, max_entries=2, max_bytes=10)
+        first = qiimp.xlsx_builder.GeneratedWorkbook("a.xlsx", b"12345")
+        second = qiimp.xlsx_builder.GeneratedWorkbook("b.xlsx", b"12345")
+        third = qiimp.xlsx_builder.GeneratedWorkbook("c.xlsx", b"1")
+
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", first)
+        cache.put("b", second)
+        self.assertEqual(first, cache.get("a"))
+
+        # over the byte limit, so the least recently used ("b") goes
+        cache.put("c", third)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(first, cache.get("a"))
+        self.assertEqual(third, cache.get("c"))
+        self.assertEqual({"num_entries": 2, "total_bytes": 6, "max_entries": 2, "max_bytes": 10, "num_hits": 3,
+                          "num_misses": 2, "num_evictions": 1, "num_coalesced": 0, "num_in_flight": 0},
+                         cache.get_stats())
+
+    def test_get_on_disk_file_removed(self):
+        cache = wc.WorkbookCache(self.wizard_state, max_entries=2)
+        with open(self.wizard_state.get_output_path("a.xlsx"), "wb") as f:
+            f.write(b"12345")
+        on_disk = qiimp.xlsx_builder.GeneratedWorkbook("a.xlsx", None)
+
+        cache.put("a", on_disk)
+        self.assertEqual(on_disk, cache.get("a"))
+        os.remove(self.wizard_state.get_output_path("a.xlsx"))
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(0, cache.get_stats()["num_entries"])
+
+    def test_put_disabled(self):
+        cache = wc.WorkbookCache(self.wizard_state, max_entries=0)
+        cache.put("a", qiimp.xlsx_builder.GeneratedWorkbook("a.xlsx", b"12345"))
+        self.assertIsNone(cache.get("a"))
+
+
+class TestWorkbookCacheGetOrGenerate(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.num_builds = 0
+        self.build_finished = tornado.locks.Event()
+
+    async def _mock_generate(self):
+        self.num_builds += 1
+        await self.build_finished.wait()
+        return qiimp.xlsx_builder.GeneratedWorkbook("a.xlsx", b"12345")
+
+    @tornado.testing.gen_test
+    async def test_get_or_generate_coalesces(self):
+        cache = wc.WorkbookCache(None, max_entries=2)
+        waiters = [cache.get_or_generate("a", self._mock_generate) for _ in range(3)]
+        self.io_loop.call_later(0.01, self.build_finished.set)
+
+        obs = await tornado.gen.multi(waiters)
+        self.assertEqual(1, self.num_builds)
+        self.assertEqual([qiimp.xlsx_builder.GeneratedWorkbook("a.xlsx", b"12345")] * 3, obs)
+        self.assertEqual(2, cache.get_stats()["num_coalesced"])
+        self.assertEqual(0, cache.get_stats()["num_in_flight"])
+
+        # and once built, it comes from the cache
+        await cache.get_or_generate("a", self._mock_generate)
+        self.assertEqual(1, self.num_builds)
+
+    @tornado.testing.gen_test
+    async def test_get_or_generate_error(self):
+        async def failing_generate():
+            raise ValueError("no workbook for you")
+
+        cache = wc.WorkbookCache(None, max_entries=2)
+        with self.assertRaisesRegex(ValueError, "no workbook for you"):
+            await cache.get_or_generate("a", failing_generate)
+
+        self.build_finished.set()
+        await cache.get_or_generate("a", self._mock_generate)
+        self.assertEqual(1, self.num_builds)
+
+
+if __name__ == '__main__':
+    main()
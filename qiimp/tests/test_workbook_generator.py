@@ -0,0 +1,119 @@
+from unittest import main, mock
+import concurrent.futures.process
+import os
+import threading
+
+import tornado.locks
+import tornado.testing
+
+import qiimp.workbook_generator as wg
+import qiimp.xlsx_builder
+
+
+class TestWorkbookGenerator(tornado.testing.AsyncTestCase):
+    def test_init_unknown_executor(self):
+        with self.assertRaisesRegex(ValueError, "Unrecognized workbook generation executor 'fork'"):
+            wg.WorkbookGenerator(None, "fork")
+
+    @tornado.testing.gen_test
+    async def test_generate_thread_executor(self):
+        calling_threads = []
+
+        def mock_write_workbook(study_name, schema_dict, form_dict, wizard_state, progress_callback=None,
+                                build_tracer=None):
+            calling_threads.append(threading.current_thread())
+            with build_tracer.span("write_metadata_grid"):
+                pass
+            return "{0}_{1}_{2}.xlsx".format(study_name, len(schema_dict), wizard_state)
+
+        generator = wg.WorkbookGenerator("state", wg.THREAD_EXECUTOR, 1)
+        self.addCleanup(generator.shutdown)
+        with mock.patch("qiimp.xlsx_builder.write_workbook", side_effect=mock_write_workbook):
+            obs = await generator.generate("study", {"a": {}, "b": {}}, {})
+
+        self.assertEqual("study_2_state.xlsx", obs.file_name)
+        self.assertIsNone(obs.content)
+        # every build is traced
+        self.assertEqual(["thread_name", "write_metadata_grid"], [x["name"] for x in obs.build_trace["traceEvents"]])
+        # the workbook must not have been built on the IOLoop's thread
+        self.assertNotEqual([threading.current_thread()], calling_threads)
+
+    @tornado.testing.gen_test
+    async def test_generate_memory_output_mode(self):
+        def mock_write_workbook(study_name, schema_dict, form_dict, wizard_state, output_stream=None,
+                                progress_callback=None, build_tracer=None):
+            output_stream.write(b"xlsx bytes")
+            return "study.xlsx"
+
+        generator = wg.WorkbookGenerator("state", wg.THREAD_EXECUTOR, 1, wg.MEMORY_OUTPUT_MODE)
+        self.addCleanup(generator.shutdown)
+        with mock.patch("qiimp.xlsx_builder.write_workbook", side_effect=mock_write_workbook):
+            obs = await generator.generate("study", {}, {})
+
+        self.assertEqual("study.xlsx", obs.file_name)
+        self.assertEqual(b"xlsx bytes", obs.content)
+
+    @tornado.testing.gen_test
+    async def test_generate_progress_thread_executor(self):
+        self._check_generate_progress(await self._generate_with_progress(wg.THREAD_EXECUTOR))
+
+    @tornado.testing.gen_test(timeout=30)
+    async def test_generate_progress_process_executor(self):
+        self._check_generate_progress(await self._generate_with_progress(wg.PROCESS_EXECUTOR))
+
+    @tornado.testing.gen_test(timeout=30)
+    async def test_generate_progress_worker_process_dies(self):
+        def mock_write_workbook(study_name, schema_dict, form_dict, wizard_state, progress_callback=None,
+                                build_tracer=None):
+            os._exit(1)
+
+        generator = wg.WorkbookGenerator("state", wg.PROCESS_EXECUTOR, 1)
+        self.addCleanup(generator.shutdown)
+        with mock.patch("qiimp.xlsx_builder.write_workbook", side_effect=mock_write_workbook):
+            with self.assertRaises(concurrent.futures.process.BrokenProcessPool):
+                await generator.generate("study", {}, {}, progress_callback=lambda x: None)
+
+        # the dead worker never said it was done with the job, but the job's progress target is gone all the same
+        self.assertEqual({}, generator._progress_targets_by_job_key)
+
+    async def _generate_with_progress(self, executor_type):
+        def mock_write_workbook(study_name, schema_dict, form_dict, wizard_state, progress_callback=None,
+                                build_tracer=None):
+            for curr_phase in qiimp.xlsx_builder.BuildPhases:
+                progress_callback(curr_phase)
+            return "study.xlsx"
+
+        reported = []
+        all_reported = tornado.locks.Event()
+
+        def progress_callback(build_phase):
+            # progress must be reported on the IOLoop's thread
+            reported.append((build_phase, threading.current_thread()))
+            if build_phase == qiimp.xlsx_builder.BuildPhases.zip_close:
+                all_reported.set()
+
+        self.build_timings = []
+        generator = wg.WorkbookGenerator("state", executor_type, 1,
+                                         build_timing_callback=lambda *x: self.build_timings.append(x))
+        self.addCleanup(generator.shutdown)
+        # NB: worker processes are forked once there is work for them, so they get the patched function too
+        with mock.patch("qiimp.xlsx_builder.write_workbook", side_effect=mock_write_workbook):
+            obs = await generator.generate("study", {}, {}, progress_callback=progress_callback)
+            await all_reported.wait()
+
+        self.assertEqual("study.xlsx", obs.file_name)
+        return reported
+
+    def _check_generate_progress(self, reported):
+        self.assertEqual(list(qiimp.xlsx_builder.BuildPhases), [x[0] for x in reported])
+        self.assertEqual({threading.current_thread()}, {x[1] for x in reported})
+
+        # every build is timed, phase by phase
+        self.assertEqual(1, len(self.build_timings))
+        phase_seconds_by_phase, total_seconds = self.build_timings[0]
+        self.assertEqual([x.value for x in qiimp.xlsx_builder.BuildPhases], list(phase_seconds_by_phase))
+        self.assertLessEqual(sum(phase_seconds_by_phase.values()), total_seconds)
+
+
+if __name__ == '__main__':
+    main()
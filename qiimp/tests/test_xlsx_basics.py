@@ -0,0 +1,162 @@
+import io
+import os
+import tempfile
+import zipfile
+from unittest import main, mock, TestCase
+
+import openpyxl
+import xlsxwriter
+
+import qiimp.xlsx_basics as xlsxbasics
+
+
+class TestAddressing(TestCase):
+    def test_get_col_letters(self):
+        self.assertEqual(["A", "Z", "AA", "AZ", "BA", "ZZ", "AAA", "XFD"],
+                         [xlsxbasics.get_col_letters(x) for x in [0, 25, 26, 51, 52, 701, 702, 16383]])
+
+    def test_get_col_letters_error(self):
+        for curr_col_index in [-1, 16384]:
+            with self.assertRaisesRegex(ValueError, "16384 columns is not supported"):
+                xlsxbasics.get_col_letters(curr_col_index)
+
+    def test_format_range_single_cell(self):
+        self.assertEqual("AAB12", xlsxbasics.format_range(703, 12))
+        self.assertEqual("Metadata!$B$2", xlsxbasics.format_range(1, 2, last_row_index=2, sheet_name="Metadata",
+                                                                  first_col_fixed=True, first_row_fixed=True,
+                                                                  last_row_fixed=True))
+        # not actually a single cell, because the two halves are fixed differently
+        self.assertEqual("B$2:B2", xlsxbasics.format_range(1, 2, first_row_fixed=True))
+        self.assertEqual("$B2:B2", xlsxbasics.format_range(1, 2, first_col_fixed=True, last_col_fixed=False))
+
+    def test_format_range(self):
+        self.assertEqual("$ZZ$2:$XFD$1001", xlsxbasics.format_range(701, 2, 16383, 1001, first_col_fixed=True,
+                                                                     first_row_fixed=True, last_col_fixed=True,
+                                                                     last_row_fixed=True))
+        self.assertEqual("Metadata!B:B", xlsxbasics.format_range(1, None, sheet_name="Metadata"))
+
+
+class TestRowMajorSheetPlan(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.temp_dir.name, "test.xlsx")
+        self.workbook = xlsxwriter.Workbook(self.file_path, {"constant_memory": True})
+        self.worksheet = self.workbook.add_worksheet("sheet")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_write_rows_order(self):
+        written_cells = []
+
+        def write_cell(col_letter, row_index):
+            written_cells.append("{0}{1}".format(col_letter, row_index))
+
+        plan = xlsxbasics.RowMajorSheetPlan(self.worksheet)
+        plan.add_col_run(2, 4, lambda x: write_cell("B", x))
+        plan.add_cell(10, write_cell, "A", 10)
+        plan.add_col_run(3, 3, lambda x: write_cell("C", x))
+        plan.add_cell(1, write_cell, "A", 1)
+        plan.add_col_run(2, 3, lambda x: write_cell("A", x))
+        plan.write_rows()
+
+        self.assertEqual(["A1", "B2", "A2", "B3", "A3", "C3", "B4", "A10"], written_cells)
+
+    def test_write_rows_constant_memory(self):
+        plan = xlsxbasics.RowMajorSheetPlan(self.worksheet)
+        # column by column, as the builders plan them
+        plan.add_cell(1, self.worksheet.write, "A1", "header_a")
+        xlsxbasics.copy_formula_throughout_range(plan, "={curr_col_letter}{curr_row_index}_in_A", 0, 2,
+                                                 last_row_index=4)
+        plan.add_cell(1, self.worksheet.write, "B1", "header_b")
+        full_range = xlsxbasics.copy_formula_throughout_range(plan, "=ROW({cell})*2", 1, 2, last_row_index=4)
+        plan.add_cell(2, self.worksheet.write_array_formula, "C2:C4", "{=ROW(A2:A4)}")
+        plan.write_rows()
+        self.workbook.close()
+
+        self.assertEqual("B2:B4", full_range)
+        worksheet = openpyxl.load_workbook(self.file_path)["sheet"]
+        self.assertEqual("header_a", worksheet["A1"].value)
+        self.assertEqual("header_b", worksheet["B1"].value)
+        self.assertEqual(["=A2_in_A", "=A3_in_A", "=A4_in_A"], [worksheet["A{0}".format(x)].value for x in range(2, 5)])
+        self.assertEqual(["=ROW(B2)*2", "=ROW(B3)*2", "=ROW(B4)*2"],
+                         [worksheet["B{0}".format(x)].value for x in range(2, 5)])
+        self.assertEqual("C2:C4", worksheet["C2"].value.ref)
+
+    def test_write_rows_error(self):
+        self.worksheet.write("A5", "already written")
+        self.worksheet.write("A6", "moves xlsxwriter past row 5")
+
+        plan = xlsxbasics.RowMajorSheetPlan(self.worksheet)
+        plan.add_cell(5, self.worksheet.write, "B5", "too late")
+        with self.assertRaisesRegex(ValueError, "row 5 of worksheet 'sheet'"):
+            plan.write_rows()
+        self.workbook.close()
+
+
+class TestRowFormulaTemplate(TestCase):
+    def test_render_precompiled(self):
+        def make_formula(row_index):
+            cell = xlsxbasics.format_range(1, row_index)
+            return "=IF({0}=\"\",\"\",{0})".format(cell)
+
+        template = xlsxbasics.RowFormulaTemplate(make_formula, [2, 1001])
+        self.assertTrue(template.is_precompiled)
+        self.assertEqual([make_formula(x) for x in range(2, 12)], [template.render(x) for x in range(2, 12)])
+
+    def test_render_not_precompiled(self):
+        # does arithmetic on the row index
+        def make_id_formula(row_index):
+            return "=IF(B{0}=\"\",\"\",{1})".format(row_index, row_index - 1)
+
+        # range from a fixed row down to the current row collapses to one cell in the fixed row
+        def make_range_formula(row_index):
+            return "=COUNT({0})".format(xlsxbasics.format_range(1, 2, last_row_index=row_index))
+
+        for curr_make_formula in [make_id_formula, make_range_formula]:
+            template = xlsxbasics.RowFormulaTemplate(curr_make_formula, [2, 1001])
+            self.assertFalse(template.is_precompiled)
+            self.assertIsNone(template.marked_formula)
+            self.assertEqual([curr_make_formula(x) for x in range(2, 12)], [template.render(x) for x in range(2, 12)])
+
+
+class TestFormulaTemplateWorksheet(TestCase):
+    def test_add_formula_col_run(self):
+        formulas = ["=IF(B{0}=\"\",\"\",B{0})", "{{=AND(IF($A$2:$A$4,TRUE,B{0}))}}",
+                    # needs xlsxwriter's rewrites, to add the _xlfn. prefix
+                    "=XLOOKUP(B{0},A:A,B:B)"]
+        output_streams = []
+        for curr_workbook_class in [xlsxwriter.Workbook, xlsxbasics.FormulaTemplateWorkbook]:
+            output_stream = io.BytesIO()
+            workbook = curr_workbook_class(output_stream, {"in_memory": True})
+            worksheet = workbook.add_worksheet("sheet")
+            plan = xlsxbasics.RowMajorSheetPlan(worksheet)
+            for col_index, curr_formula in enumerate(formulas):
+                xlsxbasics.add_formula_col_run(plan, col_index + 2, 2, 4, curr_formula.format)
+            plan.write_rows()
+            workbook.close()
+            output_streams.append(output_stream)
+
+        with zipfile.ZipFile(output_streams[0]) as expected_zip, zipfile.ZipFile(output_streams[1]) as actual_zip:
+            expected_sheet_xml = expected_zip.read("xl/worksheets/sheet1.xml")
+            self.assertIn(b"_xlfn.XLOOKUP(B3,A:A,B:B)", expected_sheet_xml)
+            self.assertEqual(expected_sheet_xml, actual_zip.read("xl/worksheets/sheet1.xml"))
+
+    def test_is_unchanged_by_formula_rewrites(self):
+        workbook = xlsxbasics.FormulaTemplateWorkbook(io.BytesIO(), {"in_memory": True})
+        worksheet = workbook.add_worksheet("sheet")
+        self.assertTrue(worksheet.is_unchanged_by_formula_rewrites("{=AND(IF($A$2:$A$4,TRUE,B2))}"))
+        self.assertFalse(worksheet.is_unchanged_by_formula_rewrites("=XLOOKUP(B2,A:A,B:B)"))
+        workbook.close()
+
+    def test_is_unchanged_by_formula_rewrites_old_xlsxwriter(self):
+        # without xlsxwriter's _prepare_formula to go by, every formula gets the rewrites
+        workbook = xlsxbasics.FormulaTemplateWorkbook(io.BytesIO(), {"in_memory": True})
+        worksheet = workbook.add_worksheet("sheet")
+        with mock.patch("qiimp.xlsx_basics._CAN_SKIP_FORMULA_REWRITES", False):
+            self.assertFalse(worksheet.is_unchanged_by_formula_rewrites("{=AND(IF($A$2:$A$4,TRUE,B2))}"))
+        workbook.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+from unittest import main, mock, TestCase
+import io
+import os
+import tempfile
+import zipfile
+
+import openpyxl
+import openpyxl.utils.cell
+from openpyxl.worksheet.formula import ArrayFormula
+import xlsxwriter
+
+import qiimp.metadata_wizard_settings as mws
+import qiimp.workbook_benchmark
+import qiimp.xlsx_basics
+import qiimp.xlsx_builder as xb
+import qiimp.xlsx_static_grid_builder as xsgb
+
+_NUM_ALLOWABLE_SAMPLES = 40
+
+
+def _read_cells(workbook):
+    # (sheet name, cell ref) to (value, style) for every cell with a value; array formulas as (ref, text) tuples
+    result = {}
+    for curr_sheet in workbook.worksheets:
+        for curr_row in curr_sheet.iter_rows():
+            for curr_cell in curr_row:
+                curr_value = curr_cell.value
+                if curr_value is None:
+                    continue
+                if isinstance(curr_value, ArrayFormula):
+                    curr_value = (curr_value.ref, curr_value.text)
+                curr_style = (curr_cell.number_format, curr_cell.font.b, curr_cell.fill.fgColor.rgb,
+                              curr_cell.protection.locked, curr_cell.alignment.wrap_text)
+                result[(curr_sheet.title, curr_cell.coordinate)] = (curr_value, curr_style)
+    return result
+
+
+def _read_sheet_settings(workbook):
+    # everything else about the workbook that the builders set
+    result = {"defined_names": sorted((x, workbook.defined_names[x].attr_text) for x in workbook.defined_names)}
+    for curr_sheet in workbook.worksheets:
+        result[curr_sheet.title] = {
+            "state": curr_sheet.sheet_state,
+            "data_validations": sorted(
+                (str(x.sqref), x.type, x.formula1, x.formula2, x.operator, x.showErrorMessage, x.error, x.allow_blank)
+                for x in curr_sheet.data_validations.dataValidation),
+            "conditional_formats": sorted(
+                (str(x.sqref), tuple((y.type, tuple(y.formula), y.priority, y.stopIfTrue) for y in x.rules))
+                for x in curr_sheet.conditional_formatting),
+            "columns": sorted((k, v.width, v.hidden) for k, v in curr_sheet.column_dimensions.items()),
+            "freeze_panes": curr_sheet.freeze_panes,
+            "is_protected": curr_sheet.protection.sheet
+        }
+    return result
+
+
+def _is_array_padding_cell(cells, sheet_name, cell_ref):
+    # in constant_memory mode, xlsxwriter writes a multi-cell array formula only into its top-left cell, leaving out
+    # the zero placeholders it otherwise puts in the rest of the formula's range (Excel fills them in on recalculation)
+    col_index, row_num = openpyxl.utils.cell.coordinate_to_tuple(cell_ref)[::-1]
+    for (curr_sheet_name, curr_ref), (curr_value, _) in cells.items():
+        if curr_sheet_name != sheet_name or not isinstance(curr_value, tuple):
+            continue
+        min_col, min_row, max_col, max_row = openpyxl.utils.cell.range_boundaries(curr_value[0])
+        if min_col <= col_index <= max_col and min_row <= row_num <= max_row and curr_ref != cell_ref:
+            return True
+    return False
+
+
+class TestWriteWorkbook(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.wizard_state = mws.MetadataWizardState()
+        self.wizard_state.set_up(False)
+        base_schema = {"sample_name": {"type": "string", "unique": True, "required": True, "empty": False,
+                                       "is_phi": False}}
+        self.schema_dict, self.form_dict = qiimp.workbook_benchmark.make_synthetic_schema(
+            base_schema, 12, 8, self.wizard_state.regex_handler)
+        # NB: the readme says when the workbook was made, which mustn't differ between the workbooks compared
+        self.readme_text = self.wizard_state.make_readme_text()
+
+    def _write_workbook(self, in_memory, static_grid_layout, rank_strategy):
+        output_stream = io.BytesIO() if in_memory else None
+        with mock.patch.object(self.wizard_state, "get_output_path",
+                               side_effect=lambda x: os.path.join(self.temp_dir.name, x)), \
+                mock.patch.object(self.wizard_state, "make_readme_text", return_value=self.readme_text):
+            file_name = xb.write_workbook("my study", self.schema_dict, self.form_dict, self.wizard_state,
+                                          output_stream=output_stream, num_allowable_samples=_NUM_ALLOWABLE_SAMPLES,
+                                          static_grid_layout=static_grid_layout, rank_strategy=rank_strategy)
+        if in_memory:
+            output_stream.seek(0)
+            return openpyxl.load_workbook(output_stream)
+        return openpyxl.load_workbook(os.path.join(self.temp_dir.name, file_name))
+
+    def test_write_workbook_disk_matches_memory(self):
+        # disk workbooks are written in xlsxwriter's constant_memory mode, memory ones aren't; the contents must
+        # nonetheless be the same
+        for curr_layout in [xsgb.INLINE_LAYOUT, xsgb.HIDDEN_SHEET_LAYOUT]:
+            for curr_rank_strategy in [xsgb.COUNTIF_RANK_STRATEGY, xsgb.RUNNING_COUNT_RANK_STRATEGY]:
+                with self.subTest(static_grid_layout=curr_layout, rank_strategy=curr_rank_strategy):
+                    memory_workbook = self._write_workbook(True, curr_layout, curr_rank_strategy)
+                    disk_workbook = self._write_workbook(False, curr_layout, curr_rank_strategy)
+                    memory_cells = _read_cells(memory_workbook)
+                    disk_cells = _read_cells(disk_workbook)
+
+                    padding_keys = set(memory_cells.keys()) - set(disk_cells.keys())
+                    for curr_sheet_name, curr_ref in padding_keys:
+                        self.assertEqual(0, memory_cells[(curr_sheet_name, curr_ref)][0])
+                        self.assertTrue(_is_array_padding_cell(memory_cells, curr_sheet_name, curr_ref),
+                                        "{0}!{1}".format(curr_sheet_name, curr_ref))
+                    for curr_key in padding_keys:
+                        del memory_cells[curr_key]
+
+                    self.assertEqual(memory_cells, disk_cells)
+                    self.assertEqual(_read_sheet_settings(memory_workbook), _read_sheet_settings(disk_workbook))
+
+    def test_write_workbook_formula_templates_match_plain_xlsxwriter(self):
+        # skipping xlsxwriter's formula rewrites (see xlsx_basics.FormulaTemplateWorksheet) must not change a thing
+        def read_parts(workbook_bytes):
+            with zipfile.ZipFile(io.BytesIO(workbook_bytes)) as workbook_zip:
+                # NB: the document properties include the time the workbook was made
+                return {x: workbook_zip.read(x) for x in workbook_zip.namelist() if x != "docProps/core.xml"}
+
+        def write_workbook_bytes(static_grid_layout, rank_strategy):
+            output_stream = io.BytesIO()
+            with mock.patch.object(self.wizard_state, "make_readme_text", return_value=self.readme_text):
+                xb.write_workbook("my study", self.schema_dict, self.form_dict, self.wizard_state,
+                                  output_stream=output_stream, num_allowable_samples=_NUM_ALLOWABLE_SAMPLES,
+                                  static_grid_layout=static_grid_layout, rank_strategy=rank_strategy)
+            return output_stream.getvalue()
+
+        for curr_layout in [xsgb.INLINE_LAYOUT, xsgb.HIDDEN_SHEET_LAYOUT]:
+            for curr_rank_strategy in [xsgb.COUNTIF_RANK_STRATEGY, xsgb.RUNNING_COUNT_RANK_STRATEGY]:
+                with self.subTest(static_grid_layout=curr_layout, rank_strategy=curr_rank_strategy):
+                    real_write_func = qiimp.xlsx_basics.FormulaTemplateWorksheet.write_without_formula_rewrites
+                    with mock.patch.object(qiimp.xlsx_basics.FormulaTemplateWorksheet,
+                                           "write_without_formula_rewrites", autospec=True,
+                                           side_effect=real_write_func) as mock_write_func:
+                        templated_parts = read_parts(write_workbook_bytes(curr_layout, curr_rank_strategy))
+                    # NB: or there was nothing to compare
+                    self.assertTrue(mock_write_func.called)
+                    with mock.patch("qiimp.xlsx_basics.FormulaTemplateWorkbook", xlsxwriter.Workbook):
+                        plain_parts = read_parts(write_workbook_bytes(curr_layout, curr_rank_strategy))
+                    with mock.patch("qiimp.xlsx_basics._CAN_SKIP_FORMULA_REWRITES", False):
+                        fallback_parts = read_parts(write_workbook_bytes(curr_layout, curr_rank_strategy))
+
+                    self.assertEqual(plain_parts, templated_parts)
+                    self.assertEqual(plain_parts, fallback_parts)
+
+
+if __name__ == '__main__':
+    main()
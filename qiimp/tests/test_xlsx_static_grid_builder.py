@@ -0,0 +1,241 @@
+import io
+import os
+import random
+from unittest import main, skipUnless, TestCase
+
+import openpyxl
+
+import qiimp.metadata_wizard_settings as mws
+import qiimp.xlsx_basics as xlsxbasics
+import qiimp.xlsx_dynamic_grid_builder
+import qiimp.xlsx_static_grid_builder as xsgb
+
+# NB: pycel (which recalculates workbooks in Python) isn't a dependency of QIIMP; the tests that need it are skipped
+# without it
+try:
+    import pycel
+    import qiimp.pycel_functions
+except ImportError:
+    pycel = None
+
+
+class TestValidationWorksheet(TestCase):
+    def setUp(self):
+        self.regex_handler = mws.RegexHandler(os.path.join(os.path.dirname(mws.__file__), "settings",
+                                                           "regex_definitions.yaml"))
+        self.schema_dict = {"sample_name": {"type": "string", "unique": True, "required": True, "empty": False},
+                            "age": {"type": "integer", "min": 0, "required": True}}
+        self.output_stream = io.BytesIO()
+        self.workbook = xlsxbasics.FormulaTemplateWorkbook(self.output_stream, {"in_memory": True})
+
+    def _write_validation_sheet(self, static_grid_layout, rank_strategy=xsgb.COUNTIF_RANK_STRATEGY):
+        val_sheet = xsgb.ValidationWorksheet(self.workbook, len(self.schema_dict), 0, self.regex_handler,
+                                             num_allowable_samples=5, static_grid_layout=static_grid_layout,
+                                             rank_strategy=rank_strategy)
+        index_and_range_str_tuple_by_header_dict = xsgb.write_static_validation_grid_and_helpers(val_sheet,
+                                                                                                 self.schema_dict)
+        qiimp.xlsx_dynamic_grid_builder.write_dynamic_validation_grid(val_sheet,
+                                                                       index_and_range_str_tuple_by_header_dict)
+        val_sheet.write_planned_rows()
+        self.workbook.close()
+        return val_sheet, openpyxl.load_workbook(self.output_stream)
+
+    def test_inline_layout(self):
+        val_sheet, obs_workbook = self._write_validation_sheet(xsgb.INLINE_LAYOUT)
+
+        self.assertIs(val_sheet, val_sheet.static_grid_sheet)
+        self.assertIsNone(val_sheet.static_grid_sheet_name)
+        self.assertEqual(["Validation"], obs_workbook.sheetnames)
+        worksheet = obs_workbook["Validation"]
+        # the grid is off to the right of the dynamic grid (in column N), with the helpers just to the left of it
+        self.assertEqual(13, val_sheet.first_static_grid_col_index)
+        self.assertEqual(["row_rank", "sample_name", None, "sample_name"],
+                         [worksheet[x].value for x in ["G1", "L1", "M1", "N1"]])
+        # all hidden (NB: openpyxl's column numbers are 1-based)
+        self.assertEqual([(7, 15)], [(x.min, x.max) for x in worksheet.column_dimensions.values() if x.hidden])
+        self.assertNotIn("!", worksheet["B1"].value)
+
+    def test_hidden_sheet_layout(self):
+        val_sheet, obs_workbook = self._write_validation_sheet(xsgb.HIDDEN_SHEET_LAYOUT)
+
+        self.assertEqual("validation_grid", val_sheet.static_grid_sheet_name)
+        self.assertEqual(["Validation", "validation_grid"], obs_workbook.sheetnames)
+        self.assertEqual("veryHidden", obs_workbook["validation_grid"].sheet_state)
+
+        # the helper columns start in column A, then comes the empty column holding the helper rows' headers, then
+        # the grid
+        grid_worksheet = obs_workbook["validation_grid"]
+        self.assertEqual(7, val_sheet.first_static_grid_col_index)  # column H
+        self.assertEqual(["row_rank", "row_order_weight", "row_in_metadata", "is_valid_row", "is_absent",
+                          "sample_name", None, "sample_name", "age"],
+                         [x.value for x in grid_worksheet[1]][:9])
+        self.assertEqual("col_rank", grid_worksheet["G{0}".format(val_sheet.first_helper_rows_row_index + 3)].value)
+        self.assertTrue(grid_worksheet["I2"].value.startswith("=AND(IF(Metadata!C2=\"\",FALSE,"))
+
+        # and the validation sheet holds just the dynamic grid, which looks everything up on the hidden sheet
+        worksheet = obs_workbook["Validation"]
+        self.assertEqual(3, worksheet.max_column)
+        self.assertEqual([], [x for x, y in worksheet.column_dimensions.items() if y.hidden])
+        self.assertIn("INDEX(validation_grid!$H$1:$I$1, 1, MATCH(COLUMNS(validation_grid!$H$", worksheet["B1"].value)
+        self.assertIn("INDEX(validation_grid!$F$2:$F$6,MATCH(ROWS(validation_grid!$A$2:A2),"
+                      "validation_grid!$A$2:$A$6,0),0)", worksheet["A2"].value)
+
+    def test_countif_rank_strategy(self):
+        val_sheet, obs_workbook = self._write_validation_sheet(xsgb.HIDDEN_SHEET_LAYOUT)
+
+        grid_worksheet = obs_workbook["validation_grid"]
+        self.assertEqual("row_rank", grid_worksheet["A1"].value)
+        self.assertEqual("=COUNTIF(B$2:B$6,\"<=\"&$B2:$B6)", grid_worksheet["A2"].value.text)
+        self.assertEqual("col_rank", grid_worksheet["G11"].value)
+        self.assertEqual("=COUNTIF($H10:$I10,\"<=\"&H$10:I10)", grid_worksheet["H11"].value.text)
+
+    def test_running_count_rank_strategy(self):
+        val_sheet, obs_workbook = self._write_validation_sheet(xsgb.HIDDEN_SHEET_LAYOUT,
+                                                               xsgb.RUNNING_COUNT_RANK_STRATEGY)
+
+        # the running counts come just before the ranks, which there is room for on the hidden sheet
+        grid_worksheet = obs_workbook["validation_grid"]
+        self.assertEqual(10, val_sheet.first_static_grid_col_index)  # column K
+        self.assertEqual(["row_at_rank", "row_rank", "row_valid_count", "row_invalid_count", "row_order_weight",
+                          "row_in_metadata", "is_valid_row", "is_absent", "sample_name", None, "sample_name", "age"],
+                         [x.value for x in grid_worksheet[1]][:12])
+        self.assertEqual(["=N(D1)+IF(G2,0,1)", "=N(D5)+IF(G6,0,1)"], [grid_worksheet[x].value for x in ["D2", "D6"]])
+        self.assertEqual(["=N(C1)+IF(G2,1,0)", "=N(C5)+IF(G6,1,0)"], [grid_worksheet[x].value for x in ["C2", "C6"]])
+        self.assertEqual(["=IF(G2,$D$6+F2-$F$2+1-D2,D2)", "=IF(G6,$D$6+F6-$F$2+1-D6,D6)"],
+                         [grid_worksheet[x].value for x in ["B2", "B6"]])
+        self.assertEqual("=IF(ROWS($B$2:B3)<=$D$6,IFERROR(MATCH(ROWS($B$2:B3)-0.5,$D$2:$D$6,1),0),"
+                         "IFERROR(MATCH(ROWS($B$2:B3)-$D$6-0.5,$C$2:$C$6,1),0))+1", grid_worksheet["A3"].value)
+        self.assertEqual(["is_valid_col", "col_in_metadata", "col_order_weight", "col_invalid_count",
+                          "col_valid_count", "col_rank", "col_at_rank"],
+                         [grid_worksheet["J{0}".format(x)].value for x in range(8, 15)])
+        self.assertEqual(["=N(J11)+IF(K8,0,1)", "=N(K11)+IF(L8,0,1)"],
+                         [grid_worksheet[x].value for x in ["K11", "L11"]])
+        self.assertEqual(["=N(J12)+IF(K8,1,0)", "=N(K12)+IF(L8,1,0)"],
+                         [grid_worksheet[x].value for x in ["K12", "L12"]])
+        self.assertEqual(["=IF(K8,$L$11+K9-$K$9+1-K11,K11)", "=IF(L8,$L$11+L9-$K$9+1-L11,L11)"],
+                         [grid_worksheet[x].value for x in ["K13", "L13"]])
+        self.assertEqual("=IF(COLUMNS($K$13:L13)<=$L$11,IFERROR(MATCH(COLUMNS($K$13:L13)-0.5,$K$11:$L$11,1),0),"
+                         "IFERROR(MATCH(COLUMNS($K$13:L13)-$L$11-0.5,$K$12:$L$12,1),0))+1", grid_worksheet["L14"].value)
+
+        # and the dynamic grid looks its rows and columns up in the at-rank helpers
+        worksheet = obs_workbook["Validation"]
+        self.assertIn("INDEX(validation_grid!$K$1:$L$1, 1, validation_grid!K$14)", worksheet["B1"].value)
+        self.assertIn("INDEX(validation_grid!$I$2:$I$6,validation_grid!$A2,0)", worksheet["A2"].value)
+        self.assertNotIn("MATCH", worksheet["B2"].value)
+
+    def test_unknown_layout(self):
+        with self.assertRaisesRegex(ValueError, "Unrecognized static grid layout 'sideways'"):
+            xsgb.ValidationWorksheet(self.workbook, len(self.schema_dict), 0, self.regex_handler,
+                                     static_grid_layout="sideways")
+        self.workbook.close()
+
+    def test_unknown_rank_strategy(self):
+        with self.assertRaisesRegex(ValueError, "Unrecognized rank strategy 'bubble_sort'"):
+            xsgb.ValidationWorksheet(self.workbook, len(self.schema_dict), 0, self.regex_handler,
+                                     rank_strategy="bubble_sort")
+        self.workbook.close()
+
+
+
+@skipUnless(pycel is not None, "pycel is not installed")
+class TestRankStrategyRecalculation(TestCase):
+    # pycel can't recalculate the static grid's validation formulas, so this recalculates each rank strategy's helpers
+    # from made-up validity and checks that the running_count strategy puts rows and columns in the same order as the
+    # countif strategy (and that both give the order worked out here)
+    _NUM_SAMPLES = 8
+    _NUM_FIELDS = 6
+
+    def setUp(self):
+        self.regex_handler = mws.RegexHandler(os.path.join(os.path.dirname(mws.__file__), "settings",
+                                                           "regex_definitions.yaml"))
+        self.schema_dict = {"sample_name": {"type": "string", "unique": True, "required": True, "empty": False}}
+        for curr_index in range(self._NUM_FIELDS - 1):
+            self.schema_dict["field_{0}".format(curr_index)] = {"type": "integer", "min": 0, "required": True}
+        self.random = random.Random(0)
+
+    def _write_workbook(self, static_grid_layout, rank_strategy):
+        output_stream = io.BytesIO()
+        workbook = xlsxbasics.FormulaTemplateWorkbook(output_stream, {"in_memory": True})
+        val_sheet = xsgb.ValidationWorksheet(workbook, len(self.schema_dict), 0, self.regex_handler,
+                                             num_allowable_samples=self._NUM_SAMPLES,
+                                             static_grid_layout=static_grid_layout, rank_strategy=rank_strategy)
+        index_and_range_str_tuple_by_header_dict = xsgb.write_static_validation_grid_and_helpers(val_sheet,
+                                                                                                 self.schema_dict)
+        qiimp.xlsx_dynamic_grid_builder.write_dynamic_validation_grid(val_sheet,
+                                                                       index_and_range_str_tuple_by_header_dict)
+        val_sheet.write_planned_rows()
+        workbook.close()
+        return val_sheet, index_and_range_str_tuple_by_header_dict, output_stream.getvalue()
+
+    def _recalculate(self, val_sheet, index_dict, workbook_bytes, row_validities, col_validities):
+        # returns the (ranks, at-ranks) of the rows and of the columns, once the is_valid and position helpers (which
+        # depend on the metadata) are replaced by the given validities and the positions they'd have anyway
+        workbook = openpyxl.load_workbook(io.BytesIO(workbook_bytes))
+        worksheet = workbook[val_sheet.static_grid_sheet.worksheet.name]
+        row_indices = range(val_sheet.first_data_row_index, val_sheet.last_data_row_index + 1)
+        col_indices = range(val_sheet.first_static_grid_col_index, val_sheet.last_static_grid_col_index + 1)
+
+        def get_cell(col_index, row_index):
+            return xlsxbasics.format_range(col_index, row_index)
+
+        for curr_position, (curr_row_index, curr_is_valid) in enumerate(zip(row_indices, row_validities)):
+            worksheet[get_cell(index_dict[val_sheet.IS_VALID_ROW_HEADER][0], curr_row_index)] = curr_is_valid
+            worksheet[get_cell(index_dict[val_sheet.ROW_IN_METADATA_HEADER][0], curr_row_index)] = curr_position + 2
+        for curr_position, (curr_col_index, curr_is_valid) in enumerate(zip(col_indices, col_validities)):
+            worksheet[get_cell(curr_col_index, index_dict[val_sheet.IS_VALID_COL_HEADER][0])] = curr_is_valid
+            worksheet[get_cell(curr_col_index, index_dict[val_sheet.COL_IN_METADATA_HEADER][0])] = curr_position + 2
+
+        recalculated_stream = io.BytesIO()
+        workbook.save(recalculated_stream)
+        recalculated_stream.seek(0)
+        compiler = pycel.ExcelCompiler(excel=openpyxl.load_workbook(recalculated_stream),
+                                       plugins=[qiimp.pycel_functions.__name__])
+
+        def evaluate(cells):
+            return [compiler.evaluate("{0}!{1}".format(worksheet.title, x)) for x in cells]
+
+        row_ranks = evaluate([get_cell(index_dict[val_sheet.ROW_RANK_HEADER][0], x) for x in row_indices])
+        col_ranks = evaluate([get_cell(x, index_dict[val_sheet.COL_RANK_HEADER][0]) for x in col_indices])
+        # the countif strategy has no at-rank helpers: the dynamic grid finds the position of each rank with an exact
+        # MATCH over the ranks, which is what the index of that rank is here
+        if val_sheet.ROW_AT_RANK_HEADER in index_dict:
+            row_at_ranks = evaluate([get_cell(index_dict[val_sheet.ROW_AT_RANK_HEADER][0], x) for x in row_indices])
+            col_at_ranks = evaluate([get_cell(x, index_dict[val_sheet.COL_AT_RANK_HEADER][0]) for x in col_indices])
+        else:
+            row_at_ranks = [row_ranks.index(x) + 1 for x in range(1, len(row_ranks) + 1)]
+            col_at_ranks = [col_ranks.index(x) + 1 for x in range(1, len(col_ranks) + 1)]
+        return [row_ranks, row_at_ranks], [col_ranks, col_at_ranks]
+
+    def _get_expected_ranks_and_at_ranks(self, validities):
+        # invalid before valid, and otherwise in the order they're in
+        order_weights = [int(x) * 100000 + y for y, x in enumerate(validities)]
+        ranks = [len([x for x in order_weights if x <= y]) for y in order_weights]
+        at_ranks = [ranks.index(x) + 1 for x in range(1, len(ranks) + 1)]
+        return [ranks, at_ranks]
+
+    def test_running_count_matches_countif(self):
+        num_samples = self._NUM_SAMPLES
+        validity_patterns = [([True] * num_samples, [True] * self._NUM_FIELDS),
+                             ([False] * num_samples, [False] * self._NUM_FIELDS)]
+        for _ in range(8):
+            validity_patterns.append(([self.random.random() < 0.5 for _ in range(num_samples)],
+                                      [self.random.random() < 0.5 for _ in range(self._NUM_FIELDS)]))
+
+        for curr_layout in [xsgb.INLINE_LAYOUT, xsgb.HIDDEN_SHEET_LAYOUT]:
+            workbook_info_by_strategy = {x: self._write_workbook(curr_layout, x)
+                                         for x in [xsgb.COUNTIF_RANK_STRATEGY, xsgb.RUNNING_COUNT_RANK_STRATEGY]}
+            for curr_row_validities, curr_col_validities in validity_patterns:
+                with self.subTest(static_grid_layout=curr_layout, row_validities=curr_row_validities,
+                                  col_validities=curr_col_validities):
+                    countif_results = self._recalculate(*workbook_info_by_strategy[xsgb.COUNTIF_RANK_STRATEGY],
+                                                        curr_row_validities, curr_col_validities)
+                    running_count_results = self._recalculate(
+                        *workbook_info_by_strategy[xsgb.RUNNING_COUNT_RANK_STRATEGY], curr_row_validities,
+                        curr_col_validities)
+                    self.assertEqual(countif_results, running_count_results)
+                    self.assertEqual((self._get_expected_ranks_and_at_ranks(curr_row_validities),
+                                      self._get_expected_ranks_and_at_ranks(curr_col_validities)),
+                                     running_count_results)
+
+if __name__ == '__main__':
+    main()
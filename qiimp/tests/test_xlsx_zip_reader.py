@@ -0,0 +1,115 @@
+from unittest import main, TestCase
+import io
+import os
+import tempfile
+import zipfile
+
+import openpyxl
+import xlsxwriter
+
+import qiimp.metadata_wizard_settings as mws
+import qiimp.xlsx_zip_reader as xzr
+
+
+def _make_workbook_bytes(workbook_options=None):
+    output = io.BytesIO()
+    options = {'in_memory': True}
+    if workbook_options is not None:
+        options.update(workbook_options)
+    workbook = xlsxwriter.Workbook(output, options)
+    metadata_sheet = workbook.add_worksheet("Metadata")
+    for row_index in range(50):
+        metadata_sheet.write_formula(row_index, 0, "=ROW()*2")
+        metadata_sheet.write_string(row_index, 1, "row {0}".format(row_index))
+    schema_sheet = workbook.add_worksheet("metadata_schema")
+    schema_sheet.write_string("A1", "sample_name:\n  type: string\n  unique: true\n")
+    schema_sheet.write_string("B1", "not this one")
+    schema_sheet.hide()
+    number_sheet = workbook.add_worksheet("numbers")
+    number_sheet.write_number("C3", 42)
+    workbook.close()
+    return output.getvalue()
+
+
+def _replace_workbook_part(workbook_bytes, part_path, part_bytes):
+    output = io.BytesIO()
+    with zipfile.ZipFile(io.BytesIO(workbook_bytes)) as in_zip, zipfile.ZipFile(output, "w") as out_zip:
+        for curr_info in in_zip.infolist():
+            curr_bytes = part_bytes if curr_info.filename == part_path else in_zip.read(curr_info)
+            out_zip.writestr(curr_info, curr_bytes)
+    return output.getvalue()
+
+
+class TestXlsxZipReader(TestCase):
+    def test_sheetnames(self):
+        with xzr.XlsxZipReader(io.BytesIO(_make_workbook_bytes())) as reader:
+            self.assertEqual(["Metadata", "metadata_schema", "numbers"], reader.sheetnames)
+
+    def test_read_cell_value_shared_string(self):
+        with xzr.XlsxZipReader(io.BytesIO(_make_workbook_bytes())) as reader:
+            obs = reader.read_cell_value("metadata_schema", "A1")
+        self.assertEqual("sample_name:\n  type: string\n  unique: true\n", obs)
+
+    def test_read_cell_value_inline_string(self):
+        # constant_memory mode makes xlsxwriter write inline strings rather than shared ones
+        workbook_bytes = _make_workbook_bytes({'in_memory': False, 'constant_memory': True})
+        with xzr.XlsxZipReader(io.BytesIO(workbook_bytes)) as reader:
+            obs = reader.read_cell_value("metadata_schema")
+        self.assertEqual("sample_name:\n  type: string\n  unique: true\n", obs)
+
+    def test_read_cell_value_number_and_missing(self):
+        with xzr.XlsxZipReader(io.BytesIO(_make_workbook_bytes())) as reader:
+            self.assertEqual("42", reader.read_cell_value("numbers", "C3"))
+            self.assertIsNone(reader.read_cell_value("numbers", "A1"))
+            self.assertIsNone(reader.read_cell_value("numbers", "C4"))
+
+    def test_read_cell_value_matches_openpyxl_for_packages(self):
+        packages_dir = os.path.join(os.path.dirname(mws.__file__), "settings", "packages")
+        for curr_file_name in ["base.xlsx", "human-gut.xlsx"]:
+            curr_fp = os.path.join(packages_dir, curr_file_name)
+            exp = openpyxl.load_workbook(curr_fp)["metadata_schema"]["A1"].value
+            with xzr.XlsxZipReader(curr_fp) as reader:
+                obs = reader.read_cell_value("metadata_schema", "A1")
+            self.assertEqual(exp, obs)
+
+
+class TestLoadYamlFromWizardXlsx(TestCase):
+    def test_load_yaml_from_wizard_xlsx(self):
+        obs = mws.load_yaml_from_wizard_xlsx(io.BytesIO(_make_workbook_bytes()), "metadata_schema")
+        self.assertEqual({"sample_name": {"type": "string", "unique": True}}, obs)
+
+    def test_load_yaml_from_wizard_xlsx_missing_sheet(self):
+        with tempfile.NamedTemporaryFile(suffix=".xlsx") as temp_file:
+            temp_file.write(_make_workbook_bytes())
+            temp_file.flush()
+            with self.assertRaisesRegex(ValueError, mws.NON_WIZARD_XLSX_ERROR_PREFIX):
+                mws.load_yaml_from_wizard_xlsx(temp_file.name, "metadata_form")
+
+    def test_load_yaml_from_wizard_xlsx_not_xlsx(self):
+        with self.assertRaisesRegex(ValueError, mws.NON_WIZARD_XLSX_ERROR_PREFIX + "'notes.txt'"):
+            mws.load_yaml_from_wizard_xlsx(io.BytesIO(b"just some text"), "metadata_form", display_name="notes.txt")
+
+    def test_load_yaml_from_wizard_xlsx_corrupted(self):
+        workbook_bytes = _make_workbook_bytes()
+        # the sheet holding the yaml is xl/worksheets/sheet2.xml
+        corrupted_bytes_list = [
+            _replace_workbook_part(workbook_bytes, "xl/workbook.xml", b"<workbook"),
+            _replace_workbook_part(workbook_bytes, "xl/worksheets/sheet2.xml", b"<worksheet><sheetData><row"),
+            workbook_bytes[:len(workbook_bytes) // 2]
+        ]
+
+        # flip some bits in the middle of the yaml sheet's compressed data, as a bad disk or download might
+        with zipfile.ZipFile(io.BytesIO(workbook_bytes)) as workbook_zip:
+            sheet_info = workbook_zip.getinfo("xl/worksheets/sheet2.xml")
+        data_offset = sheet_info.header_offset + 30 + len(sheet_info.filename.encode("utf-8")) + len(sheet_info.extra)
+        flip_index = data_offset + sheet_info.compress_size // 2
+        corrupted_bytes_list.append(workbook_bytes[:flip_index] + bytes([workbook_bytes[flip_index] ^ 0xFF]) +
+                                    workbook_bytes[flip_index + 1:])
+
+        for curr_bytes in corrupted_bytes_list:
+            with self.assertRaisesRegex(ValueError, mws.NON_WIZARD_XLSX_ERROR_PREFIX + "'broken.xlsx'"):
+                mws.load_yaml_from_wizard_xlsx(io.BytesIO(curr_bytes), "metadata_schema", display_name="broken.xlsx")
+
+
+if __name__ == '__main__':
+    main()
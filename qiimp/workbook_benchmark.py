@@ -0,0 +1,420 @@
+import argparse
+import concurrent.futures
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import statistics
+import sys
+import time
+import traceback
+
+import openpyxl
+import xlsxwriter
+
+# NB: pycel (which recalculates workbooks in Python) isn't a dependency of QIIMP; without it, --recalculate is refused
+try:
+    import pycel
+    import qiimp.pycel_functions
+except ImportError:
+    pycel = None
+
+import qiimp.build_tracer
+import qiimp.metadata_package_schema_builder as mpsb
+import qiimp.metadata_package_schema_cache
+import qiimp.metadata_wizard_settings as mws
+import qiimp.schema_builder
+import qiimp.xlsx_basics as xlsxbasics
+import qiimp.xlsx_builder
+import qiimp.xlsx_static_grid_builder
+
+# Benchmarks for building workbooks, so that a change meant to make builds faster (or leaner) can show that it does.
+# xlsx_builder.write_workbook is run over a matrix of real packages and synthetic schemas at a range of sample caps, and
+# the wall time, peak RSS, formulas written and output size of each build are saved as JSON; give the JSON from an
+# earlier run as --baseline to see how each case has changed since.
+#
+# Each case can also be built with each of the static grid layouts and rank strategies (see xlsx_static_grid_builder);
+# cases built with any but the default inline layout or countif strategy have its name on the end of theirs.  The rank
+# strategies differ less in how long the workbook takes to build than in how much work the spreadsheet does to
+# recalculate it, which the builds don't measure; so with --recalculate, each workbook's rank helpers (the part of the
+# recalculation that differs between the strategies) are also recalculated by pycel, after a change in which samples
+# and fields are valid, and that is timed too.  pycel is far slower than Excel (and can't recalculate the rest of the
+# workbook), so only compare these times with each other, and keep the sample caps small for the countif strategy.
+#
+# The synthetic schemas start from the base package (just sample_name) and add custom fields built just as the wizard
+# builds them from its form (see schema_builder), cycling through the kinds of field in _SYNTHETIC_FIELD_KINDS.
+#
+# NB: each build runs in a freshly spawned process, so that its peak RSS is its own and not left over from an earlier
+# (bigger) build.  The whole default matrix takes hours; use the options to run just part of it.
+
+DISK_OUTPUT_MODE = mws.WorkbookOutputModes.disk.value
+MEMORY_OUTPUT_MODE = mws.WorkbookOutputModes.memory.value
+
+_DEFAULT_PACKAGE_KEYS = ["human:stool", "built_env:other"]
+_DEFAULT_FIELD_COUNTS = [10, 50, 150, 300, 600]
+_DEFAULT_SAMPLE_CAPS = [1000, 5000, 10000]
+_DEFAULT_CATEGORICAL_SIZE = 500
+_DEFAULT_STATIC_GRID_LAYOUT = qiimp.xlsx_static_grid_builder.INLINE_LAYOUT
+_DEFAULT_RANK_STRATEGY = qiimp.xlsx_static_grid_builder.COUNTIF_RANK_STRATEGY
+_BASE_PACKAGE_KEY = ("base", "other")
+_SMALL_CATEGORICAL_SIZE = 5
+_SYNTHETIC_FIELD_KINDS = ["text", "categorical", "integer", "datetime", "large_categorical", "decimal", "boolean",
+                          "unique_text"]
+
+
+def main():
+    args = _parse_cmd_line_args()
+    cases = _get_cases(args.packages, args.field_counts, args.sample_caps, args.categorical_size,
+                       args.static_grid_layouts, args.rank_strategies)
+    baseline_results_by_name = {}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline_results_by_name = _get_median_results_by_name(json.load(f)["results"])
+
+    results = []
+    for curr_case, curr_run_index in itertools.product(cases, range(args.repeat)):
+        curr_result = dict(curr_case, run_index=curr_run_index)
+        try:
+            curr_result.update(_run_case_in_new_process(curr_case, args.output_mode, args.recalculate))
+        except Exception:
+            curr_result["error"] = traceback.format_exc()
+        results.append(curr_result)
+        print(_describe_result(curr_result, baseline_results_by_name.get(curr_case["name"])), flush=True)
+
+    output_path = args.output
+    if output_path is None:
+        output_path = "qiimp_benchmark_{0}.json".format(time.strftime("%Y%m%d-%H%M%S"))
+    with open(output_path, "w") as f:
+        json.dump({"started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                   "qiimp_version": mws.MetadataWizardState().VERSION,
+                   "python_version": platform.python_version(),
+                   "xlsxwriter_version": xlsxwriter.__version__,
+                   "platform": platform.platform(),
+                   "output_mode": args.output_mode,
+                   "results": results}, f, indent=2)
+    print("Results written to {0}".format(output_path))
+
+
+def _parse_cmd_line_args():
+    parser = argparse.ArgumentParser(description="Benchmark building QIIMP workbooks.")
+    parser.add_argument("--packages", nargs="*", default=_DEFAULT_PACKAGE_KEYS, metavar="ENV:SAMPLE_TYPE",
+                        help="real packages to build (default: {0})".format(" ".join(_DEFAULT_PACKAGE_KEYS)))
+    parser.add_argument("--field-counts", nargs="*", type=int, default=_DEFAULT_FIELD_COUNTS,
+                        help="numbers of fields in the synthetic schemas to build (default: {0})".format(
+                            " ".join(str(x) for x in _DEFAULT_FIELD_COUNTS)))
+    parser.add_argument("--sample-caps", nargs="+", type=int, default=_DEFAULT_SAMPLE_CAPS,
+                        help="numbers of sample rows to build each workbook with (default: {0})".format(
+                            " ".join(str(x) for x in _DEFAULT_SAMPLE_CAPS)))
+    parser.add_argument("--categorical-size", type=int, default=_DEFAULT_CATEGORICAL_SIZE,
+                        help="number of values in the synthetic schemas' large categorical fields "
+                             "(default: {0})".format(_DEFAULT_CATEGORICAL_SIZE))
+    parser.add_argument("--static-grid-layouts", nargs="+", default=[_DEFAULT_STATIC_GRID_LAYOUT],
+                        choices=[qiimp.xlsx_static_grid_builder.INLINE_LAYOUT,
+                                 qiimp.xlsx_static_grid_builder.HIDDEN_SHEET_LAYOUT],
+                        help="static grid layouts to build each workbook with (default: {0})".format(
+                            _DEFAULT_STATIC_GRID_LAYOUT))
+    parser.add_argument("--rank-strategies", nargs="+", default=[_DEFAULT_RANK_STRATEGY],
+                        choices=[qiimp.xlsx_static_grid_builder.COUNTIF_RANK_STRATEGY,
+                                 qiimp.xlsx_static_grid_builder.RUNNING_COUNT_RANK_STRATEGY],
+                        help="rank strategies to build each workbook with (default: {0})".format(
+                            _DEFAULT_RANK_STRATEGY))
+    parser.add_argument("--repeat", type=int, default=1, help="number of times to build each case (default 1)")
+    parser.add_argument("--output-mode", choices=[DISK_OUTPUT_MODE, MEMORY_OUTPUT_MODE], default=DISK_OUTPUT_MODE,
+                        help="write each workbook to the output directory (and then delete it), or to memory, as "
+                             "the server's workbook_output_mode does (default disk)")
+    parser.add_argument("--recalculate", action="store_true",
+                        help="also time pycel recalculating each workbook's rank helpers after a change in which "
+                             "samples and fields are valid (needs pycel installed; slow)")
+    parser.add_argument("--output", help="path of the JSON results file (default: qiimp_benchmark_<time>.json)")
+    parser.add_argument("--baseline", help="JSON results file of an earlier run to compare against")
+
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error("--repeat must be 1 or more")
+    if args.recalculate and pycel is None:
+        parser.error("--recalculate needs pycel, which isn't installed")
+    for curr_package in args.packages:
+        if len(curr_package.split(":")) != 2:
+            parser.error("Packages must be given as ENV:SAMPLE_TYPE, not '{0}'".format(curr_package))
+    return args
+
+
+def _get_cases(package_keys, field_counts, sample_caps, categorical_size, static_grid_layouts=None,
+               rank_strategies=None):
+    if static_grid_layouts is None:
+        static_grid_layouts = [_DEFAULT_STATIC_GRID_LAYOUT]
+    if rank_strategies is None:
+        rank_strategies = [_DEFAULT_RANK_STRATEGY]
+
+    result = []
+    for curr_sample_cap in sample_caps:
+        curr_cases = []
+        for curr_package in package_keys:
+            env, sample_type = curr_package.split(":")
+            curr_cases.append({"name": "package-{0}-{1}_samples{2}".format(env, sample_type, curr_sample_cap),
+                               "package_key": [env, sample_type], "num_fields": None, "categorical_size": None,
+                               "num_allowable_samples": curr_sample_cap})
+        for curr_num_fields in field_counts:
+            curr_cases.append({"name": "synthetic-{0}fields_samples{1}".format(curr_num_fields, curr_sample_cap),
+                               "package_key": None, "num_fields": curr_num_fields,
+                               "categorical_size": categorical_size, "num_allowable_samples": curr_sample_cap})
+
+        for curr_case, curr_layout, curr_strategy in itertools.product(curr_cases, static_grid_layouts,
+                                                                       rank_strategies):
+            # NB: the defaults' cases keep their plain names, so they can be compared against older results
+            curr_name = curr_case["name"]
+            if curr_layout != _DEFAULT_STATIC_GRID_LAYOUT:
+                curr_name = "{0}_{1}".format(curr_name, curr_layout)
+            if curr_strategy != _DEFAULT_RANK_STRATEGY:
+                curr_name = "{0}_{1}".format(curr_name, curr_strategy)
+            result.append(dict(curr_case, name=curr_name, static_grid_layout=curr_layout,
+                               rank_strategy=curr_strategy))
+    return result
+
+
+def _run_case_in_new_process(case, output_mode, recalculate=False):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1,
+                                                mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(_run_case, case, output_mode, recalculate).result()
+
+
+def _run_case(case, output_mode, recalculate=False):
+    # runs in its own process (see _run_case_in_new_process)
+    wizard_state = _load_wizard_state()
+    if case["package_key"] is not None:
+        env, sample_type = case["package_key"]
+        schema_dict = mpsb.load_schemas_for_package_key(env, sample_type, wizard_state.parent_stack_by_env_name,
+                                                        wizard_state.env_schemas)
+        form_dict = {}
+    else:
+        base_schema = mpsb.load_schemas_for_package_key(_BASE_PACKAGE_KEY[0], _BASE_PACKAGE_KEY[1],
+                                                        wizard_state.parent_stack_by_env_name,
+                                                        wizard_state.env_schemas)
+        schema_dict, form_dict = make_synthetic_schema(base_schema, case["num_fields"], case["categorical_size"],
+                                                       wizard_state.regex_handler)
+
+    setup_peak_rss_bytes = _get_peak_rss_bytes()
+    build_tracer = qiimp.build_tracer.BuildTracer()
+    output_stream = io.BytesIO() if output_mode == MEMORY_OUTPUT_MODE else None
+    start_time = time.perf_counter()
+    file_name = qiimp.xlsx_builder.write_workbook("benchmark", schema_dict, form_dict, wizard_state,
+                                                  output_stream=output_stream, build_tracer=build_tracer,
+                                                  num_allowable_samples=case["num_allowable_samples"],
+                                                  static_grid_layout=case["static_grid_layout"],
+                                                  rank_strategy=case["rank_strategy"])
+    wall_seconds = time.perf_counter() - start_time
+    peak_rss_bytes = _get_peak_rss_bytes()
+
+    recalculation_seconds = None
+    try:
+        if recalculate:
+            if output_stream is not None:
+                output_stream.seek(0)
+            workbook_file = wizard_state.get_output_path(file_name) if output_stream is None else output_stream
+            recalculation_seconds = time_rank_recalculation(
+                workbook_file, len(schema_dict), wizard_state.regex_handler, case["num_allowable_samples"],
+                case["static_grid_layout"], case["rank_strategy"])
+    finally:
+        if output_stream is None:
+            os.remove(wizard_state.get_output_path(file_name))
+
+    span_seconds_by_name = {}
+    for curr_event in build_tracer.to_chrome_trace()["traceEvents"]:
+        if curr_event["ph"] == "X":
+            span_seconds_by_name[curr_event["name"]] = curr_event["dur"] / 1000000
+
+    result = {"actual_num_fields": len(schema_dict),
+              "wall_seconds": wall_seconds,
+              "peak_rss_bytes": peak_rss_bytes,
+              "setup_peak_rss_bytes": setup_peak_rss_bytes,
+              "num_formulas": build_tracer.counts[qiimp.build_tracer.FORMULAS],
+              "num_data_validations": build_tracer.counts[qiimp.build_tracer.DATA_VALIDATIONS],
+              "num_conditional_formats": build_tracer.counts[qiimp.build_tracer.CONDITIONAL_FORMATS],
+              "output_bytes": build_tracer.counts[qiimp.build_tracer.BYTES_WRITTEN],
+              "span_seconds": span_seconds_by_name}
+    if recalculation_seconds is not None:
+        result["recalculation_seconds"] = recalculation_seconds
+    return result
+
+
+def time_rank_recalculation(workbook_file, num_fields, a_regex_handler, num_allowable_samples, static_grid_layout,
+                            rank_strategy, random_seed=0):
+    """Return the seconds pycel takes to recalculate a built workbook's rank helpers after a change in validity.
+
+    pycel can't recalculate the static grid's validation formulas, so the is_valid (and position) helpers that they
+    feed are replaced by made-up values: one set of random validities first, then, for the timed recalculation,
+    another.  num_fields and the rest must be what the workbook was built with (see xlsx_builder.write_workbook).
+    """
+    # a ValidationWorksheet for the same arguments (on a throwaway workbook) says where everything is
+    throwaway_workbook = xlsxbasics.FormulaTemplateWorkbook(io.BytesIO(), {"in_memory": True})
+    val_sheet = qiimp.xlsx_static_grid_builder.ValidationWorksheet(
+        throwaway_workbook, num_fields, 0, a_regex_handler, num_allowable_samples=num_allowable_samples,
+        static_grid_layout=static_grid_layout, rank_strategy=rank_strategy)
+    throwaway_workbook.close()
+
+    workbook = openpyxl.load_workbook(workbook_file)
+    worksheet = workbook[val_sheet.static_grid_sheet.worksheet.name]
+    # NB: openpyxl's column numbers are 1-based, while xlsxbasics' column indices are 0-based (its row indices are
+    # 1-based too, though)
+    col_index_by_header = {x.value: x.column - 1 for x in worksheet[1][:val_sheet.first_static_grid_col_index]}
+    row_index_by_header = {x[0].value: x[0].row for x in worksheet.iter_rows(
+        min_row=val_sheet.first_helper_rows_row_index, min_col=val_sheet.helper_rows_header_col_index + 1,
+        max_col=val_sheet.helper_rows_header_col_index + 1)}
+    row_indices = range(val_sheet.first_data_row_index, val_sheet.last_data_row_index + 1)
+    col_indices = range(val_sheet.first_static_grid_col_index, val_sheet.last_static_grid_col_index + 1)
+
+    def get_cell(col_index, row_index):
+        return xlsxbasics.format_range(col_index, row_index)
+
+    is_valid_row_cells = [get_cell(col_index_by_header[val_sheet.IS_VALID_ROW_HEADER], x) for x in row_indices]
+    is_valid_col_cells = [get_cell(x, row_index_by_header[val_sheet.IS_VALID_COL_HEADER]) for x in col_indices]
+    random_generator = random.Random(random_seed)
+    for curr_cell in is_valid_row_cells + is_valid_col_cells:
+        worksheet[curr_cell] = random_generator.random() < 0.5
+    for curr_row_index in row_indices:
+        worksheet[get_cell(col_index_by_header[val_sheet.ROW_IN_METADATA_HEADER], curr_row_index)] = curr_row_index
+    for curr_position, curr_col_index in enumerate(col_indices):
+        worksheet[get_cell(curr_col_index, row_index_by_header[val_sheet.COL_IN_METADATA_HEADER])] = curr_position + 2
+
+    # NB: in the order the spreadsheet would work them out; pycel evaluates each cell's precedents recursively, which
+    # would otherwise go as deep as the running counts are long
+    cells_in_order = []
+    for curr_header in [val_sheet.ROW_INVALID_COUNT_HEADER, val_sheet.ROW_VALID_COUNT_HEADER,
+                        val_sheet.ROW_RANK_HEADER, val_sheet.ROW_AT_RANK_HEADER]:
+        if curr_header in col_index_by_header:
+            cells_in_order.extend(get_cell(col_index_by_header[curr_header], x) for x in row_indices)
+    for curr_header in [val_sheet.COL_INVALID_COUNT_HEADER, val_sheet.COL_VALID_COUNT_HEADER,
+                        val_sheet.COL_RANK_HEADER, val_sheet.COL_AT_RANK_HEADER]:
+        if curr_header in row_index_by_header:
+            cells_in_order.extend(get_cell(x, row_index_by_header[curr_header]) for x in col_indices)
+    cells_in_order = ["{0}!{1}".format(worksheet.title, x) for x in cells_in_order]
+
+    compiler = pycel.ExcelCompiler(excel=workbook, plugins=[qiimp.pycel_functions.__name__])
+    # the first evaluation also compiles every formula, so it isn't what's timed
+    for curr_cell in cells_in_order:
+        compiler.evaluate(curr_cell)
+    # NB: from the last backwards, for the same reason: pycel resets everything that depends on a changed cell
+    # recursively, but stops at cells it has already reset
+    for curr_cell in reversed(is_valid_row_cells + is_valid_col_cells):
+        compiler.set_value("{0}!{1}".format(worksheet.title, curr_cell), random_generator.random() < 0.5)
+
+    start_time = time.perf_counter()
+    for curr_cell in cells_in_order:
+        compiler.evaluate(curr_cell)
+    return time.perf_counter() - start_time
+
+
+def _load_wizard_state():
+    # just as the server does at start-up (see metadata_wizard_server.main), minus precomputing every package
+    wizard_state = mws.MetadataWizardState()
+    wizard_state.set_up(False)
+    schema_cache = qiimp.metadata_package_schema_cache.PackageSchemaCache(wizard_state.package_cache_path,
+                                                                          wizard_state.VERSION)
+    wizard_state.set_env_and_sampletype_infos(mpsb.load_environment_and_sampletype_info(
+        wizard_state.environment_definitions, wizard_state.displayname_by_sampletypes_list,
+        wizard_state.packages_dir_path, schema_cache))
+    return wizard_state
+
+
+def make_synthetic_schema(base_schema, num_fields, categorical_size, a_regex_handler):
+    """Return a schema of num_fields fields (base_schema's, plus synthetic ones) and the form dict for it."""
+    schema_dict = dict(base_schema)
+    form_dict = {}
+    for field_index in itertools.count():
+        if len(schema_dict) >= num_fields:
+            break
+        field_kind = _SYNTHETIC_FIELD_KINDS[field_index % len(_SYNTHETIC_FIELD_KINDS)]
+        field_form_dict = _make_synthetic_field_form_dict(field_index, field_kind, categorical_size)
+        form_dict[field_index] = field_form_dict
+        for curr_field_name, curr_field_schema in qiimp.schema_builder.get_validation_schemas(field_form_dict,
+                                                                                              a_regex_handler):
+            if field_kind == "unique_text":
+                curr_field_schema[mws.ValidationKeys.unique.value] = True
+            schema_dict[curr_field_name] = curr_field_schema
+    return schema_dict, form_dict
+
+
+def _make_synthetic_field_form_dict(field_index, field_kind, categorical_size):
+    # mimics what the wizard's form sends for a custom field of this kind
+    result = {mws.InputNames.field_name.value: "synthetic_{0}_{1}".format(field_kind, field_index),
+              mws.InputNames.field_desc.value: "A synthetic {0} field.".format(field_kind.replace("_", " ")),
+              mws.InputNames.default_value.value: mws.DefaultTypes.no_default.value}
+
+    if field_kind in ["text", "unique_text"]:
+        result[mws.InputNames.field_type.value] = mws.FieldTypes.Text.value
+    elif field_kind in ["categorical", "large_categorical"]:
+        num_values = categorical_size if field_kind == "large_categorical" else _SMALL_CATEGORICAL_SIZE
+        result[mws.InputNames.field_type.value] = mws.FieldTypes.Categorical.value
+        result[mws.InputNames.categorical_values.value] = "\r\n".join(
+            "category {0}".format(x) for x in range(num_values))
+    elif field_kind == "boolean":
+        result[mws.InputNames.field_type.value] = mws.FieldTypes.Boolean.value
+        result[mws.InputNames.true_value.value] = "yes"
+        result[mws.InputNames.false_value.value] = "no"
+    else:
+        data_types_by_kind = {"integer": mws.CerberusDataTypes.Integer.value,
+                              "decimal": mws.CerberusDataTypes.Decimal.value,
+                              "datetime": mws.CerberusDataTypes.DateTime.value}
+        result[mws.InputNames.field_type.value] = mws.FieldTypes.Continuous.value
+        result[mws.InputNames.data_type.value] = data_types_by_kind[field_kind]
+        if field_kind == "integer":
+            result[mws.InputNames.minimum_comparison.value] = mws.ValidationKeys.min_inclusive.value
+            result[mws.InputNames.minimum_value.value] = "0"
+            result[mws.InputNames.maximum_comparison.value] = mws.ValidationKeys.max_exclusive.value
+            result[mws.InputNames.maximum_value.value] = "1000"
+        else:
+            # like most of the packages' continuous fields, these may be left missing
+            result[mws.InputNames.allowed_missing_vals.value] = [mws.EbiMissingValues.ebi_not_collected.name,
+                                                                 mws.EbiMissingValues.ebi_not_provided.name]
+    return result
+
+
+def _get_peak_rss_bytes():
+    # NB: ru_maxrss is in kilobytes on linux but in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def _get_median_results_by_name(results):
+    # the median of each case's repeats, for comparing against
+    results_by_name = {}
+    for curr_result in results:
+        if "error" not in curr_result:
+            results_by_name.setdefault(curr_result["name"], []).append(curr_result)
+
+    median_results_by_name = {}
+    for curr_name, curr_results in results_by_name.items():
+        curr_keys = ["wall_seconds", "peak_rss_bytes"]
+        # NB: only runs with --recalculate have a recalculation time
+        if all("recalculation_seconds" in x for x in curr_results):
+            curr_keys.append("recalculation_seconds")
+        median_results_by_name[curr_name] = {x: statistics.median(y[x] for y in curr_results) for x in curr_keys}
+    return median_results_by_name
+
+
+def _describe_result(result, baseline_result=None):
+    if "error" in result:
+        return "{0}: FAILED\n{1}".format(result["name"], result["error"])
+
+    description = "{0}: {1:.2f}s, peak RSS {2:.0f} MB, {3} formulas, {4:.1f} MB".format(
+        result["name"], result["wall_seconds"], result["peak_rss_bytes"] / 2 ** 20, result["num_formulas"],
+        result["output_bytes"] / 2 ** 20)
+    if "recalculation_seconds" in result:
+        description += ", rank recalculation {0:.2f}s".format(result["recalculation_seconds"])
+    if baseline_result is not None:
+        description += " (time {0:+.1%}, peak RSS {1:+.1%}".format(
+            result["wall_seconds"] / baseline_result["wall_seconds"] - 1,
+            result["peak_rss_bytes"] / baseline_result["peak_rss_bytes"] - 1)
+        if "recalculation_seconds" in result and "recalculation_seconds" in baseline_result:
+            description += ", rank recalculation {0:+.1%}".format(
+                result["recalculation_seconds"] / baseline_result["recalculation_seconds"] - 1)
+        description += " vs. baseline)"
+    return description
+
+
+if __name__ == '__main__':
+    main()
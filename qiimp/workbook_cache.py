@@ -0,0 +1,139 @@
+import asyncio
+import collections
+import hashlib
+import json
+import os
+
+# Many submissions are exact repeats (the same package, locale and custom fields, from retries, repeated downloads,
+# workshops full of people following the same instructions ...), and there is no point spending seconds of cpu
+# rebuilding a workbook we already have.  Each generated workbook is remembered under a fingerprint of everything that
+# goes into it, and a later submission with the same fingerprint just gets the existing workbook.
+#
+# Likewise, when identical submissions arrive at the same time (a double-click on the submit button, a room full of
+# people starting the same exercise together), only the first one actually builds the workbook: the others just wait
+# for that build to finish and get the same result.
+#
+# NB: the readme sheet of a workbook records when it was generated, so a workbook served from the cache shows when
+# it was first built, not when it was requested.
+
+
+def make_workbook_fingerprint(version, package_schema, form_dict, study_default_locale, study_name, build_settings):
+    """Return a hex digest that is the same for any two requests that would generate identical workbooks.
+
+    build_settings is a dict of every server setting that changes how a workbook is built (the static grid layout,
+    say); since finished workbooks are also found by fingerprint in the job store, which outlives the server, a
+    server restarted with different settings would otherwise keep handing out workbooks built with the old ones.
+    """
+    fingerprint_inputs = [version, package_schema, form_dict, study_default_locale, study_name, build_settings]
+    # NB: sort_keys makes this independent of dict ordering; default=str copes with the odd non-json value (e.g., a
+    # date) that can come out of the package yaml
+    canonical_json = json.dumps(fingerprint_inputs, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical_json.encode("utf-8")).hexdigest()
+
+
+class WorkbookCache(object):
+    """LRU cache of generated workbooks (xlsx_builder.GeneratedWorkbook objects) keyed by fingerprint.
+
+    Workbooks built in memory are held in the cache itself, and count toward max_bytes; workbooks written to the
+    output directory are remembered only by name, and are treated as missing once the output retention has removed
+    their files.  A max_entries of 0 turns the cache off.
+    """
+
+    def __init__(self, wizard_state, max_entries=0, max_bytes=0):
+        self.wizard_state = wizard_state
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+        self.num_coalesced = 0
+        self.total_bytes = 0
+        self._workbooks_by_fingerprint = collections.OrderedDict()
+        self._in_flight_futures_by_fingerprint = {}
+
+    async def get_or_generate(self, fingerprint, generate_func):
+        """Return the cached workbook for this fingerprint, building it with generate_func if necessary.
+
+        generate_func is called with no arguments and must return an awaitable whose result is a GeneratedWorkbook.
+        If a build for the same fingerprint is already under way, it is waited on rather than starting another.
+        """
+        generated_workbook = self.get(fingerprint)
+        if generated_workbook is not None:
+            return generated_workbook
+
+        in_flight_future = self._in_flight_futures_by_fingerprint.get(fingerprint)
+        if in_flight_future is not None:
+            self.num_coalesced += 1
+            # NB: shield, so that one waiter being cancelled doesn't cancel the build for everyone else
+            return await asyncio.shield(in_flight_future)
+
+        in_flight_future = asyncio.ensure_future(generate_func())
+        self._in_flight_futures_by_fingerprint[fingerprint] = in_flight_future
+        in_flight_future.add_done_callback(lambda x: self._finish_in_flight(fingerprint, x))
+        return await asyncio.shield(in_flight_future)
+
+    def get(self, fingerprint):
+        generated_workbook = self._workbooks_by_fingerprint.get(fingerprint)
+        if generated_workbook is not None and generated_workbook.content is None:
+            output_path = self.wizard_state.get_output_path(generated_workbook.file_name)
+            try:
+                # mark the file as recently used, so the output retention doesn't remove a popular workbook
+                os.utime(output_path)
+            except OSError:
+                self._remove(fingerprint)
+                generated_workbook = None
+
+        if generated_workbook is None:
+            self.num_misses += 1
+            return None
+
+        self.num_hits += 1
+        self._workbooks_by_fingerprint.move_to_end(fingerprint)
+        return generated_workbook
+
+    def put(self, fingerprint, generated_workbook):
+        if not self.max_entries:
+            return
+
+        content_size = _get_content_size(generated_workbook)
+        if self.max_bytes and content_size > self.max_bytes:
+            return  # would push everything else out and still not fit
+
+        self._remove(fingerprint)
+        self._workbooks_by_fingerprint[fingerprint] = generated_workbook
+        self.total_bytes += content_size
+
+        while len(self._workbooks_by_fingerprint) > self.max_entries or \
+                (self.max_bytes and self.total_bytes > self.max_bytes):
+            oldest_fingerprint = next(iter(self._workbooks_by_fingerprint))
+            self._remove(oldest_fingerprint)
+            self.num_evictions += 1
+
+    def get_stats(self):
+        return {
+            "num_entries": len(self._workbooks_by_fingerprint),
+            "total_bytes": self.total_bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "num_hits": self.num_hits,
+            "num_misses": self.num_misses,
+            "num_evictions": self.num_evictions,
+            "num_coalesced": self.num_coalesced,
+            "num_in_flight": len(self._in_flight_futures_by_fingerprint)
+        }
+
+    def _finish_in_flight(self, fingerprint, in_flight_future):
+        # whether it worked or not, later requests should now use the cache (or start their own build)
+        self._in_flight_futures_by_fingerprint.pop(fingerprint, None)
+        if not in_flight_future.cancelled() and in_flight_future.exception() is None:
+            self.put(fingerprint, in_flight_future.result())
+
+    def _remove(self, fingerprint):
+        generated_workbook = self._workbooks_by_fingerprint.pop(fingerprint, None)
+        if generated_workbook is not None:
+            self.total_bytes -= _get_content_size(generated_workbook)
+
+
+def _get_content_size(generated_workbook):
+    return 0 if generated_workbook.content is None else len(generated_workbook.content)
@@ -0,0 +1,248 @@
+import collections
+import concurrent.futures
+import datetime
+import io
+import itertools
+import multiprocessing
+import threading
+import time
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+import tornado.util
+
+import qiimp.build_tracer
+import qiimp.metadata_wizard_settings
+import qiimp.request_profiler
+import qiimp.xlsx_builder
+
+PROCESS_EXECUTOR = "process"
+THREAD_EXECUTOR = "thread"
+DISK_OUTPUT_MODE = qiimp.metadata_wizard_settings.WorkbookOutputModes.disk.value
+MEMORY_OUTPUT_MODE = qiimp.metadata_wizard_settings.WorkbookOutputModes.memory.value
+
+# Building a workbook is cpu-bound and can take many seconds for a big package, so it must not be done on the tornado
+# IOLoop thread: while it runs, no other request (not even a static file) can be answered.  Instead, generation is
+# handed off to a pool of worker processes (or threads).  Each worker process gets its own copy of the wizard state
+# once, when it starts, so only the per-request inputs (the schema and the form) need to be sent to it for each job.
+#
+# A caller can also ask to hear about the build's progress (see xlsx_builder.BuildPhases).  Progress callbacks are
+# always run on the caller's IOLoop.  Worker threads can just schedule them there; worker processes instead put
+# (job key, phase) messages on a queue shared with the server process, where a relay thread passes them on to the
+# IOLoop.  NB: everything about which job's progress goes where is kept on the IOLoop's thread; the relay thread only
+# ever hands messages over.
+#
+# Every build is also timed, phase by phase, in the worker; the timings come back along with the workbook and are
+# passed to the generator's build_timing_callback (if any), e.g. for the server's metrics.  A finer-grained trace of
+# the build (see build_tracer) comes back as part of the GeneratedWorkbook.
+#
+# Finally, a caller can ask for a build to be profiled (see request_profiler); that, too, has to happen in the worker,
+# since that is where the time goes.
+
+# the wizard state and progress queue for this worker process; set by _init_worker_process, and only ever used in
+# worker processes
+_worker_wizard_state = None
+_worker_progress_queue = None
+
+# how long a finished process-pool build waits for the last of its progress to come through the queue
+_PROGRESS_DONE_TIMEOUT_SECONDS = 5
+
+# the progress callback for a process-pool job, and a future that is done once the worker says it has sent all of the
+# job's progress
+_ProgressTarget = collections.namedtuple("_ProgressTarget", ["progress_callback", "done_future"])
+
+
+class WorkbookGenerator(object):
+    def __init__(self, wizard_state, executor_type=THREAD_EXECUTOR, num_workers=1, output_mode=DISK_OUTPUT_MODE,
+                 build_timing_callback=None):
+        # NB: build_timing_callback, if given, is called (on the IOLoop) after each build with a dict of the seconds
+        # spent in each phase, by xlsx_builder.BuildPhases value, and the total seconds for the build
+        if executor_type not in [PROCESS_EXECUTOR, THREAD_EXECUTOR]:
+            raise ValueError("Unrecognized workbook generation executor '{0}'; expected '{1}' or '{2}'.".format(
+                executor_type, PROCESS_EXECUTOR, THREAD_EXECUTOR))
+        if output_mode not in [DISK_OUTPUT_MODE, MEMORY_OUTPUT_MODE]:
+            raise ValueError("Unrecognized workbook output mode '{0}'; expected '{1}' or '{2}'.".format(
+                output_mode, DISK_OUTPUT_MODE, MEMORY_OUTPUT_MODE))
+
+        self.wizard_state = wizard_state
+        self.executor_type = executor_type
+        self.in_memory = output_mode == MEMORY_OUTPUT_MODE
+        self.build_timing_callback = build_timing_callback
+        # NB: 0 means "one per cpu", which is what the executors do when given None
+        max_workers = num_workers or None
+
+        self._progress_queue = None
+        self._progress_relay_thread = None
+        # the IOLoop the relay thread hands progress to; NB: a generator is used from just one IOLoop
+        self._progress_io_loop = None
+        # _ProgressTarget for each process-pool job that wants progress, by job key; only used on the IOLoop's thread
+        self._progress_targets_by_job_key = {}
+        self._job_keys = itertools.count()
+
+        if executor_type == PROCESS_EXECUTOR:
+            self._progress_queue = multiprocessing.Queue()
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                                                                    initializer=_init_worker_process,
+                                                                    initargs=(wizard_state, self._progress_queue))
+            self._progress_relay_thread = threading.Thread(target=self._relay_progress,
+                                                           name="workbook_generator_progress", daemon=True)
+            self._progress_relay_thread.start()
+        else:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                                   thread_name_prefix="workbook_generator")
+
+    async def generate(self, study_name, schema_dict, form_dict, progress_callback=None, profile_file_base=None):
+        """Build the workbook (in a worker) and return it as an xlsx_builder.GeneratedWorkbook.
+
+        If progress_callback is given, it is called (on this IOLoop) with each xlsx_builder.BuildPhases member as the
+        build reaches that phase.  If profile_file_base is given, the build is profiled and the profile files are
+        saved under that path (see request_profiler.profile_call).
+        """
+        io_loop = tornado.ioloop.IOLoop.current()
+
+        if self.executor_type == PROCESS_EXECUTOR:
+            job_key = None
+            if progress_callback is not None:
+                job_key = next(self._job_keys)
+                self._progress_io_loop = io_loop
+                self._progress_targets_by_job_key[job_key] = _ProgressTarget(progress_callback,
+                                                                             tornado.concurrent.Future())
+
+            try:
+                generation_result = await io_loop.run_in_executor(
+                    self._executor, _generate_workbook_in_worker_process, study_name, schema_dict, form_dict,
+                    self.in_memory, job_key, profile_file_base)
+                if job_key is not None:
+                    await self._wait_for_progress_done(job_key)
+            finally:
+                # NB: here rather than when the worker says it is done, since a worker that dies (e.g., a
+                # BrokenProcessPool) never says so
+                self._progress_targets_by_job_key.pop(job_key, None)
+        else:
+            worker_progress_callback = None
+            if progress_callback is not None:
+                def worker_progress_callback(build_phase):
+                    io_loop.add_callback(progress_callback, build_phase)
+
+            generation_result = await io_loop.run_in_executor(
+                self._executor, _generate_workbook, study_name, schema_dict, form_dict, self.wizard_state,
+                self.in_memory, worker_progress_callback, profile_file_base)
+
+        generated_workbook, phase_seconds_by_phase, total_seconds = generation_result
+        if self.build_timing_callback is not None:
+            self.build_timing_callback(phase_seconds_by_phase, total_seconds)
+        return generated_workbook
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+        if self._progress_relay_thread is not None:
+            self._progress_queue.put(None)  # tells the relay thread to stop
+            self._progress_relay_thread.join()
+            self._progress_relay_thread = None
+
+    async def _wait_for_progress_done(self, job_key):
+        # The worker's progress comes on a different queue from its result, so some of it may still be on the way;
+        # wait for the rest (the worker says when it has sent all of it) so the caller hears about every phase before
+        # the build is over.
+        try:
+            await tornado.gen.with_timeout(datetime.timedelta(seconds=_PROGRESS_DONE_TIMEOUT_SECONDS),
+                                           self._progress_targets_by_job_key[job_key].done_future)
+        except tornado.util.TimeoutError:
+            pass  # any progress still to come is dropped
+
+    def _relay_progress(self):
+        # runs in its own thread in the server process
+        while True:
+            progress_message = self._progress_queue.get()
+            if progress_message is None:
+                break
+            self._progress_io_loop.add_callback(self._report_progress, *progress_message)
+
+    def _report_progress(self, job_key, build_phase):
+        # runs on the IOLoop
+        progress_target = self._progress_targets_by_job_key.get(job_key)
+        if progress_target is None:
+            return  # the build is already over
+
+        if build_phase is None:
+            # the worker has sent all of this job's progress
+            progress_target.done_future.set_result(None)
+        else:
+            progress_target.progress_callback(build_phase)
+
+
+def _init_worker_process(wizard_state, progress_queue):
+    global _worker_wizard_state, _worker_progress_queue
+    _worker_wizard_state = wizard_state
+    _worker_progress_queue = progress_queue
+
+
+def _generate_workbook_in_worker_process(study_name, schema_dict, form_dict, in_memory, job_key,
+                                         profile_file_base=None):
+    if job_key is None:
+        return _generate_workbook(study_name, schema_dict, form_dict, _worker_wizard_state, in_memory,
+                                  profile_file_base=profile_file_base)
+
+    def progress_callback(build_phase):
+        _worker_progress_queue.put((job_key, build_phase))
+
+    try:
+        return _generate_workbook(study_name, schema_dict, form_dict, _worker_wizard_state, in_memory,
+                                  progress_callback, profile_file_base)
+    finally:
+        _worker_progress_queue.put((job_key, None))
+
+
+def _generate_workbook(study_name, schema_dict, form_dict, wizard_state, in_memory, progress_callback=None,
+                       profile_file_base=None):
+    # returns the GeneratedWorkbook, the seconds spent in each build phase, and the total seconds for the build
+    phase_timer = _BuildPhaseTimer(progress_callback)
+    build_tracer = qiimp.build_tracer.BuildTracer()
+
+    def build_workbook():
+        if not in_memory:
+            file_name = qiimp.xlsx_builder.write_workbook(study_name, schema_dict, form_dict, wizard_state,
+                                                          progress_callback=phase_timer.start_phase,
+                                                          build_tracer=build_tracer)
+            return qiimp.xlsx_builder.GeneratedWorkbook(file_name, None, build_tracer.to_chrome_trace())
+
+        output_stream = io.BytesIO()
+        file_name = qiimp.xlsx_builder.write_workbook(study_name, schema_dict, form_dict, wizard_state,
+                                                      output_stream=output_stream,
+                                                      progress_callback=phase_timer.start_phase,
+                                                      build_tracer=build_tracer)
+        return qiimp.xlsx_builder.GeneratedWorkbook(file_name, output_stream.getvalue(),
+                                                    build_tracer.to_chrome_trace())
+
+    if profile_file_base is None:
+        generated_workbook = build_workbook()
+    else:
+        generated_workbook = qiimp.request_profiler.profile_call(build_workbook, profile_file_base)
+        # the trace is a handy summary to go with the profile
+        qiimp.build_tracer.write_chrome_trace(generated_workbook.build_trace,
+                                              profile_file_base + qiimp.build_tracer.BUILD_TRACE_EXTENSION)
+
+    phase_seconds_by_phase, total_seconds = phase_timer.finish()
+    return generated_workbook, phase_seconds_by_phase, total_seconds
+
+
+class _BuildPhaseTimer(object):
+    # each phase is taken to last until the next one starts (or, for the last one, until the build is done)
+    def __init__(self, progress_callback):
+        self._progress_callback = progress_callback
+        self._start_time = time.perf_counter()
+        self._phase_start_times = []  # (BuildPhases value, start time)
+
+    def start_phase(self, build_phase):
+        self._phase_start_times.append((build_phase.value, time.perf_counter()))
+        if self._progress_callback is not None:
+            self._progress_callback(build_phase)
+
+    def finish(self):
+        end_time = time.perf_counter()
+        phase_seconds_by_phase = {}
+        next_start_times = [x[1] for x in self._phase_start_times[1:]] + [end_time]
+        for (curr_phase, curr_start_time), next_start_time in zip(self._phase_start_times, next_start_times):
+            phase_seconds_by_phase[curr_phase] = next_start_time - curr_start_time
+        return phase_seconds_by_phase, end_time - self._start_time
@@ -1,8 +1,9 @@
+import collections
 from enum import Enum
+import itertools
 import string
-import yaml
-
-import openpyxl
+import xlsxwriter
+import xlsxwriter.worksheet
 
 import qiimp.metadata_wizard_settings as mws
 
@@ -11,6 +12,8 @@ class SheetNames(Enum):
     # Note: these are in the order they appear in the workbook
     metadata = "Metadata"
     validation = "Validation"
+    # NB: only in workbooks built with the static grid on its own sheet; see xlsx_static_grid_builder.HIDDEN_SHEET_LAYOUT
+    validation_grid = "validation_grid"
     data_dictionary = "Data Dictionary"
     schema = "metadata_schema"
     form = "metadata_form"
@@ -26,15 +29,10 @@ def get_min_col_width():
     return mws.MIN_COL_WIDTH
 
 
-def load_yaml_from_wizard_xlsx(filepath, yaml_sheetname):
-    assumed_cell = "A1"
-    wb = openpyxl.load_workbook(filename=filepath)
-    check_is_metadata_wizard_file(wb, yaml_sheetname, filepath)
-
-    yaml_sheet = wb[yaml_sheetname]
-    yaml_string = yaml_sheet[assumed_cell].value
-    yaml_dict = yaml.load(yaml_string)
-    return yaml_dict
+def load_yaml_from_wizard_xlsx(filepath, yaml_sheetname, display_name=None):
+    # the implementation lives in metadata_wizard_settings because the UploadHandler needs it too and
+    # metadata_wizard_settings can't reference this module without creating a circular reference
+    return mws.load_yaml_from_wizard_xlsx(filepath, yaml_sheetname, display_name)
 
 
 def check_is_metadata_wizard_file(openpyxl_workbook, yaml_sheetname, filepath):
@@ -70,25 +68,42 @@ def get_letter(zero_based_letter_index):
     return (string.ascii_lowercase[zero_based_letter_index]).upper()
 
 
-def get_col_letters(curr_col_index):
-    len_alphabet = len(string.ascii_lowercase)
-    num_complete_alphabets = curr_col_index // len_alphabet
-    if num_complete_alphabets >= len_alphabet:
-        max_num_columns = len_alphabet * len_alphabet
-        raise ValueError("Having greater than or equal to {0} columns is not supported".format(max_num_columns))
+def _make_col_letters_table():
+    # A, B, ..., Z, AA, AB, ..., ZZ, AAA, ... up to Excel's last column, XFD
+    result = []
+    for num_letters in range(1, 4):
+        for curr_letters in itertools.product(string.ascii_uppercase, repeat=num_letters):
+            result.append("".join(curr_letters))
+            if len(result) == MAX_NUM_COLUMNS:
+                return tuple(result)
+
 
-    prefix_letter = "" if num_complete_alphabets == 0 else get_letter(num_complete_alphabets - 1)
-    index_within_curr_alphabet = curr_col_index % len_alphabet
-    current_letter = get_letter(index_within_curr_alphabet)
-    result = "{0}{1}".format(prefix_letter, current_letter)
-    return result
+# the column range available for worksheets is 'A:XFD'
+MAX_NUM_COLUMNS = 16384
+# NB: building a column's letters is one of the most frequent things the builders do, so they are all built up front
+_COL_LETTERS = _make_col_letters_table()
+
+
+def get_col_letters(curr_col_index):
+    if not 0 <= curr_col_index < MAX_NUM_COLUMNS:
+        raise ValueError("Having greater than or equal to {0} columns is not supported".format(MAX_NUM_COLUMNS))
+    return _COL_LETTERS[curr_col_index]
 
 
 def format_range(first_col_index, first_row_index, last_col_index=None, last_row_index=None, sheet_name=None,
                  first_col_fixed=False, first_row_fixed=False, last_col_fixed=None, last_row_fixed=False):
+    formatted_sheet_name = "{0}!".format(sheet_name) if sheet_name is not None else ""
+
+    # fast path for the most common case by far: a single cell (e.g., B2, or $B$2)
+    if last_col_index is None and first_row_index is not None and \
+            (last_row_index is None or last_row_index == first_row_index) and \
+            (last_col_fixed is None or last_col_fixed == first_col_fixed) and last_row_fixed == first_row_fixed:
+        return "{0}{1}{2}{3}{4}".format(formatted_sheet_name, get_fix_symbol(first_col_fixed),
+                                        get_col_letters(first_col_index), get_fix_symbol(first_row_fixed),
+                                        first_row_index)
+
     first_col_letter = get_col_letters(first_col_index)
     second_col_letter = first_col_letter if last_col_index is None else get_col_letters(last_col_index)
-    formatted_sheet_name = "{0}!".format(sheet_name) if sheet_name is not None else ""
     if last_col_index is None and last_col_fixed is None:
         last_col_fixed = first_col_fixed
 
@@ -105,7 +120,7 @@ def format_range(first_col_index, first_row_index, last_col_index=None, last_row
         if second_half_of_range == first_half_of_range:
             second_half_of_range = ""
 
-    if second_half_of_range is not "":
+    if second_half_of_range != "":
         second_half_of_range = ":{0}".format(second_half_of_range)
 
     return "{0}{1}{2}".format(formatted_sheet_name, first_half_of_range, second_half_of_range)
@@ -113,26 +128,35 @@ def format_range(first_col_index, first_row_index, last_col_index=None, last_row
 
 # NB: can handle array formulas AS LONG AS they work on columns and only return a single cell!
 # No array formulas that return ranges and no array formulas that work on rows are supported.
-def copy_formula_throughout_range(worksheet, partial_formula_str, first_col_index, first_row_index,
+# NB: the cells are not written right away but added to the given RowMajorSheetPlan, one run per column; see
+# add_formula_col_run.
+def copy_formula_throughout_range(row_plan, partial_formula_str, first_col_index, first_row_index,
                                   last_col_index=None, last_row_index=None, sheet_name=None,
                                   first_col_fixed=False, first_row_fixed=False,
                                   last_col_fixed=None, last_row_fixed=False,
                                   cell_format=None, is_array_formula=False):
+    """
 
-    cell_enumerator = loop_through_range(first_col_index, first_row_index, last_col_index=last_col_index,
-                                         last_row_index=last_row_index, sheet_name=sheet_name,
-                                         col_fixed=first_col_fixed, row_fixed=first_row_fixed)
+    :type row_plan: RowMajorSheetPlan
+    """
+    last_col_index = first_col_index if last_col_index is None else last_col_index
+    run_last_row_index = first_row_index if last_row_index is None else last_row_index
 
-    for curr_col_index, curr_row_index, curr_cell in cell_enumerator:
+    def add_col_run(curr_col_index):
         curr_col_letter = get_col_letters(curr_col_index)
-        completed_formula = partial_formula_str.format(cell=curr_cell, curr_col_letter=curr_col_letter,
-                                                       curr_row_index=curr_row_index, first_row_index=first_row_index,
-                                                       last_row_index=last_row_index)
 
-        if not is_array_formula:
-            worksheet.write_formula(curr_cell, completed_formula, cell_format)
-        else:
-            worksheet.write_array_formula(curr_cell, completed_formula, cell_format)
+        def make_formula(curr_row_index):
+            curr_cell = format_range(curr_col_index, curr_row_index, sheet_name=sheet_name,
+                                     first_col_fixed=first_col_fixed, first_row_fixed=first_row_fixed)
+            return partial_formula_str.format(cell=curr_cell, curr_col_letter=curr_col_letter,
+                                              curr_row_index=curr_row_index, first_row_index=first_row_index,
+                                              last_row_index=last_row_index)
+
+        add_formula_col_run(row_plan, curr_col_index, first_row_index, run_last_row_index, make_formula,
+                            cell_format=cell_format, is_array_formula=is_array_formula)
+
+    for curr_col_index in range(first_col_index, last_col_index + 1):  # +1 bc range is exclusive of last number!
+        add_col_run(curr_col_index)
 
     full_range = format_range(first_col_index, first_row_index, last_col_index=last_col_index,
                               last_row_index=last_row_index, first_col_fixed=first_col_fixed,
@@ -141,15 +165,42 @@ def copy_formula_throughout_range(worksheet, partial_formula_str, first_col_inde
     return full_range
 
 
+def add_formula_col_run(row_plan, col_index, first_row_index, last_row_index, make_formula_func, cell_format=None,
+                        is_array_formula=False):
+    """Plan a formula in each row of a column, where make_formula_func(row_index) returns the row's formula.
+
+    :type row_plan: RowMajorSheetPlan
+    """
+    worksheet = row_plan.worksheet
+    formula_template = RowFormulaTemplate(make_formula_func, [first_row_index, last_row_index])
+    skip_formula_rewrites = formula_template.is_precompiled and isinstance(worksheet, FormulaTemplateWorksheet) and \
+        worksheet.is_unchanged_by_formula_rewrites(formula_template.marked_formula)
+    write_func = worksheet.write_array_formula if is_array_formula else worksheet.write_formula
+
+    def write_cell(curr_row_index):
+        # NB: xlsxwriter's own rows are zero-based; passing it numbers rather than an A1 cell name also saves it
+        # parsing the name back into numbers for every cell
+        write_args = [curr_row_index - 1, col_index]
+        if is_array_formula:
+            write_args.extend([curr_row_index - 1, col_index])
+        write_args.extend([formula_template.render(curr_row_index), cell_format])
+
+        if skip_formula_rewrites:
+            return worksheet.write_without_formula_rewrites(write_func, *write_args)
+        return write_func(*write_args)
+
+    row_plan.add_col_run(first_row_index, last_row_index, write_cell)
+
+
 def loop_through_range(first_col_index, first_row_index, last_col_index=None, last_row_index=None, sheet_name=None,
                        col_fixed=False, row_fixed=False):
     last_col_index = first_col_index if last_col_index is None else last_col_index
     last_row_index = first_row_index if last_row_index is None else last_row_index
 
-    # at outer level, move across columns
-    for curr_col_index in range(first_col_index, last_col_index + 1):  # +1 bc range is exclusive of last number!
-        # at inner level, move down rows
-        for curr_row_index in range(first_row_index, last_row_index + 1):  # +1 bc range is exclusive of last number!
+    # at outer level, move down rows (the order in which xlsxwriter's constant_memory mode needs cells written)
+    for curr_row_index in range(first_row_index, last_row_index + 1):  # +1 bc range is exclusive of last number!
+        # at inner level, move across columns
+        for curr_col_index in range(first_col_index, last_col_index + 1):  # +1 bc range is exclusive of last number!
             curr_cell = format_range(curr_col_index, curr_row_index, sheet_name=sheet_name,
                                      first_col_fixed=col_fixed, first_row_fixed=row_fixed)
             yield curr_col_index, curr_row_index, curr_cell
@@ -173,6 +224,137 @@ def sort_keys(schema_dict):
 # end region
 
 
+class RowFormulaTemplate(object):
+    # Most formulas copied down a column differ from row to row *only* in the row numbers in their cell references
+    # (e.g., =IF(B2="","",B2) vs =IF(B3="","",B3)), but building each one from scratch costs a str.format and
+    # several format_range calls.  So the formula is built just once, with a marker in place of the row number, and
+    # split into the pieces between the markers; each row's formula is then just those pieces joined by the row number.
+    # (Excel's "shared formulas" would do one better and store the formula only once in the file, but xlsxwriter
+    # has no way to write them.)  Not every formula fits: some do arithmetic on the row number, or come out differently
+    # in one row than another (e.g., a range from a fixed row down to the current row collapses to a single cell in
+    # the fixed row).  So the template is checked against the fully-built formulas of the given sample rows, and
+    # it is not used if it doesn't match them exactly (or can't be built at all).
+    _ROW_INDEX_MARKER = "\x00row_index\x00"
+
+    def __init__(self, make_formula_func, sample_row_indices):
+        self._make_formula_func = make_formula_func
+        self._formula_pieces = None
+        # the formula with the marker in place of the row number, if the template is used
+        self.marked_formula = None
+
+        try:
+            marked_formula = make_formula_func(self._ROW_INDEX_MARKER)
+        except (TypeError, ValueError):
+            # e.g., the formula does arithmetic on the row index
+            return
+
+        formula_pieces = marked_formula.split(self._ROW_INDEX_MARKER)
+        # NB: a formula with no row number in it at all is the same in every row, which is fine too
+        if all(str(x).join(formula_pieces) == make_formula_func(x) for x in sample_row_indices):
+            self._formula_pieces = formula_pieces
+            self.marked_formula = marked_formula
+
+    @property
+    def is_precompiled(self):
+        return self._formula_pieces is not None
+
+    def render(self, row_index):
+        if self._formula_pieces is None:
+            return self._make_formula_func(row_index)
+        return str(row_index).join(self._formula_pieces)
+
+
+# NB: _prepare_formula is xlsxwriter's own (private) method for the formula rewrites; with a version of xlsxwriter that
+# doesn't have it, FormulaTemplateWorksheet just writes every formula the ordinary way
+_CAN_SKIP_FORMULA_REWRITES = hasattr(xlsxwriter.worksheet.Worksheet, "_prepare_formula")
+
+
+class FormulaTemplateWorksheet(xlsxwriter.worksheet.Worksheet):
+    # xlsxwriter runs every formula it is given through ~30 regex substitutions (to add the "_xlfn." prefix that the
+    # newer Excel functions need), which, for QIIMP's long formulas, is most of the time a whole build takes.  But if
+    # a RowFormulaTemplate's marked formula comes through those substitutions unchanged, then so will every row's
+    # formula made from it (the row numbers are just digits in cell references, which none of the substitutions match),
+    # so add_formula_col_run has xlsxwriter skip them for those formulas.
+    _skip_formula_rewrites = False
+
+    def is_unchanged_by_formula_rewrites(self, formula):
+        # NB: if xlsxwriter's _prepare_formula ever does more (or other) than strip the delimiters and do the rewrites,
+        # formulas will stop comparing equal here and so will all be written the ordinary way
+        if not _CAN_SKIP_FORMULA_REWRITES:
+            return False
+        return super()._prepare_formula(formula) == _strip_formula_delimiters(formula)
+
+    def write_without_formula_rewrites(self, write_func, *write_args):
+        """Call write_func(*write_args), a write method of this worksheet, skipping xlsxwriter's formula rewrites."""
+        self._skip_formula_rewrites = True
+        try:
+            return write_func(*write_args)
+        finally:
+            self._skip_formula_rewrites = False
+
+    def _prepare_formula(self, formula, expand_future_functions=False):
+        if self._skip_formula_rewrites:
+            return _strip_formula_delimiters(formula)
+        return super()._prepare_formula(formula, expand_future_functions)
+
+
+class FormulaTemplateWorkbook(xlsxwriter.Workbook):
+    worksheet_class = FormulaTemplateWorksheet
+
+
+def _strip_formula_delimiters(formula):
+    # just what xlsxwriter's Worksheet._prepare_formula does before its rewrites: remove any array formula braces and
+    # the leading =
+    if formula.startswith("{"):
+        formula = formula[1:]
+    if formula.startswith("="):
+        formula = formula[1:]
+    if formula.endswith("}"):
+        formula = formula[:-1]
+    return formula
+
+
+class RowMajorSheetPlan(object):
+    # In constant_memory mode, xlsxwriter writes each row of a worksheet out to a temp file as soon as a cell in a
+    # later row is written, and (silently!) drops any cell written to a row it has already written out.  That keeps
+    # just one row of cells in memory rather than the whole sheet, but the builders naturally work a column (i.e., a
+    # field) at a time.  So instead of writing cells, they add them to the sheet's plan: either as one cell or as a
+    # "column run" of cells, one per row, whose contents aren't worked out until write_rows writes that row.  The
+    # plan thus holds only a function per column, never the cells themselves.
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+        # key is first row index of the runs; value is list of (last row index, write_cell_func) tuples
+        self._col_runs_by_first_row_index = collections.defaultdict(list)
+
+    def add_cell(self, row_index, write_func, *write_args):
+        """Have write_func(*write_args) called when row row_index is written."""
+        self.add_col_run(row_index, row_index, lambda curr_row_index: write_func(*write_args))
+
+    def add_col_run(self, first_row_index, last_row_index, write_cell_func):
+        """Have write_cell_func(row_index) called for every row index from first_row_index to last_row_index."""
+        self._col_runs_by_first_row_index[first_row_index].append((last_row_index, write_cell_func))
+
+    def write_rows(self):
+        """Write all the planned cells, in row order."""
+        pending_first_row_indices = sorted(self._col_runs_by_first_row_index, reverse=True)
+        active_col_runs = []
+        curr_row_index = None
+        while active_col_runs or pending_first_row_indices:
+            # skip ahead over any rows with nothing in them
+            curr_row_index = pending_first_row_indices[-1] if not active_col_runs else curr_row_index + 1
+            if pending_first_row_indices and pending_first_row_indices[-1] == curr_row_index:
+                active_col_runs.extend(self._col_runs_by_first_row_index.pop(pending_first_row_indices.pop()))
+
+            for _, curr_write_cell_func in active_col_runs:
+                return_code = curr_write_cell_func(curr_row_index)
+                # NB: xlsxwriter's write methods return -2 if the cell is in a row it has already written out
+                if return_code is not None and return_code < 0:
+                    raise ValueError("Writing a cell in row {0} of worksheet '{1}' failed with return code "
+                                     "'{2}'.".format(curr_row_index, self.worksheet.name, return_code))
+
+            active_col_runs = [x for x in active_col_runs if x[0] > curr_row_index]
+
+
 class MetadataWorksheet(object):
     # I think the column range available for worksheets is 'A:XFD'
 
@@ -230,6 +412,7 @@ class MetadataWorksheet(object):
         # sometime down the road, *this* is where that change should be reflected.
         self.name_col_index = self.first_data_col_index
 
+        self.row_plan = None
         if make_sheet:
             self.worksheet = self._create_worksheet(self.metadata_sheet_name, self._permissive_protect_options,
                                                     num_cols_to_freeze=self.name_col_index + 1)
@@ -244,8 +427,13 @@ class MetadataWorksheet(object):
         # result.set_column('{0}:XFD'.format(first_unused_col_letter), None, None, {'hidden': True})
         result.set_default_row(hide_unused_rows=True)
 
+        # all cells for this sheet are written through its plan; see RowMajorSheetPlan
+        self.row_plan = RowMajorSheetPlan(result)
         return result
 
+    def write_planned_rows(self):
+        self.row_plan.write_rows()
+
 
 # region functions for working with worksheet objects
 def write_header(a_sheet, the_field_name, col_index, row_index=None,
@@ -256,7 +444,8 @@ def write_header(a_sheet, the_field_name, col_index, row_index=None,
     """
     row_index = row_index if row_index is not None else a_sheet.name_row_index
     the_col_letter = get_col_letters(col_index)
-    a_sheet.worksheet.write("{0}{1}".format(the_col_letter, row_index), the_field_name, a_sheet.header_format)
+    a_sheet.row_plan.add_cell(row_index, a_sheet.worksheet.write, "{0}{1}".format(the_col_letter, row_index),
+                              the_field_name, a_sheet.header_format)
     # set the width of the column to be the default minimum unless it is
     # e.g. a hidden column (width overrides hiding in xlsxwriter :( )
     if set_width:
@@ -312,12 +501,17 @@ def write_array_formula(val_sheet, range_index, array_formula_str, write_col, sh
     """
     if write_col:
         range_builder_func = format_single_col_range
+        first_row_index = val_sheet.first_data_row_index
     else:
         range_builder_func = format_single_static_grid_row_range
+        first_row_index = range_index
 
     range_to_hold_formula = range_builder_func(val_sheet, range_index, sheet_name, first_col_fixed,
                                                first_row_fixed, last_col_fixed, last_row_fixed)
-    val_sheet.worksheet.write_array_formula(range_to_hold_formula, array_formula_str)
+    # NB: xlsxwriter stores an array formula in the top-left cell of its range, so that's the row it is written in
+    static_grid_sheet = val_sheet.static_grid_sheet
+    static_grid_sheet.row_plan.add_cell(first_row_index, static_grid_sheet.worksheet.write_array_formula,
+                                        range_to_hold_formula, array_formula_str)
     return range_to_hold_formula
 
 
@@ -1,10 +1,13 @@
 import collections
+import contextlib
+from enum import Enum
+import os
 from random import randrange
 import re
 import unicodedata
-import xlsxwriter
 import yaml
 
+import qiimp.build_tracer
 import qiimp.schema_builder
 import qiimp.xlsx_basics as xlsxbasics
 import qiimp.xlsx_metadata_grid_builder
@@ -16,9 +19,44 @@ import qiimp.xlsx_dynamic_grid_builder
 from yaml.representer import Representer
 yaml.add_representer(collections.defaultdict, Representer.represent_dict)
 
+# how many sample rows the wizard's workbooks have room for
+DEFAULT_NUM_ALLOWABLE_SAMPLES = 1000
+
+# file_name is what the workbook should be called; content is the workbook's bytes when it was built in memory, or None
+# when it was written to the output directory (at metadata_wizard_settings.get_output_path(file_name)); build_trace, if
+# known, is the Chrome trace of the build that made it (see build_tracer.BuildTracer.to_chrome_trace)
+GeneratedWorkbook = collections.namedtuple("GeneratedWorkbook", ["file_name", "content", "build_trace"],
+                                           defaults=[None])
+
+
+class BuildPhases(Enum):
+    # Note: these are in the order they happen in write_workbook
+    metadata_grid = "metadata_grid"
+    static_grid = "static_grid"
+    dynamic_grid = "dynamic_grid"
+    data_dictionary = "data_dictionary"
+    yaml_dump = "yaml_dump"
+    zip_close = "zip_close"
+
+
+def write_workbook(study_name, schema_dict, form_dict, metadata_wizard_settings, output_stream=None,
+                   progress_callback=None, build_tracer=None, num_allowable_samples=DEFAULT_NUM_ALLOWABLE_SAMPLES,
+                   static_grid_layout=None, rank_strategy=None):
+    # NB: if output_stream (e.g., an io.BytesIO) is given, the workbook is written to it instead of to the output
+    # directory, and nothing at all is written to disk.  If progress_callback is given, it is called with each
+    # BuildPhases member as that phase starts.  If build_tracer (a build_tracer.BuildTracer) is given, each step of
+    # the build is recorded as one of its spans.  num_allowable_samples is how many sample rows the workbook has room
+    # for; the wizard always uses the default, but the benchmarks (see workbook_benchmark) try others.
+    # static_grid_layout and rank_strategy (see xlsx_static_grid_builder) override the settings' values for them.
+    def report_progress(build_phase):
+        if progress_callback is not None:
+            progress_callback(build_phase)
+
+    def trace_span(span_name):
+        if build_tracer is None:
+            return contextlib.nullcontext()
+        return build_tracer.span(span_name)
 
-def write_workbook(study_name, schema_dict, form_dict, metadata_wizard_settings):
-    num_allowable_samples = 1000
     # TODO: someday: either expand code to use num_samples and add real code to get in from interface, or take out unused hook
     num_samples = 0
     num_columns = len(schema_dict.keys())
@@ -27,49 +65,105 @@ def write_workbook(study_name, schema_dict, form_dict, metadata_wizard_settings)
     # create workbook
     file_base_name = slugify(study_name)
     file_name = '{0}_{1}.xlsx'.format(file_base_name, randrange(1000, 9999))
-    output_path = metadata_wizard_settings.get_output_path(file_name)
-    workbook = xlsxwriter.Workbook(output_path, {'strings_to_numbers': False,
-                                               'strings_to_formulas': True,
-                                               'strings_to_urls': True})
+    workbook_options = {'strings_to_numbers': False,
+                        'strings_to_formulas': True,
+                        'strings_to_urls': True}
+    if output_stream is None:
+        output_target = metadata_wizard_settings.get_output_path(file_name)
+        # write each worksheet row out to a temp file as soon as the next row is started, rather than holding every
+        # cell of the workbook in memory until close; this only works because all the cells of the big sheets are
+        # written in row order (see xlsxbasics.RowMajorSheetPlan)
+        workbook_options['constant_memory'] = True
+    else:
+        output_target = output_stream
+        # otherwise xlsxwriter assembles the workbook out of temp files
+        # NB: xlsxwriter can't do constant_memory in in_memory mode, so this does hold every cell in memory
+        workbook_options['in_memory'] = True
+    if build_tracer is None:
+        workbook = xlsxbasics.FormulaTemplateWorkbook(output_target, workbook_options)
+    else:
+        workbook = build_tracer.make_workbook(output_target, workbook_options)
 
     # write metadata worksheet
+    report_progress(BuildPhases.metadata_grid)
     phi_renamed_schema_dict = qiimp.schema_builder.rewrite_field_names_with_phi_if_relevant(schema_dict)
     metadata_worksheet = xlsxbasics.MetadataWorksheet(workbook, num_columns, num_samples, a_regex_handler,
                                                       num_allowable_samples=num_allowable_samples)
-    qiimp.xlsx_metadata_grid_builder.write_metadata_grid(metadata_worksheet, phi_renamed_schema_dict,
-                                                                   DescriptionWorksheet.get_sheet_name())
+    with trace_span("write_metadata_grid"):
+        qiimp.xlsx_metadata_grid_builder.write_metadata_grid(metadata_worksheet, phi_renamed_schema_dict,
+                                                             DescriptionWorksheet.get_sheet_name())
+        metadata_worksheet.write_planned_rows()
 
     # write validation worksheet
-    validation_worksheet = qiimp.xlsx_static_grid_builder.ValidationWorksheet(workbook, num_columns,
-                                                                                        num_samples, a_regex_handler)
-    index_and_range_str_tuple_by_header_dict = qiimp.xlsx_static_grid_builder.write_static_validation_grid_and_helpers(
-        validation_worksheet, phi_renamed_schema_dict)
-    qiimp.xlsx_dynamic_grid_builder.write_dynamic_validation_grid(
-        validation_worksheet, index_and_range_str_tuple_by_header_dict)
+    report_progress(BuildPhases.static_grid)
+    if static_grid_layout is None:
+        static_grid_layout = metadata_wizard_settings.static_grid_layout
+    if rank_strategy is None:
+        rank_strategy = metadata_wizard_settings.rank_strategy
+    validation_worksheet = qiimp.xlsx_static_grid_builder.ValidationWorksheet(
+        workbook, num_columns, num_samples, a_regex_handler, num_allowable_samples=num_allowable_samples,
+        static_grid_layout=static_grid_layout, rank_strategy=rank_strategy)
+    with trace_span("write_static_validation_grid_and_helpers"):
+        index_and_range_str_tuple_by_header_dict = \
+            qiimp.xlsx_static_grid_builder.write_static_validation_grid_and_helpers(
+                validation_worksheet, phi_renamed_schema_dict)
+    report_progress(BuildPhases.dynamic_grid)
+    with trace_span("write_dynamic_validation_grid"):
+        qiimp.xlsx_dynamic_grid_builder.write_dynamic_validation_grid(
+            validation_worksheet, index_and_range_str_tuple_by_header_dict)
+    # NB: the static and dynamic grids share the validation sheet's rows, so neither can write its cells until both
+    # have been planned (this also writes the static grid's own sheet, if it has one)
+    with trace_span("write_validation_rows"):
+        validation_worksheet.write_planned_rows()
 
     # write descriptions worksheet
+    report_progress(BuildPhases.data_dictionary)
     descriptions_worksheet = DescriptionWorksheet(workbook, num_columns, num_samples, a_regex_handler)
     xlsxbasics.write_header(descriptions_worksheet, "field name", 0)
     xlsxbasics.write_header(descriptions_worksheet, "field description", 1)
-    sorted_keys = xlsxbasics.sort_keys(phi_renamed_schema_dict)
-    for field_index, field_name in enumerate(sorted_keys):
-        row_num = field_index + 1 + 1  # plus 1 to move past name row, and plus 1 again because row nums are 1-based
-        field_specs_dict = phi_renamed_schema_dict[field_name]
-        message = qiimp.xlsx_validation_builder.get_field_constraint_description(field_specs_dict, a_regex_handler)
-        descriptions_worksheet.worksheet.write("A{0}".format(row_num), field_name, metadata_worksheet.header_format)
-        descriptions_worksheet.worksheet.write("B{0}".format(row_num), message)
+    with trace_span("data_dictionary"):
+        sorted_keys = xlsxbasics.sort_keys(phi_renamed_schema_dict)
+        for field_index, field_name in enumerate(sorted_keys):
+            row_num = field_index + 1 + 1  # plus 1 to move past name row, and plus 1 again because row nums are 1-based
+            field_specs_dict = phi_renamed_schema_dict[field_name]
+            message = qiimp.xlsx_validation_builder.get_field_constraint_description(field_specs_dict, a_regex_handler)
+            descriptions_worksheet.row_plan.add_cell(row_num, descriptions_worksheet.worksheet.write,
+                                                     "A{0}".format(row_num), field_name,
+                                                     metadata_worksheet.header_format)
+            descriptions_worksheet.row_plan.add_cell(row_num, descriptions_worksheet.worksheet.write,
+                                                     "B{0}".format(row_num), message)
+        descriptions_worksheet.write_planned_rows()
 
     # write schema worksheet--note, don't use the phi_renamed_schema_dict but the original schema_dict
-    schema_worksheet = xlsxbasics.create_worksheet(workbook, xlsxbasics.SheetNames.schema.value)
-    schema_worksheet.write_string("A1", yaml.dump(schema_dict, default_flow_style=False))
-    schema_worksheet.hide()
+    # (the yaml dumps of the schema and form, and the readme after them, are reported together)
+    report_progress(BuildPhases.yaml_dump)
+    with trace_span("yaml.dump schema"):
+        schema_worksheet = xlsxbasics.create_worksheet(workbook, xlsxbasics.SheetNames.schema.value)
+        schema_worksheet.write_string("A1", yaml.dump(schema_dict, default_flow_style=False))
+        schema_worksheet.hide()
 
     # write form worksheet
-    form_worksheet = xlsxbasics.create_worksheet(workbook, xlsxbasics.SheetNames.form.value)
-    form_worksheet.write_string("A1", yaml.dump(form_dict, default_flow_style=False))
-    form_worksheet.hide()
+    with trace_span("yaml.dump form"):
+        form_worksheet = xlsxbasics.create_worksheet(workbook, xlsxbasics.SheetNames.form.value)
+        form_worksheet.write_string("A1", yaml.dump(form_dict, default_flow_style=False))
+        form_worksheet.hide()
 
     # write readme worksheet
+    with trace_span("readme"):
+        _write_readme_worksheet(workbook, metadata_wizard_settings)
+
+    # close workbook; this is when xlsxwriter actually assembles and zips up the xlsx
+    report_progress(BuildPhases.zip_close)
+    with trace_span("workbook.close"):
+        workbook.close()
+        if build_tracer is not None:
+            # NB: xlsxwriter leaves an output stream positioned at the end of what it wrote
+            num_bytes = output_stream.tell() if output_stream is not None else os.path.getsize(output_target)
+            build_tracer.count(qiimp.build_tracer.BYTES_WRITTEN, num_bytes)
+    return file_name
+
+
+def _write_readme_worksheet(workbook, metadata_wizard_settings):
     readme_format = workbook.add_format({'align': 'left', 'valign': 'top'})
     readme_format.set_text_wrap()
     readme_worksheet = xlsxbasics.create_worksheet(workbook, xlsxbasics.SheetNames.readme.value)
@@ -86,10 +180,6 @@ def write_workbook(study_name, schema_dict, form_dict, metadata_wizard_settings)
                                    xlsxbasics.make_format(workbook, {'font_color': 'blue', 'underline': 1}))
     readme_worksheet.write_string('A3', metadata_wizard_settings.make_readme_text(), readme_format)
 
-    # close workbook
-    workbook.close()
-    return file_name
-
 
 class DescriptionWorksheet(xlsxbasics.MetadataWorksheet):
     @classmethod
@@ -102,6 +192,7 @@ class DescriptionWorksheet(xlsxbasics.MetadataWorksheet):
         SHEET_NAME = self.get_sheet_name()
         self.worksheet = xlsxbasics.create_worksheet(self.workbook, SHEET_NAME,
                                                       self._permissive_protect_options)
+        self.row_plan = xlsxbasics.RowMajorSheetPlan(self.worksheet)
 
 
 # very slight modification of django code at https://github.com/django/django/blob/master/django/utils/text.py#L413
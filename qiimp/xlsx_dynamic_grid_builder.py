@@ -26,17 +26,27 @@ def write_dynamic_validation_grid(val_sheet, index_and_range_str_tuple_by_header
 
         _write_dynamic_header_cell(val_sheet, curr_col_index, col_rank)
 
-        # at inner level, move down rows
-        for curr_row_index in range(val_sheet.first_data_row_index, val_sheet.last_data_row_index + 1):
-            cell_formula = _generate_dynamic_grid_cell_formula_str(val_sheet, col_rank, col_already_valid_condition,
-                                                                   curr_row_index,
-                                                                   index_and_range_str_tuple_by_header_dict)
-            curr_cell = xlsxbasics.format_range(curr_col_index, curr_row_index)
-            val_sheet.worksheet.write_formula(curr_cell, cell_formula)
+        # at inner level, move down rows (once the sheet's rows are written; see xlsxbasics.RowMajorSheetPlan)
+        _add_dynamic_grid_col_run(val_sheet, curr_col_index, col_rank, col_already_valid_condition,
+                                  index_and_range_str_tuple_by_header_dict)
 
     _write_dynamic_grid_conditional_formatting(val_sheet)
 
 
+def _add_dynamic_grid_col_run(val_sheet, curr_col_index, col_rank, col_already_valid_condition,
+                              index_and_range_str_tuple_by_header_dict):
+    """
+
+    :type val_sheet: xlsx_static_grid_builder.ValidationWorksheet
+    """
+    def make_formula(curr_row_index):
+        return _generate_dynamic_grid_cell_formula_str(val_sheet, col_rank, col_already_valid_condition,
+                                                       curr_row_index, index_and_range_str_tuple_by_header_dict)
+
+    xlsxbasics.add_formula_col_run(val_sheet.row_plan, curr_col_index, val_sheet.first_data_row_index,
+                                   val_sheet.last_data_row_index, make_formula)
+
+
 def _write_dynamic_grid_conditional_formatting(val_sheet):
     """
 
@@ -82,11 +92,12 @@ def _write_dynamic_name_link_col(val_sheet, index_and_range_str_tuple_by_header_
 
     # NB: grid goes as far as last allowable row for samples, not just to number of expected samples, in case user
     # adds some extra ones :)
-    for curr_row_index in range(val_sheet.first_data_row_index, val_sheet.last_allowable_row_for_sample_index + 1):
+    def make_name_link_formula(curr_row_index):
         row_rank_num = _format_dynamic_rank_formula_str(val_sheet, curr_row_index,
                                                         index_and_range_str_tuple_by_header_dict, for_row=True)
 
-        row_in_metadata_fixed_range_str = index_and_range_str_tuple_by_header_dict[val_sheet.ROW_IN_METADATA_HEADER][1]
+        row_in_metadata_fixed_range_str = _get_helper_range_str(val_sheet, index_and_range_str_tuple_by_header_dict,
+                                                                val_sheet.ROW_IN_METADATA_HEADER)
         # the below returns a 1-based row number
         metadata_row_num = "INDEX({row_in_metadata_fixed_range_str},{row_rank_num},0)".format(
             row_in_metadata_fixed_range_str=row_in_metadata_fixed_range_str, row_rank_num=row_rank_num)
@@ -96,34 +107,34 @@ def _write_dynamic_name_link_col(val_sheet, index_and_range_str_tuple_by_header_
         link_address = "CONCATENATE(\"#metadata!\",ADDRESS({metadata_row_num},{metadata_name_col_num}))".format(
             metadata_row_num=metadata_row_num, metadata_name_col_num=val_sheet.name_col_index+1)
 
-        helper_name_fixed_range_str = index_and_range_str_tuple_by_header_dict[val_sheet.SAMPLE_NAME_HEADER][1]
+        helper_name_fixed_range_str = _get_helper_range_str(val_sheet, index_and_range_str_tuple_by_header_dict,
+                                                            val_sheet.SAMPLE_NAME_HEADER)
         # this index formula will get the value of the name for this sample from the helper col next to the static grid
         helper_name_val = "INDEX({conditional_name_fixed_range_str},{row_num},0)".format(
             conditional_name_fixed_range_str=helper_name_fixed_range_str, row_num=row_rank_num)
 
-        curr_cell = xlsxbasics.format_range(val_sheet.name_link_col_index, curr_row_index)
-
         # If this sample is entirely valid as shown by the fact that the first data cell in the dynamic grid for this
         # row is just an empty string, write a space into the dynamic name cell.  Otherwise, write a link to the
         # name column for this sample in the metadata sheet.  NB: it does NOT work to look at
         # the value in the is_valid helper column for this sample (either True or False) because the samples
         # change order based on validation status ...
         first_data_cell_in_first_data_col = xlsxbasics.format_range(val_sheet.name_link_col_index + 1, curr_row_index)
-        full_formula = "=IF({first_validation_cell}=\" \",\" \",HYPERLINK({link_address},{helper_name_val}))".format(
+        return "=IF({first_validation_cell}=\" \",\" \",HYPERLINK({link_address},{helper_name_val}))".format(
             first_validation_cell=first_data_cell_in_first_data_col, link_address=link_address,
             helper_name_val=helper_name_val)
-        val_sheet.worksheet.write_formula(curr_cell, full_formula, url_format)
+
+    xlsxbasics.add_formula_col_run(val_sheet.row_plan, val_sheet.name_link_col_index, val_sheet.first_data_row_index,
+                                   val_sheet.last_allowable_row_for_sample_index, make_name_link_formula,
+                                   cell_format=url_format)
 
 
 def _write_dynamic_header_cell(val_sheet, curr_col_index, col_rank):
     # e.g., =IF(B2=" ", " ", INDEX($AS$1:$BY$1, 1, MATCH(COLUMNS($AS$1005:AS1005),$AS$1005:$BY$1005,0)))
 
     first_data_cell_in_col = xlsxbasics.format_range(curr_col_index, val_sheet.first_data_row_index)
-    static_grid_header_row = xlsxbasics.format_single_static_grid_row_range(val_sheet, val_sheet.name_row_index,
-                                                                             first_col_fixed=True,
-                                                                             first_row_fixed=True,
-                                                                             last_col_fixed=True,
-                                                                             last_row_fixed=True)
+    static_grid_header_row = xlsxbasics.format_single_static_grid_row_range(
+        val_sheet, val_sheet.name_row_index, sheet_name=val_sheet.static_grid_sheet_name, first_col_fixed=True,
+        first_row_fixed=True, last_col_fixed=True, last_row_fixed=True)
 
     # if ALL samples are valid in this column, then all the data cells for this column will have a space
     # in them.  Conversely, if ANY sample is invalid in this column, the data cells will either be *empty* (have
@@ -187,11 +198,24 @@ def _format_dynamic_rank_formula_str(val_sheet, curr_range_index, index_and_rang
     # # 2: Get the col_rank for the metadata column that should be shown in this validation column
     # (e.g., if we're in validation column 6, we should be showing the metadata column with col_rank 6).
     # MATCH(COLUMNS($AQ$16:AQ16),$AQ$16:$BW$16,0)
+    #
+    # With the running_count rank strategy, the row_at_rank helper cell in this same row (or the col_at_rank helper
+    # cell in the matching static grid column) has already worked that out, so this just points at it
+    # (e.g., $AM2 or AQ$18) rather than searching the ranks again; see xlsx_static_grid_builder.
+    at_rank_header = val_sheet.ROW_AT_RANK_HEADER if for_row else val_sheet.COL_AT_RANK_HEADER
+    if at_rank_header in index_and_range_str_tuple_by_header_dict:
+        at_rank_range_index = index_and_range_str_tuple_by_header_dict[at_rank_header][0]
+        if for_row:
+            return xlsxbasics.format_range(at_rank_range_index, curr_range_index,
+                                           sheet_name=val_sheet.static_grid_sheet_name, first_col_fixed=True)
+        return xlsxbasics.format_range(curr_range_index, at_rank_range_index,
+                                       sheet_name=val_sheet.static_grid_sheet_name, first_row_fixed=True,
+                                       last_row_fixed=True)
 
     rank_header = val_sheet.ROW_RANK_HEADER if for_row else val_sheet.COL_RANK_HEADER
     rank_index_and_range_tuple = index_and_range_str_tuple_by_header_dict[rank_header]
     rank_range_index = rank_index_and_range_tuple[0]
-    rank_fixed_range_str = rank_index_and_range_tuple[1]
+    rank_fixed_range_str = _get_helper_range_str(val_sheet, index_and_range_str_tuple_by_header_dict, rank_header)
 
     if for_row:
         excel_func_name = "ROWS"
@@ -208,8 +232,9 @@ def _format_dynamic_rank_formula_str(val_sheet, curr_range_index, index_and_rang
 
     rank_to_curr_point_range = xlsxbasics.format_range(first_col_index, first_row_index,
                                                         last_col_index=last_col_index,
-                                                        last_row_index=last_row_index, first_col_fixed=True,
-                                                        first_row_fixed=True)
+                                                        last_row_index=last_row_index,
+                                                        sheet_name=val_sheet.static_grid_sheet_name,
+                                                        first_col_fixed=True, first_row_fixed=True)
 
     rank_num = "MATCH({excel_func_name}({rank_to_curr_point_range}),{rank_fixed_range_str},0)".format(
         excel_func_name=excel_func_name, rank_to_curr_point_range=rank_to_curr_point_range,
@@ -246,7 +271,8 @@ def _format_range_already_valid_formula_str(val_sheet, rank_num, index_and_range
         row_num = 1
         col_num = rank_num
 
-    order_weight_fixed_range_str = index_and_range_str_tuple_by_header_dict[order_weight_header][1]
+    order_weight_fixed_range_str = _get_helper_range_str(val_sheet, index_and_range_str_tuple_by_header_dict,
+                                                         order_weight_header)
     range_already_valid_condition = "INDEX({order_weight_fixed_range_str},{row_num},{col_num})>=100000".format(
         order_weight_fixed_range_str=order_weight_fixed_range_str, row_num=row_num, col_num=col_num)
     return range_already_valid_condition
@@ -265,6 +291,7 @@ def _format_static_grid_cell_reference_formula_str(val_sheet, row_rank_num, col_
                                                            val_sheet.first_data_row_index,
                                                            last_col_index=val_sheet.last_static_grid_col_index,
                                                            last_row_index=val_sheet.last_data_row_index,
+                                                           sheet_name=val_sheet.static_grid_sheet_name,
                                                            first_col_fixed=True, first_row_fixed=True,
                                                            last_col_fixed=True, last_row_fixed=True)
 
@@ -289,8 +316,10 @@ def _format_hyperlink_to_metadata_grid_cell(val_sheet, row_rank_num, col_rank_nu
     #
     # INDEX($AL$2:$AL$11,MATCH(ROWS($AJ$2:AJ2),$AJ$2:$AJ$11,0),0),
     # INDEX($AQ$14:$BW$14,1,MATCH(COLUMNS($AQ$16:AQ16),$AQ$16:$BW$16,0))
-    row_in_metadata_fixed_range_str = index_and_range_str_tuple_by_header_dict[val_sheet.ROW_IN_METADATA_HEADER][1]
-    col_in_metadata_fixed_range_str = index_and_range_str_tuple_by_header_dict[val_sheet.COL_IN_METADATA_HEADER][1]
+    row_in_metadata_fixed_range_str = _get_helper_range_str(val_sheet, index_and_range_str_tuple_by_header_dict,
+                                                            val_sheet.ROW_IN_METADATA_HEADER)
+    col_in_metadata_fixed_range_str = _get_helper_range_str(val_sheet, index_and_range_str_tuple_by_header_dict,
+                                                            val_sheet.COL_IN_METADATA_HEADER)
     metadata_grid_cell_range = "INDEX({row_in_metadata_fixed_range_str},{row_rank_num},0), " \
                                "INDEX({col_in_metadata_fixed_range_str},1,{col_rank_num}" \
                                ")".format(row_in_metadata_fixed_range_str=row_in_metadata_fixed_range_str,
@@ -304,3 +333,17 @@ def _format_hyperlink_to_metadata_grid_cell(val_sheet, row_rank_num, col_rank_nu
                                                  metadata_grid_cell_range=metadata_grid_cell_range)
 
     return hyperlink_to_metadata_grid_cell
+
+
+def _get_helper_range_str(val_sheet, index_and_range_str_tuple_by_header_dict, header):
+    """
+
+    :type val_sheet: xlsx_static_grid_builder.ValidationWorksheet
+    """
+    # NB: the static builder's helper range strings are relative to the sheet the helpers are on, so they need that
+    # sheet's name in front of them when it isn't the validation sheet itself (see
+    # xlsx_static_grid_builder.HIDDEN_SHEET_LAYOUT)
+    helper_range_str = index_and_range_str_tuple_by_header_dict[header][1]
+    if val_sheet.static_grid_sheet_name is None:
+        return helper_range_str
+    return "{0}!{1}".format(val_sheet.static_grid_sheet_name, helper_range_str)
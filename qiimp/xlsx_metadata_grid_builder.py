@@ -1,4 +1,4 @@
-import collections
+import collections.abc
 
 import qiimp.metadata_wizard_settings as mws
 import qiimp.xlsx_basics as xlsxbasics
@@ -10,6 +10,7 @@ def write_metadata_grid(data_worksheet, schema_dict, field_descs_sheet_name):
 
     :type data_worksheet: xlsxbasics.MetadataWorksheet
     """
+    # NB: the cells are only planned here; see data_worksheet.write_planned_rows
 
     _write_sample_id_col(data_worksheet)
 
@@ -78,15 +79,18 @@ def _write_sample_id_col(data_sheet):
     xlsxbasics.write_header(data_sheet, "sample_id",
                             data_sheet.sample_id_col_index, set_width=False)
 
-    # +1 bc range is exclusive of last number
-    for row_index in range(data_sheet.first_data_row_index, data_sheet.last_allowable_row_for_sample_index + 1):
-        curr_cell = xlsxbasics.format_range(data_sheet.sample_id_col_index, row_index)
+    # NB: the id_num makes this formula different from row to row in more than its row numbers, so it doesn't get
+    # the precompiled fast path (see xlsxbasics.RowFormulaTemplate)
+    def make_sample_id_formula(row_index):
         id_num = row_index - data_sheet.first_data_row_index + 1
         data_row_range = xlsxbasics.format_single_data_grid_row_range(data_sheet, row_index)
 
-        completed_formula = "=IF(COUNTBLANK({data_row_range})<>COLUMNS({data_row_range}),{id_num},\"\")".format(
+        return "=IF(COUNTBLANK({data_row_range})<>COLUMNS({data_row_range}),{id_num},\"\")".format(
             data_row_range=data_row_range, id_num=id_num)
-        data_sheet.worksheet.write_formula(curr_cell, completed_formula)
+
+    xlsxbasics.add_formula_col_run(data_sheet.row_plan, data_sheet.sample_id_col_index,
+                                   data_sheet.first_data_row_index, data_sheet.last_allowable_row_for_sample_index,
+                                   make_sample_id_formula)
 
 
 def _get_validation_dict(field_name, field_schema_dict, a_regex_handler, field_descs_sheet_name):
@@ -197,10 +201,10 @@ def _add_default_if_any(data_worksheet, field_specs_dict, col_index):
 
     partial_default_formula = xvb.get_default_formula(field_specs_dict, trigger_col_letter)
     if partial_default_formula is not None:
-        xlsxbasics.copy_formula_throughout_range(data_worksheet.worksheet, partial_default_formula, col_index,
-                                                  data_worksheet.first_data_row_index,
-                                                  last_row_index=data_worksheet.last_allowable_row_for_sample_index,
-                                                  cell_format=None)
+        xlsxbasics.copy_formula_throughout_range(data_worksheet.row_plan, partial_default_formula, col_index,
+                                                 data_worksheet.first_data_row_index,
+                                                 last_row_index=data_worksheet.last_allowable_row_for_sample_index,
+                                                 cell_format=None)
 
 
 def _determine_if_format_should_be_text(field_specs_dict):
@@ -233,7 +237,7 @@ def _apply_func_to_nested_dict_vals(a_val, func_to_apply):
     else:
         # see https://stackoverflow.com/a/6711233 on why this type-checking is kosher.
         # using str instead of basestring because later is not in python 3
-        if isinstance(a_val, collections.Iterable) and not isinstance(a_val, str):
+        if isinstance(a_val, collections.abc.Iterable) and not isinstance(a_val, str):
             for curr_item in a_val:
                 result.extend(_apply_func_to_nested_dict_vals(curr_item, func_to_apply))
 
@@ -2,10 +2,44 @@ import qiimp.metadata_wizard_settings
 import qiimp.xlsx_basics as xlsxbasics
 import qiimp.xlsx_validation_builder
 
+# Where the static validation grid and its helper rows and columns go: the INLINE_LAYOUT puts them in hidden columns
+# of the Validation sheet itself, off to the right of the (visible) dynamic grid; the HIDDEN_SHEET_LAYOUT puts them,
+# packed together, on a separate very hidden sheet (which the user can't even unhide), so the Validation sheet holds
+# only what the user sees and Excel has far fewer columns of it to load, scroll and recalculate.
+INLINE_LAYOUT = qiimp.metadata_wizard_settings.StaticGridLayouts.inline.value
+HIDDEN_SHEET_LAYOUT = qiimp.metadata_wizard_settings.StaticGridLayouts.hidden_sheet.value
+
+# How the row_rank and col_rank helpers order the metadata rows and columns for the dynamic grid (invalid ones first,
+# then valid ones, each in their order in the metadata sheet).  The COUNTIF_RANK_STRATEGY ranks each one by counting
+# how many order weights are <= its own, which means every recalculation compares each row against every other row
+# (so 1000 rows make a million comparisons, and 10000 rows a hundred million).  The RUNNING_COUNT_RANK_STRATEGY gets
+# the same ranks from an extra helper holding a running count of the invalid rows (or columns) so far, each cell of
+# which just adds one to (or keeps) the count in the cell before it: an invalid row's rank is that count, and a valid
+# row's rank is the total number of invalid rows plus the number of valid rows so far.
+#
+# The dynamic grid also needs the opposite lookup: which metadata row has the rank of the validation row being shown.
+# With the COUNTIF_RANK_STRATEGY, each of its cells does that itself, with exact MATCHes over all the ranks (several
+# per cell).  With the RUNNING_COUNT_RANK_STRATEGY, each row_at_rank (and col_at_rank) helper cell works it out once,
+# for its own rank, and the dynamic grid's cells just point at it: the wanted row is where the running count of
+# invalid (or, with a second helper, valid) rows reaches the wanted number, which--since running counts only ever go
+# up--an approximate MATCH finds by binary search.
+COUNTIF_RANK_STRATEGY = qiimp.metadata_wizard_settings.RankStrategies.countif.value
+RUNNING_COUNT_RANK_STRATEGY = qiimp.metadata_wizard_settings.RankStrategies.running_count.value
+
 
 class ValidationWorksheet(xlsxbasics.MetadataWorksheet):
-    def __init__(self, workbook, num_attributes, num_samples, a_regex_handler):
-        super().__init__(workbook, num_attributes, num_samples, a_regex_handler, make_sheet=False)
+    def __init__(self, workbook, num_attributes, num_samples, a_regex_handler, num_allowable_samples=1000,
+                 static_grid_layout=INLINE_LAYOUT, rank_strategy=COUNTIF_RANK_STRATEGY):
+        super().__init__(workbook, num_attributes, num_samples, a_regex_handler, make_sheet=False,
+                         num_allowable_samples=num_allowable_samples)
+
+        if static_grid_layout not in [INLINE_LAYOUT, HIDDEN_SHEET_LAYOUT]:
+            raise ValueError("Unrecognized static grid layout '{0}'; expected '{1}' or '{2}'".format(
+                static_grid_layout, INLINE_LAYOUT, HIDDEN_SHEET_LAYOUT))
+        if rank_strategy not in [COUNTIF_RANK_STRATEGY, RUNNING_COUNT_RANK_STRATEGY]:
+            raise ValueError("Unrecognized rank strategy '{0}'; expected '{1}' or '{2}'".format(
+                rank_strategy, COUNTIF_RANK_STRATEGY, RUNNING_COUNT_RANK_STRATEGY))
+        self.rank_strategy = rank_strategy
 
         SHEET_NAME = xlsxbasics.SheetNames.validation.value
 
@@ -14,13 +48,24 @@ class ValidationWorksheet(xlsxbasics.MetadataWorksheet):
         self.IS_VALID_ROW_HEADER = "is_valid_row"
         self.ROW_IN_METADATA_HEADER = "row_in_metadata"
         self.ROW_ORDER_WEIGHT_HEADER = "row_order_weight"
+        self.ROW_INVALID_COUNT_HEADER = "row_invalid_count"
+        self.ROW_VALID_COUNT_HEADER = "row_valid_count"
         self.ROW_RANK_HEADER = "row_rank"
+        self.ROW_AT_RANK_HEADER = "row_at_rank"
         self.IS_VALID_COL_HEADER = "is_valid_col"
         self.COL_IN_METADATA_HEADER = "col_in_metadata"
         self.COL_ORDER_WEIGHT_HEADER = "col_order_weight"
+        self.COL_INVALID_COUNT_HEADER = "col_invalid_count"
+        self.COL_VALID_COUNT_HEADER = "col_valid_count"
         self.COL_RANK_HEADER = "col_rank"
-
-        self._col_offset = self._num_field_columns + 10
+        self.COL_AT_RANK_HEADER = "col_at_rank"
+
+        if static_grid_layout == INLINE_LAYOUT:
+            self._col_offset = self._num_field_columns + 10
+        else:
+            # NB: just enough room to the left of the grid for the helper columns (starting in column A) and the empty
+            # column between them and the grid that holds the helper rows' headers; see _write_static_helper_ranges
+            self._col_offset = len(_get_static_helper_col_header_and_writer_func_tuple_list(self))
         self.first_static_grid_col_index = self.first_data_col_index + self._col_offset
         self.last_static_grid_col_index = self.last_data_col_index + self._col_offset
 
@@ -36,12 +81,42 @@ class ValidationWorksheet(xlsxbasics.MetadataWorksheet):
 
         self.worksheet = self._create_worksheet(SHEET_NAME)
 
+        # the sheet that the static grid and helpers are written to, and the name that references to them from this
+        # sheet need (None when they are on this sheet too)
+        self.static_grid_sheet = self
+        self.static_grid_sheet_name = None
+        if static_grid_layout == HIDDEN_SHEET_LAYOUT:
+            self.static_grid_sheet = StaticGridWorksheet(workbook, num_attributes, num_samples, a_regex_handler,
+                                                         num_allowable_samples=num_allowable_samples)
+            self.static_grid_sheet_name = self.static_grid_sheet.worksheet.name
+
+    def write_planned_rows(self):
+        super().write_planned_rows()
+        if self.static_grid_sheet is not self:
+            self.static_grid_sheet.write_planned_rows()
+
     def hide_columns(self, first_col_index, last_col_index=None):
         first_col_letter = xlsxbasics.get_col_letters(first_col_index)
         last_col_letter = first_col_letter if last_col_index is None else xlsxbasics.get_col_letters(last_col_index)
         self.worksheet.set_column('{0}:{1}'.format(first_col_letter, last_col_letter), None, None, {'hidden': True})
 
 
+class StaticGridWorksheet(xlsxbasics.MetadataWorksheet):
+    # just the sheet for the static grid and helpers in the HIDDEN_SHEET_LAYOUT; all of their positions are still
+    # those given by the ValidationWorksheet
+    def __init__(self, workbook, num_attributes, num_samples, a_regex_handler, num_allowable_samples=1000):
+        super().__init__(workbook, num_attributes, num_samples, a_regex_handler, make_sheet=False,
+                         num_allowable_samples=num_allowable_samples)
+
+        SHEET_NAME = xlsxbasics.SheetNames.validation_grid.value
+        self.worksheet = self._create_worksheet(SHEET_NAME)
+        self.worksheet.very_hidden()
+
+    def hide_columns(self, first_col_index, last_col_index=None):
+        # NB: nothing to do; the whole sheet is hidden
+        pass
+
+
 # I know what you're thinking: if all these functions take in the ValidationWorksheet object as their first argument,
 # why the heck aren't they methods of the Validation Worksheet object?  Well, they don't *all* take that in as their
 # first argument, but that aside, it is because I ALSO want to pass the data contained in the ValidationWorksheet
@@ -54,6 +129,7 @@ def write_static_validation_grid_and_helpers(val_sheet, schema_dict):
 
 
 # write invariant sample by feature grid
+# NB: like everything else in this module, the cells are only planned here; see val_sheet.write_planned_rows
 def _write_static_validation_grid(val_sheet, schema_dict):
     """
 
@@ -65,7 +141,7 @@ def _write_static_validation_grid(val_sheet, schema_dict):
         field_specs_dict = schema_dict[field_name]
         curr_grid_col_index = val_sheet.first_static_grid_col_index + field_index
 
-        xlsxbasics.write_header(val_sheet, field_name, curr_grid_col_index,
+        xlsxbasics.write_header(val_sheet.static_grid_sheet, field_name, curr_grid_col_index,
                                 set_width=False)
 
         unformatted_formula_str = qiimp.xlsx_validation_builder.get_formula_constraint(field_specs_dict,
@@ -75,22 +151,31 @@ def _write_static_validation_grid(val_sheet, schema_dict):
             # metadata_cell_range_str = xlsxbasics.format_single_col_range(val_sheet, curr_metadata_col_index,
             #                                                    sheet_name=val_sheet.metadata_sheet_name)
 
-            cell_enumerator = xlsxbasics.loop_through_range(curr_grid_col_index, val_sheet.first_data_row_index,
-                                                             last_row_index=
-                                                             val_sheet.last_allowable_row_for_sample_index)
-            for curr_col_index, curr_row_index, curr_cell_range in cell_enumerator:
-                metadata_col_range = xlsxbasics.format_range(curr_metadata_col_index, None,
-                                                              sheet_name=val_sheet.metadata_sheet_name)
-                metadata_cell = xlsxbasics.format_range(curr_metadata_col_index, curr_row_index,
-                                                         sheet_name=val_sheet.metadata_sheet_name)
-                formatted_formula_str = unformatted_formula_str.format(cell=metadata_cell, col_range=metadata_col_range)
-                val_sheet.worksheet.write_formula(curr_cell_range, formatted_formula_str)
+            _add_static_grid_col_run(val_sheet, unformatted_formula_str, curr_grid_col_index, curr_metadata_col_index)
 
-                # xlsxbasics.format_and_write_array_formula(val_sheet, curr_grid_col_index, unformatted_formula_str,
-                #                                            write_col=True, cell_range_str=metadata_cell_range_str)
+            # xlsxbasics.format_and_write_array_formula(val_sheet, curr_grid_col_index, unformatted_formula_str,
+            #                                            write_col=True, cell_range_str=metadata_cell_range_str)
 
     # hide all the columns in the static grid.  Use value of curr_grid_col_index left over from last time thru loop.
-    if curr_grid_col_index: val_sheet.hide_columns(val_sheet.first_static_grid_col_index, curr_grid_col_index)
+    if curr_grid_col_index: val_sheet.static_grid_sheet.hide_columns(val_sheet.first_static_grid_col_index,
+                                                                     curr_grid_col_index)
+
+
+def _add_static_grid_col_run(val_sheet, unformatted_formula_str, grid_col_index, metadata_col_index):
+    """
+
+    :type val_sheet: ValidationWorksheet
+    """
+    metadata_col_range = xlsxbasics.format_range(metadata_col_index, None, sheet_name=val_sheet.metadata_sheet_name)
+
+    def make_formula(curr_row_index):
+        metadata_cell = xlsxbasics.format_range(metadata_col_index, curr_row_index,
+                                                 sheet_name=val_sheet.metadata_sheet_name)
+        return unformatted_formula_str.format(cell=metadata_cell, col_range=metadata_col_range)
+
+    xlsxbasics.add_formula_col_run(val_sheet.static_grid_sheet.row_plan, grid_col_index,
+                                   val_sheet.first_data_row_index, val_sheet.last_allowable_row_for_sample_index,
+                                   make_formula)
 
 
 def _write_static_helper_rows_and_cols(val_sheet):
@@ -98,12 +183,7 @@ def _write_static_helper_rows_and_cols(val_sheet):
 
     :type val_sheet: ValidationWorksheet
     """
-    col_header_and_writer_func_tuple_list = [(val_sheet.SAMPLE_NAME_HEADER, _write_static_name_col),
-                                             (val_sheet.IS_ABSENT_HEADER, _write_is_absent_col),
-                                             (val_sheet.IS_VALID_ROW_HEADER, _write_is_valid_row_col),
-                                             (val_sheet.ROW_IN_METADATA_HEADER, _write_row_in_metadata_col),
-                                             (val_sheet.ROW_ORDER_WEIGHT_HEADER, _write_row_order_weight_col),
-                                             (val_sheet.ROW_RANK_HEADER, _write_row_rank_col)]
+    col_header_and_writer_func_tuple_list = _get_static_helper_col_header_and_writer_func_tuple_list(val_sheet)
     index_and_range_str_tuple_by_header_dict = _write_static_helper_ranges(val_sheet,
                                                                            col_header_and_writer_func_tuple_list)
 
@@ -111,6 +191,12 @@ def _write_static_helper_rows_and_cols(val_sheet):
                                              (val_sheet.COL_IN_METADATA_HEADER, _write_col_in_metadata_row),
                                              (val_sheet.COL_ORDER_WEIGHT_HEADER, _write_col_order_weight_row),
                                              (val_sheet.COL_RANK_HEADER, _write_col_rank_row)]
+    if val_sheet.rank_strategy == RUNNING_COUNT_RANK_STRATEGY:
+        # NB: the rank and the at-rank need the running counts, so the counts have to come before them
+        row_header_and_writer_func_tuple_list[-1:-1] = [
+            (val_sheet.COL_INVALID_COUNT_HEADER, _write_col_invalid_count_row),
+            (val_sheet.COL_VALID_COUNT_HEADER, _write_col_valid_count_row)]
+        row_header_and_writer_func_tuple_list.append((val_sheet.COL_AT_RANK_HEADER, _write_col_at_rank_row))
 
     index_and_range_str_tuple_by_header_dict = _write_static_helper_ranges(val_sheet,
                                                                            row_header_and_writer_func_tuple_list,
@@ -119,6 +205,25 @@ def _write_static_helper_rows_and_cols(val_sheet):
     return index_and_range_str_tuple_by_header_dict
 
 
+def _get_static_helper_col_header_and_writer_func_tuple_list(val_sheet):
+    """
+
+    :type val_sheet: ValidationWorksheet
+    """
+    result = [(val_sheet.SAMPLE_NAME_HEADER, _write_static_name_col),
+              (val_sheet.IS_ABSENT_HEADER, _write_is_absent_col),
+              (val_sheet.IS_VALID_ROW_HEADER, _write_is_valid_row_col),
+              (val_sheet.ROW_IN_METADATA_HEADER, _write_row_in_metadata_col),
+              (val_sheet.ROW_ORDER_WEIGHT_HEADER, _write_row_order_weight_col),
+              (val_sheet.ROW_RANK_HEADER, _write_row_rank_col)]
+    if val_sheet.rank_strategy == RUNNING_COUNT_RANK_STRATEGY:
+        # NB: the rank and the at-rank need the running counts, so the counts have to come before them
+        result[-1:-1] = [(val_sheet.ROW_INVALID_COUNT_HEADER, _write_row_invalid_count_col),
+                         (val_sheet.ROW_VALID_COUNT_HEADER, _write_row_valid_count_col)]
+        result.append((val_sheet.ROW_AT_RANK_HEADER, _write_row_at_rank_col))
+    return result
+
+
 def _write_static_helper_ranges(val_sheet, header_and_writer_func_tuple_list,
                                 range_index_and_range_str_tuple_by_header_dict=None):
     """
@@ -145,7 +250,7 @@ def _write_static_helper_ranges(val_sheet, header_and_writer_func_tuple_list,
 
         col_index = get_col_index(curr_header_index) if write_col else val_sheet.helper_rows_header_col_index
         row_index = None if write_col else get_row_index(curr_header_index)
-        xlsxbasics.write_header(val_sheet, curr_header, col_index, row_index,
+        xlsxbasics.write_header(val_sheet.static_grid_sheet, curr_header, col_index, row_index,
                                 set_width=False)
 
         curr_range_index = col_index if write_col else row_index
@@ -155,7 +260,7 @@ def _write_static_helper_ranges(val_sheet, header_and_writer_func_tuple_list,
 
     if write_col and col_index is not None:
         # use the col_index left over from last time through loop
-        val_sheet.hide_columns(val_sheet.first_static_grid_col_index-1, col_index)
+        val_sheet.static_grid_sheet.hide_columns(val_sheet.first_static_grid_col_index-1, col_index)
 
     return range_index_and_range_str_tuple_by_header_dict
 
@@ -189,7 +294,7 @@ def _write_is_absent_col(val_sheet, col_index, index_and_range_tuple_by_header_d
         metadata_single_row_range=metadata_single_row_range).format()
 
     # Note: when I use the is_absent range later, I need it to be fixed, so making it so now
-    return xlsxbasics.copy_formula_throughout_range(val_sheet.worksheet, is_absent_partial_formula,
+    return xlsxbasics.copy_formula_throughout_range(val_sheet.static_grid_sheet.row_plan, is_absent_partial_formula,
                                                      first_col_index=col_index,
                                                      first_row_index=val_sheet.first_data_row_index,
                                                      last_row_index=val_sheet.last_data_row_index,
@@ -213,8 +318,8 @@ def _write_is_valid_row_col(val_sheet, col_index, index_and_range_tuple_by_heade
         is_absent_1cell_range_str=is_absent_single_cell_range_str,
         static_grid_1row_range_str=static_grid_single_row_range_str).format()
 
-    return xlsxbasics.copy_formula_throughout_range(val_sheet.worksheet, is_valid_row_partial_formula, col_index,
-                                                     val_sheet.first_data_row_index,
+    return xlsxbasics.copy_formula_throughout_range(val_sheet.static_grid_sheet.row_plan, is_valid_row_partial_formula,
+                                                     col_index, val_sheet.first_data_row_index,
                                                      last_row_index=val_sheet.last_data_row_index)
 
 
@@ -250,12 +355,87 @@ def _write_row_rank_col(val_sheet, col_index, index_and_range_tuple_by_header_di
 
     :type val_sheet: ValidationWorksheet
     """
+    if val_sheet.rank_strategy == RUNNING_COUNT_RANK_STRATEGY:
+        # write row_rank column: e.g., =IF(AM2,$AK$11+AL2-$AL$2+1-AK2,AK2)
+        partial_formula_str = _format_running_count_rank_formula(
+            val_sheet, index_and_range_tuple_by_header_dict, val_sheet.IS_VALID_ROW_HEADER,
+            val_sheet.ROW_IN_METADATA_HEADER, val_sheet.ROW_INVALID_COUNT_HEADER, write_col=True)
+        return xlsxbasics.copy_formula_throughout_range(val_sheet.static_grid_sheet.row_plan, partial_formula_str,
+                                                         col_index, val_sheet.first_data_row_index,
+                                                         last_row_index=val_sheet.last_data_row_index,
+                                                         first_col_fixed=True, first_row_fixed=True,
+                                                         last_col_fixed=True, last_row_fixed=True)
+
     # write row_rank column: e.g., =COUNTIF(AK$2:AK$11,"<="&$AK2:AK11)
     row_rank_formula_str = _format_rank_formula(val_sheet, index_and_range_tuple_by_header_dict,
                                                 val_sheet.ROW_ORDER_WEIGHT_HEADER, write_col=True)
     return xlsxbasics.format_and_write_array_formula(val_sheet, col_index, row_rank_formula_str, write_col=True)
 
 
+def _write_row_invalid_count_col(val_sheet, col_index, index_and_range_tuple_by_header_dict):
+    """
+
+    :type val_sheet: ValidationWorksheet
+    """
+    # write row_invalid_count column: e.g., =N(AK1)+IF(AM2,0,1)
+    return _write_running_count_col(val_sheet, col_index, index_and_range_tuple_by_header_dict, count_valid=False)
+
+
+def _write_row_valid_count_col(val_sheet, col_index, index_and_range_tuple_by_header_dict):
+    """
+
+    :type val_sheet: ValidationWorksheet
+    """
+    # write row_valid_count column: e.g., =N(AJ1)+IF(AM2,1,0)
+    return _write_running_count_col(val_sheet, col_index, index_and_range_tuple_by_header_dict, count_valid=True)
+
+
+def _write_running_count_col(val_sheet, col_index, index_and_range_tuple_by_header_dict, count_valid):
+    """
+
+    :type val_sheet: ValidationWorksheet
+    """
+    # (NB: N() of the column's header, above its first cell, is 0)
+    is_valid_col_index = index_and_range_tuple_by_header_dict[val_sheet.IS_VALID_ROW_HEADER][0]
+    increments_str = "1,0" if count_valid else "0,1"
+
+    def make_formula(curr_row_index):
+        return "=N({prev_count_cell})+IF({is_valid_cell},{increments})".format(
+            prev_count_cell=xlsxbasics.format_range(col_index, curr_row_index - 1),
+            is_valid_cell=xlsxbasics.format_range(is_valid_col_index, curr_row_index), increments=increments_str)
+
+    xlsxbasics.add_formula_col_run(val_sheet.static_grid_sheet.row_plan, col_index, val_sheet.first_data_row_index,
+                                   val_sheet.last_data_row_index, make_formula)
+    return xlsxbasics.format_single_col_range(val_sheet, col_index, first_col_fixed=True, first_row_fixed=True,
+                                              last_col_fixed=True, last_row_fixed=True)
+
+
+def _write_row_at_rank_col(val_sheet, col_index, index_and_range_tuple_by_header_dict):
+    """
+
+    :type val_sheet: ValidationWorksheet
+    """
+    # write row_at_rank column (for the RUNNING_COUNT_RANK_STRATEGY only): e.g.,
+    # =IF(ROWS($AI$2:AI2)<=$AK$11,IFERROR(MATCH(ROWS($AI$2:AI2)-0.5,$AK$2:$AK$11,1),0),
+    # IFERROR(MATCH(ROWS($AI$2:AI2)-$AK$11-0.5,$AJ$2:$AJ$11,1),0))+1
+    rank_col_index = index_and_range_tuple_by_header_dict[val_sheet.ROW_RANK_HEADER][0]
+
+    def make_formula(curr_row_index):
+        rank_to_curr_row_range = xlsxbasics.format_range(rank_col_index, val_sheet.first_data_row_index,
+                                                         last_col_index=rank_col_index,
+                                                         last_row_index=curr_row_index,
+                                                         first_col_fixed=True, first_row_fixed=True)
+        return "=" + _format_at_rank_formula(val_sheet, index_and_range_tuple_by_header_dict,
+                                             "ROWS({0})".format(rank_to_curr_row_range),
+                                             val_sheet.ROW_INVALID_COUNT_HEADER, val_sheet.ROW_VALID_COUNT_HEADER,
+                                             write_col=True)
+
+    xlsxbasics.add_formula_col_run(val_sheet.static_grid_sheet.row_plan, col_index, val_sheet.first_data_row_index,
+                                   val_sheet.last_data_row_index, make_formula)
+    return xlsxbasics.format_single_col_range(val_sheet, col_index, first_col_fixed=True, first_row_fixed=True,
+                                              last_col_fixed=True, last_row_fixed=True)
+
+
 def _write_is_valid_col_row(val_sheet, row_index, index_and_range_tuple_by_header_dict):
     """
 
@@ -272,7 +452,7 @@ def _write_is_valid_col_row(val_sheet, row_index, index_and_range_tuple_by_heade
                                                       first_row_index=val_sheet.first_data_row_index,
                                                       last_row_index=val_sheet.last_data_row_index)
 
-    return xlsxbasics.copy_formula_throughout_range(val_sheet.worksheet, partial_formula_str,
+    return xlsxbasics.copy_formula_throughout_range(val_sheet.static_grid_sheet.row_plan, partial_formula_str,
                                                      first_col_index=val_sheet.first_static_grid_col_index,
                                                      first_row_index=row_index,
                                                      last_col_index=val_sheet.last_static_grid_col_index,
@@ -312,12 +492,96 @@ def _write_col_rank_row(val_sheet, row_index, index_and_range_tuple_by_header_di
 
     :type val_sheet: ValidationWorksheet
     """
+    if val_sheet.rank_strategy == RUNNING_COUNT_RANK_STRATEGY:
+        # write col_rank row: e.g., =IF(AQ13,$BW$16+AQ14-$AQ$14+1-AQ16,AQ16)
+        partial_formula_str = _format_running_count_rank_formula(
+            val_sheet, index_and_range_tuple_by_header_dict, val_sheet.IS_VALID_COL_HEADER,
+            val_sheet.COL_IN_METADATA_HEADER, val_sheet.COL_INVALID_COUNT_HEADER, write_col=False)
+        return xlsxbasics.copy_formula_throughout_range(val_sheet.static_grid_sheet.row_plan, partial_formula_str,
+                                                         first_col_index=val_sheet.first_static_grid_col_index,
+                                                         first_row_index=row_index,
+                                                         last_col_index=val_sheet.last_static_grid_col_index,
+                                                         last_row_index=row_index,
+                                                         first_col_fixed=True, first_row_fixed=True,
+                                                         last_col_fixed=True, last_row_fixed=True)
+
     # write col_rank row: =COUNTIF($AQ15:$BW15,"<="&AQ$15:BW15)
     col_rank_formula_str = _format_rank_formula(val_sheet, index_and_range_tuple_by_header_dict,
                                                 val_sheet.COL_ORDER_WEIGHT_HEADER, write_col=False)
     return xlsxbasics.format_and_write_array_formula(val_sheet, row_index, col_rank_formula_str, write_col=False)
 
 
+def _write_col_invalid_count_row(val_sheet, row_index, index_and_range_tuple_by_header_dict):
+    """
+
+    :type val_sheet: ValidationWorksheet
+    """
+    # write col_invalid_count row: e.g., =N(AP16)+IF(AQ13,0,1)
+    return _write_running_count_row(val_sheet, row_index, index_and_range_tuple_by_header_dict, count_valid=False)
+
+
+def _write_col_valid_count_row(val_sheet, row_index, index_and_range_tuple_by_header_dict):
+    """
+
+    :type val_sheet: ValidationWorksheet
+    """
+    # write col_valid_count row: e.g., =N(AP17)+IF(AQ13,1,0)
+    return _write_running_count_row(val_sheet, row_index, index_and_range_tuple_by_header_dict, count_valid=True)
+
+
+def _write_running_count_row(val_sheet, row_index, index_and_range_tuple_by_header_dict, count_valid):
+    """
+
+    :type val_sheet: ValidationWorksheet
+    """
+    # (NB: N() of the row's header, left of its first cell, is 0)
+    is_valid_row_index = index_and_range_tuple_by_header_dict[val_sheet.IS_VALID_COL_HEADER][0]
+    increments_str = "1,0" if count_valid else "0,1"
+
+    def add_cell(curr_col_index):
+        formula_str = "=N({prev_count_cell})+IF({is_valid_cell},{increments})".format(
+            prev_count_cell=xlsxbasics.format_range(curr_col_index - 1, row_index),
+            is_valid_cell=xlsxbasics.format_range(curr_col_index, is_valid_row_index), increments=increments_str)
+        xlsxbasics.add_formula_col_run(val_sheet.static_grid_sheet.row_plan, curr_col_index, row_index, row_index,
+                                       lambda x: formula_str)
+
+    for curr_col_index in range(val_sheet.first_static_grid_col_index, val_sheet.last_static_grid_col_index + 1):
+        add_cell(curr_col_index)
+
+    return xlsxbasics.format_single_static_grid_row_range(val_sheet, row_index, first_col_fixed=True,
+                                                          first_row_fixed=True, last_col_fixed=True,
+                                                          last_row_fixed=True)
+
+
+def _write_col_at_rank_row(val_sheet, row_index, index_and_range_tuple_by_header_dict):
+    """
+
+    :type val_sheet: ValidationWorksheet
+    """
+    # write col_at_rank row (for the RUNNING_COUNT_RANK_STRATEGY only): e.g.,
+    # =IF(COLUMNS($AQ$18:AQ18)<=$BW$16,IFERROR(MATCH(COLUMNS($AQ$18:AQ18)-0.5,$AQ$16:$BW$16,1),0),
+    # IFERROR(MATCH(COLUMNS($AQ$18:AQ18)-$BW$16-0.5,$AQ$17:$BW$17,1),0))+1
+    rank_row_index = index_and_range_tuple_by_header_dict[val_sheet.COL_RANK_HEADER][0]
+
+    def add_cell(curr_col_index):
+        rank_to_curr_col_range = xlsxbasics.format_range(val_sheet.first_static_grid_col_index, rank_row_index,
+                                                         last_col_index=curr_col_index, last_row_index=rank_row_index,
+                                                         first_col_fixed=True, first_row_fixed=True)
+        formula_str = "=" + _format_at_rank_formula(val_sheet, index_and_range_tuple_by_header_dict,
+                                                    "COLUMNS({0})".format(rank_to_curr_col_range),
+                                                    val_sheet.COL_INVALID_COUNT_HEADER,
+                                                    val_sheet.COL_VALID_COUNT_HEADER, write_col=False)
+        xlsxbasics.add_formula_col_run(val_sheet.static_grid_sheet.row_plan, curr_col_index, row_index, row_index,
+                                       lambda x: formula_str)
+
+    for curr_col_index in range(val_sheet.first_static_grid_col_index, val_sheet.last_static_grid_col_index + 1):
+        add_cell(curr_col_index)
+
+    return xlsxbasics.format_single_static_grid_row_range(val_sheet, row_index, first_col_fixed=True,
+                                                          first_row_fixed=True, last_col_fixed=True,
+                                                          last_row_fixed=True)
+
+
 def _format_order_weight_formula(index_and_range_tuple_by_name_dict, is_valid_header, position_in_metadata_header):
     # format row_order_weight column: e.g., =INT(AM2:AM11)*100000+AL2:AL11
     # or
@@ -359,3 +623,80 @@ def _format_rank_formula(val_sheet, index_and_range_tuple_by_name_dict, order_we
 
     rank_formula_str = "COUNTIF({0},\"<=\"&{1})".format(order_weight_range1_str, order_weight_range2_str)
     return rank_formula_str
+
+
+def _format_running_count_rank_formula(val_sheet, index_and_range_tuple_by_name_dict, is_valid_header,
+                                       position_in_metadata_header, invalid_count_header, write_col):
+    """
+
+    :type val_sheet: ValidationWorksheet
+    """
+    # format row_rank column: e.g., IF(AM2,$AK$11+AL2-$AL$2+1-AK2,AK2)
+    # or
+    # format col_rank row: e.g., IF(AQ13,$BW$16+AQ14-$AQ$14+1-AQ16,AQ16)
+    # i.e., an invalid one is ranked by how many invalid ones there are up to and including it, and a valid one comes
+    # after ALL the invalid ones, ranked by how many valid ones there are up to and including it (which is its position
+    # less the number of invalid ones up to it).  Left as partial formulas for copy_formula_throughout_range.
+    is_valid_index = index_and_range_tuple_by_name_dict[is_valid_header][0]
+    position_index = index_and_range_tuple_by_name_dict[position_in_metadata_header][0]
+    invalid_count_index = index_and_range_tuple_by_name_dict[invalid_count_header][0]
+
+    if write_col:
+        def format_curr_cell(range_index):
+            return xlsxbasics.format_range(range_index, "{curr_row_index}")
+
+        first_position_cell = xlsxbasics.format_range(position_index, val_sheet.first_data_row_index,
+                                                       first_col_fixed=True, first_row_fixed=True,
+                                                       last_row_fixed=True)
+    else:
+        def format_curr_cell(range_index):
+            return "{{curr_col_letter}}{0}".format(range_index)
+
+        first_position_cell = xlsxbasics.format_range(val_sheet.first_static_grid_col_index, position_index,
+                                                       first_col_fixed=True, first_row_fixed=True,
+                                                       last_row_fixed=True)
+
+    total_invalid_count_cell = _format_total_invalid_count_cell(val_sheet, invalid_count_index, write_col)
+    invalid_count_cell = format_curr_cell(invalid_count_index)
+    return "IF({is_valid_cell},{total_invalid_count_cell}+{position_cell}-{first_position_cell}+1-" \
+           "{invalid_count_cell},{invalid_count_cell})".format(
+                is_valid_cell=format_curr_cell(is_valid_index), total_invalid_count_cell=total_invalid_count_cell,
+                position_cell=format_curr_cell(position_index), first_position_cell=first_position_cell,
+                invalid_count_cell=invalid_count_cell)
+
+
+def _format_at_rank_formula(val_sheet, index_and_range_tuple_by_name_dict, rank_num, invalid_count_header,
+                            valid_count_header, write_col):
+    """
+
+    :type val_sheet: ValidationWorksheet
+    """
+    # format the position (in the helper ranges) of the row or column whose rank is rank_num, from the running
+    # counts of the RUNNING_COUNT_RANK_STRATEGY: e.g.,
+    # IF(ROWS($AI$2:AI2)<=$AK$11,IFERROR(MATCH(ROWS($AI$2:AI2)-0.5,$AK$2:$AK$11,1),0),
+    # IFERROR(MATCH(ROWS($AI$2:AI2)-$AK$11-0.5,$AJ$2:$AJ$11,1),0))+1
+    # The row with invalid rank k is the one just after the last row whose running invalid count is still less than
+    # k (or the first row, if there isn't one).  The running count only goes up, so an approximate MATCH (which, on
+    # values in ascending order, finds the LAST one <= what it looks for) can find that last row by binary search;
+    # looking for k-0.5 rather than k-1 just makes clear that no count is ever equal to what is looked for.  A valid
+    # row, ranked after all the invalid ones, is found the same way in the running count of valid rows.
+    invalid_count_index, invalid_count_range = index_and_range_tuple_by_name_dict[invalid_count_header]
+    valid_count_range = index_and_range_tuple_by_name_dict[valid_count_header][1]
+    total_invalid_count_cell = _format_total_invalid_count_cell(val_sheet, invalid_count_index, write_col)
+    return "IF({rank_num}<={total_invalid_count_cell},IFERROR(MATCH({rank_num}-0.5,{invalid_count_range},1),0)," \
+           "IFERROR(MATCH({rank_num}-{total_invalid_count_cell}-0.5,{valid_count_range},1),0))+1".format(
+                rank_num=rank_num, total_invalid_count_cell=total_invalid_count_cell,
+                invalid_count_range=invalid_count_range, valid_count_range=valid_count_range)
+
+
+def _format_total_invalid_count_cell(val_sheet, invalid_count_index, write_col):
+    """
+
+    :type val_sheet: ValidationWorksheet
+    """
+    # the last cell of the running count of invalid rows (or columns), e.g., $AK$11 (or $BW$16)
+    if write_col:
+        return xlsxbasics.format_range(invalid_count_index, val_sheet.last_data_row_index, first_col_fixed=True,
+                                       first_row_fixed=True, last_row_fixed=True)
+    return xlsxbasics.format_range(val_sheet.last_static_grid_col_index, invalid_count_index, first_col_fixed=True,
+                                   first_row_fixed=True, last_row_fixed=True)
@@ -0,0 +1,174 @@
+import posixpath
+import re
+import xml.etree.ElementTree as ElementTree
+import zipfile
+import zlib
+
+# An xlsx file is just a zip of xml files.  QIIMP only ever needs to read ONE cell (A1 of one of the hidden yaml
+# sheets) out of a workbook, and building the whole openpyxl object model--including the thousands of formulas on the
+# Metadata and Validation sheets--just to do that is very slow and uses memory in proportion to the size of the whole
+# workbook.  The functions here instead go straight to the one sheet xml file needed and stream through it only as far
+# as the requested cell.
+
+_MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_OFFICE_REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_PACKAGE_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+
+_WORKBOOK_PATH = "xl/workbook.xml"
+_WORKBOOK_RELS_PATH = "xl/_rels/workbook.xml.rels"
+_SHARED_STRINGS_REL_TYPE = _OFFICE_REL_NS + "/sharedStrings"
+_DEFAULT_SHARED_STRINGS_PATH = "xl/sharedStrings.xml"
+
+_SHEET_TAG = "{{{0}}}sheet".format(_MAIN_NS)
+_ROW_TAG = "{{{0}}}row".format(_MAIN_NS)
+_CELL_TAG = "{{{0}}}c".format(_MAIN_NS)
+_VALUE_TAG = "{{{0}}}v".format(_MAIN_NS)
+_INLINE_STRING_TAG = "{{{0}}}is".format(_MAIN_NS)
+_STRING_ITEM_TAG = "{{{0}}}si".format(_MAIN_NS)
+_TEXT_TAG = "{{{0}}}t".format(_MAIN_NS)
+_PHONETIC_RUN_TAG = "{{{0}}}rPh".format(_MAIN_NS)
+_RELATIONSHIP_TAG = "{{{0}}}Relationship".format(_PACKAGE_REL_NS)
+_REL_ID_ATTRIB = "{{{0}}}id".format(_OFFICE_REL_NS)
+
+_CELL_REF_REGEX = re.compile(r"^\$?([A-Z]+)\$?([0-9]+)$")
+
+# what reading a file that isn't an xlsx at all, or is a damaged one, can raise: a bad or truncated zip, a zip without
+# the parts an xlsx must have, or parts that aren't well-formed xml
+READ_ERRORS = (zipfile.BadZipFile, zlib.error, EOFError, KeyError, ElementTree.ParseError)
+
+
+class XlsxZipReader(object):
+    """Minimal read-only view of an xlsx file that reads individual cells without loading the whole workbook.
+
+    Mimics the small part of the openpyxl workbook interface (sheetnames) that
+    metadata_wizard_settings.check_is_metadata_wizard_file relies on.
+    """
+
+    def __init__(self, file_or_filepath):
+        # zipfile accepts either a path or a seekable file-like object
+        self._zip_file = zipfile.ZipFile(file_or_filepath)
+        try:
+            self._sheet_paths_by_name, self._shared_strings_path = self._read_workbook_structure()
+        except Exception:
+            self._zip_file.close()
+            raise
+
+    @property
+    def sheetnames(self):
+        return list(self._sheet_paths_by_name.keys())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._zip_file.close()
+
+    def read_cell_value(self, sheet_name, cell_ref="A1"):
+        """Return the value of the cell as a string (or None if the cell is empty or absent)."""
+
+        target_col_letters, target_row_num = _parse_cell_ref(cell_ref)
+        sheet_path = self._sheet_paths_by_name[sheet_name]
+
+        with self._zip_file.open(sheet_path) as sheet_stream:
+            for _, elem in ElementTree.iterparse(sheet_stream, events=("end",)):
+                # NB: the r (reference) attribute is optional in the spec, although every writer QIIMP deals with
+                # (xlsxwriter, Excel, openpyxl) includes it; cells/rows without it are skipped rather than guessed at
+                if elem.tag == _CELL_TAG and elem.get("r") is not None:
+                    curr_col_letters, curr_row_num = _parse_cell_ref(elem.get("r"))
+                    if curr_row_num == target_row_num and curr_col_letters == target_col_letters:
+                        return self._get_cell_value(elem)
+                elif elem.tag == _ROW_TAG:
+                    # rows are stored in order, so once we are past the target row it isn't coming
+                    if elem.get("r") is not None and int(elem.get("r")) >= target_row_num:
+                        break
+                    # throw away each finished row so memory use doesn't grow with the size of the sheet
+                    elem.clear()
+
+        return None
+
+    def _read_workbook_structure(self):
+        sheet_rel_ids_by_name = {}
+        workbook_root = ElementTree.fromstring(self._zip_file.read(_WORKBOOK_PATH))
+        for curr_sheet_elem in workbook_root.iter(_SHEET_TAG):
+            sheet_rel_ids_by_name[curr_sheet_elem.get("name")] = curr_sheet_elem.get(_REL_ID_ATTRIB)
+
+        targets_by_rel_id = {}
+        shared_strings_path = None
+        rels_root = ElementTree.fromstring(self._zip_file.read(_WORKBOOK_RELS_PATH))
+        for curr_rel_elem in rels_root.iter(_RELATIONSHIP_TAG):
+            curr_target_path = _resolve_workbook_rel_target(curr_rel_elem.get("Target"))
+            targets_by_rel_id[curr_rel_elem.get("Id")] = curr_target_path
+            if curr_rel_elem.get("Type") == _SHARED_STRINGS_REL_TYPE:
+                shared_strings_path = curr_target_path
+
+        if shared_strings_path is None and _DEFAULT_SHARED_STRINGS_PATH in self._zip_file.namelist():
+            shared_strings_path = _DEFAULT_SHARED_STRINGS_PATH
+
+        # keep the sheets in workbook order, as openpyxl does
+        sheet_paths_by_name = {}
+        for curr_sheet_name, curr_rel_id in sheet_rel_ids_by_name.items():
+            sheet_paths_by_name[curr_sheet_name] = targets_by_rel_id[curr_rel_id]
+
+        return sheet_paths_by_name, shared_strings_path
+
+    def _get_cell_value(self, cell_elem):
+        cell_type = cell_elem.get("t")
+        if cell_type == "inlineStr":
+            inline_string_elem = cell_elem.find(_INLINE_STRING_TAG)
+            return None if inline_string_elem is None else _get_string_item_text(inline_string_elem)
+
+        value_elem = cell_elem.find(_VALUE_TAG)
+        if value_elem is None or value_elem.text is None:
+            return None
+
+        if cell_type == "s":
+            return self._read_shared_string(int(value_elem.text))
+        return value_elem.text
+
+    def _read_shared_string(self, string_index):
+        if self._shared_strings_path is None:
+            raise ValueError("Cell refers to shared string {0} but workbook has no shared strings.".format(
+                string_index))
+
+        curr_index = 0
+        with self._zip_file.open(self._shared_strings_path) as strings_stream:
+            for _, elem in ElementTree.iterparse(strings_stream, events=("end",)):
+                if elem.tag == _STRING_ITEM_TAG:
+                    if curr_index == string_index:
+                        return _get_string_item_text(elem)
+                    curr_index += 1
+                    elem.clear()
+
+        raise ValueError("Shared string {0} not found in workbook.".format(string_index))
+
+
+def _get_string_item_text(string_item_elem):
+    # A string item is either a single <t> or a list of rich text runs (<r><t>...</t></r>); either way, the text is
+    # the concatenation of all the <t> elements, EXCEPT those in phonetic runs (<rPh>), which are reading hints.
+    text_pieces = []
+    for curr_child in string_item_elem:
+        if curr_child.tag == _TEXT_TAG:
+            text_pieces.append(curr_child.text or "")
+        elif curr_child.tag != _PHONETIC_RUN_TAG:
+            for curr_text_elem in curr_child.iter(_TEXT_TAG):
+                text_pieces.append(curr_text_elem.text or "")
+
+    # match openpyxl, which un-escapes literal underscores this way (and only this way)
+    return "".join(text_pieces).replace("x005F_", "")
+
+
+def _resolve_workbook_rel_target(target):
+    # targets are normally relative to the xl folder, but can also be absolute within the package
+    if target.startswith("/"):
+        return target.lstrip("/")
+    return posixpath.normpath(posixpath.join(posixpath.dirname(_WORKBOOK_PATH), target))
+
+
+def _parse_cell_ref(cell_ref):
+    match = _CELL_REF_REGEX.match(cell_ref.upper())
+    if match is None:
+        raise ValueError("Unrecognized cell reference '{0}'.".format(cell_ref))
+    return match.group(1), int(match.group(2))
@@ -78,6 +78,7 @@ setup(
     extras_require={
         'dev': ['check-manifest'],
         'test': ['coverage'],
+        'benchmark': ['pycel'],
     },
 
     package_data={
@@ -116,7 +117,8 @@ setup(
     # pip to create the appropriate form of executable for the target platform.
     entry_points={
         'console_scripts': [
-            'start_qiimp_server=qiimp.metadata_wizard_server:main'
+            'start_qiimp_server=qiimp.metadata_wizard_server:main',
+            'benchmark_qiimp_workbooks=qiimp.workbook_benchmark:main'
         ]
     }
 )
\ No newline at end of file